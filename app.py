@@ -1,34 +1,264 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, make_response
 import os
 import logging
 from config import Config
 from utils.sms_parser import parse_sms_input
 from utils.maps_client import GoogleMapsClient
 from utils.response_formatter import format_eta_response
-from utils.sms_sender import Fast2SMSSender
+from utils.sms_sender import Fast2SMSSender, send_with_retry
+from utils.eta_cache import create_eta_cache
+from utils.eta_prefetcher import create_eta_prefetcher
+from utils.headway_estimator import create_headway_estimator
+from utils.reply_queue import ReplyWorkerPool, create_job_queue
+from utils.sms_batcher import BatchingSMSSender
+from utils.http_transport import transport_stats
+from utils.circuit_breaker import breaker_stats
+from utils.gtfs_schedule import load_schedule
+from utils.stop_resolver import load_stop_resolver
+from utils.route_catalog import load_route_catalog
+from utils.rate_limiter import SLOW_DOWN_MESSAGE, create_rate_limiter
+from utils.idempotency import create_idempotency_guard, make_idempotency_key
+from utils.webhook_batch import parse_batch_body, process_batch
+from utils.retry_scheduler import get_retry_scheduler
+from utils.logging_setup import configure_logging, get_correlation_id, set_correlation_id
+from utils.traffic_capture import configure_traffic_capture, note_parsed
+from utils.metrics import CONTENT_TYPE, WEBHOOK_IN_PROGRESS, WEBHOOK_REQUESTS, WEBHOOK_SECONDS, generate_latest
+
+def process_sms(phone_number, message_text, maps_client, sms_sender):
+    """
+    Run the parse → ETA → format → send pipeline for one inbound SMS
+    
+    Args:
+        phone_number (str): The sender's phone number
+        message_text (str): The SMS message text
+        maps_client (GoogleMapsClient): Client used for the ETA lookup
+        sms_sender (Fast2SMSSender): Client used to send the reply
+    
+    Returns:
+        tuple: (response payload dict, HTTP status code)
+    """
+    # Parse SMS input
+    parsed_data = parse_sms_input(message_text)
+    note_parsed(parsed_data)
+    
+    if not parsed_data['valid']:
+        logging.error("Invalid SMS format: %s", parsed_data['error'])
+        # Send error response via SMS
+        sms_sender.send_sms(phone_number, parsed_data['error'])
+        return {"error": parsed_data['error']}, 400
+    
+    # Get ETA from Google Maps
+    eta_data = maps_client.get_bus_eta(parsed_data['location'], parsed_data['route'])
+    
+    if not eta_data['success']:
+        logging.error("Failed to get ETA: %s", eta_data['error'])
+        # Send error response via SMS
+        if eta_data.get('source') == 'route_catalog':
+            error_message = format_eta_response(eta_data, parsed_data['route'], parsed_data['location'])
+            sms_sender.send_sms(phone_number, error_message)
+            return {"error": "Route not found"}, 404
+        sms_sender.send_sms(phone_number, "Unable to fetch ETA. Please try again later.")
+        return {"error": "Failed to get ETA"}, 500
+    
+    # Estimate the bus after this one from observed departures and headways
+    if maps_client.headways is not None:
+        eta_data = maps_client.headways.fill([eta_data])[0]
+    
+    # Format response
+    response_message = format_eta_response(eta_data, parsed_data['route'], parsed_data['location'])
+    
+    # Send SMS response; transient failures are retried in the background
+    sms_result = send_with_retry(sms_sender, phone_number, response_message, Config.SMS_RETRY_ATTEMPTS)
+    
+    if not sms_result['success']:
+        logging.error("Failed to send SMS: %s", sms_result['error'])
+        if sms_result.get('retry_scheduled'):
+            return {"message": "Reply send failed, retry scheduled", "phone_number": phone_number}, 202
+        return {"error": "Failed to send response SMS"}, 500
+    
+    logging.info(
+        "Replied to %s for route %s at %s", phone_number, parsed_data['route'], parsed_data['location'],
+        extra={'sample': True, 'eta_source': eta_data.get('source', 'maps')}
+    )
+    return {
+        "message": "SMS processed successfully",
+        "phone_number": phone_number,
+        "location": parsed_data['location'],
+        "route": parsed_data['route'],
+        "eta_data": eta_data
+    }, 200
 
 def create_app():
+    # Validated here rather than on import, so tools and tests can import
+    # the modules without API keys
+    Config.validate()
+    
     app = Flask(__name__)
     app.config.from_object(Config)
     
     # Set up logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s %(levelname)s %(module)s %(message)s'
-    )
+    configure_logging()
+    # Record traffic for replay when TRAFFIC_CAPTURE_PATH is set
+    recorder = configure_traffic_capture()
     
     # Initialize clients
-    maps_client = GoogleMapsClient()
+    # Loaded before gunicorn forks (preload_app), so workers share one copy
+    route_catalog = load_route_catalog(Config.ROUTE_CATALOG_PATH, Config.ROUTE_CATALOG_RELOAD_INTERVAL)
+    maps_client = GoogleMapsClient(
+        cache=create_eta_cache(),
+        schedule=load_schedule(Config.GTFS_FEED_PATH),
+        stop_resolver=load_stop_resolver(Config.stops_file_path()),
+        route_catalog=route_catalog
+    )
+    # Popular pairs are refreshed before they expire; the thread starts in
+    # each worker on its first query
+    maps_client.prefetcher = create_eta_prefetcher(maps_client)
+    maps_client.headways = create_headway_estimator(route_catalog, maps_client.schedule)
+    rate_limiter = create_rate_limiter()
+    idempotency = create_idempotency_guard()
     sms_sender = Fast2SMSSender()
+    if Config.SMS_BATCHING:
+        sms_sender = BatchingSMSSender(
+            sms_sender,
+            window=Config.SMS_BATCH_WINDOW_MS / 1000,
+            max_batch_size=Config.SMS_BATCH_MAX_SIZE,
+            max_latency=Config.SMS_BATCH_MAX_LATENCY_MS / 1000
+        )
+    
+    # Background reply workers (only used when ASYNC_REPLIES is enabled)
+    reply_pool = None
+    if Config.ASYNC_REPLIES:
+        def handle_reply_job(job):
+            set_correlation_id(job.get('correlation_id'))
+            if 'batch' in job:
+                process_batch(job['batch'], maps_client, sms_sender, rate_limiter, idempotency)
+                return
+            result, status = process_sms(job['phone_number'], job['message_text'], maps_client, sms_sender)
+            if status != 200:
+                logging.error("Queued reply to %s failed: %s", job['phone_number'], result['error'])
+        
+        # Threads are started per process, after gunicorn has forked
+        # (utils.startup.init_worker)
+        reply_pool = ReplyWorkerPool(
+            create_job_queue(),
+            handle_reply_job,
+            workers=Config.REPLY_WORKERS
+        )
+    
+    app.extensions['reply_pool'] = reply_pool
     
     @app.route('/health', methods=['GET'])
     def health_check():
         """Health check endpoint"""
-        return jsonify({"status": "healthy"}), 200
+        breakers = breaker_stats()
+        degraded = any(breaker['state'] != 'closed' for breaker in breakers.values())
+        health = {
+            "status": "degraded" if degraded else "healthy",
+            "http_pools": transport_stats(),
+            "circuit_breakers": breakers,
+            "sms_retries": get_retry_scheduler().stats(),
+            "route_catalog": route_catalog.stats()
+        }
+        if reply_pool is not None:
+            health["reply_queue"] = reply_pool.stats()
+        if rate_limiter is not None:
+            health["rate_limiter"] = rate_limiter.stats()
+        if idempotency is not None:
+            health["idempotency"] = idempotency.stats()
+        if maps_client.prefetcher is not None:
+            health["eta_prefetch"] = maps_client.prefetcher.stats()
+        if maps_client.headways is not None:
+            health["headways"] = maps_client.headways.stats()
+        if recorder is not None:
+            health["traffic_capture"] = recorder.stats()
+        return jsonify(health), 200
+    
+    def handle_message(phone_number, message_text):
+        """Rate-limit, then queue or process one inbound SMS; returns (payload, status)"""
+        # Throttle flooding senders before any parsing or upstream call
+        if rate_limiter is not None:
+            decision = rate_limiter.check(phone_number)
+            if not decision.allowed:
+                logging.warning("Rate limit exceeded by %s", phone_number)
+                if decision.notify:
+                    sms_sender.send_sms(phone_number, SLOW_DOWN_MESSAGE)
+                return {"error": "Too many requests", "retry_after": int(decision.retry_after) + 1}, 429
+        
+        # Acknowledge immediately and reply from a background worker
+        if reply_pool is not None:
+            job_id = reply_pool.submit({
+                "phone_number": phone_number,
+                "message_text": message_text,
+                "correlation_id": get_correlation_id()
+            })
+            if job_id is None:
+                logging.error("Reply queue is full, rejecting webhook")
+                return {"error": "Service busy, try again later"}, 503
+            return {"message": "SMS accepted", "job_id": job_id}, 202
+        
+        return process_sms(phone_number, message_text, maps_client, sms_sender)
+    
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Prometheus metrics, summed over all gunicorn workers in multiprocess mode"""
+        return Response(generate_latest(), content_type=CONTENT_TYPE)
+    
+    def instrumented(handler):
+        """Run a webhook handler with a correlation ID and request metrics"""
+        # Every log line of this message carries the same ID
+        correlation_id = set_correlation_id(request.headers.get('X-Request-ID'))
+        capture = recorder.begin() if recorder is not None else None
+        WEBHOOK_IN_PROGRESS.inc()
+        try:
+            with WEBHOOK_SECONDS.time():
+                response = make_response(handler())
+        finally:
+            WEBHOOK_IN_PROGRESS.dec()
+        WEBHOOK_REQUESTS.labels(response.status_code).inc()
+        if capture is not None:
+            recorder.finish(capture, request.path, request.get_data(), response.status_code, response.get_data())
+        response.headers['X-Request-ID'] = correlation_id
+        return response
     
     @app.route('/webhook', methods=['POST'])
     def webhook():
         """Webhook endpoint for incoming SMS"""
+        return instrumented(receive_webhook)
+    
+    @app.route('/webhook/batch', methods=['POST'])
+    def webhook_batch():
+        """Webhook endpoint for many incoming SMS (JSON array or NDJSON)"""
+        return instrumented(receive_batch)
+    
+    def receive_batch():
+        """Handle one batch delivery; returns a Flask response value"""
+        try:
+            try:
+                items = parse_batch_body(request.get_data())
+            except ValueError as e:
+                logging.error("Invalid batch webhook body: %s", e)
+                return jsonify({"error": "Invalid batch: send a JSON array of messages or NDJSON"}), 400
+            
+            if len(items) > Config.WEBHOOK_BATCH_MAX_MESSAGES:
+                return jsonify({"error": "Batch too large", "max_messages": Config.WEBHOOK_BATCH_MAX_MESSAGES}), 413
+            
+            # Acknowledge immediately and process the batch on a background worker
+            if reply_pool is not None:
+                job_id = reply_pool.submit({"batch": items, "correlation_id": get_correlation_id()})
+                if job_id is None:
+                    logging.error("Reply queue is full, rejecting batch webhook")
+                    return jsonify({"error": "Service busy, try again later"}), 503
+                return jsonify({"message": "Batch accepted", "job_id": job_id, "messages": len(items)}), 202
+            
+            result, status = process_batch(items, maps_client, sms_sender, rate_limiter, idempotency)
+            return jsonify(result), status
+        
+        except Exception as e:
+            logging.error("Unexpected error in batch webhook: %s", e)
+            return jsonify({"error": "Internal server error"}), 500
+    
+    def receive_webhook():
+        """Handle one webhook delivery; returns a Flask response value"""
         try:
             # Parse webhook JSON for phone number and message text
             data = request.get_json()
@@ -48,52 +278,32 @@ def create_app():
                 sms_sender.send_sms(phone_number, "Invalid format. Send: Location RouteNumber")
                 return jsonify({"error": "Missing phone number or message"}), 400
             
-            # Parse SMS input
-            parsed_data = parse_sms_input(message_text)
-            
-            if not parsed_data['valid']:
-                logging.error(f"Invalid SMS format: {parsed_data['error']}")
-                # Send error response via SMS
-                sms_sender.send_sms(phone_number, parsed_data['error'])
-                return jsonify({"error": parsed_data['error']}), 400
-            
-            # Get ETA from Google Maps
-            eta_data = maps_client.get_bus_eta(parsed_data['location'], parsed_data['route'])
-            
-            if not eta_data['success']:
-                logging.error(f"Failed to get ETA: {eta_data['error']}")
-                # Send error response via SMS
-                sms_sender.send_sms(phone_number, "Unable to fetch ETA. Please try again later.")
-                return jsonify({"error": "Failed to get ETA"}), 500
-            
-            # Format response
-            response_message = format_eta_response(eta_data, parsed_data['route'], parsed_data['location'])
-            
-            # Send SMS response
-            sms_result = sms_sender.send_sms(phone_number, response_message)
-            
-            if not sms_result['success']:
-                logging.error(f"Failed to send SMS: {sms_result['error']}")
-                return jsonify({"error": "Failed to send response SMS"}), 500
-            
-            return jsonify({
-                "message": "SMS processed successfully",
-                "phone_number": phone_number,
-                "location": parsed_data['location'],
-                "route": parsed_data['route'],
-                "eta_data": eta_data
-            }), 200
+            # Gateway retries of a message already handled get the recorded response
+            key = None
+            if idempotency is not None:
+                key = make_idempotency_key(data, phone_number, message_text, Config.IDEMPOTENCY_WINDOW,
+                                           Config.IDEMPOTENCY_CONTENT_FALLBACK)
+            if key is not None:
+                result, status = idempotency.run(key, lambda: handle_message(phone_number, message_text))
+            else:
+                result, status = handle_message(phone_number, message_text)
             
+            headers = {"Retry-After": str(result["retry_after"])} if status == 429 else {}
+            return jsonify(result), status, headers
+        
         except Exception as e:
-            logging.error(f"Unexpected error in webhook: {str(e)}")
+            logging.error("Unexpected error in webhook: %s", e)
             return jsonify({"error": "Internal server error"}), 500
     
     return app
 
 if __name__ == '__main__':
+    from utils.startup import init_worker
     app = create_app()
+    # The development server is its own (only) worker
+    init_worker()
     app.run(
         host=os.getenv('HOST', '0.0.0.0'),
         port=int(os.getenv('PORT', 5000)),
         debug=os.getenv('FLASK_ENV') == 'development'
-    )
\ No newline at end of file
+    )
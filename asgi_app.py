@@ -0,0 +1,305 @@
+import json
+import logging
+from config import Config
+from utils.sms_parser import parse_sms_input
+from utils.response_formatter import format_eta_response
+from utils.eta_cache import create_eta_cache
+from utils.eta_prefetcher import create_eta_prefetcher
+from utils.headway_estimator import create_headway_estimator
+from utils.gtfs_schedule import load_schedule
+from utils.stop_resolver import load_stop_resolver
+from utils.route_catalog import load_route_catalog
+from utils.rate_limiter import SLOW_DOWN_MESSAGE, create_rate_limiter
+from utils.idempotency import create_idempotency_guard, make_idempotency_key
+from utils.circuit_breaker import breaker_stats
+from utils.logging_setup import configure_logging, set_correlation_id
+from utils.metrics import CONTENT_TYPE, WEBHOOK_IN_PROGRESS, WEBHOOK_REQUESTS, WEBHOOK_SECONDS, generate_latest
+from utils.async_clients import AsyncGoogleMapsClient, AsyncFast2SMSSender, run_blocking
+from utils.webhook_batch import parse_batch_body, process_batch_async
+from utils.traffic_capture import configure_traffic_capture, note_parsed
+
+async def process_sms_async(phone_number, message_text, maps_client, sms_sender):
+    """
+    Run the parse → ETA → format → send pipeline for one inbound SMS (asyncio)
+    
+    Args:
+        phone_number (str): The sender's phone number
+        message_text (str): The SMS message text
+        maps_client (AsyncGoogleMapsClient): Client used for the ETA lookup
+        sms_sender (AsyncFast2SMSSender): Client used to send the reply
+    
+    Returns:
+        tuple: (response payload dict, HTTP status code)
+    """
+    parsed_data = parse_sms_input(message_text)
+    note_parsed(parsed_data)
+    
+    if not parsed_data['valid']:
+        logging.error("Invalid SMS format: %s", parsed_data['error'])
+        await sms_sender.send_sms(phone_number, parsed_data['error'])
+        return {"error": parsed_data['error']}, 400
+    
+    eta_data = await maps_client.get_bus_eta(parsed_data['location'], parsed_data['route'])
+    
+    if not eta_data['success']:
+        logging.error("Failed to get ETA: %s", eta_data['error'])
+        if eta_data.get('source') == 'route_catalog':
+            error_message = format_eta_response(eta_data, parsed_data['route'], parsed_data['location'])
+            await sms_sender.send_sms(phone_number, error_message)
+            return {"error": "Route not found"}, 404
+        await sms_sender.send_sms(phone_number, "Unable to fetch ETA. Please try again later.")
+        return {"error": "Failed to get ETA"}, 500
+    
+    if maps_client.headways is not None:
+        eta_data = maps_client.headways.fill([eta_data])[0]
+    
+    response_message = format_eta_response(eta_data, parsed_data['route'], parsed_data['location'])
+    sms_result = await sms_sender.send_sms(phone_number, response_message)
+    
+    if not sms_result['success']:
+        logging.error("Failed to send SMS: %s", sms_result['error'])
+        return {"error": "Failed to send response SMS"}, 500
+    
+    logging.info(
+        "Replied to %s for route %s at %s", phone_number, parsed_data['route'], parsed_data['location'],
+        extra={'sample': True, 'eta_source': eta_data.get('source', 'maps')}
+    )
+    return {
+        "message": "SMS processed successfully",
+        "phone_number": phone_number,
+        "location": parsed_data['location'],
+        "route": parsed_data['route'],
+        "eta_data": eta_data
+    }, 200
+
+async def _read_body(receive):
+    """Read the full HTTP request body from an ASGI receive channel"""
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+async def _send_json(send, payload, status):
+    """Send a JSON response on an ASGI send channel"""
+    data = json.dumps(payload).encode()
+    headers = [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(data)).encode())
+    ]
+    # Throttled senders are told when to retry, as in the Flask app
+    if status == 429 and 'retry_after' in payload:
+        headers.append((b'retry-after', str(payload['retry_after']).encode()))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers
+    })
+    await send({'type': 'http.response.body', 'body': data})
+
+async def _send_text(send, text, content_type):
+    """Send a plain text response on an ASGI send channel"""
+    data = text.encode()
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', content_type.encode()),
+            (b'content-length', str(len(data)).encode())
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': data})
+
+def create_asgi_app():
+    """
+    Create the ASGI application serving /webhook, /health and /metrics on an event loop
+    
+    Run with e.g. `uvicorn --factory asgi_app:create_asgi_app`.
+    
+    Returns:
+        callable: ASGI application
+    """
+    Config.validate()
+    configure_logging()
+    recorder = configure_traffic_capture()
+    
+    maps_client = AsyncGoogleMapsClient(
+        cache=create_eta_cache(),
+        schedule=load_schedule(Config.GTFS_FEED_PATH),
+        stop_resolver=load_stop_resolver(Config.stops_file_path()),
+        route_catalog=load_route_catalog(Config.ROUTE_CATALOG_PATH, Config.ROUTE_CATALOG_RELOAD_INTERVAL)
+    )
+    maps_client.prefetcher = create_eta_prefetcher(maps_client)
+    maps_client.headways = create_headway_estimator(maps_client.route_catalog, maps_client.schedule)
+    sms_sender = AsyncFast2SMSSender()
+    rate_limiter = create_rate_limiter()
+    idempotency = create_idempotency_guard()
+    # SQLite backends are called from a thread so lock waits never stall the loop
+    rate_limit_store = rate_limiter.store if rate_limiter is not None else None
+    idempotency_store = idempotency.store if idempotency is not None else None
+    
+    async def health_check(send):
+        breakers = breaker_stats()
+        degraded = any(breaker['state'] != 'closed' for breaker in breakers.values())
+        health = {
+            "status": "degraded" if degraded else "healthy",
+            "circuit_breakers": breakers
+        }
+        if maps_client.prefetcher is not None:
+            health["eta_prefetch"] = maps_client.prefetcher.stats()
+        if maps_client.headways is not None:
+            health["headways"] = maps_client.headways.stats()
+        if recorder is not None:
+            health["traffic_capture"] = recorder.stats()
+        await _send_json(send, health, 200)
+    
+    async def handle_message(phone_number, message_text):
+        # Throttle flooding senders before any parsing or upstream call
+        if rate_limiter is not None:
+            decision = await run_blocking([rate_limit_store], rate_limiter.check, phone_number)
+            if not decision.allowed:
+                logging.warning("Rate limit exceeded by %s", phone_number)
+                if decision.notify:
+                    await sms_sender.send_sms(phone_number, SLOW_DOWN_MESSAGE)
+                return {"error": "Too many requests", "retry_after": int(decision.retry_after) + 1}, 429
+        
+        return await process_sms_async(phone_number, message_text, maps_client, sms_sender)
+    
+    async def webhook(receive, send):
+        try:
+            try:
+                data = json.loads(await _read_body(receive) or b'null')
+            except ValueError:
+                data = None
+            
+            if not data or not isinstance(data, dict):
+                logging.error("No JSON data received in webhook")
+                return await _send_json(send, {"error": "No data received"}, 400)
+            
+            phone_number = data.get("from", data.get("sender", ""))
+            message_text = data.get("message", data.get("text", ""))
+            
+            if not phone_number or not message_text:
+                logging.error("Missing phone number or message text in webhook data")
+                await sms_sender.send_sms(phone_number, "Invalid format. Send: Location RouteNumber")
+                return await _send_json(send, {"error": "Missing phone number or message"}, 400)
+            
+            # Gateway retries of a message already handled get the recorded response
+            key = None
+            if idempotency is not None:
+                key = make_idempotency_key(data, phone_number, message_text, Config.IDEMPOTENCY_WINDOW,
+                                           Config.IDEMPOTENCY_CONTENT_FALLBACK)
+            if key is None:
+                result, status = await handle_message(phone_number, message_text)
+                return await _send_json(send, result, status)
+            
+            previous = await run_blocking([idempotency_store], idempotency.begin, key)
+            if previous is not None:
+                return await _send_json(send, *previous)
+            try:
+                result, status = await handle_message(phone_number, message_text)
+            except BaseException:
+                await run_blocking([idempotency_store], idempotency.release, key)
+                raise
+            await run_blocking([idempotency_store], idempotency.complete, key, result, status)
+            await _send_json(send, result, status)
+            
+        except Exception as e:
+            logging.error("Unexpected error in webhook: %s", e)
+            await _send_json(send, {"error": "Internal server error"}, 500)
+    
+    async def webhook_batch(receive, send):
+        try:
+            try:
+                items = parse_batch_body(await _read_body(receive))
+            except ValueError as e:
+                logging.error("Invalid batch webhook body: %s", e)
+                return await _send_json(send, {"error": "Invalid batch: send a JSON array of messages or NDJSON"}, 400)
+            
+            if len(items) > Config.WEBHOOK_BATCH_MAX_MESSAGES:
+                return await _send_json(
+                    send, {"error": "Batch too large", "max_messages": Config.WEBHOOK_BATCH_MAX_MESSAGES}, 413
+                )
+            
+            result, status = await process_batch_async(items, maps_client, sms_sender, rate_limiter, idempotency)
+            await _send_json(send, result, status)
+            
+        except Exception as e:
+            logging.error("Unexpected error in batch webhook: %s", e)
+            await _send_json(send, {"error": "Internal server error"}, 500)
+    
+    async def instrumented(handler, scope, receive, send):
+        # Every log line of this message carries the same ID
+        correlation_id = set_correlation_id(dict(scope.get('headers', [])).get(b'x-request-id', b'').decode())
+        statuses = []
+        # Request and response bodies, kept only while capturing traffic
+        capture = recorder.begin() if recorder is not None else None
+        bodies = {'request': [], 'response': []}
+        
+        async def receive_and_record():
+            message = await receive()
+            if capture is not None and message['type'] == 'http.request':
+                bodies['request'].append(message.get('body', b''))
+            return message
+        
+        async def send_and_record(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+                message = dict(message, headers=message['headers'] + [(b'x-request-id', correlation_id.encode())])
+            elif capture is not None and message['type'] == 'http.response.body':
+                bodies['response'].append(message.get('body', b''))
+            await send(message)
+        
+        WEBHOOK_IN_PROGRESS.inc()
+        try:
+            with WEBHOOK_SECONDS.time():
+                await handler(receive_and_record, send_and_record)
+        finally:
+            WEBHOOK_IN_PROGRESS.dec()
+        WEBHOOK_REQUESTS.labels(statuses[0] if statuses else 500).inc()
+        if capture is not None:
+            record = recorder.webhook_record(capture, scope['path'], b''.join(bodies['request']),
+                                             statuses[0] if statuses else 500, b''.join(bodies['response']))
+            await run_blocking([recorder], recorder.write, record)
+    
+    async def lifespan(receive, send):
+        import asyncio
+        
+        prefetch_task = None
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Popular pairs are refreshed from a task on the server's loop
+                if maps_client.prefetcher is not None:
+                    prefetch_task = asyncio.ensure_future(maps_client.prefetcher.run_async())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if prefetch_task is not None:
+                    maps_client.prefetcher.stop()
+                    prefetch_task.cancel()
+                await maps_client.aclose()
+                await sms_sender.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        
+        route = (scope['method'], scope['path'])
+        if route == ('GET', '/health'):
+            return await health_check(send)
+        if route == ('GET', '/metrics'):
+            return await _send_text(send, generate_latest(), CONTENT_TYPE)
+        if route == ('POST', '/webhook'):
+            return await instrumented(webhook, scope, receive, send)
+        if route == ('POST', '/webhook/batch'):
+            return await instrumented(webhook_batch, scope, receive, send)
+        if scope['path'] in ('/health', '/metrics', '/webhook', '/webhook/batch'):
+            return await _send_json(send, {"error": "Method not allowed"}, 405)
+        await _send_json(send, {"error": "Not found"}, 404)
+    
+    return app
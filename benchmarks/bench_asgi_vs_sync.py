@@ -0,0 +1,47 @@
+"""
+Load-test the sync (gunicorn + Flask) and ASGI (uvicorn) service modes
+
+Both modes talk to the same local stub upstreams, which add a fixed latency
+to every Directions and Fast2SMS call. Requires gunicorn, uvicorn and aiohttp.
+
+Usage: python benchmarks/bench_asgi_vs_sync.py [requests] [concurrency] [upstream_latency_ms]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.harness import running_server, server_env
+from benchmarks.loadgen import format_result, run_load
+from benchmarks.stub_upstreams import StubUpstreamServer
+
+
+def run_mode(name, mode, env, payloads, concurrency):
+    with running_server(mode, env) as base_url:
+        result = run_load(f'{base_url}/webhook', payloads, concurrency=concurrency, timeout=120)
+        print(format_result(name, result))
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    latency_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 100
+
+    payloads = [
+        {'from': f'98{i:08d}', 'message': f'Stop {i % 500} {(23, 45, 12, 7, 5)[i % 5]}'}
+        for i in range(total)
+    ]
+
+    with StubUpstreamServer(latency_ms=latency_ms) as stub:
+        env = server_env(stub)
+        print(f"{total} webhooks, {concurrency} concurrent clients, {latency_ms:.0f} ms per upstream call")
+        run_mode('sync (gunicorn 4x sync)', 'sync', env, payloads, concurrency)
+        run_mode('asgi (uvicorn 1 process)', [
+            sys.executable, '-m', 'uvicorn', '--factory', 'asgi_app:create_asgi_app',
+            '--host', '127.0.0.1', '--port', '{port}', '--log-level', 'warning'
+        ], env, payloads, concurrency)
+        print(f"Upstream calls served by stub: {stub.config.calls}")
+
+
+if __name__ == '__main__':
+    main()
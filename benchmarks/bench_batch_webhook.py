@@ -0,0 +1,69 @@
+"""
+Messages per second through /webhook versus /webhook/batch
+
+Delivers the same synthetic message mix once as one /webhook request per
+message and once as /webhook/batch requests of several batch sizes, and
+reports messages per second, request latency and upstream calls per
+message. Runs offline against the stub upstreams; requires gunicorn (and
+uvicorn and aiohttp for the asgi mode).
+
+Usage: python benchmarks/bench_batch_webhook.py [--messages 2000] [--batch-sizes 10,100,500] [--modes gthread,asgi]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.harness import running_server, server_env
+from benchmarks.loadgen import run_load
+from benchmarks.sms_mix import synthetic_messages, webhook_payloads
+from benchmarks.stub_upstreams import StubUpstreamServer
+
+
+def fresh_ids(payloads, run):
+    """Copy payloads with message IDs unique to this run, so no run replays another's responses"""
+    return [dict(payload, message_id=f"{run}-{payload['message_id']}") for payload in payloads]
+
+
+def report(name, result, messages, calls):
+    seconds = result['elapsed_s']
+    print(f"  {name:22s} {messages / seconds:8.1f} msg/s  {result['requests']:5d} requests  "
+          f"p50 {result['p50_ms']:7.1f} ms  p99 {result['p99_ms']:7.1f} ms  "
+          f"maps {calls['maps'] / messages:.2f}/msg  sms {calls['sms'] / messages:.2f}/msg  {result['statuses']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--batch-sizes', default='10,100,500')
+    parser.add_argument('--modes', default='gthread,asgi')
+    parser.add_argument('--concurrency', type=int, default=50, help='in-flight /webhook requests')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=50, help='stub upstream latency in ms')
+    args = parser.parse_args()
+
+    payloads = webhook_payloads(synthetic_messages(args.messages), args.messages)
+    with StubUpstreamServer(latency_ms=args.latency) as stub:
+        # The replay repeats senders faster than a person would; do not
+        # throttle them
+        env = server_env(stub, {'RATE_LIMIT_BACKEND': 'none'})
+        for mode in args.modes.split(','):
+            print(f"\n{mode}: {args.messages} messages, upstream latency {args.latency:.0f} ms")
+            with running_server(mode, env, workers=args.workers) as base_url:
+                stub.config.reset()
+                result = run_load(f'{base_url}/webhook', fresh_ids(payloads, 'single'),
+                                  concurrency=args.concurrency)
+                report('/webhook', result, args.messages, stub.config.calls)
+
+                for size in map(int, args.batch_sizes.split(',')):
+                    run = fresh_ids(payloads, f'batch{size}')
+                    batches = [run[i:i + size] for i in range(0, len(run), size)]
+                    stub.config.reset()
+                    result = run_load(f'{base_url}/webhook/batch', batches,
+                                      concurrency=max(1, min(args.concurrency, len(batches) // 4)))
+                    report(f'/webhook/batch x{size}', result, args.messages, stub.config.calls)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Load time, memory and query latency of the GTFS schedule engine
+
+Usage: python benchmarks/bench_gtfs.py [stops] [routes] [trips_per_route] [stops_per_trip]
+"""
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'bench')
+os.environ.setdefault('FAST2SMS_API_KEY', 'bench')
+
+from benchmarks.synthetic_gtfs import write_synthetic_feed
+from utils.gtfs_schedule import GTFSSchedule
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    stops, routes, trips_per_route, stops_per_trip = (args + [5000, 300, 120, 30][len(args):])[:4]
+
+    with tempfile.TemporaryDirectory() as feed_dir:
+        rows = write_synthetic_feed(feed_dir, stops, routes, trips_per_route, stops_per_trip)
+        size_mb = sum(os.path.getsize(os.path.join(feed_dir, f)) for f in os.listdir(feed_dir)) / 1e6
+        print(f"Feed: {stops} stops, {routes} routes, {routes * trips_per_route} trips, "
+              f"{rows} stop_times ({size_mb:.1f} MB on disk)")
+
+        start = time.perf_counter()
+        schedule = GTFSSchedule.load(feed_dir)
+        print(f"Load: {time.perf_counter() - start:.2f} s "
+              f"(process max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB)")
+
+        # Second load under tracemalloc (much slower) to measure retained memory
+        del schedule
+        tracemalloc.start()
+        schedule = GTFSSchedule.load(feed_dir)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"Memory: retained {current / 1e6:.1f} MB, peak during load {peak / 1e6:.1f} MB")
+
+    rng = random.Random(1)
+    keys = list(schedule.departures)
+    queries = []
+    for _ in range(100000):
+        stop, route = rng.choice(keys)
+        queries.append((schedule.stop_names[stop], schedule.route_names[route], rng.randrange(86400)))
+
+    start = time.perf_counter()
+    for location, route, now_seconds in queries:
+        schedule.next_departures(location, route, now_seconds)
+    per_query_us = (time.perf_counter() - start) / len(queries) * 1e6
+    print(f"next_departures by stop name: {per_query_us:.2f} us/query over {len(queries)} queries")
+
+
+if __name__ == '__main__':
+    main()
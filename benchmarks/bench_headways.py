@@ -0,0 +1,79 @@
+"""
+Batched (numpy) versus per-query (bisect) estimates of the following buses
+
+Builds an observed timetable for many (stop, route) pairs, then times
+HeadwayEstimator.next_departures on batches of queries answered with one
+vectorized searchsorted pass and with one binary search per query.
+
+Usage: python benchmarks/bench_headways.py [pairs] [departures_per_pair]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'bench')
+os.environ.setdefault('FAST2SMS_API_KEY', 'bench')
+
+from utils import headway_estimator
+from utils.headway_estimator import HeadwayEstimator
+
+BATCH_SIZES = (1, 10, 100, 1000, 10000)
+
+
+def build_estimator(pairs, departures, rng):
+    """Observe departures every 1440 / departures minutes, jittered, for each pair"""
+    estimator = HeadwayEstimator(route_headways={str(route): [1200] * 24 for route in range(10)})
+    step = 86400 // departures
+    queries = []
+    for pair in range(pairs):
+        origin, route = f'stop {pair // 10}', str(pair % 10)
+        for i in range(departures):
+            estimator.observe(origin, route, i * step + rng.randint(0, 120))
+        queries.append((origin, route))
+    return estimator, queries
+
+
+def time_batches(estimator, queries, size, rounds):
+    """Return the best of 5 runs, in microseconds per query, of next_departures on batches of size"""
+    batches = [queries[batch * size % len(queries):batch * size % len(queries) + size] for batch in range(rounds)]
+    best = float('inf')
+    for _ in range(5):
+        start = time.perf_counter()
+        for batch in batches:
+            estimator.next_departures(batch, count=2)
+        best = min(best, time.perf_counter() - start)
+    return best / (rounds * size) * 1e6
+
+
+def main():
+    pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    departures = int(sys.argv[2]) if len(sys.argv) > 2 else 72
+    rng = random.Random(7)
+    estimator, pair_list = build_estimator(pairs, departures, rng)
+    queries = [(*rng.choice(pair_list), rng.randint(0, 86399)) for _ in range(20000)]
+    print(f"{pairs} pairs x {departures} observed departures, next 2 buses per query")
+
+    if not headway_estimator.HAS_NUMPY:
+        print("numpy is not installed; only the bisect path is measured")
+    available = headway_estimator.HAS_NUMPY
+    for size in BATCH_SIZES:
+        rounds = max(1, 20000 // size)
+        headway_estimator.HAS_NUMPY = False
+        bisect_us = time_batches(estimator, queries, size, rounds)
+        headway_estimator.HAS_NUMPY = available
+        line = f"  batch {size:6d}: bisect {bisect_us:7.2f} us/query"
+        if available:
+            threshold = headway_estimator.VECTOR_MIN_QUERIES
+            headway_estimator.VECTOR_MIN_QUERIES = 1
+            # The first call compiles the concatenated arrays
+            estimator.next_departures(queries[:1])
+            numpy_us = time_batches(estimator, queries, size, rounds)
+            headway_estimator.VECTOR_MIN_QUERIES = threshold
+            line += f"  numpy {numpy_us:7.2f} us/query  ({bisect_us / numpy_us:4.1f}x)"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
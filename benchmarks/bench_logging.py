@@ -0,0 +1,112 @@
+"""
+Per-request logging overhead: synchronous f-string logging versus the
+queued, lazily formatted handler, with a fast and with a stalling output
+
+Each simulated request logs like the webhook pipeline does: one sampled
+success line and, for one request in ten, a warning.
+
+Usage: python benchmarks/bench_logging.py [requests]
+"""
+import io
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'bench')
+os.environ.setdefault('FAST2SMS_API_KEY', 'bench')
+
+from utils.logging_setup import (
+    TEXT_FORMAT, CorrelationFilter, JSONFormatter, QueueLogHandler, SamplingFilter, set_correlation_id
+)
+
+
+class SlowStream(io.StringIO):
+    """Output that stalls for `stall` seconds every `every` writes (a slow pipe or disk)"""
+
+    def __init__(self, stall=0.002, every=50):
+        super().__init__()
+        self.stall = stall
+        self.every = every
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        if self.writes % self.every == 0:
+            time.sleep(self.stall)
+        return len(text)
+
+
+def old_request(logger, i):
+    """Logging of one request before: eager f-strings, every success line written"""
+    logger.info(f"Replied to 98765{i:05d} for route 23 at MG Road")
+    if i % 10 == 0:
+        logger.warning(f"Rate limit exceeded by 98765{i:05d}")
+
+
+def new_request(logger, i):
+    """Logging of one request now: lazy arguments, sampled success line"""
+    set_correlation_id(f"req-{i}")
+    logger.info("Replied to %s for route %s at %s", f"98765{i:05d}", '23', 'MG Road',
+                extra={'sample': True, 'eta_source': 'maps'})
+    if i % 10 == 0:
+        logger.warning("Rate limit exceeded by %s", f"98765{i:05d}")
+
+
+def run(label, handler, request, count):
+    """Time `count` requests and print mean and p99 logging cost per request"""
+    logger = logging.getLogger(f'bench.{label}')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    timings = []
+    for i in range(count):
+        start = time.perf_counter()
+        request(logger, i)
+        timings.append(time.perf_counter() - start)
+    if isinstance(handler, QueueLogHandler):
+        handler.stop(timeout=30)
+        dropped = f"{handler.dropped} dropped"
+    else:
+        dropped = ''
+
+    timings.sort()
+    mean = sum(timings) / count * 1e6
+    p99 = timings[int(count * 0.99)] * 1e6
+    worst = timings[-1] * 1e6
+    print(f"{label:34s} mean {mean:7.2f} us   p99 {p99:8.2f} us   max {worst:9.1f} us   {dropped}")
+
+
+def stream_handler(stream, formatter):
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(formatter)
+    return handler
+
+
+def queued(output, sample_rate):
+    handler = QueueLogHandler([output], max_size=10000)
+    handler.addFilter(CorrelationFilter())
+    handler.addFilter(SamplingFilter(sample_rate))
+    return handler
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    text = logging.Formatter('%(asctime)s %(levelname)s %(module)s %(message)s')
+    structured = logging.Formatter(TEXT_FORMAT)
+    print(f"{count} requests")
+
+    run('sync text, fast output', stream_handler(io.StringIO(), text), old_request, count)
+    run('sync text, stalling output', stream_handler(SlowStream(), text), old_request, count)
+    run('queued text, stalling output', queued(stream_handler(SlowStream(), structured), 1.0),
+        new_request, count)
+    run('queued json, stalling output', queued(stream_handler(SlowStream(), JSONFormatter()), 1.0),
+        new_request, count)
+    run('queued json, 1% sampled, stalling', queued(stream_handler(SlowStream(), JSONFormatter()), 0.01),
+        new_request, count)
+
+
+if __name__ == '__main__':
+    main()
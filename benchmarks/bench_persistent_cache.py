@@ -0,0 +1,90 @@
+"""
+Directions API calls after a worker recycle, and lookup cost, per ETA cache backend
+
+Warms an ETA cache with the synthetic message mix, then "recycles" the
+worker by building a new client and store on the same file (a fresh
+process for the memory backend) and replays the mix again, counting the
+Directions API calls the new worker makes. Also times cache hits of each
+backend.
+
+Usage: python benchmarks/bench_persistent_cache.py [--messages 2000] [--stops 200] [--latency 20]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'bench')
+os.environ.setdefault('FAST2SMS_API_KEY', 'bench')
+
+from benchmarks.stub_upstreams import StubUpstreamServer
+from benchmarks.sms_mix import synthetic_messages
+from utils.eta_cache import ETACache, make_eta_cache_key
+from utils.kv_store import create_kv_store
+from utils.maps_client import GoogleMapsClient
+from utils.sms_parser import parse_sms_input
+
+BACKENDS = ('memory', 'sqlite', 'log')
+
+
+def make_client(backend, path, stub):
+    """Build a client whose cache lives in a new store instance"""
+    store = create_kv_store(backend, path=path, max_entries=10000)
+    client = GoogleMapsClient(cache=ETACache(store, ttl=600))
+    client.base_url = stub.maps_url
+    return client
+
+
+def replay(client, queries):
+    """Look up every query; return the elapsed seconds"""
+    start = time.perf_counter()
+    for origin, route in queries:
+        client.get_bus_eta(origin, route)
+    return time.perf_counter() - start
+
+
+def time_hits(store, keys, rounds=5):
+    """Return the best of rounds, in microseconds per get, of reading keys"""
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for key in keys:
+            store.get(key)
+        best = min(best, time.perf_counter() - start)
+    return best / len(keys) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--stops', type=int, default=200, help='distinct stops in the message mix')
+    parser.add_argument('--latency', type=float, default=20, help='stub Directions API latency in ms')
+    args = parser.parse_args()
+
+    queries = []
+    for phone, text in synthetic_messages(args.messages, stops=args.stops):
+        parsed = parse_sms_input(text)
+        if parsed['valid']:
+            queries.append((parsed['location'], parsed['route']))
+    keys = [make_eta_cache_key(origin, route) for origin, route in queries]
+
+    with StubUpstreamServer(latency_ms=args.latency) as stub, tempfile.TemporaryDirectory() as tmpdir:
+        print(f"{len(queries)} lookups, {len(set(queries))} distinct pairs, "
+              f"Directions API latency {args.latency:.0f} ms")
+        for backend in BACKENDS:
+            path = os.path.join(tmpdir, f'eta_cache.{backend}')
+            replay(make_client(backend, path, stub), queries)
+
+            # The recycled worker starts with a new store on the same file
+            recycled = make_client(backend, path, stub)
+            stub.config.reset()
+            elapsed = replay(recycled, queries)
+            hit_us = time_hits(recycled.cache.store, keys)
+            print(f"  {backend:7s} after recycle: Directions API calls {stub.config.calls['maps']:5d}  "
+                  f"replay {elapsed * 1000:8.1f} ms  cache hit {hit_us:6.2f} us/get")
+
+
+if __name__ == '__main__':
+    main()
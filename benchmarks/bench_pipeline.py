@@ -0,0 +1,98 @@
+"""
+End-to-end load test of the SMS -> ETA -> SMS path against local stub upstreams
+
+Replays a message mix (synthetic, or recorded in a JSON lines file) against
+/webhook for every combination of server mode and configuration, and reports
+latency percentiles, throughput, status codes and upstream calls per
+request. Runs offline; requires gunicorn (and uvicorn and aiohttp for the
+asgi mode).
+
+Examples:
+    python benchmarks/bench_pipeline.py --requests 2000 --modes sync,asgi
+    python benchmarks/bench_pipeline.py --config nocache:ETA_CACHE_BACKEND=none \\
+        --config cache:ETA_CACHE_BACKEND=memory --maps-latency 120 --jitter 30
+    python benchmarks/bench_pipeline.py --mix recorded.jsonl --rate 200 --json results.json
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.harness import MODES, running_server, server_env
+from benchmarks.loadgen import format_result, run_load
+from benchmarks.sms_mix import load_recorded_messages, synthetic_messages, webhook_payloads
+from benchmarks.stub_upstreams import StubUpstreamServer
+
+
+def parse_config(spec):
+    """Parse NAME:KEY=VALUE,KEY=VALUE into (name, overrides)"""
+    name, _, assignments = spec.partition(':')
+    overrides = {}
+    for assignment in filter(None, assignments.split(',')):
+        key, _, value = assignment.partition('=')
+        overrides[key.strip()] = value.strip()
+    return name, overrides
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000, help='webhooks per run')
+    parser.add_argument('--concurrency', type=int, default=100, help='concurrent clients')
+    parser.add_argument('--rate', type=float, help='open-loop target requests/s (default: closed loop)')
+    parser.add_argument('--modes', default='sync,asgi', help=f"comma-separated: {', '.join(MODES)}")
+    parser.add_argument('--workers', type=int, default=4, help='server worker processes')
+    parser.add_argument('--config', action='append', type=parse_config, metavar='NAME:KEY=VALUE,...',
+                        help='named set of environment overrides; repeat to compare')
+    parser.add_argument('--mix', help='JSON lines file of recorded messages (default: synthetic mix)')
+    parser.add_argument('--maps-latency', type=float, default=80, help='Directions stub latency in ms')
+    parser.add_argument('--sms-latency', type=float, default=150, help='Fast2SMS stub latency in ms')
+    parser.add_argument('--jitter', type=float, default=20, help='mean extra exponential latency in ms')
+    parser.add_argument('--maps-error-rate', type=float, default=0.0, help='fraction of Directions 503s')
+    parser.add_argument('--sms-error-rate', type=float, default=0.0, help='fraction of Fast2SMS 503s')
+    parser.add_argument('--payload-bytes', type=int, default=20000, help='Directions response size')
+    parser.add_argument('--json', help='also write the results to this file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    messages = load_recorded_messages(args.mix) if args.mix else synthetic_messages(args.requests)
+    payloads = webhook_payloads(messages, args.requests)
+    configs = args.config or [('default', {})]
+
+    stub = StubUpstreamServer(
+        jitter_ms=args.jitter,
+        payload_bytes=args.payload_bytes,
+        upstreams={
+            'maps': {'latency_ms': args.maps_latency, 'error_rate': args.maps_error_rate},
+            'sms': {'latency_ms': args.sms_latency, 'error_rate': args.sms_error_rate}
+        }
+    )
+    results = []
+    with stub:
+        print(f"{len(payloads)} webhooks from {'recorded ' + args.mix if args.mix else 'a synthetic mix'}, "
+              f"{args.concurrency} clients{f' at {args.rate:.0f} req/s' if args.rate else ''}; "
+              f"maps {args.maps_latency:.0f} ms, sms {args.sms_latency:.0f} ms, +{args.jitter:.0f} ms jitter")
+        for mode in args.modes.split(','):
+            for name, overrides in configs:
+                with running_server(mode, server_env(stub, overrides), workers=args.workers) as base_url:
+                    stub.config.reset()
+                    result = run_load(f'{base_url}/webhook', payloads, concurrency=args.concurrency,
+                                      timeout=120, rate=args.rate)
+                calls, errors = dict(stub.config.calls), dict(stub.config.errors)
+                label = f"{mode}/{name}"
+                print(format_result(label, result))
+                print(f"{'':<26} upstream calls/request: maps {calls['maps'] / result['requests']:.2f}, "
+                      f"sms {calls['sms'] / result['requests']:.2f}; stub 503s {errors}")
+                results.append(dict(result, mode=mode, config=name, overrides=overrides,
+                                    upstream_calls=calls, upstream_errors=errors))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
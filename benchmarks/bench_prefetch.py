@@ -0,0 +1,109 @@
+"""
+Cache hit ratio, lookup latency and API calls with and without ETA prefetching
+
+Replays the synthetic message mix (skewed towards a few popular stops) at a
+fixed rate through GoogleMapsClient with a short cache TTL, once on demand
+only and once with the background prefetcher keeping the popular pairs warm
+within a per-minute Directions API budget. With --workers N the mix is
+split over N clients, each with its own cache and prefetcher as in N
+gunicorn workers, spending from one budget in a shared SQLite file.
+
+Usage: python benchmarks/bench_prefetch.py [--seconds 20] [--rate 100] [--ttl 5] [--budget 600] [--stops 50] [--top-k 50] [--workers 1]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'bench')
+os.environ.setdefault('FAST2SMS_API_KEY', 'bench')
+
+from benchmarks.loadgen import percentile
+from benchmarks.sms_mix import synthetic_messages
+from benchmarks.stub_upstreams import StubUpstreamServer
+from utils.eta_cache import ETACache
+from utils.eta_prefetcher import ETAPrefetcher, QueryPopularity
+from utils.kv_store import MemoryKVStore, SQLiteKVStore
+from utils.maps_client import GoogleMapsClient
+from utils.sms_parser import parse_sms_input
+
+
+def replay(client, queries, seconds, rate):
+    """Look up queries at a fixed rate for a number of seconds; return latencies in ms"""
+    latencies = []
+    start = time.perf_counter()
+    for i in range(int(seconds * rate)):
+        scheduled = start + i / rate
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        origin, route = queries[i % len(queries)]
+        began = time.perf_counter()
+        client.get_bus_eta(origin, route)
+        latencies.append((time.perf_counter() - began) * 1000)
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--rate', type=float, default=100, help='lookups per second')
+    parser.add_argument('--ttl', type=int, default=5, help='ETA cache TTL in seconds')
+    parser.add_argument('--budget', type=float, default=600, help='prefetch API calls per minute')
+    parser.add_argument('--stops', type=int, default=50, help='distinct stops in the message mix')
+    parser.add_argument('--top-k', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=100, help='stub Directions API latency in ms')
+    parser.add_argument('--workers', type=int, default=1, help='simulated workers sharing the prefetch budget')
+    args = parser.parse_args()
+
+    queries = []
+    for phone, text in synthetic_messages(int(args.seconds * args.rate), stops=args.stops):
+        parsed = parse_sms_input(text)
+        if parsed['valid']:
+            queries.append((parsed['location'], parsed['route']))
+
+    with StubUpstreamServer(latency_ms=args.latency) as stub, tempfile.TemporaryDirectory() as tmpdir:
+        print(f"{len(queries)} lookups over {args.seconds:.0f} s, cache TTL {args.ttl} s, "
+              f"Directions API latency {args.latency:.0f} ms, {args.workers} worker(s)")
+        for prefetch in (False, True):
+            budget_store = SQLiteKVStore(os.path.join(tmpdir, f'budget-{prefetch}.sqlite3'))
+            clients = []
+            for _ in range(args.workers):
+                client = GoogleMapsClient(cache=ETACache(MemoryKVStore(max_entries=10000), ttl=args.ttl))
+                client.base_url = stub.maps_url
+                if prefetch:
+                    client.prefetcher = ETAPrefetcher(
+                        client, QueryPopularity(), top_k=args.top_k, min_hits=3,
+                        budget_per_minute=args.budget, lead=2, interval=1, budget_store=budget_store
+                    )
+                clients.append(client)
+            stub.config.reset()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                runs = executor.map(
+                    lambda i: replay(clients[i], queries[i::args.workers], args.seconds, args.rate / args.workers),
+                    range(args.workers)
+                )
+                latencies = sorted(latency for run in runs for latency in run)
+            # Lookups answered by the API run late, so the replay outlasts --seconds
+            minutes = (time.perf_counter() - started) / 60
+            prefetches = 0
+            for client in clients:
+                if prefetch:
+                    client.prefetcher.stop()
+                    stats = client.prefetcher.stats()
+                    prefetches += stats['refreshed'] + stats['failed']
+            cache_stats = [client.cache.stats() for client in clients]
+            hits = sum(stats['hits'] + stats['stale_hits'] for stats in cache_stats)
+            lookups = hits + sum(stats['misses'] for stats in cache_stats)
+            api_calls = stub.config.calls['maps']
+            print(f"  {'prefetch' if prefetch else 'on demand':10s} hit ratio {hits / max(1, lookups):5.1%}  "
+                  f"p50 {percentile(latencies, 0.5):7.2f} ms  p90 {percentile(latencies, 0.9):7.2f} ms  "
+                  f"p99 {percentile(latencies, 0.99):7.2f} ms  Directions API calls {api_calls} "
+                  f"({api_calls / minutes:.0f}/min, prefetch {prefetches / minutes:.0f}/min)")
+
+if __name__ == '__main__':
+    main()
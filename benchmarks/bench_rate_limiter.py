@@ -0,0 +1,73 @@
+"""
+Per-message cost of the sender rate limiter at 10k distinct senders
+
+Usage: python benchmarks/bench_rate_limiter.py [senders] [messages]
+"""
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'bench')
+os.environ.setdefault('FAST2SMS_API_KEY', 'bench')
+
+import app as app_module
+from config import Config
+from utils.kv_store import MemoryKVStore, SQLiteKVStore
+from utils.rate_limiter import RateLimiter
+
+
+def per_check_us(limiter, senders):
+    """Return the mean cost of one limiter check in microseconds"""
+    start = time.perf_counter()
+    for sender in senders:
+        limiter.check(sender)
+    return (time.perf_counter() - start) / len(senders) * 1e6
+
+
+def per_webhook_us(backend, senders):
+    """Return the mean cost of one /webhook request with the pipeline stubbed out"""
+    with patch.object(Config, 'RATE_LIMIT_BACKEND', backend), \
+            patch.object(Config, 'RATE_LIMIT_MAX_SENDERS', len(set(senders))), \
+            patch('app.process_sms', return_value=({}, 200)), \
+            patch('app.Fast2SMSSender'):
+        client = app_module.create_app().test_client()
+        logging.disable(logging.WARNING)
+        start = time.perf_counter()
+        for sender in senders:
+            client.post('/webhook', json={'from': sender, 'message': 'MG Road 23'})
+        return (time.perf_counter() - start) / len(senders) * 1e6
+
+
+def main():
+    sender_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    rng = random.Random(5)
+    phones = [f'9{i:09d}' for i in range(sender_count)]
+    # A few heavy senders among many occasional ones
+    senders = [phones[min(int(rng.paretovariate(1.2)) - 1, sender_count - 1)] if rng.random() < 0.3
+               else rng.choice(phones) for _ in range(message_count)]
+    print(f"{message_count} messages from {len(set(senders))} distinct senders")
+
+    limiter = RateLimiter(MemoryKVStore(max_entries=sender_count), max_messages=5, window=60)
+    print(f"memory limiter check      {per_check_us(limiter, senders):8.2f} us/message  "
+          f"({limiter.throttled} throttled, {len(limiter.store)} senders tracked)")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = SQLiteKVStore(os.path.join(tmpdir, 'limits.sqlite3'), max_entries=sender_count)
+        limiter = RateLimiter(store, max_messages=5, window=60)
+        print(f"sqlite limiter check      {per_check_us(limiter, senders[:20000]):8.2f} us/message")
+
+    sample = senders[:10000]
+    without = per_webhook_us('none', sample)
+    with_limiter = per_webhook_us('memory', sample)
+    print(f"/webhook (stubbed ETA+SMS) {without:7.1f} us without limiter, {with_limiter:7.1f} us with "
+          f"({(with_limiter - without) / without:+.1%})")
+
+
+if __name__ == '__main__':
+    main()
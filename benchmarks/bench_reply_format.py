@@ -0,0 +1,88 @@
+"""
+Segments billed and formatting cost of SMS replies, by location
+
+Formats an ETA reply for every location of a corpus (and with a longer ETA
+wording, which leaves less room for the location) with the compiled reply
+templates of utils.response_formatter and with the previous formatter, which
+sliced every message to 160 characters regardless of its encoding. Reports
+how many replies need more than one segment, the segments billed per reply,
+and the time per formatted reply.
+
+Usage: python benchmarks/bench_reply_format.py [locations.txt] [--rounds 200]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'bench')
+os.environ.setdefault('FAST2SMS_API_KEY', 'bench')
+
+from utils.response_formatter import format_eta_response
+from utils.sms_template import sms_segments
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), 'locations.example.txt')
+
+ETA_DATA = (
+    {'success': True, 'error': '', 'data': {
+        'eta_text': '12 mins', 'departure_time': '2:30 PM', 'next_time': '2:50 PM'}},
+    {'success': True, 'error': '', 'data': {
+        'eta_text': '1 hour 5 mins', 'departure_time': '11:45 AM', 'next_time': '12:20 PM'}},
+)
+
+
+def legacy_format(eta_data, route, location):
+    """The reply as built before the templates: an f-string sliced to 160 characters"""
+    data = eta_data['data']
+    message = (f"Route {route} from {location}: Next bus in {data['eta_text']} at "
+               f"{data['departure_time']}. Next: {data['next_time']}")
+    if len(message) > 160:
+        message = message[:157] + "..."
+    return message
+
+
+def load_locations(path):
+    """Read one location per line, skipping blank lines and comments"""
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def summarize(name, replies, seconds, calls):
+    segments = [sms_segments(reply) for reply in replies]
+    multipart = sum(1 for encoding, length, count in segments if count > 1)
+    unicode = sum(1 for encoding, length, count in segments if encoding == 'ucs2')
+    billed = sum(count for encoding, length, count in segments)
+    print(f"  {name:9s} multi-part {multipart:3d}/{len(replies)}  UCS-2 {unicode:3d}  "
+          f"segments per reply {billed / len(replies):4.2f}  {seconds / calls * 1e6:6.2f} us/reply")
+
+
+def time_formatter(formatter, cases, rounds):
+    """Return (replies, best seconds of 5 runs of rounds passes over the cases)"""
+    replies = [formatter(eta_data, route, location) for eta_data, route, location in cases]
+    best = float('inf')
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for eta_data, route, location in cases:
+                formatter(eta_data, route, location)
+        best = min(best, time.perf_counter() - start)
+    return replies, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('corpus', nargs='?', default=DEFAULT_CORPUS, help='location strings, one per line')
+    parser.add_argument('--rounds', type=int, default=200, help='passes over the corpus per timing run')
+    args = parser.parse_args()
+
+    locations = load_locations(args.corpus)
+    cases = [(eta_data, '500D', location) for eta_data in ETA_DATA for location in locations]
+    print(f"{len(locations)} locations x {len(ETA_DATA)} ETA wordings = {len(cases)} replies")
+    for name, formatter in (('sliced', legacy_format), ('templates', format_eta_response)):
+        replies, seconds = time_formatter(formatter, cases, args.rounds)
+        summarize(name, replies, seconds, args.rounds * len(cases))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Throughput of the single-pass SMS parser versus the previous three-regex parser
+
+Usage: python benchmarks/bench_sms_parser.py [messages]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'bench')
+os.environ.setdefault('FAST2SMS_API_KEY', 'bench')
+
+from benchmarks.synthetic_gtfs import stop_names
+from utils.sms_parser import parse_sms_batch, parse_sms_input
+
+
+def legacy_parse_sms_input(message_text):
+    """The previous parser: up to three lazy re.match passes per message"""
+    message_text = message_text.strip()
+    if not message_text:
+        return {'location': '', 'route': '', 'valid': False, 'error': 'Invalid format. Send: Location RouteNumber'}
+    for pattern, flags in ((r'^(.+?)\s+route\s+(\d+)$', re.IGNORECASE),
+                           (r'^(.+?)\s+[rR](\d+)$', 0),
+                           (r'^(.+?)\s+(\d+)$', 0)):
+        match = re.match(pattern, message_text, flags)
+        if match:
+            return {'location': match.group(1).strip(), 'route': match.group(2), 'valid': True, 'error': ''}
+    return {'location': '', 'route': '', 'valid': False, 'error': 'Invalid format. Send: Location RouteNumber'}
+
+
+def synthetic_messages(count, seed=7):
+    """Messages in every supported form, plus some invalid ones"""
+    rng = random.Random(seed)
+    names = stop_names(2000, seed)
+    forms = ('{} {}', '{} Route {}', '{} route  {}', '{} R{}', '  {}   {}  ', '{} to town')
+    return [rng.choice(forms).format(rng.choice(names), rng.randint(1, 999)) for _ in range(count)]
+
+
+def pathological_messages():
+    """Long inputs that make lazy patterns backtrack"""
+    return [
+        'a' + ' ' * 2000 + 'b',
+        'route ' * 400,
+        'MG Road ' + '1 ' * 1000 + 'x',
+        'x' * 5000,
+        ' \t' * 1000 + '23'
+    ]
+
+
+def measure(parse, messages, repeat=1):
+    """Return messages parsed per second"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for message in messages:
+            parse(message)
+    return len(messages) * repeat / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    messages = synthetic_messages(count)
+
+    mismatches = sum(1 for message in messages
+                     if legacy_parse_sms_input(message) != parse_sms_input(message))
+    print(f"{count} synthetic messages, {mismatches} parsed differently by the two parsers")
+
+    before = measure(legacy_parse_sms_input, messages)
+    after = measure(parse_sms_input, messages)
+    start = time.perf_counter()
+    parse_sms_batch(messages)
+    batch = count / (time.perf_counter() - start)
+    print(f"typical       before {before:>11,.0f} msg/s   after {after:>11,.0f} msg/s ({after / before:.1f}x)"
+          f"   batch {batch:,.0f} msg/s")
+
+    pathological = pathological_messages()
+    before = measure(legacy_parse_sms_input, pathological, repeat=5)
+    after = measure(parse_sms_input, pathological, repeat=5)
+    print(f"pathological  before {before:>11,.0f} msg/s   after {after:>11,.0f} msg/s ({after / before:.0f}x)")
+
+
+if __name__ == '__main__':
+    main()
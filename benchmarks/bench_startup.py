@@ -0,0 +1,175 @@
+"""
+Cold-start time and per-worker memory of the service
+
+Measures, each in a fresh interpreter:
+  - import time of config, app and asgi_app, and of app with requests and
+    asyncio imported up front as they were before they became lazy
+  - create_app() time, with and without a GTFS feed
+  - copy-on-write sharing of the loaded indexes: private memory of forked
+    children after a garbage collection, with and without gc.freeze()
+  - time from launching the server to its first healthy /health response,
+    and RSS, PSS and private (USS) memory of the master and each worker
+    after a short load
+
+Memory figures come from /proc/<pid>/smaps_rollup, so they need Linux.
+
+Usage: python benchmarks/bench_startup.py [--runs 7] [--workers 4] [--stops 5000] [--modes sync,asgi]
+"""
+import argparse
+import gc
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'bench')
+os.environ.setdefault('FAST2SMS_API_KEY', 'bench')
+
+from benchmarks.harness import ROOT, server_env, server_process
+from benchmarks.loadgen import run_load
+from benchmarks.sms_mix import synthetic_messages, webhook_payloads
+from benchmarks.stub_upstreams import StubUpstreamServer
+from benchmarks.synthetic_gtfs import write_synthetic_feed
+
+# Statements timed in a fresh interpreter: (label, setup, timed statement)
+IMPORTS = (
+    ('import config', '', 'import config'),
+    ('import app', '', 'import app'),
+    ('import app (eager requests, asyncio)', '', 'import requests, asyncio, app'),
+    ('import asgi_app', '', 'import asgi_app'),
+    ('create_app()', 'import app', 'app.create_app()')
+)
+
+
+def time_in_fresh_interpreter(setup, statement, env, runs):
+    """Return the median seconds statement takes in a new interpreter, after setup"""
+    code = (f"import time\n{setup}\nstart = time.perf_counter()\n{statement}\n"
+            f"print(time.perf_counter() - start)")
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        timings.append(float(output.split()[-1]))
+    return statistics.median(timings)
+
+
+def memory_kb(pid):
+    """Return (RSS, PSS, USS) of a process in kB, from /proc/<pid>/smaps_rollup"""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return fields['Rss'], fields['Pss'], fields['Private_Clean'] + fields['Private_Dirty']
+
+
+def child_pids(pid):
+    """Return the PIDs of the direct children of a process"""
+    pids = []
+    for task in os.listdir(f'/proc/{pid}/task'):
+        with open(f'/proc/{pid}/task/{task}/children') as f:
+            pids.extend(int(child) for child in f.read().split())
+    return pids
+
+
+def bench_imports(env, runs, label):
+    print(f"\nImport and boot time ({label}, median of {runs} fresh interpreters)")
+    for name, setup, statement in IMPORTS:
+        seconds = time_in_fresh_interpreter(setup, statement, env, runs)
+        print(f"  {name:38s} {seconds * 1000:8.1f} ms")
+
+
+def bench_shared_heap(feed_dir, children=4):
+    """Fork children after loading the indexes and report their private memory"""
+    from utils.gtfs_schedule import load_schedule
+    from utils.stop_resolver import load_stop_resolver
+    indexes = (load_schedule(feed_dir), load_stop_resolver(os.path.join(feed_dir, 'stops.txt')))
+
+    print(f"\nCopy-on-write sharing of the loaded indexes ({children} forked children, after gc.collect())")
+    for frozen in (False, True):
+        if frozen:
+            gc.collect()
+            gc.freeze()
+        ready_read, ready_write = os.pipe()
+        exit_read, exit_write = os.pipe()
+        pids = []
+        for _ in range(children):
+            pid = os.fork()
+            if pid == 0:
+                os.close(exit_write)
+                # A worker's collector runs sooner or later; force it now
+                gc.collect()
+                os.write(ready_write, b'.')
+                os.read(exit_read, 1)
+                os._exit(0)
+            pids.append(pid)
+        ready = 0
+        while ready < children:
+            ready += len(os.read(ready_read, children))
+        usage = [memory_kb(pid) for pid in pids]
+        os.close(exit_write)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        for fd in (ready_read, ready_write, exit_read):
+            os.close(fd)
+        print(f"  {'gc.freeze()' if frozen else 'no freeze':12s} per child: "
+              f"RSS {statistics.mean(u[0] for u in usage) / 1024:6.1f} MB  "
+              f"PSS {statistics.mean(u[1] for u in usage) / 1024:6.1f} MB  "
+              f"private {statistics.mean(u[2] for u in usage) / 1024:6.1f} MB")
+    gc.unfreeze()
+    return indexes
+
+
+def bench_servers(modes, workers, overrides):
+    print(f"\nServer cold start and memory ({workers} workers, after 500 webhooks)")
+    payloads = webhook_payloads(synthetic_messages(500), 500)
+    with StubUpstreamServer(latency_ms=5) as stub:
+        for mode in modes:
+            env = server_env(stub, overrides)
+            with server_process(mode, env, workers=workers) as (process, base_url, boot_seconds):
+                # Workers may still be starting after the first one answers
+                time.sleep(1)
+                run_load(f'{base_url}/webhook', payloads, concurrency=20)
+                master = memory_kb(process.pid)
+                workers_usage = [memory_kb(pid) for pid in child_pids(process.pid)]
+            print(f"  {mode:6s} first healthy response after {boot_seconds * 1000:7.0f} ms")
+            print(f"         master       RSS {master[0] / 1024:6.1f} MB  PSS {master[1] / 1024:6.1f} MB  "
+                  f"private {master[2] / 1024:6.1f} MB")
+            for rss, pss, uss in workers_usage:
+                print(f"         worker       RSS {rss / 1024:6.1f} MB  PSS {pss / 1024:6.1f} MB  "
+                      f"private {uss / 1024:6.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=7, help='fresh interpreters per import timing')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--stops', type=int, default=5000, help='stops in the synthetic GTFS feed (0: no feed)')
+    parser.add_argument('--modes', default='sync,asgi')
+    args = parser.parse_args()
+    proc = os.path.exists('/proc/self/smaps_rollup')
+
+    bench_imports(dict(os.environ), args.runs, 'no feed')
+    if not args.stops:
+        if proc:
+            bench_servers(args.modes.split(','), args.workers, {})
+        return
+
+    with tempfile.TemporaryDirectory() as feed_dir:
+        rows = write_synthetic_feed(feed_dir, stops=args.stops)
+        print(f"\nSynthetic GTFS feed: {args.stops} stops, {rows} stop_times")
+        overrides = {'GTFS_FEED_PATH': feed_dir}
+        bench_imports(dict(os.environ, **overrides), args.runs, 'with feed')
+        if not proc:
+            print("\n/proc/<pid>/smaps_rollup is not available; skipping memory measurements")
+            return
+        bench_shared_heap(feed_dir)
+        bench_servers(args.modes.split(','), args.workers, overrides)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Build time and resolve latency (mean, p50, p99) of the fuzzy stop resolver
+
+Usage: python benchmarks/bench_stop_resolver.py [stops]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'bench')
+os.environ.setdefault('FAST2SMS_API_KEY', 'bench')
+
+from benchmarks.loadgen import percentile
+from benchmarks.synthetic_gtfs import stop_names
+from utils.startup import freeze_shared_heap
+from utils.stop_resolver import StopResolver
+
+
+def typo(name, rng):
+    """Introduce one random deletion, substitution or abbreviation"""
+    name = name.replace('Road', 'Rd').replace('Station', 'Stn') if rng.random() < 0.3 else name
+    i = rng.randrange(len(name))
+    if rng.random() < 0.5:
+        return name[:i] + name[i + 1:]
+    return name[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + name[i + 1:]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+    names = stop_names(count)
+
+    start = time.perf_counter()
+    resolver = StopResolver((f'S{i}', name) for i, name in enumerate(names))
+    print(f"Built index over {len(resolver)} stops in {time.perf_counter() - start:.2f} s")
+    # As the gunicorn master does before forking, so collections skip the index
+    freeze_shared_heap()
+
+    rng = random.Random(3)
+    sample = [rng.choice(names) for _ in range(5000)]
+    for label, queries in (
+        ('exact (case/punctuation)', [name.upper() for name in sample]),
+        ('one typo / abbreviation', [typo(name, rng) for name in sample])
+    ):
+        results = []
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            results.append(resolver.resolve(query))
+            latencies.append((time.perf_counter() - start) * 1e6)
+        latencies.sort()
+        correct = sum(1 for result, name in zip(results, sample) if result and result.stop_name == name)
+        print(f"{label:<26} {sum(latencies) / len(latencies):8.1f} us/query  p50 {percentile(latencies, 0.5):7.1f} us  "
+              f"p99 {percentile(latencies, 0.99):7.1f} us  {correct / len(queries):6.1%} resolved to the intended stop")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Throughput and latency of each gunicorn worker profile against stub upstreams
+
+Starts the service with gunicorn.conf.py for every WORKER_PROFILE, sized
+automatically from the core count and the stub's upstream latency (or with
+explicit --workers/--threads), and replays the same synthetic message mix.
+
+Usage: python benchmarks/bench_worker_profiles.py [--profiles sync,gthread,gevent,asgi]
+    [--requests 2000] [--concurrency 200] [--maps-latency 80] [--sms-latency 150]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.harness import running_server, server_env
+from benchmarks.loadgen import format_result, run_load
+from benchmarks.sms_mix import synthetic_messages, webhook_payloads
+from benchmarks.stub_upstreams import StubUpstreamServer
+from utils.worker_profiles import available_cpus, resolve_profile, tune_profile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--profiles', default='sync,gthread,gevent,asgi')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200, help='concurrent clients')
+    parser.add_argument('--maps-latency', type=float, default=80)
+    parser.add_argument('--sms-latency', type=float, default=150)
+    parser.add_argument('--jitter', type=float, default=20)
+    parser.add_argument('--request-cpu-ms', type=float, default=3)
+    parser.add_argument('--workers', type=int, default=0, help='worker processes (0: auto)')
+    parser.add_argument('--threads', type=int, default=0, help='threads/greenlets per worker (0: auto)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    payloads = webhook_payloads(synthetic_messages(args.requests), args.requests)
+    latency = args.maps_latency + args.sms_latency + 2 * args.jitter
+    stub = StubUpstreamServer(
+        jitter_ms=args.jitter,
+        upstreams={'maps': {'latency_ms': args.maps_latency}, 'sms': {'latency_ms': args.sms_latency}}
+    )
+    print(f"{args.requests} webhooks, {args.concurrency} clients, {available_cpus()} CPUs; "
+          f"upstream wait ~{latency:.0f} ms per request")
+    with stub:
+        for name in args.profiles.split(','):
+            profile = tune_profile(resolve_profile(name), upstream_latency_ms=latency,
+                                   request_cpu_ms=args.request_cpu_ms, workers=args.workers,
+                                   threads=args.threads)
+            env = server_env(stub, {
+                'WORKER_PROFILE': name,
+                'UPSTREAM_LATENCY_MS': str(latency),
+                'REQUEST_CPU_MS': str(args.request_cpu_ms),
+                'WEB_CONCURRENCY': str(args.workers),
+                'WORKER_THREADS': str(args.threads)
+            })
+            with running_server('profile', env) as base_url:
+                result = run_load(f'{base_url}/webhook', payloads, concurrency=args.concurrency, timeout=120)
+            label = f"{profile['profile']} {profile['workers']}x{profile['concurrency']}"
+            print(format_result(label, result))
+
+
+if __name__ == '__main__':
+    main()
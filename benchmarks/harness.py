@@ -0,0 +1,119 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from contextlib import contextmanager
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Server command lines; {port} and {workers} are filled in per run
+MODES = {
+    'sync': [
+        sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', '127.0.0.1:{port}',
+        '--workers', '{workers}', '--worker-class', 'sync', '--threads', '1', 'app:create_app()'
+    ],
+    'gthread': [
+        sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', '127.0.0.1:{port}',
+        '--workers', '{workers}', '--worker-class', 'gthread', '--threads', '8', 'app:create_app()'
+    ],
+    # Worker class, workers and threads from gunicorn.conf.py's profile
+    # (WORKER_PROFILE and the sizing variables in the server environment)
+    'profile': [
+        sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', '127.0.0.1:{port}'
+    ],
+    'asgi': [
+        sys.executable, '-m', 'uvicorn', '--factory', 'asgi_app:create_asgi_app',
+        '--host', '127.0.0.1', '--port', '{port}', '--workers', '{workers}', '--log-level', 'warning'
+    ]
+}
+
+
+def free_port():
+    """Return a TCP port that is free on the loopback interface"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_healthy(base_url, timeout=20, interval=0.2):
+    """Poll /health every interval seconds until the server answers 200"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f'{base_url}/health', timeout=1) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(interval)
+    raise RuntimeError(f"Server at {base_url} did not become healthy")
+
+
+def server_env(stub, overrides=None):
+    """
+    Build the environment of a server process that talks to the stub upstreams
+
+    Args:
+        stub (StubUpstreamServer): The running stub
+        overrides (dict): Extra configuration variables, e.g. {'ETA_CACHE_BACKEND': 'memory'}
+
+    Returns:
+        dict: Environment variables
+    """
+    env = dict(os.environ)
+    env.update({
+        'GOOGLE_MAPS_API_KEY': 'bench',
+        'FAST2SMS_API_KEY': 'bench',
+        'GOOGLE_MAPS_BASE_URL': stub.maps_url,
+        'FAST2SMS_BASE_URL': stub.sms_url,
+        # Measure the request path itself, not cache hits
+        'ETA_CACHE_BACKEND': 'none',
+        'HTTP_POOL_SIZE': '100'
+    })
+    env.update(overrides or {})
+    return env
+
+
+@contextmanager
+def server_process(mode, env, workers=4):
+    """
+    Start a server in one of MODES and yield it once it is healthy
+
+    Args:
+        mode (str): Key of MODES, or a full command line list
+        env (dict): Environment of the server process
+        workers (int): Worker processes
+
+    Yields:
+        tuple: (subprocess.Popen, base URL, seconds from launch to the
+            first healthy /health response)
+    """
+    port = free_port()
+    command = MODES[mode] if isinstance(mode, str) else mode
+    command = [arg.format(port=port, workers=workers) for arg in command]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base_url = f'http://127.0.0.1:{port}'
+        wait_until_healthy(base_url, interval=0.01)
+        yield process, base_url, time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait(10)
+
+
+@contextmanager
+def running_server(mode, env, workers=4):
+    """
+    Start a server in one of MODES and yield its base URL
+
+    Args:
+        mode (str): Key of MODES, or a full command line list
+        env (dict): Environment of the server process
+        workers (int): Worker processes
+    """
+    with server_process(mode, env, workers) as (process, base_url, boot_seconds):
+        yield base_url
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(sorted_values, fraction):
+    """Return the value at the given fraction of a sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class _Connection:
+    """Minimal HTTP/1.1 keep-alive client connection for load generation"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.reused = False
+
+    async def post_json(self, path, payload):
+        body = json.dumps(payload).encode()
+        request = (
+            f'POST {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n'
+            f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body
+        )
+        status_line = await self._send(request)
+        if not status_line and self.reused:
+            # An idle keep-alive connection closed by the server (e.g. a
+            # recycled worker): reconnect and resend once, as HTTP clients do
+            self.close()
+            status_line = await self._send(request)
+        if not status_line:
+            raise ConnectionError('Connection closed by server')
+        status = int(status_line.split()[1])
+        length, close = 0, False
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            name = name.strip().lower()
+            if name == 'content-length':
+                length = int(value.strip())
+            elif name == 'connection' and value.strip().lower() == 'close':
+                close = True
+        await self.reader.readexactly(length)
+        if close:
+            self.close()
+        return status
+
+    async def _send(self, request):
+        """Write a request, opening the connection if needed, and read the status line"""
+        self.reused = self.writer is not None
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            self.writer.write(request)
+            await self.writer.drain()
+            return await self.reader.readline()
+        except ConnectionResetError:
+            if not self.reused:
+                raise
+            return b''
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def _run(url, payloads, concurrency, timeout, rate):
+    parts = urlsplit(url)
+    latencies = []
+    statuses = {}
+    queue = asyncio.Queue()
+    for item in enumerate(payloads):
+        queue.put_nowait(item)
+    start = time.perf_counter()
+
+    async def worker():
+        connection = _Connection(parts.hostname, parts.port or 80)
+        while True:
+            try:
+                index, payload = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            sent_at = time.perf_counter()
+            if rate:
+                # Open loop: latency counts from the scheduled send time, so a
+                # slow server is not hidden by clients that fell behind
+                scheduled = start + index / rate
+                if scheduled > sent_at:
+                    await asyncio.sleep(scheduled - sent_at)
+                sent_at = scheduled
+            try:
+                status = await asyncio.wait_for(
+                    connection.post_json(parts.path or '/', payload), timeout
+                )
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                connection.close()
+                status = 'error'
+            latencies.append((time.perf_counter() - sent_at) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+        connection.close()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, statuses, time.perf_counter() - start
+
+
+def run_load(url, payloads, concurrency=50, timeout=30.0, rate=None):
+    """
+    POST every payload to url with a fixed number of concurrent keep-alive clients
+
+    Args:
+        url (str): Endpoint to load, e.g. http://127.0.0.1:5000/webhook
+        payloads (list): JSON bodies to send, in order
+        concurrency (int): Number of in-flight requests
+        timeout (float): Per-request timeout in seconds
+        rate (float): Target requests per second (open loop); None sends as
+            fast as the clients get responses (closed loop)
+
+    Returns:
+        dict: Request count, throughput, latency percentiles and status counts
+    """
+    latencies, statuses, elapsed = asyncio.run(_run(url, payloads, concurrency, timeout, rate))
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'elapsed_s': elapsed,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'mean_ms': statistics.mean(latencies) if latencies else 0.0,
+        'statuses': statuses
+    }
+
+
+def format_result(name, result):
+    """Format a run_load result as one report line"""
+    return (
+        f"{name:<26} {result['requests']:>6} req  {result['throughput_rps']:8.1f} req/s  "
+        f"p50 {result['p50_ms']:8.1f} ms  p95 {result['p95_ms']:8.1f} ms  "
+        f"p99 {result['p99_ms']:8.1f} ms  {result['statuses']}"
+    )
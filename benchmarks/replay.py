@@ -0,0 +1,374 @@
+"""
+Replay captured webhook traffic against recorded upstream responses
+
+Reads a capture written by a server running with TRAFFIC_CAPTURE_PATH set,
+answers every Google Maps and Fast2SMS call from the recorded responses
+(after their recorded latency), and sends the captured webhooks again at
+their original pace, or N times faster, to an in-process Flask test client
+or to a server started in one of the benchmark modes. Reports end-to-end
+latency, per-stage latency (from the server's /metrics), responses whose
+status differs from the recorded one and, given the report of another
+build, the latency regressions between the two builds.
+
+Examples:
+    python benchmarks/replay.py capture.jsonl --speed 4 --output main.json
+    git checkout my-branch
+    python benchmarks/replay.py capture.jsonl --speed 4 --baseline main.json
+    python benchmarks/replay.py capture.jsonl --target gthread --config ETA_CACHE_BACKEND=log
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'replay')
+os.environ.setdefault('FAST2SMS_API_KEY', 'replay')
+
+from benchmarks.harness import MODES, running_server, server_env
+from benchmarks.loadgen import percentile
+from benchmarks.stub_upstreams import StubUpstreamServer
+from utils.traffic_capture import UpstreamPlayback, encode_body, load_capture
+
+CONTENT_TYPES = {'json': 'application/json', 'ndjson': 'application/x-ndjson', 'text': 'text/plain'}
+STAGE_METRIC = 'sms_pipeline_stage_seconds'
+WEBHOOK_METRIC = 'sms_webhook_request_seconds'
+
+
+class ReplayUpstreamServer(StubUpstreamServer):
+    """Stub upstreams answering with the responses of a capture"""
+
+    def __init__(self, playback, recorded_latency=True, **options):
+        """
+        Args:
+            playback (UpstreamPlayback): Recorded responses
+            recorded_latency (bool): Delay each response by its recorded latency
+        """
+        super().__init__(**options)
+        self.playback = playback
+        self.recorded_latency = recorded_latency
+
+    def respond(self, method, path, body):
+        if method == 'GET':
+            upstream, params, json_body = 'maps', dict(parse_qsl(urlsplit(path).query)), None
+        else:
+            upstream, params, json_body = 'sms', None, json.loads(body or b'{}')
+        recorded = self.playback.lookup(upstream, params, json_body)
+        if recorded is None:
+            # Nothing was captured for this upstream: answer like the plain stub
+            return super().respond(method, path, body)
+        self.config.calls[upstream] += 1
+        status, text, ms = recorded
+        delay = ms / 1000 if self.recorded_latency else 0
+        return f'{status} {HTTPStatus(status).phrase}', text.encode(), delay
+
+
+class TestClientTarget:
+    """The app built by create_app(), driven through Flask test clients"""
+
+    def __init__(self, stub, overrides):
+        from config import Config
+
+        settings = {'GOOGLE_MAPS_BASE_URL': stub.maps_url, 'FAST2SMS_BASE_URL': stub.sms_url,
+                    'HTTP_POOL_SIZE': 100, 'TRAFFIC_CAPTURE_PATH': ''}
+        settings.update(overrides)
+        for name, value in settings.items():
+            current = getattr(Config, name, '')
+            if isinstance(current, bool):
+                value = str(value).lower() == 'true'
+            elif isinstance(current, (int, float)) and not isinstance(value, (int, float)):
+                value = type(current)(value)
+            setattr(Config, name, value)
+
+        import app as app_module
+
+        self.app = app_module.create_app()
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        return client
+
+    def post(self, path, body, content_type):
+        response = self._client().post(path, data=body, content_type=content_type)
+        return response.status_code, response.get_data()
+
+    def metrics(self):
+        return self._client().get('/metrics').get_data(as_text=True)
+
+
+class ServerTarget:
+    """A running server, driven over keep-alive HTTP connections"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self._local = threading.local()
+
+    def post(self, path, body, content_type):
+        for attempt in (1, 2):
+            connection = getattr(self._local, 'connection', None)
+            if connection is None:
+                connection = self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=120)
+            try:
+                connection.request('POST', path, body=body, headers={'Content-Type': content_type})
+                response = connection.getresponse()
+                return response.status, response.read()
+            except (ConnectionError, http.client.HTTPException):
+                # An idle connection closed by a recycled worker: reconnect once
+                connection.close()
+                self._local.connection = None
+                if attempt == 2:
+                    raise
+
+    def metrics(self):
+        with urllib.request.urlopen(f'{self.base_url}/metrics', timeout=10) as response:
+            return response.read().decode()
+
+
+def parse_metrics(text):
+    """Parse Prometheus text into {(sample name, labels): value}"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name_and_labels, _, value = line.rpartition(' ')
+        name, _, labels = name_and_labels.partition('{')
+        samples[(name, labels.rstrip('}'))] = float(value)
+    return samples
+
+
+def histogram_summary(before, after, metric, label=''):
+    """
+    Summarize the observations a histogram received between two scrapes
+
+    Returns:
+        dict: Observation count, mean and p95 (upper bound of the bucket
+            holding the 95th percentile) in milliseconds
+    """
+    def delta(name, labels):
+        return after.get((name, labels), 0.0) - before.get((name, labels), 0.0)
+
+    count = delta(f'{metric}_count', label)
+    if not count:
+        return {'count': 0, 'mean_ms': 0.0, 'p95_ms': 0.0}
+    buckets = []
+    for name, labels in after:
+        if name == f'{metric}_bucket' and (not label or labels.startswith(label + ',')):
+            bound = labels.rsplit('le="', 1)[1].rstrip('"')
+            buckets.append((float(bound), delta(name, labels)))
+    p95 = next((bound for bound, cumulative in sorted(buckets) if cumulative >= 0.95 * count), float('inf'))
+    return {
+        'count': int(count),
+        'mean_ms': delta(f'{metric}_sum', label) / count * 1000,
+        'p95_ms': p95 * 1000
+    }
+
+
+def latency_summary(latencies):
+    """Return p50/p95/p99/mean of a list of milliseconds"""
+    latencies = sorted(latencies)
+    return {
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'mean_ms': statistics.mean(latencies) if latencies else 0.0
+    }
+
+
+def replay(target, webhooks, speed, concurrency):
+    """
+    Send the captured webhooks at their recorded offsets divided by speed
+
+    Args:
+        target: TestClientTarget or ServerTarget
+        webhooks (list): 'webhook' records in time order
+        speed (float): Replay speed factor (0 sends as fast as possible)
+        concurrency (int): Maximum requests in flight
+
+    Returns:
+        tuple: (latencies in ms from each scheduled send time, replayed statuses)
+    """
+    latencies = [0.0] * len(webhooks)
+    statuses = [None] * len(webhooks)
+    first = webhooks[0]['t'] if webhooks else 0.0
+
+    def send(index, record, scheduled):
+        body = encode_body(record.get('body_format', 'json'), record['body'])
+        try:
+            statuses[index], _ = target.post(record['path'], body, CONTENT_TYPES[record.get('body_format', 'json')])
+        except OSError:
+            statuses[index] = 'error'
+        latencies[index] = (time.perf_counter() - scheduled) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index, record in enumerate(webhooks):
+            # Open loop: latency counts from the scheduled send time, so a
+            # slow build is not hidden by requests that were sent late
+            scheduled = start + ((record['t'] - first) / speed if speed else 0.0)
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, index, record, scheduled)
+    return latencies, statuses
+
+
+def run_replay(args):
+    """Replay a capture on the chosen target and return the report"""
+    webhooks, upstreams = load_capture(args.capture)
+    if args.limit:
+        webhooks = webhooks[:args.limit]
+    if not webhooks:
+        raise SystemExit(f"No webhook records in {args.capture}")
+    playback = UpstreamPlayback(upstreams)
+    overrides = dict(args.config or [])
+
+    with ReplayUpstreamServer(playback, recorded_latency=not args.no_upstream_latency) as stub:
+        with target_for(args.target, stub, overrides, args.workers) as target:
+            before = parse_metrics(target.metrics())
+            latencies, statuses = replay(target, webhooks, args.speed, args.concurrency)
+            after = parse_metrics(target.metrics())
+
+    stages = {
+        stage: histogram_summary(before, after, STAGE_METRIC, f'stage="{stage}"')
+        for stage in ('parse', 'eta', 'format', 'send')
+    }
+    stages['webhook'] = histogram_summary(before, after, WEBHOOK_METRIC)
+    mismatches = [
+        {'t': record['t'], 'path': record['path'], 'recorded': record['status'], 'replayed': status}
+        for record, status in zip(webhooks, statuses) if status != record['status']
+    ]
+    return {
+        'capture': args.capture,
+        'target': args.target,
+        'speed': args.speed,
+        'webhooks': len(webhooks),
+        'recorded': latency_summary([record['ms'] for record in webhooks]),
+        'replayed': latency_summary(latencies),
+        'stages': stages,
+        'upstream': dict(playback.counters, calls=dict(stub.config.calls)),
+        'status_mismatches': len(mismatches),
+        'mismatch_examples': mismatches[:10]
+    }
+
+
+@contextmanager
+def target_for(name, stub, overrides, workers):
+    """Yield the target: 'testclient', a benchmark server mode, or the URL of a running server"""
+    if name == 'testclient':
+        yield TestClientTarget(stub, overrides)
+    elif name.startswith('http'):
+        print(f"Point the server at GOOGLE_MAPS_BASE_URL={stub.maps_url} FAST2SMS_BASE_URL={stub.sms_url}")
+        input("Press Enter once it is running... ")
+        yield ServerTarget(name.rstrip('/'))
+    else:
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            # Caching and capture as configured, metrics summed over workers
+            env = server_env(stub, dict({'ETA_CACHE_BACKEND': 'memory', 'TRAFFIC_CAPTURE_PATH': '',
+                                         'METRICS_MULTIPROC_DIR': metrics_dir}, **overrides))
+            with running_server(name, env, workers=workers) as base_url:
+                yield ServerTarget(base_url)
+
+
+def compare(report, baseline, threshold, min_ms):
+    """
+    Compare the latencies of two replay reports
+
+    Args:
+        report (dict): Report of this build
+        baseline (dict): Report of the build compared against
+        threshold (float): Relative slowdown counted as a regression
+        min_ms (float): Absolute slowdown below which changes are noise
+
+    Returns:
+        list: (metric, baseline ms, this build's ms, change, regressed) rows
+    """
+    rows = []
+    pairs = [(f'end-to-end {name}', baseline['replayed'].get(name), report['replayed'].get(name))
+             for name in ('p50_ms', 'p95_ms', 'p99_ms', 'mean_ms')]
+    for stage, summary in report['stages'].items():
+        for name in ('mean_ms', 'p95_ms'):
+            pairs.append((f'{stage} {name}', baseline['stages'].get(stage, {}).get(name), summary[name]))
+    for metric, old, new in pairs:
+        if old is None or new is None or old == float('inf') or new == float('inf'):
+            continue
+        change = (new - old) / old if old else 0.0
+        rows.append((metric, old, new, change, change > threshold and new - old > min_ms))
+    return rows
+
+
+def print_report(report):
+    recorded, replayed = report['recorded'], report['replayed']
+    pace = f"{report['speed']}x" if report['speed'] else 'full speed'
+    print(f"{report['webhooks']} webhooks from {report['capture']} on {report['target']} at {pace}")
+    print(f"  {'':10s} {'p50':>9s} {'p95':>9s} {'p99':>9s} {'mean':>9s}")
+    for name, summary in (('recorded', recorded), ('replayed', replayed)):
+        print(f"  {name:10s} " + ' '.join(f"{summary[key]:7.1f}ms" for key in ('p50_ms', 'p95_ms', 'p99_ms', 'mean_ms')))
+    for stage, summary in report['stages'].items():
+        print(f"  stage {stage:8s} n={summary['count']:<6d} mean {summary['mean_ms']:8.2f} ms  p95 <= {summary['p95_ms']:.0f} ms")
+    upstream = report['upstream']
+    print(f"  upstream responses: {upstream['matched']} matched, {upstream['fallback']} from other requests, "
+          f"{upstream['unmatched']} synthetic; calls {upstream['calls']}")
+    print(f"  responses with a different status than recorded: {report['status_mismatches']}")
+
+
+def parse_assignment(text):
+    key, _, value = text.partition('=')
+    return key.strip(), value.strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', help='JSON lines file written with TRAFFIC_CAPTURE_PATH')
+    parser.add_argument('--target', default='testclient',
+                        help=f"testclient, a server mode ({', '.join(MODES)}) or the URL of a running server")
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed factor (0: as fast as possible)')
+    parser.add_argument('--concurrency', type=int, default=64, help='maximum requests in flight')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes of a started server')
+    parser.add_argument('--limit', type=int, help='replay only the first N webhooks')
+    parser.add_argument('--config', action='append', type=parse_assignment, metavar='KEY=VALUE',
+                        help='configuration override; repeat for several')
+    parser.add_argument('--no-upstream-latency', action='store_true', help='answer upstream calls immediately')
+    parser.add_argument('--output', help='write the report to this JSON file')
+    parser.add_argument('--baseline', help='report of another build to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative slowdown flagged as a regression')
+    parser.add_argument('--min-ms', type=float, default=1.0, help='ignore slowdowns smaller than this')
+    args = parser.parse_args()
+
+    report = run_replay(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(report, baseline, args.threshold, args.min_ms)
+        settings = ('capture', 'target', 'speed', 'webhooks')
+        if any(baseline.get(name) != report[name] for name in settings):
+            print("Warning: the baseline was replayed with different settings: "
+                  + ', '.join(f"{name} {baseline.get(name)}" for name in settings))
+        print(f"Compared with {args.baseline} (regression: > {args.threshold:.0%} and > {args.min_ms} ms slower)")
+        for metric, old, new, change, regressed in rows:
+            print(f"  {metric:22s} {old:9.2f} -> {new:9.2f} ms  {change:+7.1%}{'  REGRESSION' if regressed else ''}")
+        if any(row[4] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
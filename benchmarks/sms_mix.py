@@ -0,0 +1,119 @@
+import json
+import random
+from benchmarks.synthetic_gtfs import stop_names
+
+ROUTES = ('23', '45', '12', '7', '5')
+
+# Share of each kind of message in the synthetic mix
+MIX = (
+    ('plain', 0.70),          # "MG Road 23"
+    ('keyword', 0.08),        # "MG Road route 23", "MG Road bus #23"
+    ('typo', 0.08),           # "MG Raod 23"
+    ('unknown_route', 0.05),  # a route that is not in the catalog
+    ('no_route', 0.06),       # "MG Road", rejected by the parser
+    ('noise', 0.03)           # "hi", "?", "STOP"
+)
+
+
+def _typo(text, rng):
+    """Swap two adjacent letters of text"""
+    if len(text) < 4:
+        return text
+    i = rng.randrange(1, len(text) - 2)
+    return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+
+
+def synthetic_messages(count, stops=500, senders=5000, seed=11):
+    """
+    Generate a realistic mix of inbound SMS
+
+    Stop popularity is skewed (a few busy stops and a long tail of others),
+    and the mix includes typos, keyword forms and malformed messages in
+    the proportions of MIX.
+
+    Args:
+        count (int): Number of messages
+        stops (int): Distinct stop names
+        senders (int): Distinct sender numbers
+        seed (int): Random seed, so runs are reproducible
+
+    Returns:
+        list: (sender, message text) pairs
+    """
+    rng = random.Random(seed)
+    names = stop_names(stops, seed=seed)
+    kinds = [kind for kind, share in MIX]
+    shares = [share for kind, share in MIX]
+
+    def skewed(items):
+        return items[min(int(rng.paretovariate(1.1)) - 1, len(items) - 1)] if rng.random() < 0.6 \
+            else rng.choice(items)
+
+    phones = [f'9{i:09d}' for i in range(senders)]
+    messages = []
+    for _ in range(count):
+        kind = rng.choices(kinds, shares)[0]
+        stop, route = skewed(names), rng.choice(ROUTES)
+        if kind == 'plain':
+            text = f"{stop} {route}"
+        elif kind == 'keyword':
+            text = f"{stop} {rng.choice(['route', 'bus', 'Route', 'BUS'])} {rng.choice(['', '#', 'R'])}{route}"
+        elif kind == 'typo':
+            text = f"{_typo(stop, rng)} {route}"
+        elif kind == 'unknown_route':
+            text = f"{stop} {rng.randint(100, 999)}"
+        elif kind == 'no_route':
+            text = stop
+        else:
+            text = rng.choice(['hi', '?', 'STOP', 'help', 'bus'])
+        messages.append((rng.choice(phones), text))
+    return messages
+
+
+def load_recorded_messages(path):
+    """
+    Load recorded inbound SMS from a JSON lines file
+
+    Each line is an object with the text under 'message', 'text' or 'body'
+    and optionally the sender under 'from' or 'sender'; other lines are
+    skipped.
+
+    Args:
+        path (str): JSON lines file
+
+    Returns:
+        list: (sender, message text) pairs
+    """
+    messages = []
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(record, dict):
+                continue
+            text = record.get('message') or record.get('text') or record.get('body')
+            if not text:
+                continue
+            sender = record.get('from') or record.get('sender') or f'9{number:09d}'
+            messages.append((str(sender), str(text)))
+    return messages
+
+
+def webhook_payloads(messages, count=None):
+    """
+    Build /webhook bodies, cycling through messages up to count
+
+    Every payload gets a distinct message_id, so replayed messages are not
+    mistaken for gateway retries by the idempotency guard.
+
+    Returns:
+        list: JSON bodies
+    """
+    count = count or len(messages)
+    return [
+        {'from': messages[i % len(messages)][0], 'message': messages[i % len(messages)][1],
+         'message_id': f'bench-{i}'}
+        for i in range(count)
+    ]
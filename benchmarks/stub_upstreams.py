@@ -0,0 +1,199 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class StubConfig:
+    """Behaviour of a stub upstream server"""
+
+    def __init__(self, latency_ms=0.0, error_rate=0.0, jitter_ms=0.0, payload_bytes=0,
+                 upstreams=None):
+        """
+        Args:
+            latency_ms (float): Delay added before every response
+            error_rate (float): Fraction of requests answered with HTTP 503
+            jitter_ms (float): Mean of an exponentially distributed extra
+                delay, for a realistic latency tail
+            payload_bytes (int): Approximate size of Directions responses
+                (real ones with turn-by-turn steps run to tens of kilobytes)
+            upstreams (dict): Per-upstream overrides, e.g.
+                {'sms': {'latency_ms': 300, 'error_rate': 0.05}}
+        """
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.jitter_ms = jitter_ms
+        self.payload_bytes = payload_bytes
+        self.upstreams = upstreams or {}
+        self.calls = {'maps': 0, 'sms': 0}
+        self.errors = {'maps': 0, 'sms': 0}
+
+    def get(self, upstream, name):
+        """Return a setting for one upstream, falling back to the shared value"""
+        return self.upstreams.get(upstream, {}).get(name, getattr(self, name))
+
+    def delay(self, upstream):
+        """Return the response delay in seconds for one call"""
+        delay = self.get(upstream, 'latency_ms')
+        jitter = self.get(upstream, 'jitter_ms')
+        if jitter:
+            delay += random.expovariate(1 / jitter)
+        return delay / 1000
+
+    def reset(self):
+        """Zero the call and error counters"""
+        self.calls = {'maps': 0, 'sms': 0}
+        self.errors = {'maps': 0, 'sms': 0}
+
+
+def directions_payload(duration_seconds=720, payload_bytes=0):
+    """Build a Directions API response body, padded with steps to about payload_bytes"""
+    leg = {
+        'duration': {'value': duration_seconds, 'text': f'{duration_seconds // 60} mins'},
+        'departure_time': {'text': '2:30 PM'}
+    }
+    step = {
+        'html_instructions': 'Walk to <b>Bus Stop</b> and take the bus towards <b>Downtown</b>',
+        'distance': {'text': '0.4 km', 'value': 400},
+        'duration': {'text': '5 mins', 'value': 300},
+        'polyline': {'points': 'a~l~Fjk~uOwHJy@P' * 8}
+    }
+    step_size = len(json.dumps(step))
+    if payload_bytes > step_size:
+        leg['steps'] = [step] * (payload_bytes // step_size)
+    return {'status': 'OK', 'routes': [{'legs': [leg]}]}
+
+
+def sms_payload(numbers):
+    """Build a Fast2SMS bulkV2 success response body"""
+    return {
+        'return': True,
+        'request_id': f'stub-{time.time_ns()}',
+        'message': [f'SMS sent to {len(numbers)} numbers']
+    }
+
+
+class StubUpstreamServer:
+    """
+    Local HTTP/1.1 keep-alive server that stands in for Google Maps and Fast2SMS
+
+    GET .../directions/json answers like the Directions API and POST requests
+    answer like Fast2SMS bulkV2. It runs on its own asyncio loop in a
+    background thread, so thousands of concurrent connections cost no threads.
+    """
+
+    def __init__(self, latency_ms=0.0, error_rate=0.0, host='127.0.0.1', port=0, **options):
+        self.config = StubConfig(latency_ms=latency_ms, error_rate=error_rate, **options)
+        self.host = host
+        self.port = port
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    @property
+    def base_url(self):
+        return f'http://{self.host}:{self.port}'
+
+    @property
+    def maps_url(self):
+        return f'{self.base_url}/maps/api/directions/json'
+
+    @property
+    def sms_url(self):
+        return f'{self.base_url}/dev/bulkV2'
+
+    def route(self, method, path, body):
+        """Return (upstream name, response body) for a request"""
+        if method == 'GET':
+            if urlsplit(path).path.endswith('/directions/json'):
+                return 'maps', self._directions
+            return 'maps', {'status': 'NOT_FOUND'}
+        payload = json.loads(body or b'{}')
+        return 'sms', sms_payload(str(payload.get('numbers', '')).split(','))
+
+    def respond(self, method, path, body):
+        """Return (status line, response body, delay in seconds) for a request and count it"""
+        upstream, payload = self.route(method, path, body)
+        self.config.calls[upstream] += 1
+        status = '200 OK'
+        error_rate = self.config.get(upstream, 'error_rate')
+        if error_rate and random.random() < error_rate:
+            self.config.errors[upstream] += 1
+            status, payload = '503 Service Unavailable', {'error': 'stub failure'}
+        return status, payload, self.config.delay(upstream)
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value.strip())
+                body = await reader.readexactly(length) if length else b''
+
+                status, payload, delay = self.respond(method, path, body)
+                if delay:
+                    await asyncio.sleep(delay)
+
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                writer.write(
+                    f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                    f'Content-Length: {len(data)}\r\n\r\n'.encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _serve(self):
+        # Encoded once: large payloads would otherwise dominate the stub's CPU time
+        self._directions = json.dumps(directions_payload(payload_bytes=self.config.payload_bytes)).encode()
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port, backlog=4096)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+        self._server.close()
+        self._loop.run_until_complete(self._server.wait_closed())
+        self._loop.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, name='stub-upstreams', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    server = StubUpstreamServer(port=8900).start()
+    print(f"Stub upstreams listening on {server.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
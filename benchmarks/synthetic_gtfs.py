@@ -0,0 +1,77 @@
+import csv
+import os
+import random
+
+_PREFIXES = [
+    'MG', 'Brigade', 'Church', 'Residency', 'Richmond', 'Lalbagh', 'Hosur', 'Bannerghatta',
+    'Old Airport', 'Outer Ring', 'Kanakapura', 'Mysore', 'Tumkur', 'Bellary', 'Sarjapur',
+    'Whitefield', 'Koramangala', 'Indiranagar', 'Jayanagar', 'Malleshwaram', 'Rajajinagar',
+    'Hebbal', 'Yelahanka', 'Banashankari', 'Basavanagudi', 'Shivajinagar', 'Majestic', 'Central'
+]
+_SUFFIXES = [
+    'Road', 'Main Road', 'Cross', 'Circle', 'Bus Stand', 'Depot', 'Junction', 'Market',
+    'Station', 'Gate', 'Layout', 'Extension', 'Park', 'Temple', 'Hospital', 'College'
+]
+
+
+def stop_names(count, seed=7):
+    """Generate count distinct, realistic-looking stop names"""
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        name = f"{rng.choice(_PREFIXES)} {rng.choice(_SUFFIXES)}"
+        if name in names:
+            name = f"{name} {rng.randint(1, 40)}th Block"
+        if name in names:
+            name = f"{name} Stage {rng.randint(1, 10 ** 6)}"
+        names.add(name)
+    return sorted(names)
+
+
+def write_synthetic_feed(feed_dir, stops=5000, routes=300, trips_per_route=120,
+                         stops_per_trip=30, seed=7):
+    """
+    Write a synthetic GTFS feed
+
+    Each route visits a random sequence of stops; trips run at a fixed headway
+    between 05:00 and 23:00 with two minutes between consecutive stops.
+
+    Returns:
+        int: Number of stop_times rows written
+    """
+    rng = random.Random(seed)
+    os.makedirs(feed_dir, exist_ok=True)
+    names = stop_names(stops, seed)
+
+    with open(os.path.join(feed_dir, 'stops.txt'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['stop_id', 'stop_name', 'stop_lat', 'stop_lon'])
+        for i, name in enumerate(names):
+            writer.writerow([f'S{i}', name, 12.9 + rng.random() / 10, 77.5 + rng.random() / 10])
+
+    with open(os.path.join(feed_dir, 'routes.txt'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['route_id', 'route_short_name', 'route_long_name', 'route_type'])
+        for r in range(routes):
+            writer.writerow([f'R{r}', str(r + 1), f'{rng.choice(names)} - {rng.choice(names)}', 3])
+
+    rows = 0
+    headway = (23 - 5) * 3600 // trips_per_route
+    with open(os.path.join(feed_dir, 'trips.txt'), 'w', newline='') as trips_file, \
+            open(os.path.join(feed_dir, 'stop_times.txt'), 'w', newline='') as times_file:
+        trips = csv.writer(trips_file)
+        times = csv.writer(times_file)
+        trips.writerow(['route_id', 'service_id', 'trip_id'])
+        times.writerow(['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'])
+        for r in range(routes):
+            path = rng.sample(range(len(names)), stops_per_trip)
+            for t in range(trips_per_route):
+                trip_id = f'T{r}_{t}'
+                trips.writerow([f'R{r}', 'WEEKDAY', trip_id])
+                start = 5 * 3600 + t * headway
+                for sequence, stop in enumerate(path):
+                    seconds = start + sequence * 120
+                    clock = f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+                    times.writerow([trip_id, clock, clock, f'S{stop}', sequence + 1])
+                    rows += 1
+    return rows
@@ -9,14 +9,183 @@ class Config:
     
     # Google Maps API configuration
     GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
+    GOOGLE_MAPS_BASE_URL = os.getenv(
+        'GOOGLE_MAPS_BASE_URL', 'https://maps.googleapis.com/maps/api/directions/json'
+    )
     
     # Fast2SMS API configuration
     FAST2SMS_API_KEY = os.getenv('FAST2SMS_API_KEY')
-    FAST2SMS_BASE_URL = 'https://www.fast2sms.com/dev/bulkV2'
+    FAST2SMS_BASE_URL = os.getenv('FAST2SMS_BASE_URL', 'https://www.fast2sms.com/dev/bulkV2')
     
     # Flask configuration
     SECRET_KEY = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key')
     
+    # Gunicorn deployment profile: 'sync', 'gthread' (threads), 'gevent'
+    # (green threads) or 'asgi' (uvicorn workers running asgi_app)
+    WORKER_PROFILE = os.getenv('WORKER_PROFILE', 'gthread')
+    # Worker processes and threads/greenlets per worker; 0 derives them from
+    # the core count, upstream latency and CPU time per request
+    WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 0))
+    WORKER_THREADS = int(os.getenv('WORKER_THREADS', 0))
+    # Measured per-request upstream wait (Maps + SMS) and CPU time, e.g. from
+    # the stage histograms on /metrics
+    UPSTREAM_LATENCY_MS = float(os.getenv('UPSTREAM_LATENCY_MS', 300))
+    REQUEST_CPU_MS = float(os.getenv('REQUEST_CPU_MS', 3))
+    
+    # Upstream HTTP connection pool configuration
+    HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+    HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3))
+    HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 10))
+    HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 2))
+    HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', 0.3))
+    # Per-upstream circuit breakers: the circuit opens when BREAKER_FAILURE_RATE
+    # of the last BREAKER_WINDOW_SIZE calls failed (errors, 5xx, or slower than
+    # BREAKER_SLOW_CALL_SECONDS), and calls fail fast for BREAKER_OPEN_SECONDS
+    BREAKER_WINDOW_SIZE = int(os.getenv('BREAKER_WINDOW_SIZE', 50))
+    BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', 10))
+    BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', 0.5))
+    BREAKER_SLOW_CALL_SECONDS = float(os.getenv('BREAKER_SLOW_CALL_SECONDS', 5))
+    BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', 30))
+    BREAKER_HALF_OPEN_CALLS = int(os.getenv('BREAKER_HALF_OPEN_CALLS', 3))
+    # Adaptive read timeout: BREAKER_TIMEOUT_MULTIPLIER x observed p99 latency,
+    # between BREAKER_MIN_TIMEOUT and HTTP_READ_TIMEOUT
+    BREAKER_MIN_TIMEOUT = float(os.getenv('BREAKER_MIN_TIMEOUT', 1))
+    BREAKER_TIMEOUT_MULTIPLIER = float(os.getenv('BREAKER_TIMEOUT_MULTIPLIER', 3))
+    # Upper bound on concurrent upstream connections in the ASGI service mode
+    ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv('ASYNC_HTTP_MAX_CONNECTIONS', 1000))
+    
+    # ETA cache configuration
+    # Backends: 'memory' (per worker), 'sqlite' (shared by all workers), 'log'
+    # (memory-mapped log shared by all workers, kept across restarts), 'none'
+    ETA_CACHE_BACKEND = os.getenv('ETA_CACHE_BACKEND', 'memory')
+    ETA_CACHE_TTL = int(os.getenv('ETA_CACHE_TTL', 60))
+    # Seconds an expired ETA may still be served while it is refreshed (0 disables)
+    ETA_CACHE_STALE_TTL = int(os.getenv('ETA_CACHE_STALE_TTL', 0))
+    # Seconds an expired ETA is kept to answer queries while Google Maps is down
+    ETA_CACHE_FALLBACK_TTL = int(os.getenv('ETA_CACHE_FALLBACK_TTL', 900))
+    ETA_CACHE_MAX_ENTRIES = int(os.getenv('ETA_CACHE_MAX_ENTRIES', 2048))
+    ETA_CACHE_PATH = os.getenv('ETA_CACHE_PATH', '/tmp/bus_eta_cache.sqlite3')
+    # Background refresh of the most queried (stop, route) pairs of the current
+    # time-of-day bucket, ETA_PREFETCH_LEAD seconds before their entries expire,
+    # within ETA_PREFETCH_BUDGET_PER_MINUTE Directions API calls for the whole
+    # service (a token bucket in the SQLite file ETA_PREFETCH_BUDGET_PATH shared
+    # by all workers; empty gives every worker its own budget)
+    ETA_PREFETCH = os.getenv('ETA_PREFETCH', 'false').lower() == 'true'
+    ETA_PREFETCH_TOP_K = int(os.getenv('ETA_PREFETCH_TOP_K', 50))
+    ETA_PREFETCH_MIN_HITS = float(os.getenv('ETA_PREFETCH_MIN_HITS', 3))
+    ETA_PREFETCH_BUDGET_PER_MINUTE = float(os.getenv('ETA_PREFETCH_BUDGET_PER_MINUTE', 60))
+    ETA_PREFETCH_BUDGET_PATH = os.getenv('ETA_PREFETCH_BUDGET_PATH', '/tmp/bus_eta_prefetch_budget.sqlite3')
+    ETA_PREFETCH_LEAD = float(os.getenv('ETA_PREFETCH_LEAD', 15))
+    ETA_PREFETCH_INTERVAL = float(os.getenv('ETA_PREFETCH_INTERVAL', 5))
+    ETA_PREFETCH_BUCKET_MINUTES = int(os.getenv('ETA_PREFETCH_BUCKET_MINUTES', 30))
+    ETA_PREFETCH_SKETCH_SIZE = int(os.getenv('ETA_PREFETCH_SKETCH_SIZE', 1000))
+    ETA_PREFETCH_DAILY_DECAY = float(os.getenv('ETA_PREFETCH_DAILY_DECAY', 0.5))
+    
+    # Estimate of the bus after the next one for Directions API answers, from
+    # departures seen in past answers and the routes' headways (no extra calls)
+    HEADWAY_ESTIMATOR = os.getenv('HEADWAY_ESTIMATOR', 'true').lower() == 'true'
+    HEADWAY_MAX_PAIRS = int(os.getenv('HEADWAY_MAX_PAIRS', 10000))
+    HEADWAY_COMPILE_INTERVAL = float(os.getenv('HEADWAY_COMPILE_INTERVAL', 10))
+    
+    # Offline timetable: directory of a GTFS feed (stops.txt, routes.txt,
+    # trips.txt, stop_times.txt, optionally agency.txt for the time zone and
+    # calendar.txt/calendar_dates.txt for service days); empty disables it
+    GTFS_FEED_PATH = os.getenv('GTFS_FEED_PATH', '')
+    
+    # Stops file (GTFS stops.txt or CSV with stop_id, stop_name) used to resolve
+    # free-text locations to canonical stops; defaults to the GTFS feed's stops.txt
+    STOPS_FILE_PATH = os.getenv('STOPS_FILE_PATH', '')
+    
+    # Route catalog (CSV or JSON with route_number, destination, terminals,
+    # direction, headway_minutes); empty serves the built-in routes
+    ROUTE_CATALOG_PATH = os.getenv('ROUTE_CATALOG_PATH', '')
+    # Seconds between checks for catalog file changes (negative disables reload)
+    ROUTE_CATALOG_RELOAD_INTERVAL = float(os.getenv('ROUTE_CATALOG_RELOAD_INTERVAL', 5))
+    
+    # Per-sender rate limiting (token bucket: a burst of RATE_LIMIT_MAX_MESSAGES,
+    # earned back over RATE_LIMIT_WINDOW seconds)
+    # Backends: 'memory' (per worker), 'sqlite' (shared by all workers), 'none'
+    RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+    RATE_LIMIT_MAX_MESSAGES = int(os.getenv('RATE_LIMIT_MAX_MESSAGES', 5))
+    RATE_LIMIT_WINDOW = float(os.getenv('RATE_LIMIT_WINDOW', 60))
+    RATE_LIMIT_MAX_SENDERS = int(os.getenv('RATE_LIMIT_MAX_SENDERS', 50000))
+    RATE_LIMIT_PATH = os.getenv('RATE_LIMIT_PATH', '/tmp/bus_eta_rate_limits.sqlite3')
+    
+    # Webhook idempotency: gateway retries of the same inbound message (same
+    # gateway message ID) within IDEMPOTENCY_WINDOW seconds get the first
+    # delivery's response
+    # Backends: 'memory' (per worker), 'sqlite' (shared by all workers), 'none'
+    IDEMPOTENCY_BACKEND = os.getenv('IDEMPOTENCY_BACKEND', 'memory')
+    IDEMPOTENCY_WINDOW = float(os.getenv('IDEMPOTENCY_WINDOW', 300))
+    # Also deduplicate messages without a gateway message ID by sender, text
+    # and IDEMPOTENCY_WINDOW bucket (a commuter re-sending a query within the
+    # bucket then gets no new SMS)
+    IDEMPOTENCY_CONTENT_FALLBACK = os.getenv('IDEMPOTENCY_CONTENT_FALLBACK', 'false').lower() == 'true'
+    # Seconds after which an unfinished delivery (e.g. a crashed worker) may be retried
+    IDEMPOTENCY_PENDING_TTL = float(os.getenv('IDEMPOTENCY_PENDING_TTL', 60))
+    IDEMPOTENCY_MAX_ENTRIES = int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', 10000))
+    IDEMPOTENCY_PATH = os.getenv('IDEMPOTENCY_PATH', '/tmp/bus_eta_idempotency.sqlite3')
+    
+    # Batch webhook (/webhook/batch): most messages accepted per request, and
+    # concurrent ETA lookups and reply sends while processing one batch
+    WEBHOOK_BATCH_MAX_MESSAGES = int(os.getenv('WEBHOOK_BATCH_MAX_MESSAGES', 1000))
+    WEBHOOK_BATCH_CONCURRENCY = int(os.getenv('WEBHOOK_BATCH_CONCURRENCY', 16))
+    
+    # Logging configuration
+    # LOG_FORMAT is 'text' or 'json'; with LOG_QUEUE, records are formatted
+    # and written by a background thread instead of the request thread
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_QUEUE = os.getenv('LOG_QUEUE', 'true').lower() == 'true'
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+    # Fraction of per-message success logs that are kept
+    LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.01))
+    
+    # Metrics configuration
+    # Directory for per-worker memory-mapped metric files, so /metrics sums
+    # all gunicorn workers; empty keeps metrics in process memory
+    METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR', '')
+    
+    # Asynchronous reply configuration
+    # When enabled, /webhook returns 202 and replies are sent by background workers
+    ASYNC_REPLIES = os.getenv('ASYNC_REPLIES', 'false').lower() == 'true'
+    # Backends: 'memory' (per worker) or 'sqlite' (survives worker restarts)
+    REPLY_QUEUE_BACKEND = os.getenv('REPLY_QUEUE_BACKEND', 'memory')
+    REPLY_QUEUE_MAX_SIZE = int(os.getenv('REPLY_QUEUE_MAX_SIZE', 1000))
+    REPLY_QUEUE_PATH = os.getenv('REPLY_QUEUE_PATH', '/tmp/bus_eta_replies.sqlite3')
+    REPLY_QUEUE_VISIBILITY_TIMEOUT = int(os.getenv('REPLY_QUEUE_VISIBILITY_TIMEOUT', 60))
+    # Deliveries of a reply job before it goes to the SMS dead letters
+    REPLY_QUEUE_MAX_ATTEMPTS = int(os.getenv('REPLY_QUEUE_MAX_ATTEMPTS', 3))
+    REPLY_WORKERS = int(os.getenv('REPLY_WORKERS', 4))
+    
+    # Outbound SMS batching configuration
+    # When enabled, identical replies are merged into multi-recipient sends
+    SMS_BATCHING = os.getenv('SMS_BATCHING', 'false').lower() == 'true'
+    SMS_BATCH_WINDOW_MS = int(os.getenv('SMS_BATCH_WINDOW_MS', 200))
+    SMS_BATCH_MAX_SIZE = int(os.getenv('SMS_BATCH_MAX_SIZE', 50))
+    SMS_BATCH_MAX_LATENCY_MS = int(os.getenv('SMS_BATCH_MAX_LATENCY_MS', 1000))
+    
+    # Outbound SMS retry configuration
+    # Failed reply sends are retried by a background scheduler with jittered
+    # exponential backoff; sends that cannot succeed go to the dead-letter store
+    SMS_RETRY_ATTEMPTS = int(os.getenv('SMS_RETRY_ATTEMPTS', 3))
+    SMS_RETRY_BASE_DELAY = float(os.getenv('SMS_RETRY_BASE_DELAY', 1))
+    SMS_RETRY_MAX_DELAY = float(os.getenv('SMS_RETRY_MAX_DELAY', 30))
+    SMS_RETRY_DEADLINE = float(os.getenv('SMS_RETRY_DEADLINE', 120))
+    SMS_RETRY_MAX_PENDING = int(os.getenv('SMS_RETRY_MAX_PENDING', 10000))
+    SMS_RETRY_WORKERS = int(os.getenv('SMS_RETRY_WORKERS', 2))
+    # JSON lines file for dead letters (empty keeps them in memory only)
+    SMS_DEAD_LETTER_PATH = os.getenv('SMS_DEAD_LETTER_PATH', '')
+    SMS_DEAD_LETTER_MAX_ENTRIES = int(os.getenv('SMS_DEAD_LETTER_MAX_ENTRIES', 1000))
+    
+    # Traffic capture for replaying production load (see benchmarks/replay.py):
+    # webhooks, parse results and upstream calls are appended to this JSON
+    # lines file (empty disables), until it reaches TRAFFIC_CAPTURE_MAX_MB
+    TRAFFIC_CAPTURE_PATH = os.getenv('TRAFFIC_CAPTURE_PATH', '')
+    TRAFFIC_CAPTURE_MAX_MB = float(os.getenv('TRAFFIC_CAPTURE_MAX_MB', 100))
+    # Replace phone numbers in the capture with stable keyed pseudonyms
+    TRAFFIC_CAPTURE_PSEUDONYMIZE = os.getenv('TRAFFIC_CAPTURE_PSEUDONYMIZE', 'true').lower() == 'true'
+    
     # Validate required environment variables
     @classmethod
     def validate(cls):
@@ -38,10 +207,16 @@ class Config:
         """Check if the application is running in development mode"""
         return os.getenv('FLASK_ENV') == 'development'
     
+    @classmethod
+    def stops_file_path(cls):
+        """Get the stops file used for location resolution (empty if none)"""
+        if cls.STOPS_FILE_PATH:
+            return cls.STOPS_FILE_PATH
+        if cls.GTFS_FEED_PATH:
+            return os.path.join(cls.GTFS_FEED_PATH, 'stops.txt')
+        return ''
+    
     @classmethod
     def is_production(cls):
         """Check if the application is running in production mode"""
         return os.getenv('FLASK_ENV') == 'production'
-
-# Validate configuration on import
-Config.validate()
\ No newline at end of file
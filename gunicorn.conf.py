@@ -1,10 +1,62 @@
 # Gunicorn configuration file
+from config import Config
+from utils.worker_profiles import resolve_profile, tune_profile
+
+# Deployment profile (WORKER_PROFILE), sized for this machine and workload
+profile = tune_profile(
+    resolve_profile(Config.WORKER_PROFILE),
+    upstream_latency_ms=Config.UPSTREAM_LATENCY_MS,
+    request_cpu_ms=Config.REQUEST_CPU_MS,
+    workers=Config.WEB_CONCURRENCY,
+    threads=Config.WORKER_THREADS
+)
+
+if profile['profile'] == 'gevent':
+    # Patch before the app is preloaded, so the locks, queues and sockets it
+    # creates cooperate with greenlets
+    from gevent import monkey
+    monkey.patch_all()
+
+# At least one pooled upstream connection per concurrent request, so
+# connections are reused instead of opened and discarded
+Config.HTTP_POOL_SIZE = max(Config.HTTP_POOL_SIZE, profile['concurrency'])
+
 bind = "0.0.0.0:5000"
-workers = 4
-worker_class = "sync"
-worker_connections = 1000
+wsgi_app = profile['wsgi_app']
+worker_class = profile['worker_class']
+workers = profile['workers']
+threads = profile['threads']
+# Only used by the gevent worker
+worker_connections = profile['worker_connections']
 timeout = 30
 keepalive = 2
 max_requests = 1000
 max_requests_jitter = 100
-preload_app = True
\ No newline at end of file
+preload_app = True
+
+def when_ready(server):
+    # The app (config, route catalog, stop index, timetable) is loaded by
+    # now; load what workers import later and freeze the heap, so all of it
+    # is shared copy-on-write instead of copied into every worker
+    from utils.startup import freeze_shared_heap, preload_shared_modules
+    if profile['profile'] != 'asgi':
+        preload_shared_modules()
+    freeze_shared_heap()
+    server.log.info("Worker profile %s: %s workers x %s concurrent requests (%s)",
+                    profile['profile'], workers, profile['concurrency'], worker_class)
+
+def post_fork(server, worker):
+    # Each worker opens its own upstream connection pools, tracks its own
+    # upstream health and starts its reply workers (ASYNC_REPLIES)
+    from utils.startup import init_worker
+    init_worker(open_pools=profile['profile'] != 'asgi')
+
+def on_starting(server):
+    # Metric files from a previous run would be summed into the new one
+    from utils.metrics import clear_multiproc_dir
+    clear_multiproc_dir()
+
+def child_exit(server, worker):
+    # Counters of an exited worker still count; its gauges do not
+    from utils.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
@@ -1,15 +1,57 @@
 import unittest
 import sys
 import os
+import tempfile
+import threading
+import time
+import asyncio
+import json
+import logging
+import subprocess
+import requests
+from datetime import datetime, timezone
 from unittest.mock import patch, MagicMock
 
 # Add the project root to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from utils.sms_parser import parse_sms_input
+from utils.sms_parser import parse_sms_input, parse_sms_batch
 from utils.response_formatter import format_eta_response
+from utils.sms_template import ReplyTemplate, sms_segments
+from utils.sms_sender import build_sms_request
 from utils.maps_client import GoogleMapsClient
 from utils.sms_sender import Fast2SMSSender
+from utils.eta_cache import ETACache, make_eta_cache_key
+from utils.kv_store import MemoryKVStore, SQLiteKVStore, LogKVStore
+from utils.single_flight import SingleFlight, AsyncSingleFlight
+from utils.reply_queue import MemoryJobQueue, SQLiteJobQueue, ReplyWorkerPool
+from utils.sms_batcher import BatchingSMSSender
+from utils.http_transport import HTTPTransport
+from utils import async_clients
+from utils.gtfs_schedule import GTFSSchedule
+from utils.route_catalog import RouteCatalog, ReloadingRouteCatalog, RouteInfo
+from utils.rate_limiter import RateLimiter, RateLimitDecision, SLOW_DOWN_MESSAGE
+from utils.idempotency import IdempotencyGuard, make_idempotency_key
+from utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+from utils.retry_scheduler import RetryScheduler, DeadLetterStore
+from utils import metrics
+from utils.traffic_capture import (
+    UpstreamPlayback, configure_traffic_capture, decode_body, encode_body, load_capture,
+    pseudonymize_phone, redact
+)
+from utils.logging_setup import (
+    CorrelationFilter, JSONFormatter, QueueLogHandler, SamplingFilter, set_correlation_id
+)
+from utils.startup import init_worker
+from utils.worker_profiles import resolve_profile, tune_profile
+from utils.webhook_batch import parse_batch_body
+from utils.eta_prefetcher import ETAPrefetcher, QueryPopularity, SpaceSaving
+from utils import headway_estimator
+from utils.headway_estimator import HeadwayEstimator, schedule_headways
+from utils.http_transport import get_transport
+from utils.stop_resolver import StopResolver, normalize_stop_name, bounded_edit_distance, within_one_edit
+from config import Config
+import app as app_module
 
 class TestSMSParsing(unittest.TestCase):
     """Test cases for SMS input parsing"""
@@ -46,6 +88,27 @@ class TestSMSParsing(unittest.TestCase):
         result = parse_sms_input("")
         self.assertFalse(result['valid'])
         self.assertIn("Invalid format", result['error'])
+    
+    def test_parse_sms_input_keywords_and_prefixes(self):
+        """Test the 'bus' keyword, '#' prefix and extra whitespace"""
+        self.assertEqual(parse_sms_input("MG Road bus 23")['location'], "MG Road")
+        self.assertEqual(parse_sms_input("MG Road #23")['route'], "23")
+        result = parse_sms_input("  Central   Station \n ROUTE   45 ")
+        self.assertEqual((result['location'], result['route']), ("Central   Station", "45"))
+        self.assertEqual(parse_sms_input("Route 45")['location'], "Route")
+    
+    def test_parse_sms_input_pathological_input(self):
+        """Test that long inputs without a route are rejected quickly"""
+        start = time.perf_counter()
+        result = parse_sms_input("a" + " " * 20000 + "b")
+        self.assertFalse(result['valid'])
+        self.assertLess(time.perf_counter() - start, 0.05)
+    
+    def test_parse_sms_batch(self):
+        """Test parsing a list of messages in order"""
+        results = parse_sms_batch(["MG Road 23", "Invalid Format", "Bus Stop A R12"])
+        self.assertEqual([r['valid'] for r in results], [True, False, True])
+        self.assertEqual(results[2]['route'], "12")
 
 class TestResponseFormatter(unittest.TestCase):
     """Test cases for ETA response formatting"""
@@ -82,11 +145,52 @@ class TestResponseFormatter(unittest.TestCase):
         
         result = format_eta_response(eta_data, '99', 'Unknown Location')
         self.assertIn("Route not found", result)
+    
+    def test_sms_segments_counts_extension_and_unicode_characters(self):
+        """Test that GSM-7 extension characters count twice and non-GSM text switches to UCS-2"""
+        self.assertEqual(sms_segments('a' * 160), ('gsm7', 160, 1))
+        self.assertEqual(sms_segments('a' * 159 + '€'), ('gsm7', 161, 2))
+        self.assertEqual(sms_segments('मैजेस्टिक' + 'a' * 61), ('ucs2', 70, 1))
+        self.assertEqual(sms_segments('’' + 'a' * 70), ('ucs2', 71, 2))
+    
+    def test_long_location_is_abbreviated_not_sliced(self):
+        """Test that a long location is shortened so the ETA still fits one segment"""
+        eta_data = {'success': True, 'error': '', 'data': {
+            'eta_text': '12 mins', 'departure_time': '2:30 PM', 'next_time': '2:50 PM'}}
+        location = ("Opposite Government Hospital, Near Railway Station Road, "
+                    "Old Market Extension, St. John’s Church Street")
+        
+        result = format_eta_response(eta_data, '23', location)
+        self.assertEqual(sms_segments(result)[::2], ('gsm7', 1))
+        self.assertIn("Opp Govt Hosp, Nr Rly Stn Rd", result)
+        self.assertIn("St. John's Church St", result)
+        self.assertTrue(result.endswith("Next bus in 12 mins at 2:30 PM. Next: 2:50 PM"))
+    
+    def test_unicode_location_fits_one_ucs2_segment(self):
+        """Test that optional fields are dropped and the location cut for a UCS-2 reply"""
+        eta_data = {'success': True, 'error': '', 'data': {
+            'eta_text': '12 mins', 'departure_time': '2:30 PM', 'next_time': '2:50 PM'}}
+        
+        result = format_eta_response(eta_data, '23', 'मैजेस्टिक बस स्टेशन')
+        self.assertEqual(result, "Route 23 from मैजेस्टिक बस स्टेशन: Next bus in 12 mins at 2:30 PM")
+        result = format_eta_response(eta_data, '23', 'मैजेस्टिक बस स्टेशन केम्पेगौडा बस स्टेशन')
+        self.assertEqual(sms_segments(result)[::2], ('ucs2', 1))
+        self.assertIn("मैजेस्टिक बस स्टेशन..: Next bus in 12 mins", result)
+        
+        template = ReplyTemplate("{location} 100% [{extra}]")
+        self.assertEqual(template.render(location='MG Road', extra='on time'), "MG Road 100% on time")
+    
+    def test_sms_request_language_follows_encoding(self):
+        """Test that replies outside the GSM alphabet are sent as Unicode"""
+        headers, payload = build_sms_request('key', ['9000000001'], "Route 23 from Café Road")
+        self.assertEqual(payload['language'], 'english')
+        headers, payload = build_sms_request('key', ['9000000001'], "Route 23 from मैजेस्टिक")
+        self.assertEqual(payload['language'], 'unicode')
 
 class TestGoogleMapsClient(unittest.TestCase):
     """Test cases for Google Maps client"""
     
-    @patch('utils.maps_client.requests.get')
+    @patch('utils.http_transport.HTTPTransport.get')
     def test_get_bus_eta_success(self, mock_get):
         """Test successful ETA retrieval"""
         # Mock the API response
@@ -112,7 +216,7 @@ class TestGoogleMapsClient(unittest.TestCase):
         self.assertEqual(result['data']['eta_minutes'], 12)
         self.assertEqual(result['data']['eta_text'], '12 mins')
     
-    @patch('utils.maps_client.requests.get')
+    @patch('utils.http_transport.HTTPTransport.get')
     def test_get_bus_eta_api_error(self, mock_get):
         """Test API error handling"""
         # Mock the API response
@@ -131,7 +235,7 @@ class TestGoogleMapsClient(unittest.TestCase):
 class TestFast2SMSSender(unittest.TestCase):
     """Test cases for Fast2SMS sender"""
     
-    @patch('utils.sms_sender.requests.post')
+    @patch('utils.http_transport.HTTPTransport.post')
     def test_send_sms_success(self, mock_post):
         """Test successful SMS sending"""
         # Mock the API response
@@ -151,7 +255,7 @@ class TestFast2SMSSender(unittest.TestCase):
         self.assertTrue(result['success'])
         self.assertEqual(result['response']['return'], True)
     
-    @patch('utils.sms_sender.requests.post')
+    @patch('utils.http_transport.HTTPTransport.post')
     def test_send_sms_api_error(self, mock_post):
         """Test API error handling"""
         # Mock the API response
@@ -166,6 +270,1607 @@ class TestFast2SMSSender(unittest.TestCase):
         # Check results
         self.assertFalse(result['success'])
         self.assertIn("Fast2SMS API error", result['error'])
+    
+    def test_only_unsent_failures_are_retryable(self):
+        """Test that sends which may have reached Fast2SMS are never retried"""
+        from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+        from utils.sms_sender import is_retryable_sms_failure
+        refused = MaxRetryError(None, '/', NewConnectionError(None, 'Connection refused'))
+        outcomes = {
+            'connect timeout': (requests.exceptions.ConnectTimeout(), True),
+            'refused': (requests.exceptions.ConnectionError(refused), True),
+            'circuit open': (CircuitOpenError('sms circuit is open'), True),
+            'read timeout': (requests.exceptions.ReadTimeout(), False),
+            'dropped': (requests.exceptions.ConnectionError(ProtocolError('Connection aborted')), False),
+        }
+        for status, retryable in ((503, True), (429, True), (400, False)):
+            outcomes[status] = (MagicMock(status_code=status), retryable)
+        
+        for name, (outcome, retryable) in outcomes.items():
+            mock = {'return_value': outcome} if isinstance(outcome, MagicMock) else {'side_effect': outcome}
+            with patch('utils.http_transport.HTTPTransport.post', **mock):
+                result = Fast2SMSSender().send_sms("1234567890", "Test message")
+            self.assertFalse(result['success'])
+            self.assertEqual(is_retryable_sms_failure(result), retryable, name)
+    
+    @unittest.skipIf(async_clients.aiohttp is None, "aiohttp is not installed")
+    def test_async_read_timeouts_are_not_retryable(self):
+        """Test that the asyncio sender flags only connect failures as retryable"""
+        from utils.sms_sender import is_retryable_sms_failure
+        aiohttp = async_clients.aiohttp
+        outcomes = [
+            (aiohttp.ConnectionTimeoutError(), True),
+            (aiohttp.ClientConnectorError(MagicMock(), OSError(111, 'Connection refused')), True),
+            (aiohttp.SocketTimeoutError(), False),
+            (aiohttp.ServerDisconnectedError(), False),
+        ]
+        for error, retryable in outcomes:
+            with patch.object(async_clients, 'request_json', side_effect=error):
+                sender = async_clients.AsyncFast2SMSSender(http_client=MagicMock())
+                result = asyncio.run(sender.send_sms('1234567890', 'Test message'))
+            self.assertEqual(is_retryable_sms_failure(result), retryable, type(error).__name__)
+
+class TestETACache(unittest.TestCase):
+    """Test cases for the ETA cache and its store backends"""
+    
+    def setUp(self):
+        self.eta_data = {
+            'success': True,
+            'error': '',
+            'data': {'eta_minutes': 12, 'eta_text': '12 mins'}
+        }
+    
+    def test_cache_key_normalization(self):
+        """Test that equivalent spellings share a cache key"""
+        self.assertEqual(
+            make_eta_cache_key("M.G.  Road", "23"),
+            make_eta_cache_key("m g road", "023")
+        )
+    
+    def test_memory_store_lru_eviction(self):
+        """Test that the least recently used entry is evicted"""
+        store = MemoryKVStore(max_entries=2)
+        store.set('a', 1)
+        store.set('b', 2)
+        store.get('a')
+        store.set('c', 3)
+        self.assertEqual(store.get('a'), 1)
+        self.assertIsNone(store.get('b'))
+    
+    def test_cache_hit_miss_and_ttl(self):
+        """Test hit/miss counting and TTL expiry"""
+        cache = ETACache(MemoryKVStore(), ttl=60)
+        self.assertIsNone(cache.get("MG Road", "23"))
+        cache.set("MG Road", "23", self.eta_data)
+        self.assertEqual(cache.get("mg road", "23"), self.eta_data)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+        
+        expired = ETACache(MemoryKVStore(), ttl=-1)
+        expired.set("MG Road", "23", self.eta_data)
+        self.assertIsNone(expired.get("MG Road", "23"))
+    
+    def test_sqlite_store_shared_between_instances(self):
+        """Test that two SQLite stores on one file see each other's writes"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache.sqlite3')
+            writer = ETACache(SQLiteKVStore(path), ttl=60)
+            reader = ETACache(SQLiteKVStore(path), ttl=60)
+            writer.set("MG Road", "23", self.eta_data)
+            self.assertEqual(reader.get("MG Road", "23"), self.eta_data)
+    
+    def test_log_store_survives_reopen(self):
+        """Test that a log store sees other instances' writes and keeps them when reopened"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache.log')
+            writer = LogKVStore(path)
+            reader = LogKVStore(path)
+            ETACache(writer, ttl=60).set("MG Road", "23", self.eta_data)
+            writer.set('gone', 1)
+            writer.delete('gone')
+            self.assertEqual(ETACache(reader, ttl=60).get("mg road", "23"), self.eta_data)
+            self.assertIsNone(reader.get('gone'))
+            
+            restarted = LogKVStore(path)
+            self.assertEqual(ETACache(restarted, ttl=60).get("MG Road", "23"), self.eta_data)
+            self.assertEqual(len(restarted), 1)
+    
+    def test_log_store_compaction_enforces_ttl_and_size(self):
+        """Test that compaction drops expired entries and all but the newest max_entries"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache.log')
+            store = LogKVStore(path, max_entries=2)
+            other = LogKVStore(path, max_entries=2)
+            for i in range(4):
+                store.set(f'key{i}', i)
+            store.set('key3', 'latest')
+            store.set('expired', 1, ttl=-1)
+            size = os.path.getsize(path)
+            
+            store.compact()
+            self.assertLess(os.path.getsize(path), size)
+            self.assertEqual(other.get('key3'), 'latest')
+            self.assertEqual(other.get('key2'), 2)
+            self.assertIsNone(other.get('key1'))
+            self.assertEqual(len(LogKVStore(path)), 2)
+    
+    def test_log_store_truncates_torn_tail(self):
+        """Test that a partially written record is ignored and replaced by the next write"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache.log')
+            LogKVStore(path).set('a', 1)
+            with open(path, 'ab') as f:
+                f.write(b'\x00torn record')
+            
+            store = LogKVStore(path)
+            self.assertEqual(store.get('a'), 1)
+            with self.assertLogs(level='WARNING'):
+                store.set('b', 2)
+            self.assertEqual(LogKVStore(path).get('b'), 2)
+    
+    @patch('utils.http_transport.HTTPTransport.get')
+    def test_maps_client_uses_cache(self, mock_get):
+        """Test that repeated lookups are served from the cache"""
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {
+            'status': 'OK',
+            'routes': [{
+                'legs': [{
+                    'duration': {'value': 720, 'text': '12 mins'},
+                    'departure_time': {'text': '2:30 PM'}
+                }]
+            }]
+        }
+        mock_get.return_value = mock_response
+        
+        client = GoogleMapsClient(cache=ETACache(MemoryKVStore(), ttl=60))
+        first = client.get_bus_eta("MG Road", "23")
+        second = client.get_bus_eta("mg road", "23")
+        
+        self.assertTrue(second['success'])
+        self.assertEqual(first, second)
+        self.assertEqual(mock_get.call_count, 1)
+
+class TestSingleFlight(unittest.TestCase):
+    """Test cases for request coalescing of ETA lookups"""
+    
+    def setUp(self):
+        self.api_response = {
+            'status': 'OK',
+            'routes': [{
+                'legs': [{
+                    'duration': {'value': 720, 'text': '12 mins'},
+                    'departure_time': {'text': '2:30 PM'}
+                }]
+            }]
+        }
+    
+    def _slow_response(self, *args, **kwargs):
+        """Simulate a slow Directions API call"""
+        time.sleep(0.2)
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = self.api_response
+        return mock_response
+    
+    def _fire_parallel(self, func, count):
+        """Call func from count threads released at the same moment"""
+        barrier = threading.Barrier(count)
+        results = [None] * count
+        
+        def worker(index):
+            barrier.wait()
+            results[index] = func()
+        
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+    
+    def test_single_flight_shares_result(self):
+        """Test that concurrent calls with one key execute once"""
+        group = SingleFlight()
+        calls = []
+        
+        def work():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'done'
+        
+        results = self._fire_parallel(lambda: group.do('key', work), 10)
+        self.assertEqual(results, ['done'] * 10)
+        self.assertEqual(len(calls), 1)
+    
+    @patch('utils.http_transport.HTTPTransport.get')
+    def test_parallel_identical_lookups_make_one_upstream_call(self, mock_get):
+        """Test that N parallel identical ETA lookups call the API once"""
+        mock_get.side_effect = self._slow_response
+        client = GoogleMapsClient(cache=ETACache(MemoryKVStore(), ttl=60))
+        
+        results = self._fire_parallel(lambda: client.get_bus_eta("MG Road", "23"), 20)
+        
+        self.assertTrue(all(result['success'] for result in results))
+        self.assertEqual(mock_get.call_count, 1)
+    
+    @patch('utils.http_transport.HTTPTransport.get')
+    def test_stale_entry_served_while_revalidating(self, mock_get):
+        """Test stale-while-revalidate returns the stale ETA and refreshes it"""
+        mock_get.side_effect = self._slow_response
+        cache = ETACache(MemoryKVStore(), ttl=0, stale_ttl=60)
+        stale = {'success': True, 'error': '', 'data': {'eta_text': 'stale'}}
+        cache.set("MG Road", "23", stale)
+        client = GoogleMapsClient(cache=cache)
+        
+        self.assertEqual(client.get_bus_eta("MG Road", "23"), stale)
+        
+        deadline = time.time() + 2
+        while mock_get.call_count == 0 or client.single_flight.in_flight():
+            if time.time() > deadline:
+                self.fail("Background refresh did not run")
+            time.sleep(0.01)
+        refreshed, fresh = cache.lookup("MG Road", "23")
+        self.assertEqual(refreshed['data']['eta_text'], '12 mins')
+
+class TestReplyQueue(unittest.TestCase):
+    """Test cases for the asynchronous reply pipeline"""
+    
+    def test_memory_queue_is_bounded(self):
+        """Test that a full queue rejects new jobs"""
+        job_queue = MemoryJobQueue(max_size=1)
+        self.assertIsNotNone(job_queue.put({'n': 1}))
+        self.assertIsNone(job_queue.put({'n': 2}))
+        self.assertEqual(job_queue.depth(), 1)
+    
+    def test_sqlite_queue_survives_restart(self):
+        """Test that queued and unacknowledged jobs survive a new queue instance"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'replies.sqlite3')
+            SQLiteJobQueue(path).put({'phone_number': '1234567890'})
+            
+            # Claimed by a worker that dies before acknowledging
+            crashed = SQLiteJobQueue(path, visibility_timeout=0)
+            self.assertIsNotNone(crashed.get(timeout=0))
+            
+            restarted = SQLiteJobQueue(path, visibility_timeout=0)
+            job_id, enqueued_at, job = restarted.get(timeout=0)
+            self.assertEqual(job['phone_number'], '1234567890')
+            restarted.ack(job_id)
+            self.assertEqual(restarted.depth(), 0)
+    
+    def test_failed_jobs_are_redelivered_then_dead_lettered(self):
+        """Test that a failing job is handed out again and given up after max_attempts"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for job_queue in (MemoryJobQueue(visibility_timeout=0.05, max_attempts=2),
+                              SQLiteJobQueue(os.path.join(tmpdir, 'replies.sqlite3'),
+                                             visibility_timeout=0.05, max_attempts=2)):
+                with self.subTest(queue=type(job_queue).__name__):
+                    attempts = []
+                    
+                    def handler(job):
+                        attempts.append(job)
+                        raise RuntimeError("gateway down")
+                    
+                    pool = ReplyWorkerPool(job_queue, handler, workers=1)
+                    pool.submit({'phone_number': '1234567890'})
+                    deadline = time.time() + 3
+                    while len(job_queue.dead_letters) == 0 and time.time() < deadline:
+                        time.sleep(0.01)
+                    pool.stop()
+                    
+                    self.assertEqual(len(attempts), 2)
+                    self.assertEqual(pool.stats()['failed'], 2)
+                    self.assertEqual(job_queue.depth(), 0)
+                    record = job_queue.dead_letters.recent()[0]
+                    self.assertEqual((record['job'], record['attempts']), ({'phone_number': '1234567890'}, 2))
+    
+    def test_worker_pool_processes_jobs(self):
+        """Test that background workers run the handler and track lag"""
+        handled = []
+        done = threading.Event()
+        
+        def handler(job):
+            handled.append(job)
+            done.set()
+        
+        pool = ReplyWorkerPool(MemoryJobQueue(), handler, workers=1)
+        pool.submit({'phone_number': '1234567890'})
+        self.assertTrue(done.wait(2))
+        pool.stop()
+        
+        self.assertEqual(handled, [{'phone_number': '1234567890'}])
+        self.assertEqual(pool.stats()['processed'], 1)
+    
+    def test_stats_count_queue_outside_the_pool_lock(self):
+        """Test that a slow queue count never holds up the workers' counter updates"""
+        job_queue = MemoryJobQueue()
+        pool = ReplyWorkerPool(job_queue, lambda job: None, workers=1)
+        
+        def depth():
+            self.assertFalse(pool._lock.locked())
+            return 0
+        
+        with patch.object(job_queue, 'depth', side_effect=depth):
+            self.assertEqual(pool.stats()['depth'], 0)
+    
+    @patch.object(Config, 'ASYNC_REPLIES', True)
+    @patch('app.process_sms')
+    def test_webhook_acknowledges_with_202(self, mock_process):
+        """Test that the webhook enqueues the reply and returns immediately"""
+        done = threading.Event()
+        mock_process.side_effect = lambda *args: (done.set(), ({}, 200))[1]
+        
+        flask_app = app_module.create_app()
+        response = flask_app.test_client().post(
+            '/webhook', json={'from': '1234567890', 'message': 'MG Road 23'}
+        )
+        
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('job_id', response.get_json())
+        self.assertTrue(done.wait(2))
+        self.assertEqual(mock_process.call_args[0][:2], ('1234567890', 'MG Road 23'))
+        flask_app.extensions['reply_pool'].stop()
+
+class TestBatchingSMSSender(unittest.TestCase):
+    """Test cases for batched outbound SMS delivery"""
+    
+    def _ok(self, phone_numbers, message):
+        return {'success': True, 'error': '', 'response': {'return': True}}
+    
+    def test_identical_messages_are_sent_in_one_call(self):
+        """Test that recipients of the same body share one bulk call"""
+        sender = MagicMock()
+        sender.send_bulk_sms.side_effect = self._ok
+        batcher = BatchingSMSSender(sender, window=0.1, max_latency=1.0)
+        
+        futures = [batcher.submit(phone, 'Route 23: 5 mins') for phone in ('111', '222', '333')]
+        futures.append(batcher.submit('444', 'Route 45: 9 mins'))
+        results = [future.result(timeout=2) for future in futures]
+        
+        self.assertTrue(all(result['success'] for result in results))
+        self.assertEqual(sender.send_bulk_sms.call_count, 2)
+        numbers = sorted(call[0][0] for call in sender.send_bulk_sms.call_args_list)
+        self.assertEqual(numbers, [['111', '222', '333'], ['444']])
+    
+    def test_full_batch_is_flushed_immediately(self):
+        """Test that reaching the maximum batch size does not wait for the window"""
+        sender = MagicMock()
+        sender.send_bulk_sms.side_effect = self._ok
+        batcher = BatchingSMSSender(sender, window=10, max_batch_size=2, max_latency=10)
+        
+        futures = [batcher.submit(phone, 'Hello') for phone in ('111', '222')]
+        for future in futures:
+            self.assertTrue(future.result(timeout=2)['success'])
+    
+    def test_rejected_batch_reports_per_recipient(self):
+        """Test that a rejected bulk send is retried per recipient"""
+        sender = MagicMock()
+        sender.send_bulk_sms.return_value = {
+            'success': False, 'error': 'Invalid number', 'response': {'return': False}
+        }
+        sender.send_sms.side_effect = lambda phone, message: {
+            'success': phone != 'bad', 'error': '', 'response': {}
+        }
+        batcher = BatchingSMSSender(sender, window=0.05)
+        
+        good = batcher.submit('111', 'Hello')
+        bad = batcher.submit('bad', 'Hello')
+        
+        self.assertTrue(good.result(timeout=2)['success'])
+        self.assertFalse(bad.result(timeout=2)['success'])
+    
+    @patch('utils.http_transport.HTTPTransport.post')
+    def test_send_bulk_sms_joins_numbers(self, mock_post):
+        """Test that bulk sends pass a comma-separated numbers field"""
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {'return': True}
+        mock_post.return_value = mock_response
+        
+        result = Fast2SMSSender().send_bulk_sms(['111', '222'], "Test message")
+        
+        self.assertTrue(result['success'])
+        self.assertEqual(mock_post.call_args[1]['json']['numbers'], '111,222')
+
+class TestHTTPTransport(unittest.TestCase):
+    """Test cases for the pooled upstream HTTP transport"""
+    
+    def test_session_reused_and_configured(self):
+        """Test that one pooled session is reused with GET-only retries"""
+        transport = HTTPTransport(pool_size=7, max_retries=3)
+        session = transport.session
+        self.assertIs(transport.session, session)
+        
+        adapter = session.get_adapter('https://maps.googleapis.com')
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertEqual(adapter.max_retries.total, 3)
+        self.assertEqual(adapter.max_retries.allowed_methods, frozenset(['GET']))
+    
+    def test_new_session_after_fork(self):
+        """Test that a forked process builds its own session"""
+        transport = HTTPTransport()
+        parent_session = transport.session
+        with patch('utils.http_transport.os.getpid', return_value=-1):
+            self.assertIsNot(transport.session, parent_session)
+    
+    def test_request_applies_split_timeouts_and_counts(self):
+        """Test default (connect, read) timeouts and utilization counters"""
+        transport = HTTPTransport(connect_timeout=1.5, read_timeout=4)
+        with patch.object(transport.session, 'request') as mock_request:
+            transport.get('http://localhost/test')
+        
+        self.assertEqual(mock_request.call_args[1]['timeout'], (1.5, 4))
+        self.assertEqual(transport.stats()['requests_total'], 1)
+        self.assertEqual(transport.stats()['in_flight'], 0)
+
+class TestASGIApp(unittest.TestCase):
+    """Test cases for the asyncio service mode"""
+    
+    def _call(self, asgi_app, method, path, payload=None):
+        """Drive one HTTP request through an ASGI app and return (status, body)"""
+        body = json.dumps(payload).encode() if payload is not None else b''
+        sent = []
+        
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        
+        async def send(message):
+            sent.append(message)
+        
+        scope = {'type': 'http', 'method': method, 'path': path}
+        asyncio.run(asgi_app(scope, receive, send))
+        return sent[0]['status'], json.loads(sent[1]['body'])
+    
+    def test_async_single_flight_shares_result(self):
+        """Test that concurrent coroutines with one key execute once"""
+        group = AsyncSingleFlight()
+        calls = []
+        
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'done'
+        
+        async def main():
+            return await asyncio.gather(*(group.do('key', work) for _ in range(50)))
+        
+        self.assertEqual(asyncio.run(main()), ['done'] * 50)
+        self.assertEqual(len(calls), 1)
+    
+    @unittest.skipIf(async_clients.aiohttp is None, "aiohttp is not installed")
+    def test_health_and_webhook(self):
+        """Test /health and the /webhook pipeline with async clients"""
+        from asgi_app import create_asgi_app
+        
+        async def fake_eta(origin, route_number):
+            return {'success': True, 'error': '', 'data': {
+                'eta_text': '12 mins', 'departure_time': '2:30 PM', 'next_time': '2:50 PM'
+            }}
+        
+        async def fake_send(phone_number, message):
+            fake_send.messages.append((phone_number, message))
+            return {'success': True, 'error': '', 'response': {'return': True}}
+        fake_send.messages = []
+        
+        with patch.object(async_clients.AsyncGoogleMapsClient, 'get_bus_eta', side_effect=fake_eta), \
+             patch.object(async_clients.AsyncFast2SMSSender, 'send_sms', side_effect=fake_send):
+            asgi_app = create_asgi_app()
+            self.assertEqual(self._call(asgi_app, 'GET', '/health')[0], 200)
+            status, body = self._call(
+                asgi_app, 'POST', '/webhook', {'from': '1234567890', 'message': 'MG Road 23'}
+            )
+        
+        self.assertEqual(status, 200)
+        self.assertEqual(body['route'], '23')
+        self.assertEqual(
+            fake_send.messages,
+            [('1234567890', "Route 23 from MG Road: Next bus in 12 mins at 2:30 PM. Next: 2:50 PM")]
+        )
+
+    @unittest.skipIf(async_clients.aiohttp is None, "aiohttp is not installed")
+    def test_rate_limited_webhook_sets_retry_after(self):
+        """Test that a throttled sender gets a Retry-After header, as from the Flask app"""
+        from asgi_app import create_asgi_app
+        sent = []
+        
+        async def receive():
+            return {'type': 'http.request', 'body': b'{"from": "9000000009", "message": "MG Road 23"}'}
+        
+        async def send(message):
+            sent.append(message)
+        
+        throttled = RateLimitDecision(allowed=False, notify=False, retry_after=29.5)
+        with patch.object(Config, 'RATE_LIMIT_BACKEND', 'memory'), \
+             patch.object(RateLimiter, 'check', return_value=throttled):
+            asgi_app = create_asgi_app()
+            asyncio.run(asgi_app({'type': 'http', 'method': 'POST', 'path': '/webhook'}, receive, send))
+        
+        headers = dict(sent[0]['headers'])
+        self.assertEqual(sent[0]['status'], 429)
+        self.assertEqual(headers[b'retry-after'], b'30')
+    
+    def test_blocking_stores_called_off_the_loop(self):
+        """Test that SQLite stores are called from a thread and memory stores on the loop"""
+        async def caller_thread(resources):
+            return await async_clients.run_blocking(resources, threading.get_ident)
+        
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sqlite_store = SQLiteKVStore(os.path.join(tmpdir, 'kv.sqlite3'))
+            loop_thread = threading.get_ident()
+            self.assertEqual(asyncio.run(caller_thread([MemoryKVStore(), None])), loop_thread)
+            self.assertNotEqual(asyncio.run(caller_thread([MemoryKVStore(), sqlite_store])), loop_thread)
+    
+    @unittest.skipIf(async_clients.aiohttp is None, "aiohttp is not installed")
+    def test_async_cache_reads_run_off_the_loop(self):
+        """Test that an async ETA lookup reads a SQLite cache from a worker thread"""
+        threads = []
+        real_lookup = async_clients.lookup_local_eta
+        
+        def lookup(*args):
+            threads.append(threading.get_ident())
+            return real_lookup(*args)
+        
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ETACache(SQLiteKVStore(os.path.join(tmpdir, 'kv.sqlite3')), ttl=60)
+            cache.set("MG Road", "23", {'success': True, 'error': '', 'data': {
+                'eta_minutes': 12, 'eta_text': '12 mins', 'departure_time': '2:30 PM', 'next_time': '2:50 PM'
+            }})
+            client = async_clients.AsyncGoogleMapsClient(cache=cache)
+            with patch.object(async_clients, 'lookup_local_eta', side_effect=lookup):
+                result = asyncio.run(client.get_bus_eta("MG Road", "23"))
+        
+        self.assertEqual(result['data']['eta_minutes'], 12)
+        self.assertNotEqual(threads, [threading.get_ident()])
+
+def write_gtfs_feed(feed_dir):
+    """Write a two-stop, one-route GTFS feed used by the schedule tests"""
+    tables = {
+        'stops.txt': "stop_id,stop_name\nS1,MG Road\nS2,Central Station\n",
+        'routes.txt': "route_id,route_short_name,route_long_name\nR23,23,Downtown\n",
+        'trips.txt': "route_id,service_id,trip_id\nR23,WK,T1\nR23,WK,T2\nR23,WK,T3\n",
+        'stop_times.txt': (
+            "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+            "T2,14:50:00,14:50:00,S1,1\nT2,15:05:00,15:05:00,S2,2\n"
+            "T1,14:30:00,14:30:00,S1,1\nT1,14:45:00,14:45:00,S2,2\n"
+            "T3,15:25:00,15:25:00,S2,2\nT3,15:10:00,15:10:00,S1,1\n"
+        )
+    }
+    for name, content in tables.items():
+        with open(os.path.join(feed_dir, name), 'w') as f:
+            f.write(content)
+
+class TestGTFSSchedule(unittest.TestCase):
+    """Test cases for the offline GTFS schedule engine"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        write_gtfs_feed(self.tmpdir.name)
+        self.schedule = GTFSSchedule.load(self.tmpdir.name)
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_next_departures_sorted_with_wraparound(self):
+        """Test binary search over sorted departures, wrapping past midnight"""
+        stop, route, upcoming = self.schedule.next_departures("mg road", "23", 14 * 3600 + 35 * 60)
+        self.assertEqual(upcoming, [14 * 3600 + 50 * 60, 15 * 3600 + 10 * 60])
+        
+        stop, route, upcoming = self.schedule.next_departures("MG Road", "23", 23 * 3600)
+        self.assertEqual(upcoming[0], 86400 + 14 * 3600 + 30 * 60)
+    
+    def test_get_bus_eta_fills_next_time(self):
+        """Test that schedule answers use the standard ETA shape"""
+        result = self.schedule.get_bus_eta("MG Road", "23", now=datetime(2026, 1, 5, 14, 20))
+        self.assertTrue(result['success'])
+        self.assertEqual(result['data']['eta_minutes'], 10)
+        self.assertEqual(result['data']['departure_time'], '2:30 PM')
+        self.assertEqual(result['data']['next_time'], '2:50 PM')
+        self.assertEqual(result['data']['destination'], 'Downtown')
+    
+    def test_trip_stop_times_ordered_by_sequence(self):
+        """Test that each trip's stop times are kept in stop_sequence order"""
+        stops, times = self.schedule.trip_stop_times[2]
+        self.assertEqual(list(stops), [0, 1])
+        self.assertEqual(list(times), [15 * 3600 + 10 * 60, 15 * 3600 + 25 * 60])
+    
+    @patch('utils.http_transport.HTTPTransport.get')
+    def test_maps_client_uses_schedule_before_api(self, mock_get):
+        """Test that the Directions API is only a fallback"""
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {'status': 'ZERO_RESULTS'}
+        mock_get.return_value = mock_response
+        client = GoogleMapsClient(schedule=self.schedule)
+        
+        self.assertEqual(client.get_bus_eta("Central Station", "23")['source'], 'schedule')
+        self.assertEqual(mock_get.call_count, 0)
+        
+        client.get_bus_eta("Unknown Stop", "23")
+        self.assertEqual(mock_get.call_count, 1)
+    
+    def test_post_midnight_trips_of_previous_service_day(self):
+        """Test that a 24:20:00 stop time is the next bus at 00:05, not the first morning trip"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_gtfs_feed(tmpdir)
+            with open(os.path.join(tmpdir, 'trips.txt'), 'a') as f:
+                f.write("R23,WK,T4\n")
+            with open(os.path.join(tmpdir, 'stop_times.txt'), 'a') as f:
+                f.write("T4,24:20:00,24:20:00,S1,1\n")
+            schedule = GTFSSchedule.load(tmpdir)
+        
+        stop, route, upcoming = schedule.next_departures("MG Road", "23", 5 * 60)
+        self.assertEqual(upcoming, [20 * 60, 14 * 3600 + 30 * 60])
+        eta = schedule.get_bus_eta("MG Road", "23", now=datetime(2024, 1, 1, 0, 5))
+        self.assertEqual((eta['data']['eta_minutes'], eta['data']['departure_time']), (15, '12:20 AM'))
+        
+        # Late in the evening the same trip is still tonight's last bus
+        stop, route, upcoming = schedule.next_departures("MG Road", "23", 23 * 3600)
+        self.assertEqual(upcoming, [24 * 3600 + 20 * 60, 86400 + 14 * 3600 + 30 * 60])
+    
+    def test_clock_in_agency_timezone(self):
+        """Test that the current time is read in the feed's agency_timezone"""
+        with open(os.path.join(self.tmpdir.name, 'agency.txt'), 'w') as f:
+            f.write("agency_name,agency_url,agency_timezone\nBMTC,https://example.com,Asia/Kolkata\n")
+        schedule = GTFSSchedule.load(self.tmpdir.name)
+        
+        result = schedule.get_bus_eta("MG Road", "23", now=datetime(2026, 1, 5, 8, 50, tzinfo=timezone.utc))
+        self.assertEqual((result['data']['eta_minutes'], result['data']['departure_time']), (10, '2:30 PM'))
+    
+    def test_trips_filtered_by_service_day(self):
+        """Test that weekday and weekend timetables are not merged"""
+        with open(os.path.join(self.tmpdir.name, 'trips.txt'), 'a') as f:
+            f.write("R23,WE,T5\n")
+        with open(os.path.join(self.tmpdir.name, 'stop_times.txt'), 'a') as f:
+            f.write("T5,14:40:00,14:40:00,S1,1\n")
+        with open(os.path.join(self.tmpdir.name, 'calendar.txt'), 'w') as f:
+            f.write("service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+                    "WK,1,1,1,1,1,0,0,20260101,20261231\nWE,0,0,0,0,0,1,1,20260101,20261231\n")
+        with open(os.path.join(self.tmpdir.name, 'calendar_dates.txt'), 'w') as f:
+            f.write("service_id,date,exception_type\nWK,20260126,2\nWE,20260126,1\n")
+        schedule = GTFSSchedule.load(self.tmpdir.name)
+        
+        def departures(now):
+            data = schedule.get_bus_eta("MG Road", "23", now=now)['data']
+            return data['departure_time'], data['next_time']
+        
+        self.assertEqual(departures(datetime(2026, 1, 5, 14, 35)), ('2:50 PM', '3:10 PM'))     # Monday
+        self.assertEqual(departures(datetime(2026, 1, 10, 14, 35)), ('2:40 PM', '2:40 PM'))    # Saturday
+        self.assertEqual(departures(datetime(2026, 1, 26, 14, 35)), ('2:40 PM', '2:30 PM'))    # holiday Monday
+        self.assertEqual(departures(datetime(2026, 1, 9, 15, 30)), ('2:40 PM', 'Unknown'))     # Friday night
+        self.assertIsNone(schedule.get_bus_eta("MG Road", "23", now=datetime(2027, 1, 4, 14, 35)))
+
+class TestStopResolver(unittest.TestCase):
+    """Test cases for fuzzy stop name resolution"""
+    
+    def setUp(self):
+        self.resolver = StopResolver([
+            ('S1', 'MG Road'),
+            ('S2', 'Central Station'),
+            ('S3', 'Koramangala 5th Block'),
+            ('S4', 'Indiranagar Metro Station')
+        ])
+    
+    def test_normalize_stop_name(self):
+        """Test punctuation, initials and abbreviation handling"""
+        self.assertEqual(normalize_stop_name("M.G. Rd"), "mg road")
+        self.assertEqual(normalize_stop_name("  Central   Stn "), "central station")
+    
+    def test_bounded_edit_distance(self):
+        """Test edit distance with an early cutoff"""
+        self.assertEqual(bounded_edit_distance("station", "statoin", 3), 2)
+        self.assertEqual(bounded_edit_distance("road", "road", 1), 0)
+        self.assertEqual(bounded_edit_distance("mg road", "koramangala", 2), 3)
+    
+    def test_within_one_edit_agrees_with_edit_distance(self):
+        """Test the slice-based one-edit check against the banded edit distance"""
+        import random
+        rng = random.Random(7)
+        for _ in range(2000):
+            a = ''.join(rng.choice('ab ') for _ in range(rng.randrange(6)))
+            b = ''.join(rng.choice('ab ') for _ in range(rng.randrange(6)))
+            self.assertEqual(within_one_edit(a, b), bounded_edit_distance(a, b, 1) <= 1, (a, b))
+    
+    def test_resolve_typos_and_abbreviations(self):
+        """Test that misspelled and abbreviated locations resolve to canonical stops"""
+        self.assertEqual(self.resolver.resolve("M.G. Rd").stop_id, 'S1')
+        self.assertEqual(self.resolver.resolve("centrl station").stop_id, 'S2')
+        self.assertEqual(self.resolver.resolve("koramangla 5th block").stop_name, 'Koramangala 5th Block')
+        self.assertEqual(self.resolver.resolve("Indiranagar Metro Stn").distance, 0)
+        # Several typos need the banded edit distance
+        self.assertEqual(self.resolver.resolve("centarl statoin"), ('S2', 'Central Station', 4))
+    
+    def test_unrelated_location_is_left_unchanged(self):
+        """Test that locations far from every stop are not resolved"""
+        self.assertIsNone(self.resolver.resolve("xyz"))
+        self.assertEqual(self.resolver.canonical_location("Airport"), "Airport")
+    
+    def test_short_codes_are_only_matched_exactly(self):
+        """Test that a short query is not rewritten to a stop one edit away"""
+        resolver = StopResolver([('S9', 'BDA'), ('S10', 'HAL'), ('S11', 'KR Puram')])
+        self.assertIsNone(resolver.resolve("BDB"))
+        self.assertIsNone(resolver.resolve("HAM"))
+        self.assertIsNone(resolver.resolve("KR"))
+        self.assertEqual(resolver.resolve("bda").stop_id, 'S9')
+    
+    @patch('utils.http_transport.HTTPTransport.get')
+    def test_maps_client_queries_canonical_name(self, mock_get):
+        """Test that the Directions API is called with the resolved stop name"""
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {'status': 'ZERO_RESULTS'}
+        mock_get.return_value = mock_response
+        client = GoogleMapsClient(stop_resolver=self.resolver)
+        
+        client.get_bus_eta("centrl stn", "23")
+        self.assertIn("Central Station", mock_get.call_args[1]['params']['origin'])
+
+class TestRouteCatalog(unittest.TestCase):
+    """Test cases for the route catalog"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'routes.csv')
+        self._write("route_number,destination,terminals,direction,headway_minutes\n"
+                    "23,Downtown,MG Road|Downtown Terminal,outbound,10\n")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def _write(self, content, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+    
+    def test_load_csv_and_json(self):
+        """Test loading route metadata from CSV and JSON files"""
+        route = RouteCatalog.from_file(self.path).get("023")
+        self.assertEqual(route.destination, "Downtown")
+        self.assertEqual(route.terminals, ("MG Road", "Downtown Terminal"))
+        self.assertEqual(route.headway_minutes, 10.0)
+        
+        json_path = os.path.join(self.tmpdir.name, 'routes.json')
+        with open(json_path, 'w') as f:
+            json.dump([{'route_number': 'R7', 'destination': 'Shopping Mall'}], f)
+        self.assertEqual(RouteCatalog.from_file(json_path).get("r7").destination, "Shopping Mall")
+    
+    def test_hot_reload_keeps_last_good_catalog(self):
+        """Test that file changes are picked up and broken files are ignored"""
+        catalog = ReloadingRouteCatalog(self.path, check_interval=0)
+        self.assertIsNone(catalog.get("45"))
+        
+        self._write("route_number,destination\n45,Airport\n", mtime=time.time() + 10)
+        self.assertEqual(catalog.get("45").destination, "Airport")
+        self.assertEqual(catalog.reloads, 2)
+        
+        self._write("route_number,destination\n99,\n", mtime=time.time() + 20)
+        self.assertEqual(catalog.get("45").destination, "Airport")
+    
+    def test_malformed_json_entries_keep_last_good_catalog(self):
+        """Test that wrongly typed JSON entries are rejected instead of raising on lookup"""
+        self.path = os.path.join(self.tmpdir.name, 'routes.json')
+        self._write(json.dumps([{'route_number': '45', 'destination': 'Airport'}]))
+        catalog = ReloadingRouteCatalog(self.path, check_interval=0)
+        
+        malformed = (
+            ["45"],
+            [{'route_number': '45', 'destination': 'Airport', 'headway_minutes': [10]}],
+            [{'route_number': '45', 'destination': 'Airport', 'terminals': ['MG Road', 7]}],
+            [{'route_number': {'id': 45}, 'destination': 'Airport'}]
+        )
+        for offset, records in enumerate(malformed, start=1):
+            with self.subTest(records=records):
+                self._write(json.dumps(records), mtime=time.time() + 10 * offset)
+                with self.assertRaises(ValueError):
+                    RouteCatalog.from_file(self.path)
+                self.assertEqual(catalog.get("45").destination, "Airport")
+        self.assertEqual(catalog.reloads, 1)
+    
+    @patch('utils.http_transport.HTTPTransport.get')
+    def test_unknown_route_short_circuits(self, mock_get):
+        """Test that unknown routes are rejected without calling the API"""
+        client = GoogleMapsClient(route_catalog=RouteCatalog([RouteInfo('23', 'Downtown', (), '', None)]))
+        result = client.get_bus_eta("MG Road", "99")
+        self.assertFalse(result['success'])
+        self.assertEqual(mock_get.call_count, 0)
+        
+        sms_sender = MagicMock()
+        payload, status = app_module.process_sms("+911234567890", "MG Road 99", client, sms_sender)
+        self.assertEqual(status, 404)
+        self.assertIn("Route not found", sms_sender.send_sms.call_args[0][1])
+
+class TestRateLimiter(unittest.TestCase):
+    """Test cases for per-sender rate limiting"""
+    
+    @patch('utils.rate_limiter.time.time')
+    def test_burst_then_single_notice_then_refill(self, mock_time):
+        """Test token-bucket semantics and one slow-down notice per window"""
+        mock_time.return_value = 1000.0
+        limiter = RateLimiter(MemoryKVStore(), max_messages=2, window=60)
+        
+        self.assertTrue(limiter.check("111").allowed)
+        self.assertTrue(limiter.check("111").allowed)
+        first = limiter.check("111")
+        self.assertEqual((first.allowed, first.notify), (False, True))
+        self.assertAlmostEqual(first.retry_after, 30.0)
+        self.assertFalse(limiter.check("111").notify)
+        self.assertTrue(limiter.check("222").allowed)
+        
+        mock_time.return_value = 1031.0
+        self.assertTrue(limiter.check("111").allowed)
+        self.assertEqual(limiter.stats()['throttled'], 2)
+    
+    def test_sqlite_state_is_shared(self):
+        """Test that limiters in different workers share buckets through SQLite"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'limits.sqlite3')
+            first = RateLimiter(SQLiteKVStore(path), max_messages=1, window=60)
+            second = RateLimiter(SQLiteKVStore(path), max_messages=1, window=60)
+            self.assertTrue(first.check("111").allowed)
+            self.assertFalse(second.check("111").allowed)
+    
+    @patch.object(Config, 'RATE_LIMIT_MAX_MESSAGES', 1)
+    @patch('app.Fast2SMSSender')
+    @patch('app.process_sms')
+    def test_webhook_throttles_before_processing(self, mock_process, mock_sender_class):
+        """Test that throttled senders get 429 and a single slow-down SMS"""
+        mock_process.return_value = ({}, 200)
+        client = app_module.create_app().test_client()
+        statuses = [
+            client.post('/webhook', json={'from': '1234567890', 'message': f'MG Road {route}'}).status_code
+            for route in (23, 45, 12)
+        ]
+        
+        self.assertEqual(statuses, [200, 429, 429])
+        self.assertEqual(mock_process.call_count, 1)
+        mock_sender_class.return_value.send_sms.assert_called_once_with('1234567890', SLOW_DOWN_MESSAGE)
+
+class TestIdempotency(unittest.TestCase):
+    """Test cases for deduplicating retried webhook deliveries"""
+    
+    def test_duplicate_gets_recorded_response(self):
+        """Test that a retried message is processed once"""
+        guard = IdempotencyGuard(MemoryKVStore(), window=60)
+        calls = []
+        
+        def process():
+            calls.append(1)
+            return {"message": "SMS processed successfully"}, 200
+        
+        self.assertEqual(guard.run("k1", process), ({"message": "SMS processed successfully"}, 200))
+        self.assertEqual(guard.run("k1", process), ({"message": "SMS processed successfully"}, 200))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(guard.stats(), {'processed': 1, 'duplicates': 1})
+    
+    def test_in_flight_duplicate_and_abandoned_claim(self):
+        """Test duplicates of a running delivery, and expiry of abandoned claims"""
+        guard = IdempotencyGuard(MemoryKVStore(), window=60, pending_ttl=0.05)
+        self.assertIsNone(guard.begin("k1"))
+        self.assertEqual(guard.begin("k1")[1], 202)
+        time.sleep(0.06)
+        self.assertIsNone(guard.begin("k1"))
+    
+    def test_retryable_failures_and_exceptions_are_not_recorded(self):
+        """Test that throttled, rejected or crashed deliveries are processed again"""
+        guard = IdempotencyGuard(MemoryKVStore(), window=60)
+        guard.run("k1", lambda: ({"error": "Service busy, try again later"}, 503))
+        self.assertIsNone(guard.begin("k1"))
+        
+        with self.assertRaises(RuntimeError):
+            guard.run("k2", MagicMock(side_effect=RuntimeError("boom")))
+        self.assertIsNone(guard.begin("k2"))
+    
+    def test_key_prefers_gateway_message_id(self):
+        """Test key derivation from a message ID or a hash of the message"""
+        self.assertEqual(make_idempotency_key({'message_id': 'abc'}, '111', 'MG Road 23', 300), 'idem:id:abc')
+        self.assertIsNone(make_idempotency_key({}, '111', 'MG Road 23', 300))
+        first = make_idempotency_key({}, '111', 'MG Road 23', 300, content_fallback=True)
+        self.assertEqual(first, make_idempotency_key({}, '111', 'MG Road 23', 300, content_fallback=True))
+        self.assertNotEqual(first, make_idempotency_key({}, '222', 'MG Road 23', 300, content_fallback=True))
+    
+    @patch('app.Fast2SMSSender')
+    @patch('app.process_sms')
+    def test_webhook_replays_response_to_retries(self, mock_process, mock_sender_class):
+        """Test that a gateway retry of the same message is not processed again"""
+        mock_process.return_value = ({"message": "SMS processed successfully"}, 200)
+        client = app_module.create_app().test_client()
+        body = {'from': '1234567890', 'message': 'MG Road 23', 'message_id': 'gw-1'}
+        
+        first = client.post('/webhook', json=body)
+        second = client.post('/webhook', json=body)
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual(second.get_json(), first.get_json())
+        self.assertEqual(mock_process.call_count, 1)
+    
+    @patch('app.Fast2SMSSender')
+    @patch('app.process_sms')
+    def test_resent_query_without_message_id_is_answered(self, mock_process, mock_sender_class):
+        """Test that a commuter re-sending the same text gets a new reply by default"""
+        mock_process.return_value = ({"message": "SMS processed successfully"}, 200)
+        client = app_module.create_app().test_client()
+        body = {'from': '1234567890', 'message': 'MG Road 23'}
+        
+        client.post('/webhook', json=body)
+        client.post('/webhook', json=body)
+        self.assertEqual(mock_process.call_count, 2)
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Test cases for upstream circuit breakers and degraded replies"""
+    
+    def test_open_half_open_close_cycle(self):
+        """Test that failures open the circuit and trial successes close it"""
+        breaker = CircuitBreaker('maps', min_calls=4, failure_rate_threshold=0.5,
+                                 open_seconds=0.05, half_open_calls=2)
+        for success in (True, False, True, False):
+            breaker.allow_request()
+            breaker.record(success, 0.01)
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(CircuitOpenError):
+            breaker.allow_request()
+        
+        time.sleep(0.06)
+        breaker.allow_request()
+        breaker.allow_request()
+        with self.assertRaises(CircuitOpenError):
+            breaker.allow_request()
+        breaker.record(True, 0.01)
+        breaker.record(True, 0.01)
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.stats()['times_opened'], 1)
+    
+    def test_slow_calls_fail_and_timeout_adapts(self):
+        """Test slow-call failures and the p99-based read timeout"""
+        breaker = CircuitBreaker('sms', min_calls=5, slow_call_seconds=1.0,
+                                 min_timeout=0.5, max_timeout=10.0, timeout_multiplier=3.0)
+        self.assertEqual(breaker.timeout(), 10.0)
+        for _ in range(10):
+            breaker.record(True, 0.4)
+        self.assertAlmostEqual(breaker.timeout(), 1.2)
+        for _ in range(10):
+            breaker.record(True, 2.0)
+        self.assertEqual(breaker.state, 'open')
+    
+    def test_timeout_follows_slower_upstream(self):
+        """Test that a slower but healthy upstream is not cut off forever"""
+        breaker = CircuitBreaker('maps', min_calls=10, open_seconds=0, half_open_calls=3,
+                                 min_timeout=1.0, max_timeout=10.0, timeout_multiplier=3.0)
+        for _ in range(50):
+            breaker.record(True, 0.3)
+        self.assertEqual(breaker.timeout(), 1.0)
+        for _ in range(4):
+            breaker.record(False, 1.0)
+        breaker._open()
+        
+        for _ in range(200):
+            try:
+                breaker.allow_request()
+            except CircuitOpenError:
+                continue
+            timeout = breaker.timeout()
+            breaker.record(timeout >= 1.5, min(timeout, 1.5))
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.times_opened, 1)
+        self.assertGreaterEqual(breaker.timeout(), 1.5)
+    
+    def test_transport_fails_fast_when_open(self):
+        """Test that an open circuit skips the network call"""
+        breaker = CircuitBreaker('maps', min_calls=2, open_seconds=60)
+        transport = HTTPTransport(breaker=breaker)
+        with patch.object(transport.session, 'request', side_effect=requests.exceptions.ConnectionError) as mock_request:
+            for _ in range(2):
+                with self.assertRaises(requests.exceptions.ConnectionError):
+                    transport.get('http://localhost/test')
+            with self.assertRaises(CircuitOpenError):
+                transport.get('http://localhost/test')
+        self.assertEqual(mock_request.call_count, 2)
+    
+    @patch('utils.http_transport.HTTPTransport.get', side_effect=CircuitOpenError("open"))
+    def test_maps_client_degrades_to_cache_or_headway(self, mock_get):
+        """Test degraded answers while the Directions API is unavailable"""
+        cache = ETACache(MemoryKVStore(), ttl=0, fallback_ttl=600)
+        cache.set("MG Road", "23", {'success': True, 'error': '', 'data': {
+            'eta_minutes': 12, 'eta_text': '12 mins', 'departure_time': '2:30 PM', 'next_time': '2:50 PM'
+        }})
+        catalog = RouteCatalog([RouteInfo('23', 'Downtown', (), '', 10), RouteInfo('45', 'Airport', (), '', None)])
+        client = GoogleMapsClient(cache=cache, route_catalog=catalog)
+        
+        stale = client.get_bus_eta("MG Road", "23")
+        self.assertEqual((stale['source'], stale['data']['departure_time']), ('stale_cache', '2:30 PM'))
+        
+        estimate = client.get_bus_eta("Central Station", "23")
+        self.assertEqual(estimate['source'], 'headway_estimate')
+        self.assertIn("every 10 mins", format_eta_response(estimate, "23", "Central Station"))
+        
+        self.assertFalse(client.get_bus_eta("Central Station", "45")['success'])
+    
+    def test_final_directions_answers_are_not_degraded(self):
+        """Test that NOT_FOUND and ZERO_RESULTS get the error reply, not a stale or estimated bus"""
+        catalog = RouteCatalog([RouteInfo('23', 'Downtown', (), '', 10)])
+        for status in ('NOT_FOUND', 'ZERO_RESULTS'):
+            with self.subTest(status=status):
+                cache = ETACache(MemoryKVStore(), ttl=0, fallback_ttl=600)
+                cache.set("Nowhere Lane", "23", {'success': True, 'error': '', 'data': {
+                    'eta_minutes': 12, 'eta_text': '12 mins', 'departure_time': '2:30 PM', 'next_time': '2:50 PM'
+                }})
+                client = GoogleMapsClient(cache=cache, route_catalog=catalog)
+                sms_sender = MagicMock()
+                answer = MagicMock(status_code=200, json=lambda: {'status': status, 'routes': []})
+                with patch('utils.http_transport.HTTPTransport.get', return_value=answer):
+                    result = client.get_bus_eta("Nowhere Lane", "23")
+                    payload, code = app_module.process_sms("9000000001", "Nowhere Lane 23", client, sms_sender)
+                
+                self.assertFalse(result['success'])
+                self.assertNotIn('source', result)
+                self.assertEqual((payload, code), ({"error": "Failed to get ETA"}, 500))
+                sms_sender.send_sms.assert_called_once_with("9000000001", "Unable to fetch ETA. Please try again later.")
+    
+    def test_server_errors_are_degraded(self):
+        """Test that a 5xx from the Directions API still gets the headway estimate"""
+        catalog = RouteCatalog([RouteInfo('23', 'Downtown', (), '', 10)])
+        client = GoogleMapsClient(route_catalog=catalog)
+        with patch('utils.http_transport.HTTPTransport.get', return_value=MagicMock(status_code=503)):
+            self.assertEqual(client.get_bus_eta("Central Station", "23")['source'], 'headway_estimate')
+    
+    def test_health_reports_breakers(self):
+        """Test that breaker state is exposed on /health"""
+        health = app_module.create_app().test_client().get('/health').get_json()
+        self.assertIn('circuit_breakers', health)
+
+class TestRetryScheduler(unittest.TestCase):
+    """Test cases for background SMS retries"""
+    
+    def setUp(self):
+        self.scheduler = RetryScheduler(base_delay=0.01, max_delay=0.02, deadline=5)
+    
+    def tearDown(self):
+        self.scheduler.stop()
+    
+    def wait_for(self, condition, timeout=2):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.005)
+    
+    def test_retries_until_success_without_blocking(self):
+        """Test that schedule returns at once and the retry succeeds later"""
+        outcomes = iter([{'success': False, 'error': 'timeout'}, {'success': True, 'error': ''}])
+        send = MagicMock(side_effect=lambda phone, message: next(outcomes))
+        
+        started = time.time()
+        self.assertTrue(self.scheduler.schedule(send, ('123', 'hi'), max_attempts=4))
+        self.assertLess(time.time() - started, 0.01)
+        
+        self.wait_for(lambda: self.scheduler.stats()['succeeded'] == 1)
+        stats = self.scheduler.stats()
+        self.assertEqual((stats['attempts'], stats['succeeded'], stats['pending']), (2, 1, 0))
+        send.assert_called_with('123', 'hi')
+    
+    def test_dead_letters_on_exhaustion_deadline_and_permanent_failure(self):
+        """Test that failed tasks end up in the dead-letter store with a reason"""
+        failing = MagicMock(return_value={'success': False, 'error': 'down', 'response': None})
+        self.scheduler.schedule(failing, ('1', 'a'), label='exhausted', max_attempts=3)
+        self.assertFalse(self.scheduler.schedule(failing, ('2', 'b'), label='expired', deadline=time.time()))
+        rejected = MagicMock(return_value={'success': False, 'error': 'bad number', 'response': {}})
+        self.scheduler.schedule(rejected, ('3', 'c'), label='permanent',
+                                retryable=lambda result: result['response'] is None)
+        
+        self.wait_for(lambda: len(self.scheduler.dead_letters) == 3)
+        reasons = {record['label']: record['reason'] for record in self.scheduler.dead_letters.recent()}
+        self.assertEqual(reasons, {'exhausted': 'exhausted', 'expired': 'expired', 'permanent': 'permanent'})
+        self.assertEqual(failing.call_count, 2)
+    
+    def test_dead_letter_file(self):
+        """Test that dead letters are appended to the configured file"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'dead.jsonl')
+            store = DeadLetterStore(path)
+            store.add({'label': 'SMS to 1', 'reason': 'exhausted'})
+            with open(path) as f:
+                self.assertEqual(json.loads(f.readline())['reason'], 'exhausted')
+    
+    @patch('utils.sms_sender.get_retry_scheduler')
+    @patch('utils.http_transport.HTTPTransport.post', side_effect=requests.exceptions.ConnectTimeout)
+    def test_send_sms_with_retry_schedules_instead_of_sleeping(self, mock_post, mock_get_scheduler):
+        """Test that a send that could not connect is handed to the scheduler"""
+        self.scheduler.base_delay = 60
+        mock_get_scheduler.return_value = self.scheduler
+        with patch('time.sleep') as mock_sleep:
+            result = Fast2SMSSender().send_sms_with_retry("1234567890", "Test message")
+        self.assertFalse(result['success'])
+        self.assertTrue(result['retry_scheduled'])
+        self.assertEqual(self.scheduler.pending(), 1)
+        mock_sleep.assert_not_called()
+
+class TestMetrics(unittest.TestCase):
+    """Test cases for the metrics subsystem and /metrics"""
+    
+    def test_histogram_buckets_are_cumulative(self):
+        """Test histogram rendering in the text exposition format"""
+        latency = metrics.histogram('test_latency_seconds', 'Test latency', ['stage'], buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            latency.labels('parse').observe(value)
+        text = metrics.generate_latest()
+        self.assertIn('# TYPE test_latency_seconds histogram', text)
+        self.assertIn('test_latency_seconds_bucket{stage="parse",le="0.1"} 1.0', text)
+        self.assertIn('test_latency_seconds_bucket{stage="parse",le="1.0"} 3.0', text)
+        self.assertIn('test_latency_seconds_bucket{stage="parse",le="+Inf"} 4.0', text)
+        self.assertIn('test_latency_seconds_count{stage="parse"} 4.0', text)
+    
+    def test_multiprocess_mode_sums_workers(self):
+        """Test that forked workers' mmap files are summed and dead gauges dropped"""
+        import multiprocessing
+        requests_total = metrics.counter('test_mp_requests_total', 'Test requests')
+        in_progress = metrics.gauge('test_mp_in_progress', 'Test gauge')
+        
+        def worker():
+            requests_total.inc(2)
+            in_progress.set(5)
+        
+        with tempfile.TemporaryDirectory() as tmp, \
+             patch.object(Config, 'METRICS_MULTIPROC_DIR', tmp), \
+             patch.object(metrics, '_stores', {}):
+            process = multiprocessing.get_context('fork').Process(target=worker)
+            process.start()
+            process.join()
+            requests_total.inc()
+            in_progress.set(1)
+            
+            text = metrics.generate_latest()
+            self.assertIn('test_mp_requests_total 3.0', text)
+            self.assertIn('test_mp_in_progress 6.0', text)
+            
+            metrics.mark_process_dead(process.pid)
+            self.assertIn('test_mp_in_progress 1.0', metrics.generate_latest())
+    
+    @patch('app.Fast2SMSSender')
+    def test_metrics_endpoint_counts_webhooks(self, mock_sender_class):
+        """Test that webhook requests and pipeline stages show up on /metrics"""
+        client = app_module.create_app().test_client()
+        client.post('/webhook', json={'from': '1234567890', 'message': 'hello'})
+        
+        response = client.get('/metrics')
+        text = response.get_data(as_text=True)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn('sms_webhook_requests_total{status="400"}', text)
+        self.assertIn('sms_pipeline_stage_seconds_count{stage="parse"}', text)
+
+class TestLogging(unittest.TestCase):
+    """Test cases for structured, queued logging"""
+    
+    def make_record(self, level=logging.INFO, msg="Replied to %s", args=('123',), **extra):
+        record = logging.LogRecord('app', level, __file__, 1, msg, args, None)
+        record.__dict__.update(extra)
+        return record
+    
+    def test_json_format_with_correlation_id_and_extras(self):
+        """Test that JSON lines carry the request's correlation ID and extra fields"""
+        set_correlation_id('req-42')
+        record = self.make_record(route='23')
+        CorrelationFilter().filter(record)
+        entry = json.loads(JSONFormatter().format(record))
+        self.assertEqual(entry['correlation_id'], 'req-42')
+        self.assertEqual(entry['message'], 'Replied to 123')
+        self.assertEqual((entry['level'], entry['route']), ('INFO', '23'))
+    
+    def test_sampling_only_drops_sampled_info(self):
+        """Test that sampling drops success logs but never warnings"""
+        sampling = SamplingFilter(0.0)
+        self.assertFalse(sampling.filter(self.make_record(sample=True)))
+        self.assertTrue(sampling.filter(self.make_record()))
+        self.assertTrue(sampling.filter(self.make_record(level=logging.WARNING, sample=True)))
+    
+    def test_queue_handler_does_not_block_on_slow_output(self):
+        """Test that records are written by the writer thread and dropped when the queue is full"""
+        written = []
+        release = threading.Event()
+        
+        class SlowHandler(logging.Handler):
+            def emit(self, record):
+                release.wait(2)
+                written.append(self.format(record))
+        
+        handler = QueueLogHandler([SlowHandler()], max_size=2)
+        started = time.perf_counter()
+        for i in range(10):
+            handler.handle(self.make_record(args=(i,)))
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertGreater(handler.dropped, 0)
+        
+        release.set()
+        handler.stop()
+        self.assertEqual(len(written), 10 - handler.dropped)
+        self.assertEqual(written[0], 'Replied to 0')
+    
+    @patch('app.Fast2SMSSender')
+    def test_webhook_echoes_request_id(self, mock_sender_class):
+        """Test that the webhook uses and returns the caller's X-Request-ID"""
+        client = app_module.create_app().test_client()
+        response = client.post('/webhook', json={'from': '1234567890'}, headers={'X-Request-ID': 'abc123'})
+        self.assertEqual(response.headers['X-Request-ID'], 'abc123')
+        self.assertTrue(client.post('/webhook', json={}).headers['X-Request-ID'])
+
+class TestStartup(unittest.TestCase):
+    """Test cases for lazy configuration checks and per-worker startup"""
+    
+    def test_import_without_api_keys(self):
+        """Test that the service modules import without API keys or requests"""
+        env = {key: value for key, value in os.environ.items()
+               if key not in ('GOOGLE_MAPS_API_KEY', 'FAST2SMS_API_KEY')}
+        code = "import sys, app, asgi_app; sys.exit('requests' in sys.modules)"
+        result = subprocess.run([sys.executable, '-c', code], env=env, cwd=os.path.dirname(app_module.__file__),
+                                capture_output=True, text=True)
+        
+        self.assertEqual(result.returncode, 0, result.stderr)
+    
+    def test_create_app_validates_config(self):
+        """Test that missing API keys are reported when the app is created"""
+        with patch.object(Config, 'GOOGLE_MAPS_API_KEY', None):
+            with self.assertRaises(ValueError):
+                app_module.create_app()
+    
+    def test_init_worker_builds_pools(self):
+        """Test that a worker builds its own upstream sessions after forking"""
+        init_worker()
+        
+        for name in ('maps', 'sms'):
+            transport = get_transport(name)
+            self.assertIsNotNone(transport._session)
+            self.assertEqual(transport._pid, os.getpid())
+    
+    def test_init_worker_starts_reply_workers(self):
+        """Test that queued replies are sent by a worker before its first request"""
+        done = threading.Event()
+        job_queue = MemoryJobQueue()
+        # Created before the fork, with a job queued by another worker
+        pool = ReplyWorkerPool(job_queue, lambda job: done.set(), workers=1)
+        job_queue.put({'phone_number': '1234567890'})
+        
+        init_worker(open_pools=False)
+        self.assertTrue(done.wait(2))
+        pool.stop()
+
+class TestWorkerProfiles(unittest.TestCase):
+    """Test cases for gunicorn worker profile sizing"""
+    
+    def test_sync_profile(self):
+        """Test that sync workers are sized 2 x cores + 1 with one request each"""
+        settings = tune_profile('sync', cpus=2)
+        
+        self.assertEqual(settings['worker_class'], 'sync')
+        self.assertEqual(settings['workers'], 5)
+        self.assertEqual(settings['threads'], 1)
+        self.assertEqual(settings['concurrency'], 1)
+    
+    def test_gthread_threads_follow_upstream_latency(self):
+        """Test that gthread threads grow with upstream latency, up to the cap"""
+        fast = tune_profile('gthread', cpus=2, upstream_latency_ms=30, request_cpu_ms=3)
+        slow = tune_profile('gthread', cpus=2, upstream_latency_ms=3000, request_cpu_ms=3)
+        
+        self.assertEqual(fast['workers'], 2)
+        self.assertEqual(fast['threads'], 11)
+        self.assertEqual(slow['threads'], 64)
+        self.assertEqual(tune_profile('gthread', cpus=2, threads=8)['threads'], 8)
+    
+    def test_gevent_and_asgi_profiles(self):
+        """Test the gevent connection floor and the ASGI application target"""
+        gevent = tune_profile('gevent', cpus=4, upstream_latency_ms=300, request_cpu_ms=3)
+        asgi = tune_profile('asgi', cpus=4, workers=2)
+        
+        self.assertEqual(gevent['workers'], 4)
+        self.assertEqual(gevent['worker_connections'], 1000)
+        self.assertEqual(asgi['worker_class'], 'uvicorn.workers.UvicornWorker')
+        self.assertEqual(asgi['wsgi_app'], 'asgi_app:create_asgi_app()')
+        self.assertEqual(asgi['workers'], 2)
+    
+    def test_resolve_profile(self):
+        """Test unknown profiles are rejected and missing workers fall back to gthread"""
+        self.assertEqual(resolve_profile('Sync'), 'sync')
+        with self.assertRaises(ValueError):
+            resolve_profile('eventlet')
+        with patch('utils.worker_profiles.importlib.util.find_spec', return_value=None):
+            self.assertEqual(resolve_profile('gevent'), 'gthread')
+
+class TestBatchWebhook(unittest.TestCase):
+    """Test cases for the batch webhook endpoint"""
+    
+    ETA = {'success': True, 'error': '', 'data': {
+        'eta_text': '12 mins', 'departure_time': '2:30 PM', 'next_time': '2:50 PM'
+    }}
+    
+    BATCH = [
+        {'from': '9000000001', 'message': 'MG Road 23'},
+        {'from': '9000000002', 'message': 'mg road  23'},
+        {'from': '9000000003', 'message': 'Central Station 45'},
+        {'from': '9000000004', 'message': 'MG Road 23'},
+        {'from': '9000000005', 'message': 'Hello'},
+        {'message': 'MG Road 23'}
+    ]
+    
+    def test_parse_batch_body(self):
+        """Test JSON array, wrapped array and NDJSON bodies"""
+        messages = [{'from': '1', 'message': 'MG Road 23'}, {'from': '2', 'message': 'MG Road 45'}]
+        ndjson = '\n'.join(json.dumps(message) for message in messages) + '\n'
+        
+        self.assertEqual(parse_batch_body(json.dumps(messages).encode()), messages)
+        self.assertEqual(parse_batch_body(json.dumps({'messages': messages}).encode()), messages)
+        self.assertEqual(parse_batch_body(ndjson.encode()), messages)
+        with self.assertRaises(ValueError):
+            parse_batch_body(b'not json')
+        with self.assertRaises(ValueError):
+            parse_batch_body(b'')
+    
+    def test_batch_dedupes_lookups_and_groups_replies(self):
+        """Test one lookup per distinct query and one send per distinct reply"""
+        sends = []
+        
+        def fake_send(phone_numbers, message):
+            sends.append((sorted(phone_numbers), message))
+            return {'success': True, 'error': '', 'response': {'return': True}}
+        
+        with patch.object(GoogleMapsClient, 'get_bus_eta', return_value=self.ETA) as mock_eta, \
+             patch.object(Fast2SMSSender, 'send_bulk_sms', side_effect=fake_send):
+            response = app_module.create_app().test_client().post('/webhook/batch', json=self.BATCH)
+        
+        body = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in body['results']], [200, 200, 200, 200, 400, 400])
+        self.assertEqual([result['index'] for result in body['results']], list(range(6)))
+        self.assertEqual(mock_eta.call_count, 2)
+        # "mg road  23" shares the lookup but its reply echoes its own spelling
+        self.assertIn(
+            (['9000000001', '9000000004'], "Route 23 from MG Road: Next bus in 12 mins at 2:30 PM. Next: 2:50 PM"),
+            sends
+        )
+        self.assertEqual(len(sends), 4)
+    
+    def test_batch_limits(self):
+        """Test oversized and malformed batches are rejected"""
+        client = app_module.create_app().test_client()
+        
+        with patch.object(Config, 'WEBHOOK_BATCH_MAX_MESSAGES', 2):
+            self.assertEqual(client.post('/webhook/batch', json=self.BATCH).status_code, 413)
+        self.assertEqual(client.post('/webhook/batch', data='{"from": 1').status_code, 400)
+    
+    @unittest.skipIf(async_clients.aiohttp is None, "aiohttp is not installed")
+    def test_asgi_batch(self):
+        """Test the batch endpoint of the asyncio service mode"""
+        from asgi_app import create_asgi_app
+        sends = []
+        
+        async def fake_eta(origin, route_number):
+            return self.ETA
+        
+        async def fake_send(phone_numbers, message):
+            sends.append(sorted(phone_numbers))
+            return {'success': True, 'error': '', 'response': {'return': True}}
+        
+        with patch.object(async_clients.AsyncGoogleMapsClient, 'get_bus_eta', side_effect=fake_eta) as mock_eta, \
+             patch.object(async_clients.AsyncFast2SMSSender, 'send_bulk_sms', side_effect=fake_send):
+            status, body = TestASGIApp()._call(create_asgi_app(), 'POST', '/webhook/batch', self.BATCH)
+        
+        self.assertEqual(status, 200)
+        self.assertEqual(body['statuses'], {'200': 4, '400': 2})
+        self.assertEqual(mock_eta.call_count, 2)
+        self.assertIn(['9000000001', '9000000004'], sends)
+
+class TestETAPrefetcher(unittest.TestCase):
+    """Test cases for the popularity sketch and the ETA prefetcher"""
+    
+    def test_space_saving_keeps_heavy_hitters(self):
+        """Test that frequent keys survive a long tail of one-off keys"""
+        sketch = SpaceSaving(capacity=10)
+        for i in range(2000):
+            sketch.add('hot' if i % 4 == 0 else 'warm' if i % 4 == 1 else f'tail{i}')
+        
+        top = sketch.top(2)
+        self.assertEqual([key for key, count, error, value in top], ['hot', 'warm'])
+        self.assertGreaterEqual(top[0][1], 500)
+        self.assertLessEqual(len(sketch), 10)
+    
+    def test_popularity_buckets_and_daily_decay(self):
+        """Test that counts are kept per time of day and decay from day to day"""
+        popularity = QueryPopularity(bucket_minutes=30, daily_decay=0.5)
+        morning = time.mktime((2026, 3, 2, 8, 10, 0, 0, 0, -1))
+        for _ in range(4):
+            popularity.record("MG Road", "23", now=morning)
+        popularity.record("Central Station", "45", now=morning + 12 * 3600)
+        
+        self.assertEqual(popularity.top(5, now=morning + 600)[0][1:], ("MG Road", "23", 4))
+        self.assertEqual(popularity.top(5, now=morning + 86400)[0][3], 2)
+        self.assertEqual(popularity.top(5, now=morning + 3600), [])
+    
+    def test_prefetch_refreshes_expiring_pairs_within_budget(self):
+        """Test that only popular, expiring pairs are refreshed, hottest first"""
+        cache = ETACache(MemoryKVStore(), ttl=60)
+        client = MagicMock()
+        client.cache = cache
+        client.single_flight = SingleFlight()
+        refreshed = []
+        
+        def refresh(origin, route_number):
+            refreshed.append((origin, route_number))
+            return {'success': True, 'error': '', 'data': {}}
+        
+        client.refresh_bus_eta = refresh
+        prefetcher = ETAPrefetcher(client, top_k=10, min_hits=2, budget_per_minute=2, lead=15)
+        for origin, route, hits in (("MG Road", "23", 5), ("Bus Stop A", "12", 3),
+                                    ("Central Station", "45", 4), ("Airport", "7", 1)):
+            for _ in range(hits):
+                prefetcher.popularity.record(origin, route)
+        cache.set("Central Station", "45", {'success': True})
+        
+        self.assertEqual(prefetcher.run_once(), 2)
+        self.assertEqual(refreshed, [("MG Road", "23"), ("Bus Stop A", "12")])
+        self.assertEqual(prefetcher.run_once(), 0)
+        self.assertEqual(prefetcher.stats()['over_budget'], 1)
+    
+    def test_budget_shared_by_workers(self):
+        """Test that prefetchers sharing a SQLite budget store make budget_per_minute calls together"""
+        refreshed = []
+        
+        def make_prefetcher(budget_store):
+            client = MagicMock()
+            client.cache = ETACache(MemoryKVStore(), ttl=60)
+            client.single_flight = SingleFlight()
+            client.refresh_bus_eta = lambda origin, route_number: refreshed.append(origin) or {'success': True}
+            prefetcher = ETAPrefetcher(client, min_hits=1, budget_per_minute=3, budget_store=budget_store)
+            for stop in range(5):
+                prefetcher.popularity.record(f"Stop {stop}", "23")
+            return prefetcher
+        
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'budget.sqlite3')
+            # Two workers, each with its own connection to the budget file
+            workers = [make_prefetcher(SQLiteKVStore(path)) for _ in range(2)]
+            refreshes = [worker.run_once() for worker in workers]
+        
+        self.assertEqual(refreshes, [3, 0])
+        self.assertEqual(len(refreshed), 3)
+        self.assertEqual(workers[1].stats()['over_budget'], 1)
+    
+    @patch('utils.http_transport.HTTPTransport.get')
+    def test_maps_client_records_api_queries(self, mock_get):
+        """Test that lookups answered by the API are counted, unknown routes are not"""
+        mock_get.return_value = MagicMock(status_code=200, json=MagicMock(return_value={'status': 'ZERO_RESULTS'}))
+        client = GoogleMapsClient(cache=ETACache(MemoryKVStore(), ttl=60))
+        client.prefetcher = ETAPrefetcher(client)
+        # As if the refresh thread were already running in this process
+        client.prefetcher._pid = os.getpid()
+        
+        client.get_bus_eta("MG Road", "23")
+        client.get_bus_eta("MG Road", "999")
+        
+        self.assertEqual([pair[1:3] for pair in client.prefetcher.popularity.top(5)], [("MG Road", "23")])
+
+class TestHeadwayEstimator(unittest.TestCase):
+    """Test cases for estimating the following bus without extra API calls"""
+    
+    def setUp(self):
+        self.estimator = HeadwayEstimator(RouteCatalog([RouteInfo('45', 'Airport', (), '', 15)]))
+        for minutes in (14 * 60 + 30, 14 * 60 + 50, 15 * 60 + 10, 23 * 60 + 50):
+            self.estimator.observe("MG Road", "23", minutes * 60)
+        self.estimator.observe("MG Road", "23", 86400 + 10 * 60 + 15)
+    
+    def queries(self):
+        return [
+            ("mg road", "23", 14 * 3600 + 30 * 60),    # observed, then a gap
+            ("MG Road", "23", 23 * 3600 + 50 * 60),    # past midnight
+            ("Central Station", "45", 8 * 3600),       # catalog headway
+            ("Bus Stop A", "12", 8 * 3600)             # nothing known
+        ]
+    
+    def test_observed_departures_and_headway_fallback(self):
+        """Test the next observed buses, wrapping past midnight, then the route headway"""
+        following = self.estimator.next_departures(self.queries(), count=2)
+        
+        self.assertEqual(following[0], [14 * 3600 + 50 * 60, 15 * 3600 + 10 * 60])
+        self.assertEqual(following[1], [86400 + 10 * 60, None])
+        self.assertEqual(following[2], [8 * 3600 + 900, 8 * 3600 + 1800])
+        self.assertEqual(following[3], [None, None])
+    
+    @unittest.skipUnless(headway_estimator.HAS_NUMPY, "numpy is not installed")
+    def test_vectorized_matches_bisect(self):
+        """Test that the numpy batch pass gives the same answers as per-query bisect"""
+        queries = self.queries() * 10
+        with patch.object(headway_estimator, 'VECTOR_MIN_QUERIES', 1):
+            vectorized = self.estimator.next_departures(queries, count=3)
+        with patch.object(headway_estimator, 'HAS_NUMPY', False):
+            self.assertEqual(self.estimator.next_departures(queries, count=3), vectorized)
+    
+    def test_fill_copies_answers(self):
+        """Test that next_time is filled in a copy of a Directions API answer"""
+        answer = {'success': True, 'error': '', 'data': {
+            'origin': 'MG Road', 'route_number': '23', 'departure_time': '2:30 PM', 'next_time': 'Unknown'
+        }}
+        scheduled = {'success': True, 'source': 'schedule', 'data': dict(answer['data'])}
+        
+        filled = self.estimator.fill([answer, scheduled])
+        
+        self.assertEqual(filled[0]['data']['next_time'], '2:50 PM')
+        self.assertEqual(answer['data']['next_time'], 'Unknown')
+        self.assertIs(filled[1], scheduled)
+    
+    def test_schedule_headways(self):
+        """Test hourly headways derived from a GTFS feed"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_gtfs_feed(tmpdir)
+            profiles = schedule_headways(GTFSSchedule.load(tmpdir))
+        
+        self.assertEqual(profiles['23'][14], 1200)
+        self.assertEqual(HeadwayEstimator(route_headways=profiles).headway('23', 14 * 3600 + 100), 1200)
+
+class TestTrafficCapture(unittest.TestCase):
+    """Test cases for traffic capture and upstream playback"""
+    
+    DIRECTIONS = {'status': 'OK', 'routes': [{'legs': [{
+        'duration': {'value': 720, 'text': '12 mins'}, 'departure_time': {'text': '2:30 PM'}
+    }]}]}
+    
+    def _response(self, method, url, **kwargs):
+        body = self.DIRECTIONS if method == 'GET' else {'return': True, 'request_id': 'r1', 'message': ['sent']}
+        return MagicMock(status_code=200, text=json.dumps(body), json=lambda: body)
+    
+    def test_webhook_and_upstream_calls_captured(self):
+        """Test that a webhook is recorded with its parse result and upstream calls, without secrets"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'capture.jsonl')
+            try:
+                with patch.object(Config, 'TRAFFIC_CAPTURE_PATH', path), \
+                     patch.object(requests.Session, 'request', side_effect=self._response):
+                    client = app_module.create_app().test_client()
+                    response = client.post('/webhook', json={'from': '9876543210', 'message': 'Capture Test Stop 23'})
+            finally:
+                configure_traffic_capture()
+            webhooks, upstreams = load_capture(path)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(webhooks), 1)
+        webhook = webhooks[0]
+        pseudonym = pseudonymize_phone('9876543210', Config.SECRET_KEY)
+        self.assertEqual(webhook['body'], {'from': pseudonym, 'message': 'Capture Test Stop 23'})
+        self.assertEqual(webhook['parsed'][0]['location'], 'Capture Test Stop')
+        self.assertEqual(webhook['status'], 200)
+        self.assertNotIn('9876543210', json.dumps(webhooks + upstreams))
+        
+        self.assertEqual([record['upstream'] for record in upstreams], ['maps', 'sms'])
+        self.assertNotIn('key', upstreams[0]['params'])
+        self.assertEqual(json.loads(upstreams[0]['response']), self.DIRECTIONS)
+        self.assertEqual(upstreams[1]['json']['numbers'], pseudonym)
+        self.assertTrue(all(record['id'] == webhook['id'] for record in upstreams))
+    
+    def test_redact_and_pseudonymize(self):
+        """Test stable pseudonyms, comma-separated numbers and dropped secrets"""
+        redacted = redact({'numbers': '9000000001,9000000002', 'key': 'secret', 'items': [{'from': '9000000001'}]}, 's')
+        
+        first, second = redacted['numbers'].split(',')
+        self.assertNotIn('key', redacted)
+        self.assertEqual(redacted['items'][0]['from'], first)
+        self.assertNotEqual(first, second)
+        self.assertRegex(first, r'^9\d{9}$')
+        self.assertNotEqual(pseudonymize_phone('9000000001', 'other'), first)
+        self.assertEqual(redact({'from': '9000000001'}), {'from': '9000000001'})
+    
+    def test_encode_body_round_trip(self):
+        """Test that captured JSON, NDJSON and text bodies are sent again as recorded"""
+        for body in (b'{"from": "1", "message": "MG Road 23"}', b'{"message": "a"}\n{"message": "b"}\n', b'MG Road 23'):
+            body_format, decoded = decode_body(body)
+            self.assertEqual(decode_body(encode_body(body_format, decoded)), (body_format, decoded))
+        self.assertEqual(decode_body(b'{"message": "a"}\n{"message": "b"}\n')[0], 'ndjson')
+    
+    def test_playback_matches_cycles_and_falls_back(self):
+        """Test that replayed requests get the responses recorded for the same request"""
+        def record(origin, text, ms):
+            return {'upstream': 'maps', 'status': 200, 'response': text, 'ms': ms, 'json': None,
+                    'params': {'origin': origin, 'destination': 'Airport', 'departure_time': 'now'}}
+        playback = UpstreamPlayback([record('MG Road', 'a', 5.0), record('Central', 'b', 7.0),
+                                     record('MG Road', 'c', 9.0)])
+        params = {'origin': 'MG Road', 'destination': 'Airport', 'departure_time': '1792316074', 'key': 'k'}
+        
+        self.assertEqual([playback.lookup('maps', params)[1] for _ in range(3)], ['a', 'c', 'a'])
+        self.assertEqual(playback.lookup('maps', {'origin': 'Unknown'})[1], 'a')
+        self.assertIsNone(playback.lookup('sms', json_body={'message': 'hi'}))
+        self.assertEqual(playback.counters, {'matched': 3, 'fallback': 1, 'unmatched': 1})
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,349 @@
+import asyncio
+import json
+import logging
+import time
+from config import Config
+from utils.circuit_breaker import CircuitOpenError, get_breaker
+from utils.eta_cache import make_eta_cache_key
+from utils.metrics import ETA_SECONDS, SEND_SECONDS, count_eta_lookup, count_sms_send
+from utils.maps_client import (
+    build_directions_params, finish_eta_lookup, lookup_local_eta, parse_directions_response, store_fetched_eta
+)
+from utils.route_catalog import RouteCatalog, DEFAULT_ROUTES, route_not_found
+from utils.single_flight import AsyncSingleFlight
+from utils.sms_sender import build_sms_request, is_retryable_sms_status, parse_sms_response
+from utils.traffic_capture import get_traffic_recorder
+
+try:
+    import aiohttp
+except ImportError:  # Only needed for the ASGI service mode
+    aiohttp = None
+
+
+def create_async_http_client():
+    """
+    Create a pooled aiohttp.ClientSession configured from Config
+
+    Returns:
+        aiohttp.ClientSession: Session bound to the running event loop
+    """
+    return aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(
+            sock_connect=Config.HTTP_CONNECT_TIMEOUT,
+            sock_read=Config.HTTP_READ_TIMEOUT
+        ),
+        connector=aiohttp.TCPConnector(limit=Config.ASYNC_HTTP_MAX_CONNECTIONS)
+    )
+
+
+async def run_blocking(resources, func, *args):
+    """
+    Call func, in a worker thread if any resource may block
+
+    SQLite and log-file stores and the traffic recorder wait on disk I/O
+    and on other processes' locks (a SQLite BEGIN IMMEDIATE can wait
+    seconds); on the event loop that wait would stall every request of
+    the worker. Calls touching only in-memory stores stay on the loop.
+
+    Args:
+        resources (iterable): Stores or recorders func uses (None entries
+            are ignored); each has a 'blocking' attribute
+        func (callable): Function to call
+        *args: Arguments for func
+
+    Returns:
+        The value returned by func
+    """
+    if any(resource is not None and resource.blocking for resource in resources):
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+
+async def request_json(http_client, upstream, method, url, **kwargs):
+    """
+    Send a request through the upstream's circuit breaker
+
+    Args:
+        http_client (aiohttp.ClientSession): Session to send the request on
+        upstream (str): Upstream name, e.g. 'maps' or 'sms'
+        method (str): HTTP method
+        url (str): Request URL
+        **kwargs: Passed to aiohttp.ClientSession.request
+
+    Returns:
+        tuple: (status code, decoded JSON body or None if the status is not 200)
+
+    Raises:
+        CircuitOpenError: If the upstream's circuit is open
+    """
+    breaker = get_breaker(upstream)
+    breaker.allow_request()
+    timeout = aiohttp.ClientTimeout(sock_connect=Config.HTTP_CONNECT_TIMEOUT, sock_read=breaker.timeout())
+    start = time.monotonic()
+    success = False
+    recorder = get_traffic_recorder()
+    status = text = error = None
+    try:
+        async with http_client.request(method, url, timeout=timeout, **kwargs) as response:
+            success = response.status < 500
+            status = response.status
+            if recorder is not None:
+                text = await response.text()
+            if response.status != 200:
+                return response.status, None
+            if text is not None:
+                return response.status, json.loads(text)
+            return response.status, await response.json(content_type=None)
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        elapsed = time.monotonic() - start
+        breaker.record(success, elapsed)
+        if recorder is not None:
+            record = recorder.upstream_record(upstream, method, url, kwargs.get('params'), kwargs.get('json'),
+                                              status, text, elapsed, error)
+            await run_blocking([recorder], recorder.write, record)
+
+
+class AsyncGoogleMapsClient:
+    """asyncio counterpart of GoogleMapsClient"""
+
+    def __init__(self, cache=None, http_client=None, schedule=None, stop_resolver=None,
+                 route_catalog=None):
+        """
+        Initialize the client with API key
+
+        Args:
+            cache (ETACache): Optional cache consulted before calling the API
+            schedule (GTFSSchedule): Optional timetable consulted first
+            stop_resolver (StopResolver): Optional resolver for free-text origins
+            route_catalog (RouteCatalog): Route destinations (defaults to the built-in routes)
+            http_client (aiohttp.ClientSession): Client to use (created lazily if None)
+        """
+        self.api_key = Config.GOOGLE_MAPS_API_KEY
+        self.base_url = Config.GOOGLE_MAPS_BASE_URL
+        self.cache = cache
+        self.schedule = schedule
+        self.stop_resolver = stop_resolver
+        self.route_catalog = route_catalog if route_catalog is not None else RouteCatalog(DEFAULT_ROUTES)
+        self.http_client = http_client
+        self.single_flight = AsyncSingleFlight()
+        self.prefetcher = None
+        self.headways = None
+
+        if not self.api_key:
+            raise ValueError("Google Maps API key is not configured")
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is required for the ASGI service mode (pip install aiohttp)")
+
+    async def get_bus_eta(self, origin, route_number):
+        """
+        Get bus ETA from the timetable, the cache, or the Directions API
+
+        Concurrent lookups for the same (origin, route) pair share a single
+        Directions API call, and stale entries are refreshed in the background.
+
+        Args:
+            origin (str): The starting location
+            route_number (str): The bus route number
+
+        Returns:
+            dict: Standardized ETA data with success status and error handling
+        """
+        with ETA_SECONDS.time():
+            result = await self._lookup_bus_eta(origin, route_number)
+        count_eta_lookup(result)
+        return result
+
+    async def _lookup_bus_eta(self, origin, route_number):
+        """Answer an ETA query from the first source that has it (see get_bus_eta)"""
+        # Cache and fallback reads hit SQLite or the log file like the writes do
+        store = self.cache.store if self.cache is not None else None
+        origin, answer = await run_blocking([store], lookup_local_eta, self, origin, route_number)
+        if answer is not None:
+            return answer
+
+        key = make_eta_cache_key(origin, route_number)
+        result = await self.single_flight.do(key, self.refresh_bus_eta, origin, route_number)
+        return await run_blocking([store], finish_eta_lookup, self, origin, route_number, result)
+
+    async def refresh_bus_eta(self, origin, route_number):
+        """Fetch a new ETA from the API and store it in the cache"""
+        result = await self.fetch_bus_eta(origin, route_number)
+        # A SQLite or log cache write waits on disk and on other workers
+        store = self.cache.store if self.cache is not None else None
+        await run_blocking([store], store_fetched_eta, self, origin, route_number, result)
+        return result
+
+    async def fetch_bus_eta(self, origin, route_number):
+        """
+        Get bus ETA using Google Maps Directions API
+
+        Args:
+            origin (str): The starting location
+            route_number (str): The bus route number
+
+        Returns:
+            dict: Standardized ETA data with success status and error handling
+        """
+        route = self.route_catalog.get(route_number)
+        if route is None:
+            return route_not_found(route_number)
+
+        try:
+            if self.http_client is None:
+                self.http_client = create_async_http_client()
+
+            destination = route.destination
+            params = build_directions_params(origin, destination, self.api_key)
+            status, data = await request_json(self.http_client, 'maps', 'GET', self.base_url, params=params)
+            if status != 200:
+                logging.error("Google Maps API request failed with status %s", status)
+                return {
+                    'success': False,
+                    'error': f'Google Maps API error: {status}',
+                    'data': None,
+                    'transient': status >= 500
+                }
+
+            return parse_directions_response(data, origin, destination, route_number)
+
+        except CircuitOpenError:
+            logging.warning("Google Maps circuit is open, skipping API call")
+            return {
+                'success': False,
+                'error': 'Google Maps API unavailable (circuit open)',
+                'data': None,
+                'transient': True
+            }
+        except asyncio.TimeoutError:
+            logging.error("Google Maps API request timed out")
+            return {
+                'success': False,
+                'error': 'Request to Google Maps API timed out',
+                'data': None,
+                'transient': True
+            }
+        except aiohttp.ClientError as e:
+            logging.error("Google Maps API request error: %s", e)
+            return {
+                'success': False,
+                'error': f'Google Maps API request error: {str(e)}',
+                'data': None,
+                'transient': isinstance(e, aiohttp.ClientConnectionError)
+            }
+        except Exception as e:
+            logging.error("Unexpected error in Google Maps client: %s", e)
+            return {
+                'success': False,
+                'error': f'Unexpected error: {str(e)}',
+                'data': None
+            }
+
+    async def aclose(self):
+        """Close pooled connections"""
+        if self.http_client is not None:
+            await self.http_client.close()
+            self.http_client = None
+
+
+class AsyncFast2SMSSender:
+    """asyncio counterpart of Fast2SMSSender"""
+
+    def __init__(self, http_client=None):
+        """
+        Initialize the sender with API key and base URL
+
+        Args:
+            http_client (aiohttp.ClientSession): Client to use (created lazily if None)
+        """
+        self.api_key = Config.FAST2SMS_API_KEY
+        self.base_url = Config.FAST2SMS_BASE_URL
+        self.http_client = http_client
+
+        if not self.api_key:
+            raise ValueError("Fast2SMS API key is not configured")
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is required for the ASGI service mode (pip install aiohttp)")
+
+    async def send_sms(self, phone_number, message):
+        """Send SMS to one recipient (see send_bulk_sms)"""
+        return await self.send_bulk_sms([phone_number], message)
+
+    async def send_bulk_sms(self, phone_numbers, message):
+        """
+        Send the same SMS to several recipients in one Fast2SMS API call
+
+        Args:
+            phone_numbers (list): The recipients' phone numbers
+            message (str): The message to send
+
+        Returns:
+            dict: Success status and details
+        """
+        with SEND_SECONDS.time():
+            result = await self._post_sms(phone_numbers, message)
+        count_sms_send(result, len(phone_numbers))
+        return result
+
+    async def _post_sms(self, phone_numbers, message):
+        """Make the Fast2SMS API call for send_bulk_sms"""
+        try:
+            if self.http_client is None:
+                self.http_client = create_async_http_client()
+
+            headers, payload = build_sms_request(self.api_key, phone_numbers, message)
+            status, data = await request_json(
+                self.http_client, 'sms', 'POST', self.base_url, json=payload, headers=headers
+            )
+            if status != 200:
+                logging.error("Fast2SMS API request failed with status %s", status)
+                return {
+                    'success': False,
+                    'error': f'Fast2SMS API error: {status}',
+                    'response': None,
+                    'transient': is_retryable_sms_status(status)
+                }
+
+            return parse_sms_response(data)
+
+        except CircuitOpenError:
+            logging.warning("Fast2SMS circuit is open, skipping API call")
+            return {
+                'success': False,
+                'error': 'Fast2SMS API unavailable (circuit open)',
+                'response': None,
+                'transient': True
+            }
+        except asyncio.TimeoutError as e:
+            logging.error("Fast2SMS API request timed out")
+            # Only a connect timeout guarantees the POST never went out
+            # (aiohttp 3.10+ tells it apart from a read timeout)
+            return {
+                'success': False,
+                'error': 'Request to Fast2SMS API timed out',
+                'response': None,
+                'transient': isinstance(e, aiohttp.ConnectionTimeoutError)
+            }
+        except aiohttp.ClientError as e:
+            logging.error("Fast2SMS API request error: %s", e)
+            return {
+                'success': False,
+                'error': f'Fast2SMS API request error: {str(e)}',
+                'response': None,
+                'transient': isinstance(e, aiohttp.ClientConnectorError)
+            }
+        except Exception as e:
+            logging.error("Unexpected error in Fast2SMS client: %s", e)
+            return {
+                'success': False,
+                'error': f'Unexpected error: {str(e)}',
+                'response': None
+            }
+
+    async def aclose(self):
+        """Close pooled connections"""
+        if self.http_client is not None:
+            await self.http_client.close()
+            self.http_client = None
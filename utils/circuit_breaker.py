@@ -0,0 +1,236 @@
+import threading
+import time
+from collections import deque
+from config import Config
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open"""
+
+
+def _percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open circuit breaker for one upstream service
+
+    The outcomes of the last window_size calls are kept; a call fails if it
+    raised, returned a 5xx or took longer than slow_call_seconds. Once at
+    least min_calls are recorded and the failure rate reaches
+    failure_rate_threshold, the circuit opens and calls fail fast with
+    CircuitOpenError for open_seconds. Then up to half_open_calls trial calls
+    are let through: if they all succeed the circuit closes, otherwise it
+    opens again.
+
+    The breaker also suggests a read timeout: timeout_multiplier times the
+    observed p99 latency of recent calls, clamped to
+    [min_timeout, max_timeout]. Failed calls count too, so calls cut off by
+    the timeout push it up when the upstream gets slower, and trial calls
+    always get max_timeout so a slower but healthy upstream can close the
+    circuit again.
+    """
+
+    def __init__(self, name, window_size=50, min_calls=10, failure_rate_threshold=0.5,
+                 slow_call_seconds=5.0, open_seconds=30.0, half_open_calls=3,
+                 min_timeout=1.0, max_timeout=10.0, timeout_multiplier=3.0):
+        """
+        Initialize the breaker
+
+        Args:
+            name (str): Upstream name, e.g. 'maps' or 'sms'
+            window_size (int): Number of recent calls the rates are computed over
+            min_calls (int): Calls needed in the window before the circuit can open
+            failure_rate_threshold (float): Failure fraction that opens the circuit
+            slow_call_seconds (float): Calls slower than this count as failures
+            open_seconds (float): Seconds the circuit stays open before trial calls
+            half_open_calls (int): Trial calls allowed while half-open
+            min_timeout (float): Lower bound of the adaptive read timeout
+            max_timeout (float): Upper bound (and cold-start value) of the timeout
+            timeout_multiplier (float): Timeout as a multiple of the p99 latency
+        """
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_multiplier = timeout_multiplier
+
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen=window_size)   # (failed, latency seconds)
+        self._trials = 0
+        self._trial_successes = 0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """
+        Check whether a call may go to the upstream
+
+        Raises:
+            CircuitOpenError: If the circuit is open (or half-open with all
+                trial calls already in flight)
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"Circuit for {self.name} is open")
+                self.state = HALF_OPEN
+                self._trials = 0
+                self._trial_successes = 0
+            if self.state == HALF_OPEN:
+                if self._trials >= self.half_open_calls:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"Circuit for {self.name} is half-open")
+                self._trials += 1
+
+    def record(self, success, latency):
+        """
+        Record the outcome of a call that allow_request let through
+
+        Args:
+            success (bool): False if the call raised or returned a 5xx
+            latency (float): Call duration in seconds
+        """
+        failed = not success or latency >= self.slow_call_seconds
+        with self._lock:
+            self._outcomes.append((failed, latency))
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._open()
+                    return
+                self._trial_successes += 1
+                if self._trial_successes >= self.half_open_calls:
+                    # Judge the closed circuit on the trial calls, not on
+                    # the calls that opened it
+                    trials = list(self._outcomes)[-self._trial_successes:]
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                    self._outcomes.extend(trials)
+                return
+
+            if self.state == CLOSED and len(self._outcomes) >= self.min_calls:
+                failures = sum(1 for outcome in self._outcomes if outcome[0])
+                if failures / len(self._outcomes) >= self.failure_rate_threshold:
+                    self._open()
+
+    def reset(self):
+        """Close the circuit and forget recorded calls"""
+        with self._lock:
+            self.state = CLOSED
+            self._outcomes.clear()
+            self._trials = 0
+            self._trial_successes = 0
+
+    def _open(self):
+        """Open the circuit (caller holds the lock)"""
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+
+    def timeout(self):
+        """
+        Get the adaptive read timeout for the next call
+
+        Returns:
+            float: Seconds, max_timeout for trial calls and until enough calls
+                are seen
+        """
+        with self._lock:
+            if self.state != CLOSED:
+                return self.max_timeout
+            latencies = sorted(latency for failed, latency in self._outcomes)
+        if len(latencies) < self.min_calls:
+            return self.max_timeout
+        p99 = _percentile(latencies, 0.99)
+        return min(self.max_timeout, max(self.min_timeout, p99 * self.timeout_multiplier))
+
+    def stats(self):
+        """
+        Get breaker state and rolling statistics
+
+        Returns:
+            dict: State, failure rate, latency percentiles, current timeout
+                and open/reject counters
+        """
+        with self._lock:
+            outcomes = list(self._outcomes)
+            state = self.state
+            if state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+                state = HALF_OPEN
+        latencies = sorted(latency for failed, latency in outcomes)
+        failures = sum(1 for failed, latency in outcomes if failed)
+        return {
+            'state': state,
+            'calls': len(outcomes),
+            'failure_rate': failures / len(outcomes) if outcomes else 0.0,
+            'p50_ms': round(_percentile(latencies, 0.50) * 1000, 1),
+            'p99_ms': round(_percentile(latencies, 0.99) * 1000, 1),
+            'timeout_s': round(self.timeout(), 3),
+            'times_opened': self.times_opened,
+            'rejected': self.rejected
+        }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """
+    Get the shared circuit breaker for an upstream service
+
+    Args:
+        name (str): Upstream name, e.g. 'maps' or 'sms'
+
+    Returns:
+        CircuitBreaker: The breaker configured from Config
+    """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    name,
+                    window_size=Config.BREAKER_WINDOW_SIZE,
+                    min_calls=Config.BREAKER_MIN_CALLS,
+                    failure_rate_threshold=Config.BREAKER_FAILURE_RATE,
+                    slow_call_seconds=Config.BREAKER_SLOW_CALL_SECONDS,
+                    open_seconds=Config.BREAKER_OPEN_SECONDS,
+                    half_open_calls=Config.BREAKER_HALF_OPEN_CALLS,
+                    min_timeout=Config.BREAKER_MIN_TIMEOUT,
+                    max_timeout=Config.HTTP_READ_TIMEOUT,
+                    timeout_multiplier=Config.BREAKER_TIMEOUT_MULTIPLIER
+                )
+                _breakers[name] = breaker
+    return breaker
+
+
+def reset_breakers():
+    """Close every breaker and forget its history, e.g. in a freshly forked worker"""
+    with _breakers_lock:
+        for breaker in _breakers.values():
+            breaker.reset()
+
+
+def breaker_stats():
+    """Return the state of every breaker created so far"""
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {name: breaker.stats() for name, breaker in breakers.items()}
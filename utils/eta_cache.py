@@ -0,0 +1,205 @@
+import re
+import threading
+import time
+from config import Config
+from utils.kv_store import create_kv_store
+
+_NON_WORD = re.compile(r'[^\w\s]')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_location(location):
+    """
+    Normalize a free-text location so equivalent spellings share a cache key
+
+    Args:
+        location (str): Location text as typed by the user
+
+    Returns:
+        str: Lower-cased location with punctuation removed and whitespace collapsed
+    """
+    text = _NON_WORD.sub(' ', location.lower())
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+def make_eta_cache_key(origin, route_number):
+    """
+    Build the cache key for an (origin, route) pair
+
+    Args:
+        origin (str): The starting location
+        route_number (str): The bus route number
+
+    Returns:
+        str: Normalized cache key
+    """
+    route = str(route_number).strip().lstrip('0') or '0'
+    return f"eta:{normalize_location(origin)}|{route}"
+
+
+class ETACache:
+    """TTL cache for ETA lookups keyed on the normalized (origin, route) pair"""
+
+    def __init__(self, store, ttl=60, stale_ttl=0, fallback_ttl=0):
+        """
+        Initialize the cache
+
+        Args:
+            store: Key/value store backend (see utils.kv_store)
+            ttl (float): Seconds a cached ETA stays fresh
+            stale_ttl (float): Extra seconds an expired ETA is kept so it can be
+                served while a refresh runs in the background (0 disables)
+            fallback_ttl (float): Extra seconds an expired ETA is kept as a
+                last resort for when the API is unavailable (see lookup_fallback)
+        """
+        self.store = store
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.fallback_ttl = fallback_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.fallback_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, origin, route_number):
+        """
+        Look up a fresh cached ETA result
+
+        Args:
+            origin (str): The starting location
+            route_number (str): The bus route number
+
+        Returns:
+            dict: The cached ETA result, or None on a miss
+        """
+        result, fresh = self.lookup(origin, route_number, allow_stale=False)
+        return result
+
+    def lookup(self, origin, route_number, allow_stale=True, record_stats=True):
+        """
+        Look up a cached ETA result, including entries past their TTL
+
+        Args:
+            origin (str): The starting location
+            route_number (str): The bus route number
+            allow_stale (bool): Whether an expired entry still inside the
+                stale window may be returned
+            record_stats (bool): Whether the lookup counts towards hit/miss stats
+
+        Returns:
+            tuple: (result, fresh) where result is None on a miss
+        """
+        entry = self.store.get(make_eta_cache_key(origin, route_number))
+        age = time.time() - entry['stored_at'] if entry is not None else None
+        fresh = entry is not None and age < self.ttl
+        # Entries kept only for the API-down fallback are not served here
+        if entry is not None and age >= self.ttl + self.stale_ttl:
+            entry = None
+        if not record_stats:
+            if fresh or (entry is not None and allow_stale):
+                return entry['result'], fresh
+            return None, False
+        with self._lock:
+            if fresh:
+                self.hits += 1
+                return entry['result'], True
+            if entry is not None and allow_stale:
+                self.stale_hits += 1
+                return entry['result'], False
+            self.misses += 1
+        return None, False
+
+    def lookup_fallback(self, origin, route_number):
+        """
+        Look up the last known ETA result for when the API is unavailable
+
+        Args:
+            origin (str): The starting location
+            route_number (str): The bus route number
+
+        Returns:
+            tuple: (result, stored_at) of the most recent entry kept within
+                ttl + fallback_ttl, or (None, None)
+        """
+        entry = self.store.get(make_eta_cache_key(origin, route_number))
+        if entry is None:
+            return None, None
+        with self._lock:
+            self.fallback_hits += 1
+        return entry['result'], entry['stored_at']
+
+    def age(self, origin, route_number):
+        """
+        Get how long ago the cached ETA for a pair was stored
+
+        Args:
+            origin (str): The starting location
+            route_number (str): The bus route number
+
+        Returns:
+            float: Seconds since the entry was stored, or None if there is none
+        """
+        entry = self.store.get(make_eta_cache_key(origin, route_number))
+        if entry is None:
+            return None
+        return time.time() - entry['stored_at']
+
+    def set(self, origin, route_number, eta_data):
+        """
+        Cache an ETA result
+
+        Args:
+            origin (str): The starting location
+            route_number (str): The bus route number
+            eta_data (dict): Result returned by GoogleMapsClient.get_bus_eta
+        """
+        entry = {'result': eta_data, 'stored_at': time.time()}
+        self.store.set(
+            make_eta_cache_key(origin, route_number),
+            entry,
+            ttl=self.ttl + max(self.stale_ttl, self.fallback_ttl)
+        )
+
+    def stats(self):
+        """
+        Get cache hit/miss counters
+
+        Returns:
+            dict: Hits, stale hits, misses, hit ratio and number of entries
+        """
+        with self._lock:
+            hits, stale_hits, misses = self.hits, self.stale_hits, self.misses
+        total = hits + stale_hits + misses
+        return {
+            'hits': hits,
+            'stale_hits': stale_hits,
+            'fallback_hits': self.fallback_hits,
+            'misses': misses,
+            'hit_ratio': (hits + stale_hits) / total if total else 0.0,
+            'entries': len(self.store)
+        }
+
+
+def create_eta_cache():
+    """
+    Create the ETA cache described by the application configuration
+
+    Returns:
+        ETACache: The configured cache, or None when caching is disabled
+    """
+    backend = Config.ETA_CACHE_BACKEND
+    if backend == 'none':
+        return None
+
+    store = create_kv_store(
+        backend,
+        path=Config.ETA_CACHE_PATH,
+        max_entries=Config.ETA_CACHE_MAX_ENTRIES
+    )
+    return ETACache(
+        store,
+        ttl=Config.ETA_CACHE_TTL,
+        stale_ttl=Config.ETA_CACHE_STALE_TTL,
+        fallback_ttl=Config.ETA_CACHE_FALLBACK_TTL
+    )
@@ -0,0 +1,427 @@
+import heapq
+import inspect
+import itertools
+import logging
+import os
+import threading
+import time
+from datetime import date
+from config import Config
+from utils.eta_cache import make_eta_cache_key
+from utils.kv_store import MemoryKVStore, create_kv_store
+from utils.metrics import ETA_PREFETCHES
+
+
+class SpaceSaving:
+    """
+    Space-Saving sketch of the most frequent keys in a stream
+
+    At most capacity keys are counted. A new key arriving when the sketch is
+    full replaces the key with the smallest count and inherits that count
+    (recorded as its error), so every key seen more than
+    total / capacity times is guaranteed to be tracked and counts are never
+    under-estimated. The smallest count is found through a heap with lazily
+    discarded entries, which is rebuilt when it grows past 4 x capacity.
+    """
+
+    def __init__(self, capacity=1000):
+        """
+        Initialize the sketch
+
+        Args:
+            capacity (int): Maximum number of keys counted
+        """
+        self.capacity = capacity
+        self.total = 0
+        # key -> [count, error, value]
+        self._counters = {}
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def add(self, key, value=None, weight=1):
+        """
+        Count an occurrence of key
+
+        Args:
+            key (str): The key seen
+            value: Payload kept with the key (replaced on every add)
+            weight (float): How much the occurrence counts
+        """
+        self.total += weight
+        counter = self._counters.get(key)
+        if counter is None:
+            error = 0
+            if len(self._counters) >= self.capacity:
+                error = self._evict_smallest()
+            counter = self._counters[key] = [error, error, value]
+        counter[0] += weight
+        counter[2] = value
+        heapq.heappush(self._heap, (counter[0], next(self._sequence), key))
+        if len(self._heap) > 4 * self.capacity:
+            self._rebuild_heap()
+
+    def _evict_smallest(self):
+        """Drop the key with the smallest count and return that count"""
+        while True:
+            count, sequence, key = heapq.heappop(self._heap)
+            counter = self._counters.get(key)
+            # Entries for keys that were evicted or counted again since are stale
+            if counter is not None and counter[0] == count:
+                del self._counters[key]
+                return count
+
+    def _rebuild_heap(self):
+        self._heap = [(counter[0], next(self._sequence), key) for key, counter in self._counters.items()]
+        heapq.heapify(self._heap)
+
+    def decay(self, factor):
+        """
+        Scale every count, so older occurrences weigh less than new ones
+
+        Args:
+            factor (float): Multiplier between 0 and 1
+        """
+        self.total *= factor
+        for counter in self._counters.values():
+            counter[0] *= factor
+            counter[1] *= factor
+        self._rebuild_heap()
+
+    def top(self, k):
+        """
+        Get the k most frequent keys
+
+        Returns:
+            list: (key, count, error, value) tuples, most frequent first
+        """
+        items = heapq.nlargest(k, self._counters.items(), key=lambda item: item[1][0])
+        return [(key, count, error, value) for key, (count, error, value) in items]
+
+    def __len__(self):
+        return len(self._counters)
+
+
+class QueryPopularity:
+    """
+    Frequency of (origin, route) queries per time-of-day bucket
+
+    Each bucket of the day (e.g. 08:00-08:30) has its own Space-Saving
+    sketch. A bucket's counts are decayed once per day that passes, so
+    yesterday's rush hour predicts which pairs will be hot at the start of
+    today's while recent days count the most.
+    """
+
+    def __init__(self, capacity=1000, bucket_minutes=30, daily_decay=0.5):
+        """
+        Initialize the tracker
+
+        Args:
+            capacity (int): Pairs counted per bucket
+            bucket_minutes (int): Length of a time-of-day bucket
+            daily_decay (float): Factor applied to a bucket's counts per day
+        """
+        self.capacity = capacity
+        self.bucket_minutes = max(1, int(bucket_minutes))
+        self.daily_decay = daily_decay
+        # bucket -> (sketch, day of the last decay)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, now):
+        """Return (bucket index, day ordinal) of a timestamp in local time"""
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        return minute // self.bucket_minutes, date(local.tm_year, local.tm_mon, local.tm_mday).toordinal()
+
+    def _sketch(self, now):
+        """Return the current bucket's sketch, decayed up to today (lock held)"""
+        bucket, day = self._bucket(now)
+        entry = self._buckets.get(bucket)
+        if entry is None:
+            entry = self._buckets[bucket] = [SpaceSaving(self.capacity), day]
+        elif entry[1] < day:
+            entry[0].decay(self.daily_decay ** (day - entry[1]))
+            entry[1] = day
+        return entry[0]
+
+    def record(self, origin, route_number, now=None):
+        """
+        Count a query
+
+        Args:
+            origin (str): The starting location
+            route_number (str): The bus route number
+            now (float): Time of the query (default: time.time())
+        """
+        key = make_eta_cache_key(origin, route_number)
+        with self._lock:
+            self._sketch(now or time.time()).add(key, (origin, route_number))
+
+    def top(self, k, now=None, min_count=1):
+        """
+        Get the most queried pairs of the current time-of-day bucket
+
+        Args:
+            k (int): Maximum pairs returned
+            now (float): Time whose bucket is used (default: time.time())
+            min_count (float): Decayed count a pair needs to be returned
+
+        Returns:
+            list: (key, origin, route_number, count) tuples, most queried first
+        """
+        with self._lock:
+            top = self._sketch(now or time.time()).top(k)
+        return [(key, value[0], value[1], count) for key, count, error, value in top if count >= min_count]
+
+    def stats(self):
+        """
+        Get the number of pairs tracked
+
+        Returns:
+            dict: Buckets in use and pairs tracked over all buckets
+        """
+        with self._lock:
+            return {
+                'buckets': len(self._buckets),
+                'tracked_pairs': sum(len(entry[0]) for entry in self._buckets.values())
+            }
+
+
+class ETAPrefetcher:
+    """
+    Background refresher of the cached ETAs of popular (origin, route) pairs
+
+    GoogleMapsClient records every query that would be answered by the
+    Directions API. Every interval seconds the prefetcher takes the top_k
+    pairs of the current time-of-day bucket and refreshes those whose cache
+    entry is missing or will expire within lead seconds, hottest first, so
+    commuters asking for them are answered from the cache. Refreshes are
+    limited to budget_per_minute Directions API calls by a token bucket kept
+    in budget_store; with a SQLite store every worker spends from the same
+    bucket, so the budget covers the whole service however many workers
+    run a prefetcher. A pair is checked again just before it is refreshed,
+    so a pair another worker refreshed meanwhile (in a shared cache) costs
+    nothing, and refreshes go through the client's single flight, so they
+    never duplicate a request's own lookup.
+    """
+
+    # Key of the token bucket in the budget store
+    BUDGET_KEY = 'eta-prefetch:budget'
+
+    def __init__(self, maps_client, popularity=None, top_k=50, min_hits=3, budget_per_minute=60,
+                 lead=15, interval=5, budget_store=None):
+        """
+        Initialize the prefetcher
+
+        Args:
+            maps_client: GoogleMapsClient or AsyncGoogleMapsClient with a cache
+            popularity (QueryPopularity): Query frequency tracker
+            top_k (int): Pairs considered per run
+            min_hits (float): Decayed query count a pair needs to be prefetched
+            budget_per_minute (float): Maximum Directions API calls per minute
+            lead (float): Seconds before expiry at which an entry is refreshed
+                (at least interval, or entries expire between runs)
+            interval (float): Seconds between runs
+            budget_store (MemoryKVStore or SQLiteKVStore): Store holding the
+                token bucket (a SQLite store shares the budget among all
+                gunicorn workers; defaults to a bucket of this process)
+        """
+        self.maps_client = maps_client
+        self.popularity = popularity if popularity is not None else QueryPopularity()
+        self.top_k = top_k
+        self.min_hits = min_hits
+        self.budget_per_minute = budget_per_minute
+        self.lead = lead
+        self.interval = interval
+        self.counters = {'runs': 0, 'refreshed': 0, 'failed': 0, 'over_budget': 0}
+        self.budget_store = budget_store if budget_store is not None else MemoryKVStore(max_entries=1)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stopped = threading.Event()
+        # The asyncio client is refreshed from a task on its own loop (run_async)
+        self.is_async = inspect.iscoroutinefunction(maps_client.refresh_bus_eta)
+
+    def record(self, origin, route_number):
+        """
+        Count a query and make sure the refresh thread runs in this process
+
+        Args:
+            origin (str): The starting location (canonical stop name if resolved)
+            route_number (str): The bus route number
+        """
+        self.popularity.record(origin, route_number)
+        if not self.is_async:
+            self._ensure_started()
+
+    def _ensure_started(self):
+        """Start the refresh thread if it is not running in this process"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stopped.clear()
+            thread = threading.Thread(target=self._run, name='eta-prefetch', daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """Stop the refresh thread or task after its current run"""
+        self._stopped.set()
+        self._pid = None
+
+    def _take_token(self):
+        """Spend one API call of the budget; False when it is used up"""
+        now = time.time()
+        taken = []
+
+        def spend(state):
+            # state: [tokens, updated_at]
+            if state is None:
+                tokens = float(self.budget_per_minute)
+            else:
+                tokens = min(self.budget_per_minute,
+                             state[0] + (now - state[1]) * self.budget_per_minute / 60)
+            taken.append(tokens >= 1)
+            return [tokens - 1 if tokens >= 1 else tokens, now]
+
+        # The entry expires once the bucket would be full again
+        self.budget_store.update(self.BUDGET_KEY, spend, ttl=60)
+        if not taken[-1]:
+            with self._lock:
+                self.counters['over_budget'] += 1
+        return taken[-1]
+
+    def _is_due(self, origin, route_number):
+        """Check whether a pair's cache entry is missing or about to expire"""
+        cache = self.maps_client.cache
+        age = cache.age(origin, route_number)
+        return age is None or age >= cache.ttl - self.lead
+
+    def due(self, now=None):
+        """
+        Get the popular pairs whose cache entry is missing or about to expire
+
+        Args:
+            now (float): Time whose bucket is used (default: time.time())
+
+        Returns:
+            list: (key, origin, route_number) tuples, most queried first
+        """
+        return [
+            (key, origin, route_number)
+            for key, origin, route_number, count in self.popularity.top(self.top_k, now, self.min_hits)
+            if self._is_due(origin, route_number)
+        ]
+
+    def _settle(self, result):
+        """Count the outcome of one refresh"""
+        outcome = 'refreshed' if result['success'] else 'failed'
+        with self._lock:
+            self.counters[outcome] += 1
+        ETA_PREFETCHES.labels(outcome).inc()
+
+    def run_once(self, now=None):
+        """
+        Refresh the due pairs within the API budget
+
+        Returns:
+            int: Number of refreshes made
+        """
+        refreshes = 0
+        for key, origin, route_number in self.due(now):
+            # Another worker may have refreshed it during this run
+            if refreshes and not self._is_due(origin, route_number):
+                continue
+            if not self._take_token():
+                break
+            result = self.maps_client.single_flight.do(key, self.maps_client.refresh_bus_eta, origin, route_number)
+            self._settle(result)
+            refreshes += 1
+        with self._lock:
+            self.counters['runs'] += 1
+        return refreshes
+
+    async def run_once_async(self, now=None):
+        """Refresh the due pairs within the API budget (asyncio client)"""
+        from utils.async_clients import run_blocking
+
+        refreshes = 0
+        for key, origin, route_number in self.due(now):
+            if refreshes and not self._is_due(origin, route_number):
+                continue
+            if not await run_blocking([self.budget_store], self._take_token):
+                break
+            result = await self.maps_client.single_flight.do(
+                key, self.maps_client.refresh_bus_eta, origin, route_number
+            )
+            self._settle(result)
+            refreshes += 1
+        with self._lock:
+            self.counters['runs'] += 1
+        return refreshes
+
+    def _run(self):
+        """Refresh loop of the thread started by record()"""
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error("ETA prefetch run failed: %s", e)
+
+    async def run_async(self):
+        """Refresh loop for the asyncio service mode; run it as a task on the server's loop"""
+        import asyncio
+
+        self._stopped.clear()
+        while not self._stopped.is_set():
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once_async()
+            except Exception as e:
+                logging.error("ETA prefetch run failed: %s", e)
+
+    def stats(self):
+        """
+        Get prefetch counters for this process
+
+        Returns:
+            dict: Runs, refreshes, failures, budget exhaustions and pairs tracked
+        """
+        with self._lock:
+            stats = dict(self.counters)
+        stats.update(self.popularity.stats())
+        return stats
+
+
+def create_eta_prefetcher(maps_client):
+    """
+    Create the ETA prefetcher described by the application configuration
+
+    Args:
+        maps_client: GoogleMapsClient or AsyncGoogleMapsClient to refresh through
+
+    Returns:
+        ETAPrefetcher: The prefetcher, or None when prefetching is disabled or
+            the client has no cache to warm
+    """
+    if not Config.ETA_PREFETCH or maps_client.cache is None:
+        return None
+
+    popularity = QueryPopularity(
+        capacity=Config.ETA_PREFETCH_SKETCH_SIZE,
+        bucket_minutes=Config.ETA_PREFETCH_BUCKET_MINUTES,
+        daily_decay=Config.ETA_PREFETCH_DAILY_DECAY
+    )
+    return ETAPrefetcher(
+        maps_client,
+        popularity,
+        top_k=Config.ETA_PREFETCH_TOP_K,
+        min_hits=Config.ETA_PREFETCH_MIN_HITS,
+        budget_per_minute=Config.ETA_PREFETCH_BUDGET_PER_MINUTE,
+        lead=Config.ETA_PREFETCH_LEAD,
+        interval=Config.ETA_PREFETCH_INTERVAL,
+        # One bucket for all workers, so the budget is the service's
+        budget_store=create_kv_store('sqlite', path=Config.ETA_PREFETCH_BUDGET_PATH, max_entries=16)
+        if Config.ETA_PREFETCH_BUDGET_PATH else None
+    )
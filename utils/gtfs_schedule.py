@@ -0,0 +1,430 @@
+import csv
+import logging
+import os
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from operator import itemgetter
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from utils.eta_cache import normalize_location
+
+SECONDS_PER_DAY = 24 * 60 * 60
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+
+def parse_gtfs_time(value):
+    """
+    Convert a GTFS HH:MM:SS time (hours may exceed 23) to seconds after midnight
+
+    Args:
+        value (str): GTFS time string
+
+    Returns:
+        int: Seconds after midnight of the service day
+    """
+    hours, minutes, seconds = value.strip().split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def format_clock_time(seconds):
+    """
+    Format seconds after midnight like the Directions API, e.g. '2:30 PM'
+
+    Args:
+        seconds (int): Seconds after midnight (may exceed one day)
+
+    Returns:
+        str: 12-hour clock time
+    """
+    minutes = (seconds % SECONDS_PER_DAY) // 60
+    hour, minute = divmod(minutes, 60)
+    suffix = 'AM' if hour < 12 else 'PM'
+    return f"{(hour % 12) or 12}:{minute:02d} {suffix}"
+
+
+def _read_table(feed_dir, name, columns):
+    """
+    Yield selected columns from a GTFS table as tuples
+
+    Args:
+        feed_dir (str): Directory containing the GTFS text files
+        name (str): Table file name, e.g. 'stops.txt'
+        columns (tuple): Column names to extract (missing columns yield '')
+    """
+    with open(os.path.join(feed_dir, name), newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f, skipinitialspace=True)
+        header = [column.strip() for column in next(reader)]
+        indexes = [header.index(column) if column in header else None for column in columns]
+
+        # Fast path: every column exists, so rows are sliced by one C call
+        if None not in indexes:
+            getter = itemgetter(*indexes)
+            width = max(indexes) + 1
+            for row in reader:
+                if len(row) >= width:
+                    yield getter(row) if len(indexes) > 1 else (getter(row),)
+            return
+
+        for row in reader:
+            yield tuple(row[i] if i is not None and i < len(row) else '' for i in indexes)
+
+
+def _read_optional_table(feed_dir, name, columns):
+    """Like _read_table, but yield nothing if the feed has no such file"""
+    if not os.path.exists(os.path.join(feed_dir, name)):
+        return iter(())
+    return _read_table(feed_dir, name, columns)
+
+
+def _load_timezone(feed_dir):
+    """
+    Get the time zone the feed's times are in
+
+    Args:
+        feed_dir (str): Directory containing the GTFS text files
+
+    Returns:
+        ZoneInfo: The first agency's agency_timezone, or None if the feed
+            has none or it is unknown (the container's local time is used)
+    """
+    for (name,) in _read_optional_table(feed_dir, 'agency.txt', ('agency_timezone',)):
+        if not name:
+            continue
+        try:
+            return ZoneInfo(name.strip())
+        except (ZoneInfoNotFoundError, ValueError):
+            logging.warning("Unknown agency_timezone %r in GTFS feed %s, using local time", name, feed_dir)
+        break
+    return None
+
+
+class GTFSSchedule:
+    """
+    Compact in-memory index over a GTFS feed for "next bus" queries
+
+    Stops and routes are interned to small integers, and departures are kept
+    per (stop, route) pair as sorted arrays of seconds after midnight, so a
+    lookup is a dict access plus a binary search. When the feed has
+    calendar.txt or calendar_dates.txt, a parallel array holds each
+    departure's service, and only services running on the day are answered;
+    without them every trip is treated as running daily. Times are read in
+    the agency_timezone of agency.txt.
+    """
+
+    def __init__(self):
+        """Initialize an empty schedule (use GTFSSchedule.load to build one)"""
+        self.stop_ids = []          # stop index -> GTFS stop_id
+        self.stop_names = []        # stop index -> display name
+        self.stop_index = {}        # GTFS stop_id -> stop index
+        self.stops_by_name = {}     # normalized stop name -> [stop index]
+        self.route_names = []       # route index -> route short name
+        self.route_destinations = []  # route index -> destination text
+        self.routes_by_name = {}    # route short name -> [route index]
+        self.route_trips = {}       # route index -> array of trip indexes
+        self.trip_stop_times = []   # trip index -> (array of stop indexes, array of departures)
+        self.departures = {}        # (stop index, route index) -> sorted array of departures
+        self.departure_services = None  # (stop index, route index) -> service index per departure
+        self.service_ids = []       # service index -> GTFS service_id
+        self.service_calendars = {}  # service index -> (weekday flags, start date, end date)
+        self.service_exceptions = {}  # YYYYMMDD -> {service index: runs}
+        self.timezone = None        # agency_timezone, None for the local clock
+        self._active_services = {}  # YYYYMMDD -> frozenset of running service indexes
+
+    @classmethod
+    def load(cls, feed_dir):
+        """
+        Load a GTFS feed directory
+
+        Args:
+            feed_dir (str): Directory with stops.txt, routes.txt, trips.txt
+                and stop_times.txt, and optionally agency.txt, calendar.txt
+                and calendar_dates.txt
+
+        Returns:
+            GTFSSchedule: The indexed schedule
+        """
+        schedule = cls()
+        schedule.timezone = _load_timezone(feed_dir)
+        service_index = {}
+
+        def intern_service(service_id):
+            index = service_index.get(service_id)
+            if index is None:
+                index = service_index[service_id] = len(schedule.service_ids)
+                schedule.service_ids.append(service_id)
+            return index
+
+        columns = ('service_id',) + WEEKDAYS + ('start_date', 'end_date')
+        for row in _read_optional_table(feed_dir, 'calendar.txt', columns):
+            weekdays = tuple(flag.strip() == '1' for flag in row[1:8])
+            schedule.service_calendars[intern_service(row[0])] = (
+                weekdays, int(row[8] or 0), int(row[9] or 99991231)
+            )
+        columns = ('service_id', 'date', 'exception_type')
+        for service_id, date, exception_type in _read_optional_table(feed_dir, 'calendar_dates.txt', columns):
+            exceptions = schedule.service_exceptions.setdefault(int(date), {})
+            exceptions[intern_service(service_id)] = exception_type.strip() == '1'
+        has_calendar = bool(schedule.service_ids)
+
+        for stop_id, stop_name in _read_table(feed_dir, 'stops.txt', ('stop_id', 'stop_name')):
+            index = len(schedule.stop_ids)
+            schedule.stop_ids.append(stop_id)
+            schedule.stop_names.append(stop_name)
+            schedule.stop_index[stop_id] = index
+            schedule.stops_by_name.setdefault(normalize_location(stop_name), []).append(index)
+
+        route_index = {}
+        columns = ('route_id', 'route_short_name', 'route_long_name')
+        for route_id, short_name, long_name in _read_table(feed_dir, 'routes.txt', columns):
+            index = len(schedule.route_names)
+            name = short_name or route_id
+            route_index[route_id] = index
+            schedule.route_names.append(name)
+            schedule.route_destinations.append(long_name or name)
+            schedule.routes_by_name.setdefault(name.lower(), []).append(index)
+
+        trip_index = {}
+        trip_routes = []
+        trip_services = array('i')
+        for route_id, trip_id, service_id in _read_table(feed_dir, 'trips.txt', ('route_id', 'trip_id', 'service_id')):
+            if route_id not in route_index:
+                continue
+            trip_index[trip_id] = len(trip_routes)
+            trip_routes.append(route_index[route_id])
+            if has_calendar:
+                trip_services.append(intern_service(service_id))
+            schedule.route_trips.setdefault(route_index[route_id], array('i')).append(len(trip_routes) - 1)
+
+        # Stop times are streamed once into compact per-trip arrays and the
+        # (stop, route) departure arrays; rows are only re-sorted for trips
+        # whose stop_sequence arrives out of order
+        trip_sequences = [array('i') for _ in trip_routes]
+        trip_stops = [array('i') for _ in trip_routes]
+        trip_times = [array('i') for _ in trip_routes]
+        departures = {}
+        services = {}
+        # Departure times repeat across trips, so parsed values are memoized
+        parsed_times = {}
+        columns = ('trip_id', 'departure_time', 'arrival_time', 'stop_id', 'stop_sequence')
+        for trip_id, departure, arrival, stop_id, sequence in _read_table(feed_dir, 'stop_times.txt', columns):
+            trip = trip_index.get(trip_id)
+            stop = schedule.stop_index.get(stop_id)
+            time_text = departure or arrival
+            if trip is None or stop is None or not time_text:
+                continue
+            seconds = parsed_times.get(time_text)
+            if seconds is None:
+                seconds = parsed_times[time_text] = parse_gtfs_time(time_text)
+
+            trip_sequences[trip].append(int(sequence or 0))
+            trip_stops[trip].append(stop)
+            trip_times[trip].append(seconds)
+
+            key = (stop, trip_routes[trip])
+            times = departures.get(key)
+            if times is None:
+                times = departures[key] = array('i')
+                if has_calendar:
+                    services[key] = array('i')
+            times.append(seconds)
+            if has_calendar:
+                services[key].append(trip_services[trip])
+
+        for sequences, stops, times in zip(trip_sequences, trip_stops, trip_times):
+            if any(a > b for a, b in zip(sequences, sequences[1:])):
+                order = sorted(range(len(sequences)), key=sequences.__getitem__)
+                stops = array('i', (stops[i] for i in order))
+                times = array('i', (times[i] for i in order))
+            schedule.trip_stop_times.append((stops, times))
+        del trip_sequences
+
+        if has_calendar:
+            schedule.departures = {}
+            schedule.departure_services = {}
+            for key, times in departures.items():
+                pairs = sorted(zip(times, services[key]))
+                schedule.departures[key] = array('i', (seconds for seconds, _ in pairs))
+                schedule.departure_services[key] = array('i', (service for _, service in pairs))
+        else:
+            schedule.departures = {key: array('i', sorted(times)) for key, times in departures.items()}
+
+        logging.info(
+            "Loaded GTFS feed from %s: %s stops, %s routes, %s trips, %s services",
+            feed_dir, len(schedule.stop_ids), len(schedule.route_names), len(trip_routes),
+            len(schedule.service_ids)
+        )
+        return schedule
+
+    def find_stops(self, location):
+        """
+        Find stop indexes for a stop name or GTFS stop_id
+
+        Args:
+            location (str): Stop name (matched after normalization) or stop_id
+
+        Returns:
+            list: Matching stop indexes
+        """
+        if location in self.stop_index:
+            return [self.stop_index[location]]
+        return self.stops_by_name.get(normalize_location(location), [])
+
+    def active_services(self, day):
+        """
+        Get the services running on a day
+
+        Args:
+            day (date): Service day
+
+        Returns:
+            frozenset: Service indexes, or None if the feed has no calendar
+                (every trip runs daily)
+        """
+        if self.departure_services is None:
+            return None
+        stamp = day.year * 10000 + day.month * 100 + day.day
+        active = self._active_services.get(stamp)
+        if active is None:
+            weekday = day.weekday()
+            running = {
+                service for service, (weekdays, start, end) in self.service_calendars.items()
+                if weekdays[weekday] and start <= stamp <= end
+            }
+            for service, runs in self.service_exceptions.get(stamp, {}).items():
+                if runs:
+                    running.add(service)
+                else:
+                    running.discard(service)
+            active = frozenset(running)
+            # Only the days around now are asked for, so keep the memo small
+            if len(self._active_services) >= 8:
+                self._active_services.clear()
+            self._active_services[stamp] = active
+        return active
+
+    @staticmethod
+    def _running(times, services, start, active, count, shift):
+        """Take up to count departures from index start on whose service is active"""
+        if active is None:
+            return [t + shift for t in times[start:start + count]]
+        found = []
+        for index in range(start, len(times)):
+            if services[index] in active:
+                found.append(times[index] + shift)
+                if len(found) == count:
+                    break
+        return found
+
+    def next_departures(self, location, route_number, now_seconds, count=2, day=None):
+        """
+        Get the next departures of a route from a stop
+
+        Departures of the previous service day listed at 24:00:00 or later
+        (trips running past midnight) count as early-morning departures of
+        today, and tomorrow's first departures follow today's last. When day
+        is given and the feed has a calendar, each of the three service days
+        only contributes trips of the services running on it.
+
+        Args:
+            location (str): Stop name or stop_id
+            route_number (str): Route short name
+            now_seconds (int): Current time in seconds after midnight
+            count (int): Number of departures to return
+            day (date): Today's service day (None treats every trip as daily)
+
+        Returns:
+            tuple: (stop index, route index, list of departure seconds after
+                today's midnight); the list is empty when the route does not
+                serve the stop
+        """
+        today = yesterday = tomorrow = None
+        if day is not None and self.departure_services is not None:
+            today = self.active_services(day)
+            yesterday = self.active_services(day - timedelta(days=1))
+            tomorrow = self.active_services(day + timedelta(days=1))
+
+        best = (None, None, [])
+        for route in self.routes_by_name.get(str(route_number).lower(), []):
+            for stop in self.find_stops(location):
+                times = self.departures.get((stop, route))
+                if not times:
+                    continue
+                services = self.departure_services[(stop, route)] if today is not None else None
+                upcoming = self._running(times, services, bisect_left(times, now_seconds), today, count, 0)
+                # Times of 24:00:00 and later are the previous service day's
+                # trips still running after midnight
+                if times[-1] >= SECONDS_PER_DAY:
+                    late = bisect_left(times, now_seconds + SECONDS_PER_DAY)
+                    upcoming = sorted(upcoming + self._running(
+                        times, services, late, yesterday, count, -SECONDS_PER_DAY))[:count]
+                # Wrap around to tomorrow's first departures
+                if len(upcoming) < count or times[0] + SECONDS_PER_DAY < upcoming[-1]:
+                    upcoming = sorted(upcoming + self._running(
+                        times, services, 0, tomorrow, count, SECONDS_PER_DAY))[:count]
+                if upcoming and (not best[2] or upcoming[0] < best[2][0]):
+                    best = (stop, route, upcoming)
+        return best
+
+    def get_bus_eta(self, origin, route_number, now=None):
+        """
+        Answer an ETA query from the timetable
+
+        Args:
+            origin (str): Stop name or stop_id
+            route_number (str): Route short name
+            now (datetime): Current time (defaults to the clock in the feed's
+                agency_timezone; naive values are taken as feed-local time)
+
+        Returns:
+            dict: Standardized ETA data (same shape as GoogleMapsClient), or
+                None when the feed does not cover the (stop, route) pair or
+                no trip of it runs today or tomorrow
+        """
+        if now is None:
+            now = datetime.now(self.timezone)
+        elif now.tzinfo is not None and self.timezone is not None:
+            now = now.astimezone(self.timezone)
+        now_seconds = now.hour * 3600 + now.minute * 60 + now.second
+        stop, route, upcoming = self.next_departures(origin, route_number, now_seconds, count=2, day=now.date())
+        if not upcoming:
+            return None
+
+        eta_minutes = (upcoming[0] - now_seconds) // 60
+        departure_time = format_clock_time(upcoming[0])
+        next_time = format_clock_time(upcoming[1]) if len(upcoming) > 1 else 'Unknown'
+
+        return {
+            'success': True,
+            'error': '',
+            'source': 'schedule',
+            'data': {
+                'eta_minutes': eta_minutes,
+                'eta_text': f"{eta_minutes} mins",
+                'departure_time': departure_time,
+                'origin': origin,
+                'destination': self.route_destinations[route],
+                'route_number': route_number,
+                'next_departure': departure_time,
+                'bus_stop_name': self.stop_names[stop],
+                'next_time': next_time
+            }
+        }
+
+
+def load_schedule(feed_dir):
+    """
+    Load the configured GTFS feed, logging instead of failing startup
+
+    Args:
+        feed_dir (str): GTFS feed directory (empty disables the schedule)
+
+    Returns:
+        GTFSSchedule: The schedule, or None if disabled or unreadable
+    """
+    if not feed_dir:
+        return None
+    try:
+        return GTFSSchedule.load(feed_dir)
+    except (OSError, ValueError, StopIteration) as e:
+        logging.error("Failed to load GTFS feed from %s: %s", feed_dir, e)
+        return None
@@ -0,0 +1,386 @@
+import importlib.util
+import logging
+import statistics
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime
+from functools import lru_cache
+from config import Config
+from utils.eta_cache import make_eta_cache_key
+from utils.gtfs_schedule import SECONDS_PER_DAY, format_clock_time
+
+# Optional: without numpy every query is answered by a binary search. It is
+# imported on the first large batch, so it adds nothing to startup time
+HAS_NUMPY = importlib.util.find_spec('numpy') is not None
+
+# Batches at least this large are answered with one vectorized numpy pass;
+# smaller ones are cheaper one binary search at a time (break-even is about
+# 100 queries, see benchmarks/bench_headways.py)
+VECTOR_MIN_QUERIES = 128
+# Longest gap accepted between two observed departures of a pair when the
+# route's headway is unknown (beyond it a departure was probably not observed)
+DEFAULT_MAX_GAP = 3600
+# Gaps between departures, relative to the headway, still taken as consecutive
+MAX_GAP_FACTOR = 1.5
+# Observed departures closer than this to the one asked about are the same bus
+SAME_BUS_SECONDS = 60
+
+# Normalized pair keys of recent queries, so a batch does not re-run the
+# location normalization for every repeated pair
+_pair_key = lru_cache(maxsize=65536)(make_eta_cache_key)
+
+# Answers the estimator fills (timetable answers already carry their next bus)
+_FILLED_SOURCES = ('maps', 'stale_cache')
+
+
+def departure_seconds(eta_data, now=None):
+    """
+    Get the departure time of an ETA answer in seconds after local midnight
+
+    Args:
+        eta_data (dict): Standardized ETA data
+        now (datetime): Current local time (defaults to datetime.now())
+
+    Returns:
+        int: Seconds after midnight, from the departure time text when it
+            parses, else now plus the ETA
+    """
+    data = eta_data['data']
+    try:
+        clock = datetime.strptime(data.get('departure_time', ''), '%I:%M %p')
+        return clock.hour * 3600 + clock.minute * 60
+    except (TypeError, ValueError):
+        now = now or datetime.now()
+        return now.hour * 3600 + now.minute * 60 + now.second + int(data.get('eta_minutes', 0)) * 60
+
+
+def schedule_headways(schedule):
+    """
+    Derive hourly headways per route from a GTFS schedule
+
+    Each route is measured at its busiest stop: the median gap between
+    consecutive departures that leave in each hour of the day.
+
+    Args:
+        schedule (GTFSSchedule): Loaded timetable
+
+    Returns:
+        dict: Lower-cased route short name -> list of 24 headways in seconds
+            (0 for hours without service)
+    """
+    busiest = {}
+    for (stop, route), times in schedule.departures.items():
+        if len(times) > len(busiest.get(route, ())):
+            busiest[route] = times
+
+    profiles = {}
+    for route, times in busiest.items():
+        gaps = [[] for _ in range(24)]
+        for previous, current in zip(times, times[1:]):
+            gap = current - previous
+            if 0 < gap <= 3 * 3600:
+                gaps[(previous % SECONDS_PER_DAY) // 3600].append(gap)
+        profiles[schedule.route_names[route].lower()] = [int(statistics.median(g)) if g else 0 for g in gaps]
+    return profiles
+
+
+class HeadwayEstimator:
+    """
+    Estimator of the buses following a known departure, without extra API calls
+
+    Departure times seen in past Directions API answers are kept per
+    (origin, route) pair as sorted seconds after midnight, so after a while
+    a pair's array holds its timetable as observed. The bus after a
+    departure is the next observed one, as long as the gap is plausible
+    for the route's headway; otherwise it is the departure plus the
+    headway, taken from the GTFS feed's hourly profile of the route or the
+    route catalog's headway_minutes.
+
+    next_departures answers many queries at once. With numpy, large
+    batches are one searchsorted call over the concatenation of every
+    pair's array (each pair shifted into its own range of values and stored
+    twice, the second copy a day later, so wrapping past midnight needs no
+    special case); otherwise each query is a binary search.
+    """
+
+    def __init__(self, route_catalog=None, route_headways=None, max_pairs=10000, compile_interval=10):
+        """
+        Initialize the estimator
+
+        Args:
+            route_catalog (RouteCatalog): Catalog whose headway_minutes are the
+                fallback headways
+            route_headways (dict): Route name -> 24 hourly headways in seconds
+                (see schedule_headways)
+            max_pairs (int): Most (origin, route) pairs whose departures are kept
+            compile_interval (float): Seconds between rebuilds of the numpy
+                arrays after new observations
+        """
+        self.route_catalog = route_catalog
+        self.route_headways = route_headways or {}
+        self.max_pairs = max_pairs
+        self.compile_interval = compile_interval
+        self.observations = 0
+        # pair key -> sorted list of observed departures (seconds after midnight)
+        self._departures = {}
+        self._compiled = None
+        self._compiled_at = 0.0
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def observe(self, origin, route_number, departure):
+        """
+        Record a departure seen in a Directions API answer
+
+        Args:
+            origin (str): The starting location
+            route_number (str): The bus route number
+            departure (int): Departure in seconds after midnight
+        """
+        key = _pair_key(origin, route_number)
+        departure = departure % SECONDS_PER_DAY // 60 * 60
+        with self._lock:
+            times = self._departures.get(key)
+            if times is None:
+                if len(self._departures) >= self.max_pairs:
+                    return
+                times = self._departures[key] = []
+            index = bisect_right(times, departure)
+            if index and times[index - 1] == departure:
+                return
+            times.insert(index, departure)
+            self.observations += 1
+            self._dirty = True
+
+    def route_profile(self, route_number):
+        """
+        Get a route's headway for every hour of the day
+
+        Hours the GTFS profile does not cover fall back to the route
+        catalog's headway_minutes.
+
+        Args:
+            route_number (str): The bus route number
+
+        Returns:
+            list: 24 headways in seconds (0 where unknown)
+        """
+        route = self.route_catalog.get(route_number) if self.route_catalog is not None else None
+        fallback = int(route.headway_minutes * 60) if route is not None and route.headway_minutes else 0
+        profile = self.route_headways.get(str(route_number).lower())
+        if profile is None:
+            return [fallback] * 24
+        return [headway or fallback for headway in profile]
+
+    def headway(self, route_number, seconds):
+        """
+        Get a route's headway at a time of day
+
+        Args:
+            route_number (str): The bus route number
+            seconds (int): Seconds after midnight
+
+        Returns:
+            int: Headway in seconds, or 0 if unknown
+        """
+        return self.route_profile(route_number)[seconds % SECONDS_PER_DAY // 3600]
+
+    def next_departures(self, queries, count=1):
+        """
+        Estimate the departures following known ones
+
+        Args:
+            queries (list): (origin, route_number, departure) tuples, the
+                departure in seconds after midnight
+            count (int): Following departures to estimate per query
+
+        Returns:
+            list: Per query, a list of count departures in seconds after
+                midnight (past a day when they are tomorrow), None where
+                nothing is known
+        """
+        if not queries:
+            return []
+        # Profiles are looked up once per distinct route of the batch
+        profiles = {}
+        for origin, route, departure in queries:
+            if route not in profiles:
+                profiles[route] = self.route_profile(route)
+        if HAS_NUMPY and len(queries) >= VECTOR_MIN_QUERIES:
+            return self._next_vectorized(queries, profiles, count)
+        return self._next_bisect(queries, profiles, count)
+
+    def _next_bisect(self, queries, profiles, count):
+        """Answer queries one binary search at a time"""
+        results = []
+        with self._lock:
+            for origin, route, departure in queries:
+                times = self._departures.get(_pair_key(origin, route), ())
+                departure %= SECONDS_PER_DAY
+                headway = profiles[route][departure // 3600]
+                max_gap = headway * MAX_GAP_FACTOR if headway else DEFAULT_MAX_GAP
+                start = bisect_right(times, departure + SAME_BUS_SECONDS)
+                following = []
+                previous = departure
+                observed = True
+                for step in range(1, count + 1):
+                    # Observed departures, wrapping into tomorrow's once
+                    index = start + step - 1
+                    if observed and index < 2 * len(times):
+                        candidate = times[index % len(times)] + SECONDS_PER_DAY * (index // len(times))
+                        if candidate - previous <= max_gap:
+                            following.append(candidate)
+                            previous = candidate
+                            continue
+                    # Once one departure is implausible, the ones after it are too
+                    observed = False
+                    following.append(departure + headway * step if headway else None)
+                results.append(following)
+        return results
+
+    def _compile(self):
+        """Rebuild the concatenated numpy arrays if observations changed (lock held)"""
+        import numpy as np
+
+        now = time.monotonic()
+        if self._compiled is not None and (not self._dirty or now - self._compiled_at < self.compile_interval):
+            return self._compiled
+        index = {}
+        offsets, ends, segments = [], [], []
+        total = 0
+        # Each pair gets its own range of 3 days: its times, then the same a day later
+        for number, (key, times) in enumerate(self._departures.items()):
+            index[key] = number
+            offset = number * 3 * SECONDS_PER_DAY
+            segment = np.asarray(times, dtype=np.int64)
+            segments.append(np.concatenate((segment, segment + SECONDS_PER_DAY)) + offset)
+            offsets.append(offset)
+            total += 2 * len(times)
+            ends.append(total)
+        flat = np.concatenate(segments) if segments else np.zeros(0, dtype=np.int64)
+        self._compiled = (index, flat, np.asarray(offsets, dtype=np.int64), np.asarray(ends, dtype=np.int64))
+        self._compiled_at = now
+        self._dirty = False
+        return self._compiled
+
+    def _next_vectorized(self, queries, profiles, count):
+        """Answer all queries with one searchsorted over every pair's departures"""
+        import numpy as np
+
+        with self._lock:
+            index, flat, offsets, ends = self._compile()
+        size = len(queries)
+        pair = np.fromiter((index.get(_pair_key(origin, route), -1) for origin, route, departure in queries),
+                           dtype=np.int64, count=size)
+        departure = np.fromiter((q[2] for q in queries), dtype=np.int64, count=size) % SECONDS_PER_DAY
+        routes = {route: number for number, route in enumerate(profiles)}
+        route = np.fromiter((routes[q[1]] for q in queries), dtype=np.int64, count=size)
+        headway = np.asarray(list(profiles.values()), dtype=np.int64)[route, departure // 3600]
+        steps = np.arange(1, count + 1)
+        estimate = departure[:, None] + headway[:, None] * steps
+
+        known = pair >= 0
+        if flat.size and known.any():
+            offset = np.where(known, offsets[pair], 0)
+            # Sorted needles walk the departures in order, which is several
+            # times faster than random probes into a large array
+            needles = offset + departure + SAME_BUS_SECONDS
+            order = np.argsort(needles, kind='stable')
+            start = np.empty_like(order)
+            start[order] = np.searchsorted(flat, needles[order], side='right')
+            candidates = start[:, None] + steps - 1
+            valid = known[:, None] & (candidates < ends[np.maximum(pair, 0)][:, None])
+            observed = flat[np.minimum(candidates, flat.size - 1)] - offset[:, None]
+            max_gap = np.where(headway > 0, headway * MAX_GAP_FACTOR, DEFAULT_MAX_GAP)
+            previous = np.concatenate((departure[:, None], observed[:, :-1]), axis=1)
+            valid &= (observed - previous) <= max_gap[:, None]
+            # Once one departure is implausible, the ones after it are too
+            valid = np.logical_and.accumulate(valid, axis=1)
+            estimate = np.where(valid, observed, estimate)
+            usable = valid | (headway[:, None] > 0)
+        else:
+            usable = np.broadcast_to(headway[:, None] > 0, estimate.shape)
+
+        return [
+            [value if value >= 0 else None for value in row]
+            for row in np.where(usable, estimate, -1).tolist()
+        ]
+
+    def fill(self, results, now=None):
+        """
+        Fill in the following bus of Directions API answers that lack one
+
+        Args:
+            results (list): Standardized ETA data dicts
+            now (datetime): Current local time, for answers without a
+                parseable departure time
+
+        Returns:
+            list: The results in the same order; the ones whose next_time
+                could be estimated are copies with it filled in (cached
+                answers are shared, so they are not modified)
+        """
+        pending = [
+            index for index, result in enumerate(results)
+            if result.get('success') and result.get('data')
+            and result.get('source', 'maps') in _FILLED_SOURCES
+            and result['data'].get('next_time', 'Unknown') == 'Unknown'
+        ]
+        if not pending:
+            return list(results)
+        queries = [
+            (results[i]['data']['origin'], results[i]['data']['route_number'], departure_seconds(results[i], now))
+            for i in pending
+        ]
+        filled = list(results)
+        for i, following in zip(pending, self.next_departures(queries, count=1)):
+            if following[0] is not None:
+                data = dict(results[i]['data'], next_time=format_clock_time(following[0]))
+                filled[i] = dict(results[i], data=data)
+        return filled
+
+    def observe_result(self, eta_data, now=None):
+        """Record the departure of a successful Directions API answer"""
+        if eta_data.get('success') and eta_data.get('source', 'maps') == 'maps':
+            data = eta_data['data']
+            self.observe(data['origin'], data['route_number'], departure_seconds(eta_data, now))
+
+    def stats(self):
+        """
+        Get the size of the observed timetable
+
+        Returns:
+            dict: Pairs and departures observed, and routes with a headway profile
+        """
+        with self._lock:
+            return {
+                'pairs': len(self._departures),
+                'departures': sum(len(times) for times in self._departures.values()),
+                'observations': self.observations,
+                'profiled_routes': len(self.route_headways)
+            }
+
+
+def create_headway_estimator(route_catalog, schedule=None):
+    """
+    Create the headway estimator described by the application configuration
+
+    Args:
+        route_catalog (RouteCatalog): Catalog with fallback headways
+        schedule (GTFSSchedule): Optional timetable to take hourly headways from
+
+    Returns:
+        HeadwayEstimator: The estimator, or None when it is disabled
+    """
+    if not Config.HEADWAY_ESTIMATOR:
+        return None
+    route_headways = schedule_headways(schedule) if schedule is not None else {}
+    if route_headways:
+        logging.info("Derived hourly headways for %s routes from the GTFS feed", len(route_headways))
+    return HeadwayEstimator(
+        route_catalog,
+        route_headways,
+        max_pairs=Config.HEADWAY_MAX_PAIRS,
+        compile_interval=Config.HEADWAY_COMPILE_INTERVAL
+    )
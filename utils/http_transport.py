@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+from config import Config
+from utils.circuit_breaker import get_breaker
+from utils.traffic_capture import get_traffic_recorder
+
+
+class HTTPTransport:
+    """
+    Per-process pooled HTTP session with keep-alive connections
+
+    The underlying requests.Session is created lazily in the process that
+    uses it, so a transport built before gunicorn forks never shares sockets
+    between workers.
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=3.0, read_timeout=10.0,
+                 max_retries=2, backoff_factor=0.3, breaker=None, name=None):
+        """
+        Initialize the transport
+
+        Args:
+            pool_size (int): Maximum pooled connections per host
+            connect_timeout (float): Seconds to wait for a TCP/TLS connection
+            read_timeout (float): Seconds to wait for response data
+            max_retries (int): Retries for idempotent (GET) requests
+            backoff_factor (float): Exponential backoff factor between retries
+            breaker (CircuitBreaker): Optional breaker that rejects requests
+                while the upstream is failing and supplies an adaptive read timeout
+            name (str): Upstream name under which calls are captured (see
+                utils.traffic_capture); None never captures them
+        """
+        self.name = name
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.breaker = breaker
+        self.requests_total = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """Return the session owned by the current process"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = self._build_session()
+                    self._pid = os.getpid()
+                    self.in_flight = 0
+        return self._session
+
+    def _build_session(self):
+        """Create a session with a bounded connection pool and retry policy"""
+        # requests costs tens of milliseconds to import; load it on first use
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # Only idempotent GETs are retried on read errors and 5xx responses;
+        # POSTs (SMS sends) are never replayed
+        retry = Retry(
+            total=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+            max_retries=retry
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def request(self, method, url, **kwargs):
+        """
+        Send an HTTP request through the pooled session
+
+        Args:
+            method (str): HTTP method
+            url (str): Request URL
+            **kwargs: Passed to requests.Session.request; a (connect, read)
+                timeout is applied unless one is given
+
+        Returns:
+            requests.Response: The response
+
+        Raises:
+            CircuitOpenError: If the upstream's circuit is open
+        """
+        if self.breaker is not None:
+            self.breaker.allow_request()
+            kwargs.setdefault('timeout', (self.timeout[0], self.breaker.timeout()))
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session
+        with self._lock:
+            self.requests_total += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        start = time.monotonic()
+        success = False
+        response = error = None
+        try:
+            response = session.request(method, url, **kwargs)
+            success = self.breaker is None or response.status_code < 500
+            return response
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            elapsed = time.monotonic() - start
+            if self.breaker is not None:
+                self.breaker.record(success, elapsed)
+            recorder = get_traffic_recorder()
+            if recorder is not None and self.name is not None:
+                recorder.record_upstream(
+                    self.name, method, url, kwargs.get('params'), kwargs.get('json'),
+                    response.status_code if response is not None else None,
+                    response.text if response is not None else None, elapsed, error
+                )
+
+    def get(self, url, **kwargs):
+        """Send a GET request"""
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """Send a POST request"""
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        """Close pooled connections (a new session is built on next use)"""
+        with self._lock:
+            if self._session is not None and self._pid == os.getpid():
+                self._session.close()
+            self._session = None
+            self._pid = None
+
+    def stats(self):
+        """
+        Get connection pool utilization
+
+        Returns:
+            dict: Pool size, in-flight requests, peak usage and request count
+        """
+        with self._lock:
+            return {
+                'pool_size': self.pool_size,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'utilization': self.in_flight / self.pool_size,
+                'requests_total': self.requests_total
+            }
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(name):
+    """
+    Get the shared transport for an upstream service
+
+    Args:
+        name (str): Upstream name, e.g. 'maps' or 'sms'
+
+    Returns:
+        HTTPTransport: The transport configured from Config
+    """
+    transport = _transports.get(name)
+    if transport is None:
+        with _transports_lock:
+            transport = _transports.get(name)
+            if transport is None:
+                transport = HTTPTransport(
+                    pool_size=Config.HTTP_POOL_SIZE,
+                    connect_timeout=Config.HTTP_CONNECT_TIMEOUT,
+                    read_timeout=Config.HTTP_READ_TIMEOUT,
+                    max_retries=Config.HTTP_MAX_RETRIES,
+                    backoff_factor=Config.HTTP_RETRY_BACKOFF,
+                    breaker=get_breaker(name),
+                    name=name
+                )
+                _transports[name] = transport
+    return transport
+
+
+def reset_transports():
+    """Drop all pooled connections, e.g. in a freshly forked worker"""
+    with _transports_lock:
+        for transport in _transports.values():
+            transport.close()
+
+
+def transport_stats():
+    """Return pool utilization for every transport created so far"""
+    with _transports_lock:
+        return {name: transport.stats() for name, transport in _transports.items()}
@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import threading
+import time
+from config import Config
+from utils.kv_store import create_kv_store
+
+# Webhook fields that may carry the gateway's message ID
+MESSAGE_ID_FIELDS = ('message_id', 'messageId', 'msg_id', 'request_id', 'id')
+
+# Statuses for which no work was done, so a retry should be processed again
+RETRYABLE_STATUSES = frozenset([429, 503])
+
+
+def make_idempotency_key(data, phone_number, message_text, bucket_seconds, content_fallback=False):
+    """
+    Build the key identifying one inbound message across gateway retries
+
+    The gateway's message ID is used when the webhook carries one. Without
+    one, a commuter texting the same query again is indistinguishable from
+    a gateway retry, so such messages are only deduplicated if
+    content_fallback is set: the key then hashes the sender, the text and
+    the time bucket it arrived in, and the same text sent again after the
+    bucket ends is a new message.
+
+    Args:
+        data (dict): Webhook JSON body
+        phone_number (str): The sender's phone number
+        message_text (str): The SMS message text
+        bucket_seconds (float): Length of the time bucket
+        content_fallback (bool): Hash the message when it has no ID
+
+    Returns:
+        str: The idempotency key, or None if the message is not deduplicated
+    """
+    for field in MESSAGE_ID_FIELDS:
+        message_id = data.get(field)
+        if message_id:
+            return f"idem:id:{message_id}"
+
+    if not content_fallback:
+        return None
+    bucket = int(time.time() // bucket_seconds)
+    digest = hashlib.sha1(f"{phone_number}\x00{message_text}\x00{bucket}".encode()).hexdigest()
+    return f"idem:hash:{digest}"
+
+
+class IdempotencyGuard:
+    """
+    Remember webhook results so retried deliveries are not processed twice
+
+    The first delivery claims the key and its result is stored for window
+    seconds; later deliveries get the stored result back. A delivery that
+    arrives while the first is still running gets a 202 without doing any
+    work. Claims left by a crashed worker expire after pending_ttl seconds.
+    """
+
+    def __init__(self, store, window=300, pending_ttl=60):
+        """
+        Initialize the guard
+
+        Args:
+            store (MemoryKVStore or SQLiteKVStore): Backing store (a SQLite
+                store is shared by all gunicorn workers)
+            window (float): Seconds a result is replayed to duplicates
+            pending_ttl (float): Seconds after which an unfinished claim is
+                considered abandoned
+        """
+        self.store = store
+        self.window = window
+        self.pending_ttl = pending_ttl
+        self.processed = 0
+        self.duplicates = 0
+        # Counters are shared by the threads (or greenlets) of a worker
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        """
+        Claim a key, or get the response recorded for it
+
+        Args:
+            key (str): Idempotency key of the inbound message
+
+        Returns:
+            tuple: None if the caller claimed the key and must process the
+                message, else the (payload, status) to return to the duplicate
+        """
+        now = time.time()
+        previous = []
+
+        def claim(record):
+            abandoned = (record is not None and record['state'] == 'pending'
+                         and now - record['claimed_at'] >= self.pending_ttl)
+            if record is not None and not abandoned:
+                previous.append(record)
+                return record
+            return {'state': 'pending', 'claimed_at': now}
+
+        self.store.update(key, claim, ttl=self.window)
+        if not previous:
+            return None
+
+        with self._lock:
+            self.duplicates += 1
+        record = previous[0]
+        logging.info("Duplicate webhook delivery for %s", key)
+        if record['state'] == 'done':
+            return record['payload'], record['status']
+        return {"message": "Duplicate message, already being processed"}, 202
+
+    def complete(self, key, payload, status):
+        """
+        Record the response for a claimed key
+
+        Args:
+            key (str): Idempotency key of the inbound message
+            payload (dict): JSON-serializable response payload
+            status (int): HTTP status code
+        """
+        with self._lock:
+            self.processed += 1
+        if status in RETRYABLE_STATUSES:
+            self.store.delete(key)
+            return
+        self.store.set(key, {'state': 'done', 'payload': payload, 'status': status}, ttl=self.window)
+
+    def release(self, key):
+        """Drop a claim so the next delivery is processed (e.g. after an exception)"""
+        self.store.delete(key)
+
+    def run(self, key, func):
+        """
+        Process a message once per key
+
+        Args:
+            key (str): Idempotency key of the inbound message
+            func (callable): Processes the message and returns (payload, status)
+
+        Returns:
+            tuple: (payload, status), recorded or freshly computed
+        """
+        previous = self.begin(key)
+        if previous is not None:
+            return previous
+        try:
+            payload, status = func()
+        except Exception:
+            self.release(key)
+            raise
+        self.complete(key, payload, status)
+        return payload, status
+
+    def stats(self):
+        """
+        Get idempotency counters for this process
+
+        Returns:
+            dict: Processed and duplicate delivery counts
+        """
+        return {'processed': self.processed, 'duplicates': self.duplicates}
+
+
+def create_idempotency_guard():
+    """
+    Create the idempotency guard described by the application configuration
+
+    Returns:
+        IdempotencyGuard: The configured guard, or None when disabled
+    """
+    backend = Config.IDEMPOTENCY_BACKEND
+    if backend == 'none':
+        return None
+
+    store = create_kv_store(
+        backend,
+        path=Config.IDEMPOTENCY_PATH,
+        max_entries=Config.IDEMPOTENCY_MAX_ENTRIES
+    )
+    return IdempotencyGuard(
+        store,
+        window=Config.IDEMPOTENCY_WINDOW,
+        pending_ttl=Config.IDEMPOTENCY_PENDING_TTL
+    )
@@ -0,0 +1,625 @@
+import fcntl
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+class MemoryKVStore:
+    """In-process key/value store with TTL expiry and LRU eviction"""
+
+    # Calls never wait on I/O, so the asyncio service mode makes them on
+    # the event loop (see utils.async_clients.run_blocking)
+    blocking = False
+
+    def __init__(self, max_entries=1024):
+        """
+        Initialize the store
+
+        Args:
+            max_entries (int): Maximum number of entries kept before the least
+                recently used entry is evicted
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get a value from the store
+
+        Args:
+            key (str): The entry key
+
+        Returns:
+            The stored value, or None if missing or expired
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value
+
+        Args:
+            key (str): The entry key
+            value: A JSON-serializable value
+            ttl (float): Seconds until the entry expires (None for no expiry)
+        """
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def update(self, key, func, ttl=None):
+        """
+        Atomically read, transform and store a value
+
+        Args:
+            key (str): The entry key
+            func (callable): Receives the current value (or None) and returns
+                the new value
+            ttl (float): Seconds until the new entry expires
+
+        Returns:
+            The new value
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            current = None
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                current = entry[0]
+            value = func(current)
+            expires_at = now + ttl if ttl is not None else None
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return value
+
+    def delete(self, key):
+        """Remove an entry if present"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SQLiteKVStore:
+    """
+    Key/value store backed by a local SQLite file
+
+    The file can be shared by several processes on the same host (e.g. the
+    gunicorn workers), so an entry written by one worker is visible to all.
+    """
+
+    # Calls wait on disk I/O and on other processes' write locks, so the
+    # asyncio service mode makes them in a thread
+    blocking = True
+    # How many writes happen between eviction sweeps
+    EVICTION_INTERVAL = 64
+
+    def __init__(self, path, max_entries=1024):
+        """
+        Initialize the store
+
+        Args:
+            path (str): Path of the SQLite database file
+            max_entries (int): Maximum number of entries kept before the least
+                recently used entries are evicted
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        self._write_lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS kv ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+            'expires_at REAL, accessed_at REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS kv_accessed ON kv (accessed_at)')
+
+    def _connection(self):
+        """Return a connection owned by the current thread and process"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        """
+        Get a value from the store
+
+        Args:
+            key (str): The entry key
+
+        Returns:
+            The stored value, or None if missing or expired
+        """
+        now = time.time()
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                'SELECT value, expires_at FROM kv WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+                return None
+            conn.execute('UPDATE kv SET accessed_at = ? WHERE key = ?', (now, key))
+            return json.loads(value)
+        except sqlite3.Error as e:
+            logging.error("SQLite store read error: %s", e)
+            return None
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value
+
+        Args:
+            key (str): The entry key
+            value: A JSON-serializable value
+            ttl (float): Seconds until the entry expires (None for no expiry)
+        """
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        try:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO kv (key, value, expires_at, accessed_at) '
+                'VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), expires_at, now)
+            )
+            self._after_write()
+        except sqlite3.Error as e:
+            logging.error("SQLite store write error: %s", e)
+
+    def update(self, key, func, ttl=None):
+        """
+        Atomically read, transform and store a value
+
+        The read-modify-write runs inside an immediate transaction, so it is
+        atomic across processes sharing the file.
+
+        Args:
+            key (str): The entry key
+            func (callable): Receives the current value (or None) and returns
+                the new value
+            ttl (float): Seconds until the new entry expires
+
+        Returns:
+            The new value
+        """
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        conn = self._connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    'SELECT value, expires_at FROM kv WHERE key = ?', (key,)
+                ).fetchone()
+                current = None
+                if row is not None and (row[1] is None or row[1] > now):
+                    current = json.loads(row[0])
+                value = func(current)
+                conn.execute(
+                    'INSERT OR REPLACE INTO kv (key, value, expires_at, accessed_at) '
+                    'VALUES (?, ?, ?, ?)',
+                    (key, json.dumps(value), expires_at, now)
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            self._after_write()
+            return value
+        except sqlite3.Error as e:
+            logging.error("SQLite store update error: %s", e)
+            return func(None)
+
+    def delete(self, key):
+        """Remove an entry if present"""
+        try:
+            self._connection().execute('DELETE FROM kv WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            logging.error("SQLite store delete error: %s", e)
+
+    def clear(self):
+        """Remove all entries"""
+        try:
+            self._connection().execute('DELETE FROM kv')
+        except sqlite3.Error as e:
+            logging.error("SQLite store clear error: %s", e)
+
+    def _after_write(self):
+        """Periodically purge expired entries and enforce the size bound"""
+        with self._write_lock:
+            self._writes += 1
+            if self._writes % self.EVICTION_INTERVAL != 1:
+                return
+        self.evict()
+
+    def evict(self):
+        """Purge expired entries and evict least recently used entries"""
+        try:
+            conn = self._connection()
+            conn.execute(
+                'DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?',
+                (time.time(),)
+            )
+            conn.execute(
+                'DELETE FROM kv WHERE key IN ('
+                'SELECT key FROM kv ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+        except sqlite3.Error as e:
+            logging.error("SQLite store eviction error: %s", e)
+
+    def __len__(self):
+        row = self._connection().execute('SELECT COUNT(*) FROM kv').fetchone()
+        return row[0]
+
+
+class LogKVStore:
+    """
+    Key/value store backed by an append-only log file read through mmap
+
+    Every write appends one record (crc32, key length, value length, expiry,
+    key, JSON value) to the log, and every process keeps an index of where
+    the latest record of each key starts. Reads come straight from the page
+    cache through a read-only memory map, with one stat() to notice new
+    records instead of a read() or a database round trip, and the file
+    outlives worker recycles, restarts and deploys. Several processes can share the file: appends are serialized by
+    an exclusive lock on a side file, and readers pick up the records other
+    processes append by indexing the log's new tail.
+
+    Expired entries, superseded records and entries beyond max_entries
+    (oldest writes first) are only dropped when the log is compacted into a
+    new file, which replaces the old one atomically once it has doubled in
+    size since it was last written out.
+    """
+
+    # Appends wait on other processes' write locks, so the asyncio service
+    # mode makes calls in a thread
+    blocking = True
+    # crc32 of the rest of the record, key length, value length, expires_at
+    HEADER = struct.Struct('<IHId')
+    # Value length of a record that deletes its key
+    TOMBSTONE = 0xFFFFFFFF
+    # Compaction runs when the log has grown this many times its size after
+    # the last compaction...
+    COMPACTION_RATIO = 2
+    # ...and is at least this large
+    COMPACTION_MIN_BYTES = 1 << 20
+
+    def __init__(self, path, max_entries=1024):
+        """
+        Initialize the store
+
+        Args:
+            path (str): Path of the log file
+            max_entries (int): Maximum number of entries kept by a compaction
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.compactions = 0
+        self._lock = threading.RLock()
+        self._pid = None
+        self._fd = None
+        self._lock_fd = None
+        self._map = None
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._sync()
+
+    def _open(self):
+        """(Re)open the log and index it from the start (lock held)"""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+        if self._pid != os.getpid():
+            # flock locks belong to the open file, so a forked worker opens
+            # its own lock file instead of sharing its parent's
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+            self._lock_fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._inode = os.fstat(self._fd).st_ino
+        # key -> (record offset, key length, value length, expires_at)
+        self._index = {}
+        self._indexed = 0
+        self._scan(os.fstat(self._fd).st_size)
+        self._compact_at = max(self.COMPACTION_MIN_BYTES, self.COMPACTION_RATIO * self._indexed)
+
+    def _sync(self):
+        """Catch up with the records and compactions of other processes (lock held)"""
+        if self._pid != os.getpid():
+            self._open()
+            return
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._open()
+            return
+        if stat.st_ino != self._inode or stat.st_size < self._indexed:
+            self._open()
+        elif stat.st_size > self._indexed:
+            self._scan(stat.st_size)
+
+    def _scan(self, size):
+        """Index the records between the indexed part of the log and size (lock held)"""
+        if size == 0:
+            return
+        if self._map is None or len(self._map) < size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+        data = self._map
+        offset = self._indexed
+        header_size = self.HEADER.size
+        while offset + header_size <= size:
+            crc, key_length, value_length, expires_at = self.HEADER.unpack_from(data, offset)
+            stored_length = 0 if value_length == self.TOMBSTONE else value_length
+            end = offset + header_size + key_length + stored_length
+            # A record still being written by another process, or torn by a
+            # crash: stop here, the next writer truncates a torn tail
+            if end > size or zlib.crc32(data[offset + 4:end]) != crc:
+                break
+            key = data[offset + header_size:offset + header_size + key_length].decode('utf-8')
+            if value_length == self.TOMBSTONE:
+                self._index.pop(key, None)
+            else:
+                self._index[key] = (offset, key_length, value_length, expires_at)
+            offset = end
+        self._indexed = offset
+
+    def _encode(self, key, value, expires_at):
+        """Serialize one record (value None writes a tombstone)"""
+        key_bytes = key.encode('utf-8')
+        if value is None:
+            value_bytes, value_length = b'', self.TOMBSTONE
+        else:
+            value_bytes = json.dumps(value, separators=(',', ':')).encode('utf-8')
+            value_length = len(value_bytes)
+        body = self.HEADER.pack(0, len(key_bytes), value_length, expires_at or 0)[4:] + key_bytes + value_bytes
+        return struct.pack('<I', zlib.crc32(body)) + body
+
+    def _read(self, key, now):
+        """Return the live value of key from the map, or None (lock held)"""
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        offset, key_length, value_length, expires_at = entry
+        if expires_at and expires_at <= now:
+            return None
+        start = offset + self.HEADER.size + key_length
+        return json.loads(self._map[start:start + value_length])
+
+    def _append(self, record):
+        """Append a record under the cross-process lock (both locks held)"""
+        self._sync()
+        size = os.fstat(self._fd).st_size
+        if size > self._indexed:
+            # Nobody else is writing, so an unindexed tail is a torn record
+            os.ftruncate(self._fd, self._indexed)
+            logging.warning("Truncated %s torn bytes from %s", size - self._indexed, self.path)
+        os.write(self._fd, record)
+        self._scan(self._indexed + len(record))
+
+    def _write(self, key, value, ttl):
+        """Append the record of one set or delete, compacting when the log is due"""
+        expires_at = time.time() + ttl if ttl is not None else None
+        record = self._encode(key, value, expires_at)
+        with self._lock:
+            self._sync()
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                self._append(record)
+                if self._indexed >= self._compact_at:
+                    self._compact()
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def get(self, key):
+        """
+        Get a value from the store
+
+        Args:
+            key (str): The entry key
+
+        Returns:
+            The stored value, or None if missing or expired
+        """
+        try:
+            with self._lock:
+                self._sync()
+                return self._read(key, time.time())
+        except (OSError, ValueError) as e:
+            logging.error("Log store read error: %s", e)
+            return None
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value
+
+        Args:
+            key (str): The entry key
+            value: A JSON-serializable value
+            ttl (float): Seconds until the entry expires (None for no expiry)
+        """
+        try:
+            self._write(key, value, ttl)
+        except OSError as e:
+            logging.error("Log store write error: %s", e)
+
+    def update(self, key, func, ttl=None):
+        """
+        Atomically read, transform and store a value
+
+        The read-modify-append runs under the cross-process lock, so it is
+        atomic across processes sharing the file.
+
+        Args:
+            key (str): The entry key
+            func (callable): Receives the current value (or None) and returns
+                the new value
+            ttl (float): Seconds until the new entry expires
+
+        Returns:
+            The new value
+        """
+        try:
+            with self._lock:
+                self._sync()
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+                try:
+                    self._sync()
+                    now = time.time()
+                    value = func(self._read(key, now))
+                    self._append(self._encode(key, value, now + ttl if ttl is not None else None))
+                    if self._indexed >= self._compact_at:
+                        self._compact()
+                finally:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            return value
+        except OSError as e:
+            logging.error("Log store update error: %s", e)
+            return func(None)
+
+    def delete(self, key):
+        """Remove an entry if present"""
+        try:
+            self._write(key, None, None)
+        except OSError as e:
+            logging.error("Log store delete error: %s", e)
+
+    def clear(self):
+        """Remove all entries"""
+        try:
+            with self._lock:
+                self._sync()
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+                try:
+                    self._replace(b'')
+                finally:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        except OSError as e:
+            logging.error("Log store clear error: %s", e)
+
+    def compact(self):
+        """Rewrite the log with only its live entries, enforcing TTLs and max_entries"""
+        try:
+            with self._lock:
+                self._sync()
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+                try:
+                    self._sync()
+                    self._compact()
+                finally:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        except OSError as e:
+            logging.error("Log store compaction error: %s", e)
+
+    def _compact(self):
+        """Write the live, most recently written entries to a new log (both locks held)"""
+        now = time.time()
+        live = [entry for entry in self._index.values() if not entry[3] or entry[3] > now]
+        # Records are in write order, so the newest max_entries are the last ones
+        live.sort()
+        live = live[-self.max_entries:] if self.max_entries > 0 else []
+        header_size = self.HEADER.size
+        data = b''.join(
+            self._map[offset:offset + header_size + key_length + value_length]
+            for offset, key_length, value_length, expires_at in live
+        )
+        self._replace(data)
+        self.compactions += 1
+
+    def _replace(self, data):
+        """Atomically swap the log for a file holding data, and reopen it (both locks held)"""
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temporary, self.path)
+        # Other processes see the new inode on their next access and reopen;
+        # their map of the old file stays valid until then
+        self._open()
+
+    def __len__(self):
+        now = time.time()
+        with self._lock:
+            self._sync()
+            return sum(1 for entry in self._index.values() if not entry[3] or entry[3] > now)
+
+
+def create_kv_store(backend, path=None, max_entries=1024):
+    """
+    Create a key/value store for the given backend name
+
+    Args:
+        backend (str): 'memory' for a per-process store, 'sqlite' for a store
+            shared by all workers on the host, or 'log' for a memory-mapped
+            log shared by all workers that also survives restarts
+        path (str): Database or log file path (required for 'sqlite' and 'log')
+        max_entries (int): Maximum number of entries
+
+    Returns:
+        MemoryKVStore, SQLiteKVStore or LogKVStore
+    """
+    if backend == 'memory':
+        return MemoryKVStore(max_entries=max_entries)
+    if backend == 'sqlite':
+        if not path:
+            raise ValueError("A file path is required for the sqlite store backend")
+        return SQLiteKVStore(path, max_entries=max_entries)
+    if backend == 'log':
+        if not path:
+            raise ValueError("A file path is required for the log store backend")
+        return LogKVStore(path, max_entries=max_entries)
+    raise ValueError(f"Unknown store backend: {backend}")
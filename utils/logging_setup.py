@@ -0,0 +1,195 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import uuid
+from datetime import datetime, timezone
+from config import Config
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(module)s [%(correlation_id)s] %(message)s'
+
+# ID of the inbound message being handled, shared by every log line of its
+# parse → maps → sms pipeline
+_correlation_id = contextvars.ContextVar('correlation_id', default='-')
+
+# LogRecord attributes that are not user-supplied `extra` fields
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'correlation_id', 'sample'
+}
+
+
+def set_correlation_id(value=None):
+    """
+    Set the correlation ID of the current request (thread or asyncio task)
+
+    Args:
+        value (str): ID received from the caller, e.g. an X-Request-ID header;
+            a new one is generated when empty
+
+    Returns:
+        str: The ID now in effect
+    """
+    value = value or uuid.uuid4().hex[:16]
+    _correlation_id.set(value)
+    return value
+
+
+def get_correlation_id():
+    """Return the correlation ID of the current request ('-' outside one)"""
+    return _correlation_id.get()
+
+
+class CorrelationFilter(logging.Filter):
+    """Stamp records with the correlation ID of the request that logged them"""
+
+    def filter(self, record):
+        record.correlation_id = _correlation_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a fraction of high-volume records
+
+    Records logged with extra={'sample': True} below WARNING are kept with
+    probability rate; everything else passes.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.__dict__.get('sample') and record.levelno < logging.WARNING:
+            return random.random() < self.rate
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including `extra` fields"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'module': record.module,
+            'correlation_id': getattr(record, 'correlation_id', '-'),
+            'message': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class QueueLogHandler(logging.Handler):
+    """
+    Handler that hands records to a background thread
+
+    The calling thread only runs the filters and a non-blocking queue put;
+    formatting (including the %-style message arguments) and the write to
+    the target handlers happen on the writer thread, so a slow stdout or
+    disk never stalls a request. When the queue is full the record is
+    dropped and counted rather than waited for. The writer thread is
+    started lazily in each process, so a handler created before gunicorn
+    forks works in every worker.
+    """
+
+    def __init__(self, handlers, max_size=10000):
+        """
+        Initialize the handler
+
+        Args:
+            handlers (list): Handlers the writer thread passes records to
+            max_size (int): Maximum records waiting to be written
+        """
+        super().__init__()
+        self.handlers = handlers
+        self.max_size = max_size
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        """Start the writer thread if it is not running in this process"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # A queue inherited from the parent may hold its records or locks
+            self._queue = queue.SimpleQueue()
+            self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def emit(self, record):
+        self._ensure_started()
+        # SimpleQueue puts never block; the bound may be overshot by a few
+        # records under concurrent emits, which is harmless
+        if self._queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self._queue.put(record)
+
+    def _run(self):
+        """Writer loop: pass queued records to the target handlers"""
+        records = self._queue
+        while True:
+            record = records.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self, timeout=1.0):
+        """Write the queued records and stop the writer thread"""
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        # Called by logging.shutdown at exit, so queued records are not lost
+        self.stop()
+        super().close()
+
+
+def configure_logging():
+    """
+    Set up root logging as described by the application configuration
+
+    Like logging.basicConfig, this does nothing if the root logger already
+    has handlers.
+
+    Returns:
+        logging.Handler: The installed handler, or None if logging was
+            already configured
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+
+    output = logging.StreamHandler(sys.stderr)
+    if Config.LOG_FORMAT == 'json':
+        output.setFormatter(JSONFormatter())
+    else:
+        output.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    handler = QueueLogHandler([output], max_size=Config.LOG_QUEUE_SIZE) if Config.LOG_QUEUE else output
+    handler.addFilter(CorrelationFilter())
+    handler.addFilter(SamplingFilter(Config.LOG_SAMPLE_RATE))
+    root.addHandler(handler)
+    root.setLevel(Config.LOG_LEVEL.upper())
+    return handler
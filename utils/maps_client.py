@@ -1,22 +1,289 @@
-import requests
 import logging
 from config import Config
+from utils.eta_cache import make_eta_cache_key
+from utils.http_transport import get_transport
+from utils.route_catalog import RouteCatalog, DEFAULT_ROUTES, route_not_found
+from utils.circuit_breaker import CircuitOpenError
+from utils.single_flight import SingleFlight
+from utils.metrics import ETA_SECONDS, count_eta_lookup
 from datetime import datetime
 
+def build_directions_params(origin, destination, api_key):
+    """
+    Build Directions API query parameters for a route lookup
+    
+    Args:
+        origin (str): The starting location
+        destination (str): The route's destination (from the route catalog)
+        api_key (str): Google Maps API key
+        
+    Returns:
+        dict: Query parameters
+    """
+    return {
+        'origin': origin,
+        'destination': destination,
+        'mode': 'transit',
+        'transit_mode': 'bus',
+        'departure_time': 'now',
+        'key': api_key
+    }
+
+def parse_directions_response(data, origin, destination, route_number):
+    """
+    Convert a Directions API JSON body into the standardized ETA dict
+    
+    Args:
+        data (dict): Decoded Directions API response
+        origin (str): The starting location
+        destination (str): The destination used for the lookup
+        route_number (str): The bus route number
+        
+    Returns:
+        dict: Standardized ETA data with success status
+    """
+    # Check API response status
+    if data.get('status') != 'OK':
+        logging.error("Google Maps API returned status: %s", data.get('status'))
+        return {
+            'success': False,
+            'error': f'Google Maps API status: {data.get("status")}',
+            'data': None,
+            # A server-side error that may succeed on retry; every other
+            # status (NOT_FOUND, ZERO_RESULTS, ...) is an answer to the query
+            'transient': data.get('status') == 'UNKNOWN_ERROR'
+        }
+    
+    # Extract ETA information
+    routes = data.get('routes', [])
+    if not routes:
+        return {
+            'success': False,
+            'error': 'No routes found',
+            'data': None
+        }
+    
+    # Get the first route
+    route = routes[0]
+    legs = route.get('legs', [])
+    
+    if not legs:
+        return {
+            'success': False,
+            'error': 'No route legs found',
+            'data': None
+        }
+    
+    # Get the first leg
+    leg = legs[0]
+    duration = leg.get('duration', {})
+    duration_in_traffic = leg.get('duration_in_traffic', {})
+    
+    # Extract time information
+    eta_minutes = duration.get('value', 0) // 60  # Convert seconds to minutes
+    eta_text = duration.get('text', 'Unknown')
+    
+    # Get departure time if available
+    departure_time = leg.get('departure_time', {}).get('text', 'Now')
+    
+    # For a real implementation, you would parse the transit details to get
+    # information about specific bus stops and next departures
+    # This is simplified for the example
+    
+    return {
+        'success': True,
+        'error': '',
+        'data': {
+            'eta_minutes': eta_minutes,
+            'eta_text': eta_text,
+            'departure_time': departure_time,
+            'origin': origin,
+            'destination': destination,
+            'route_number': route_number,
+            'next_departure': departure_time,
+            'bus_stop_name': origin,  # In a real implementation, this would be the actual bus stop
+            'next_time': 'Unknown'  # In a real implementation, this would be the next bus time
+        }
+    }
+
+def degraded_bus_eta(cache, route_catalog, origin, route_number, failure):
+    """
+    Build the best answer available when the Directions API is unreachable
+    
+    The last cached ETA for the pair is preferred (with its countdown moved
+    forward by the entry's age); otherwise an estimate from the route's
+    headway in the route catalog is returned.
+    
+    Args:
+        cache (ETACache): ETA cache, or None
+        route_catalog (RouteCatalog): Route catalog
+        origin (str): The starting location
+        route_number (str): The bus route number
+        failure (dict): The failed API result, returned if nothing better exists
+        
+    Returns:
+        dict: Standardized ETA data; 'source' is 'stale_cache' or
+            'headway_estimate' for degraded answers
+    """
+    if cache is not None:
+        cached, stored_at = cache.lookup_fallback(origin, route_number)
+        if cached is not None:
+            age_minutes = int((datetime.now().timestamp() - stored_at) // 60)
+            eta_minutes = max(0, cached['data']['eta_minutes'] - age_minutes)
+            data = dict(cached['data'], eta_minutes=eta_minutes, eta_text=f"{eta_minutes} mins")
+            return dict(cached, source='stale_cache', data=data)
+    
+    route = route_catalog.get(route_number)
+    if route is not None and route.headway_minutes:
+        headway = int(route.headway_minutes)
+        return {
+            'success': True,
+            'error': '',
+            'source': 'headway_estimate',
+            'data': {
+                'eta_minutes': headway,
+                'eta_text': f"{headway} mins",
+                'departure_time': 'Unknown',
+                'origin': origin,
+                'destination': route.destination,
+                'route_number': route_number,
+                'next_departure': 'Unknown',
+                'bus_stop_name': origin,
+                'next_time': 'Unknown',
+                'headway_minutes': headway
+            }
+        }
+    
+    return failure
+
+def lookup_local_eta(client, origin, route_number):
+    """
+    Run the steps of an ETA lookup that need no Directions API call
+    
+    Shared by GoogleMapsClient and AsyncGoogleMapsClient, which only differ
+    in how they wait for the API. The origin is mapped to its canonical stop
+    name, then the query is answered by the GTFS schedule, rejected for an
+    unknown route, or answered from the cache (a stale entry is returned and
+    refreshed in the background on the client's single flight).
+    
+    Args:
+        client (GoogleMapsClient or AsyncGoogleMapsClient): The client
+        origin (str): The starting location
+        route_number (str): The bus route number
+        
+    Returns:
+        tuple: (canonical origin, answer or None if the API must be called)
+    """
+    # Canonical stop names give typo variants a single cache entry
+    if client.stop_resolver is not None:
+        origin = client.stop_resolver.canonical_location(origin)
+    
+    if client.schedule is not None:
+        scheduled = client.schedule.get_bus_eta(origin, route_number)
+        if scheduled is not None:
+            return origin, scheduled
+    
+    if client.route_catalog.get(route_number) is None:
+        return origin, route_not_found(route_number)
+    
+    # Only queries the Directions API would answer are worth prefetching
+    if client.prefetcher is not None:
+        client.prefetcher.record(origin, route_number)
+    
+    if client.cache is not None:
+        cached, fresh = client.cache.lookup(origin, route_number)
+        if cached is not None:
+            if not fresh:
+                key = make_eta_cache_key(origin, route_number)
+                client.single_flight.do_background(key, client.refresh_bus_eta, origin, route_number)
+            return origin, cached
+    
+    return origin, None
+
+def finish_eta_lookup(client, origin, route_number, result):
+    """
+    Return an API result, or a degraded answer if the API was unreachable
+    
+    Failures marked 'transient' (circuit open, timeout, connection error,
+    5xx) are degraded; answers about the query itself are not, so a
+    location the API cannot find is reported instead of a bus.
+    
+    Args:
+        client (GoogleMapsClient or AsyncGoogleMapsClient): The client
+        origin (str): The starting location
+        route_number (str): The bus route number
+        result (dict): Result of the Directions API call
+        
+    Returns:
+        dict: Standardized ETA data (see degraded_bus_eta)
+    """
+    # Final answers (NOT_FOUND, ZERO_RESULTS, ...) are returned as they are:
+    # only an unreachable API is replaced by a stale or estimated ETA
+    if not result['success'] and result.get('transient'):
+        return degraded_bus_eta(client.cache, client.route_catalog, origin, route_number, result)
+    return result
+
+def store_fetched_eta(client, origin, route_number, result):
+    """
+    Record a Directions API result in the client's headways and cache
+    
+    Args:
+        client (GoogleMapsClient or AsyncGoogleMapsClient): The client
+        origin (str): The starting location
+        route_number (str): The bus route number
+        result (dict): Result of the Directions API call
+    """
+    # Every departure seen builds up the pair's observed timetable
+    if client.headways is not None:
+        client.headways.observe_result(result)
+    
+    # Only successful lookups are cached so transient errors are retried
+    if client.cache is not None and result['success']:
+        client.cache.set(origin, route_number, result)
+
 class GoogleMapsClient:
     """Google Maps API client for fetching bus ETAs"""
     
-    def __init__(self):
-        """Initialize the Google Maps client with API key"""
+    def __init__(self, cache=None, schedule=None, stop_resolver=None, route_catalog=None):
+        """
+        Initialize the Google Maps client with API key
+        
+        Args:
+            cache (ETACache): Optional cache consulted before calling the API
+            schedule (GTFSSchedule): Optional timetable that answers queries it
+                covers without calling the API
+            stop_resolver (StopResolver): Optional resolver that maps free-text
+                origins to canonical stop names before any lookup
+            route_catalog (RouteCatalog): Route destinations (defaults to the
+                built-in routes); unknown routes are rejected without an API call
+        """
         self.api_key = Config.GOOGLE_MAPS_API_KEY
-        self.base_url = 'https://maps.googleapis.com/maps/api/directions/json'
+        self.base_url = Config.GOOGLE_MAPS_BASE_URL
+        self.cache = cache
+        self.schedule = schedule
+        self.stop_resolver = stop_resolver
+        self.route_catalog = route_catalog if route_catalog is not None else RouteCatalog(DEFAULT_ROUTES)
+        self.single_flight = SingleFlight()
+        # Set by the app when ETA_PREFETCH is enabled (see utils.eta_prefetcher)
+        self.prefetcher = None
+        # Set by the app when HEADWAY_ESTIMATOR is enabled (see utils.headway_estimator)
+        self.headways = None
         
         if not self.api_key:
             raise ValueError("Google Maps API key is not configured")
     
     def get_bus_eta(self, origin, route_number):
         """
-        Get bus ETA using Google Maps Directions API
+        Get bus ETA from the timetable, the cache, or the Directions API
+        
+        Queries covered by the GTFS schedule are answered locally; the API is
+        only a fallback for (stop, route) pairs the feed does not know.
+        Concurrent lookups for the same (origin, route) pair share a single
+        Directions API call. When the cache has a stale entry, it is returned
+        immediately and refreshed in the background. When the API is down
+        (timeout, connection error, 5xx) or its circuit is open, a degraded
+        answer is built from the last cached ETA or the route's headway (see
+        degraded_bus_eta); a query the API answered as not found is not.
         
         Args:
             origin (str): The starting location
@@ -25,122 +292,110 @@ class GoogleMapsClient:
         Returns:
             dict: Standardized ETA data with success status and error handling
         """
-        try:
-            # For a real implementation, you would map route numbers to actual destinations
-            # For this example, we'll use a fixed destination based on route number
-            destination_mapping = {
-                '23': 'Downtown',
-                '45': 'Airport',
-                '12': 'Railway Station',
-                '7': 'Shopping Mall',
-                '5': 'University'
-            }
+        with ETA_SECONDS.time():
+            result = self._lookup_bus_eta(origin, route_number)
+        count_eta_lookup(result)
+        return result
+    
+    def _lookup_bus_eta(self, origin, route_number):
+        """Answer an ETA query from the first source that has it (see get_bus_eta)"""
+        origin, answer = lookup_local_eta(self, origin, route_number)
+        if answer is not None:
+            return answer
+        
+        key = make_eta_cache_key(origin, route_number)
+        result = self.single_flight.do(key, self._load_bus_eta, origin, route_number)
+        return finish_eta_lookup(self, origin, route_number, result)
+    
+    def _load_bus_eta(self, origin, route_number):
+        """Fetch an ETA unless another caller cached one while we waited"""
+        if self.cache is not None:
+            cached, fresh = self.cache.lookup(
+                origin, route_number, allow_stale=False, record_stats=False
+            )
+            if cached is not None:
+                return cached
+        return self.refresh_bus_eta(origin, route_number)
+    
+    def refresh_bus_eta(self, origin, route_number):
+        """
+        Fetch a new ETA from the API and store it in the cache
+        
+        Args:
+            origin (str): The starting location
+            route_number (str): The bus route number
             
-            # Default destination if route number not found
-            destination = destination_mapping.get(route_number, 'City Center')
+        Returns:
+            dict: Standardized ETA data with success status and error handling
+        """
+        result = self.fetch_bus_eta(origin, route_number)
+        store_fetched_eta(self, origin, route_number, result)
+        return result
+    
+    def fetch_bus_eta(self, origin, route_number):
+        """
+        Get bus ETA using Google Maps Directions API
+        
+        Args:
+            origin (str): The starting location
+            route_number (str): The bus route number
             
-            # Prepare API parameters
-            params = {
-                'origin': origin,
-                'destination': destination,
-                'mode': 'transit',
-                'transit_mode': 'bus',
-                'departure_time': 'now',
-                'key': self.api_key
-            }
+        Returns:
+            dict: Standardized ETA data with success status and error handling
+        """
+        route = self.route_catalog.get(route_number)
+        if route is None:
+            return route_not_found(route_number)
+        
+        # Imported here so the asyncio service mode never loads requests
+        import requests
+        
+        try:
+            destination = route.destination
+            params = build_directions_params(origin, destination, self.api_key)
             
-            # Make API request
-            response = requests.get(self.base_url, params=params, timeout=10)
+            # Make API request over the pooled keep-alive transport
+            response = get_transport('maps').get(self.base_url, params=params)
             
             # Check if request was successful
             if response.status_code != 200:
-                logging.error(f"Google Maps API request failed with status {response.status_code}")
+                logging.error("Google Maps API request failed with status %s", response.status_code)
                 return {
                     'success': False,
                     'error': f'Google Maps API error: {response.status_code}',
-                    'data': None
+                    'data': None,
+                    'transient': response.status_code >= 500
                 }
             
             # Parse response
-            data = response.json()
-            
-            # Check API response status
-            if data.get('status') != 'OK':
-                logging.error(f"Google Maps API returned status: {data.get('status')}")
-                return {
-                    'success': False,
-                    'error': f'Google Maps API status: {data.get("status")}',
-                    'data': None
-                }
-            
-            # Extract ETA information
-            routes = data.get('routes', [])
-            if not routes:
-                return {
-                    'success': False,
-                    'error': 'No routes found',
-                    'data': None
-                }
-            
-            # Get the first route
-            route = routes[0]
-            legs = route.get('legs', [])
-            
-            if not legs:
-                return {
-                    'success': False,
-                    'error': 'No route legs found',
-                    'data': None
-                }
-            
-            # Get the first leg
-            leg = legs[0]
-            duration = leg.get('duration', {})
-            duration_in_traffic = leg.get('duration_in_traffic', {})
-            
-            # Extract time information
-            eta_minutes = duration.get('value', 0) // 60  # Convert seconds to minutes
-            eta_text = duration.get('text', 'Unknown')
-            
-            # Get departure time if available
-            departure_time = leg.get('departure_time', {}).get('text', 'Now')
-            
-            # For a real implementation, you would parse the transit details to get
-            # information about specific bus stops and next departures
-            # This is simplified for the example
+            return parse_directions_response(response.json(), origin, destination, route_number)
             
+        except CircuitOpenError:
+            logging.warning("Google Maps circuit is open, skipping API call")
             return {
-                'success': True,
-                'error': '',
-                'data': {
-                    'eta_minutes': eta_minutes,
-                    'eta_text': eta_text,
-                    'departure_time': departure_time,
-                    'origin': origin,
-                    'destination': destination,
-                    'route_number': route_number,
-                    'next_departure': departure_time,
-                    'bus_stop_name': origin,  # In a real implementation, this would be the actual bus stop
-                    'next_time': 'Unknown'  # In a real implementation, this would be the next bus time
-                }
+                'success': False,
+                'error': 'Google Maps API unavailable (circuit open)',
+                'data': None,
+                'transient': True
             }
-            
         except requests.exceptions.Timeout:
             logging.error("Google Maps API request timed out")
             return {
                 'success': False,
                 'error': 'Request to Google Maps API timed out',
-                'data': None
+                'data': None,
+                'transient': True
             }
         except requests.exceptions.RequestException as e:
-            logging.error(f"Google Maps API request error: {str(e)}")
+            logging.error("Google Maps API request error: %s", e)
             return {
                 'success': False,
                 'error': f'Google Maps API request error: {str(e)}',
-                'data': None
+                'data': None,
+                'transient': isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.RetryError))
             }
         except Exception as e:
-            logging.error(f"Unexpected error in Google Maps client: {str(e)}")
+            logging.error("Unexpected error in Google Maps client: %s", e)
             return {
                 'success': False,
                 'error': f'Unexpected error: {str(e)}',
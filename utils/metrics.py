@@ -0,0 +1,538 @@
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from config import Config
+
+# Latency buckets in seconds, from an in-memory parse to a slow upstream call
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MemoryValueStore:
+    """Sample values of the current process, kept in a dict"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, key, amount):
+        """Add amount to a sample"""
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def inc_many(self, updates):
+        """Add several (key, amount) updates under one lock acquisition"""
+        with self._lock:
+            values = self._values
+            for key, amount in updates:
+                values[key] = values.get(key, 0.0) + amount
+
+    def observe(self, bucket_key, sum_key, count_key, value):
+        """Record a histogram observation under one lock acquisition"""
+        with self._lock:
+            values = self._values
+            values[bucket_key] = values.get(bucket_key, 0.0) + 1
+            values[sum_key] = values.get(sum_key, 0.0) + value
+            values[count_key] = values.get(count_key, 0.0) + 1
+
+    def set(self, key, value):
+        """Overwrite a sample"""
+        with self._lock:
+            self._values[key] = value
+
+    def items(self):
+        """Return (key, value) pairs of all samples"""
+        with self._lock:
+            return list(self._values.items())
+
+
+class MmapValueStore(MemoryValueStore):
+    """
+    Sample values of the current process, kept in a memory-mapped file
+
+    Every gunicorn worker writes its own file, so updates need no
+    cross-process locking; /metrics in any worker reads and sums all files.
+    The file is a used-bytes header followed by entries of a 4-byte key
+    length, the key padded to 8 bytes and an 8-byte double. Entries are
+    only ever appended, and the header is written after the entry, so a
+    reader never sees a half-written entry.
+    """
+
+    INITIAL_SIZE = 1 << 16
+
+    def __init__(self, path):
+        """
+        Open (or create) the file
+
+        Args:
+            path (str): File owned by this process
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(self.INITIAL_SIZE)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._used = struct.unpack_from('i', self._map, 0)[0] or 8
+        struct.pack_into('i', self._map, 0, self._used)
+        self._offsets = {key: offset for key, value, offset in _read_entries(self._map, self._used)}
+
+    def _offset(self, key):
+        """Return the value offset of a key, appending an entry for new keys (caller holds the lock)"""
+        offset = self._offsets.get(key)
+        if offset is not None:
+            return offset
+
+        encoded = key.encode()
+        padded = encoded + b' ' * (8 - (len(encoded) + 4) % 8)
+        entry = struct.pack(f'i{len(padded)}sd', len(encoded), padded, 0.0)
+        while self._used + len(entry) > len(self._map):
+            size = len(self._map) * 2
+            self._file.truncate(size)
+            self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), size)
+        self._map[self._used:self._used + len(entry)] = entry
+        offset = self._used + 4 + len(padded)
+        self._used += len(entry)
+        struct.pack_into('i', self._map, 0, self._used)
+        self._offsets[key] = offset
+        return offset
+
+    def inc(self, key, amount):
+        """Add amount to a sample"""
+        with self._lock:
+            offset = self._offset(key)
+            struct.pack_into('d', self._map, offset, struct.unpack_from('d', self._map, offset)[0] + amount)
+
+    def inc_many(self, updates):
+        """Add several (key, amount) updates under one lock acquisition"""
+        with self._lock:
+            for key, amount in updates:
+                offset = self._offset(key)
+                struct.pack_into('d', self._map, offset, struct.unpack_from('d', self._map, offset)[0] + amount)
+
+    def observe(self, bucket_key, sum_key, count_key, value):
+        """Record a histogram observation under one lock acquisition"""
+        self.inc_many(((bucket_key, 1), (sum_key, value), (count_key, 1)))
+
+    def set(self, key, value):
+        """Overwrite a sample"""
+        with self._lock:
+            struct.pack_into('d', self._map, self._offset(key), value)
+
+    def items(self):
+        """Return (key, value) pairs of all samples"""
+        with self._lock:
+            return [(key, value) for key, value, offset in _read_entries(self._map, self._used)]
+
+
+def _read_entries(data, used):
+    """Yield (key, value, value offset) for every entry of a metrics file"""
+    position = 8
+    while position < used:
+        length = struct.unpack_from('i', data, position)[0]
+        key = bytes(data[position + 4:position + 4 + length]).decode()
+        offset = position + 4 + length + (8 - (length + 4) % 8)
+        yield key, struct.unpack_from('d', data, offset)[0], offset
+        position = offset + 8
+
+
+def _read_file(path):
+    """Return (key, value) pairs from another process's metrics file"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return []
+    if len(data) < 8:
+        return []
+    used = min(struct.unpack_from('i', data, 0)[0], len(data))
+    return [(key, value) for key, value, offset in _read_entries(data, used)]
+
+
+# Value stores of this process, by kind ('counter' or 'gauge'); dropped in
+# forked children so each gunicorn worker writes its own files
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _store(kind):
+    """Return the value store of this process for a kind of metric"""
+    store = _stores.get(kind)
+    if store is None:
+        store = _open_stores()[kind]
+    return store
+
+
+def _open_stores():
+    """Create this process's value stores"""
+    global _stores
+    with _stores_lock:
+        if _stores:
+            return _stores
+        directory = Config.METRICS_MULTIPROC_DIR
+        if directory:
+            pid = os.getpid()
+            os.makedirs(directory, exist_ok=True)
+            _stores = {kind: MmapValueStore(os.path.join(directory, f"{kind}_{pid}.db"))
+                       for kind in ('counter', 'gauge')}
+        else:
+            _stores = {kind: MemoryValueStore() for kind in ('counter', 'gauge')}
+        return _stores
+
+
+def _forget_stores():
+    """Drop the parent's stores in a forked child"""
+    global _stores
+    _stores = {}
+
+
+os.register_at_fork(after_in_child=_forget_stores)
+
+
+def mark_process_dead(pid):
+    """
+    Drop the gauges of a worker that exited (gunicorn child_exit hook)
+
+    Its counters and histograms stay: they are cumulative and still count.
+    """
+    directory = Config.METRICS_MULTIPROC_DIR
+    if directory:
+        try:
+            os.remove(os.path.join(directory, f"gauge_{pid}.db"))
+        except OSError:
+            pass
+
+
+def clear_multiproc_dir():
+    """Remove metrics files left by a previous run (gunicorn on_starting hook)"""
+    directory = Config.METRICS_MULTIPROC_DIR
+    if directory:
+        for path in glob.glob(os.path.join(directory, '*.db')):
+            os.remove(path)
+
+
+def _sample_key(metric_name, sample_name, labels):
+    """Encode a sample as a store key"""
+    return json.dumps([metric_name, sample_name, labels], separators=(',', ':'))
+
+
+class _Timer:
+    """Context manager and decorator observing elapsed seconds into a histogram"""
+
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+    def __call__(self, func):
+        observe = self._histogram.observe
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(time.perf_counter() - start)
+        return wrapper
+
+
+class _CounterChild:
+    __slots__ = ('_key',)
+
+    def __init__(self, metric, labels):
+        self._key = _sample_key(metric.name, metric.name, labels)
+
+    def inc(self, amount=1):
+        """Increase the counter"""
+        _store('counter').inc(self._key, amount)
+
+
+class _GaugeChild:
+    __slots__ = ('_key',)
+
+    def __init__(self, metric, labels):
+        self._key = _sample_key(metric.name, metric.name, labels)
+
+    def inc(self, amount=1):
+        """Increase the gauge"""
+        _store('gauge').inc(self._key, amount)
+
+    def dec(self, amount=1):
+        """Decrease the gauge"""
+        _store('gauge').inc(self._key, -amount)
+
+    def set(self, value):
+        """Set the gauge"""
+        _store('gauge').set(self._key, value)
+
+
+class _HistogramChild:
+    __slots__ = ('_bounds', '_bucket_keys', '_sum_key', '_count_key')
+
+    def __init__(self, metric, labels):
+        self._bounds = metric.buckets
+        self._bucket_keys = [
+            _sample_key(metric.name, f"{metric.name}_bucket", labels + [['le', _format_bound(bound)]])
+            for bound in metric.buckets + (float('inf'),)
+        ]
+        self._sum_key = _sample_key(metric.name, f"{metric.name}_sum", labels)
+        self._count_key = _sample_key(metric.name, f"{metric.name}_count", labels)
+
+    def observe(self, value):
+        """Record one observation"""
+        _store('counter').observe(
+            self._bucket_keys[bisect_left(self._bounds, value)], self._sum_key, self._count_key, value
+        )
+
+    def time(self):
+        """Time a block (with ...) or a function (@...) in seconds"""
+        return _Timer(self)
+
+
+def _format_bound(bound):
+    """Format a bucket bound the way Prometheus expects"""
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class _Metric:
+    """A named metric family with optional labels"""
+
+    type = ''
+    child_class = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **kwargs):
+        """
+        Get the child for one combination of label values
+
+        Returns:
+            The child metric, created on first use
+        """
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    labels = [[name, value] for name, value in zip(self.labelnames, values)]
+                    child = self._children[values] = self.child_class(self, labels)
+        return child
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    type = 'counter'
+    child_class = _CounterChild
+
+    def inc(self, amount=1):
+        """Increase the unlabeled counter"""
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    """Value that goes up and down; summed over live workers in multiprocess mode"""
+
+    type = 'gauge'
+    child_class = _GaugeChild
+
+    def inc(self, amount=1):
+        """Increase the unlabeled gauge"""
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        """Decrease the unlabeled gauge"""
+        self.labels().dec(amount)
+
+    def set(self, value):
+        """Set the unlabeled gauge"""
+        self.labels().set(value)
+
+
+class Histogram(_Metric):
+    """Distribution of observations over fixed buckets"""
+
+    type = 'histogram'
+    child_class = _HistogramChild
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value):
+        """Record one observation on the unlabeled histogram"""
+        self.labels().observe(value)
+
+    def time(self):
+        """Time a block or function on the unlabeled histogram"""
+        return self.labels().time()
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _register(metric_class, name, *args, **kwargs):
+    """Return the registered metric of that name, creating it on first use"""
+    metric = _registry.get(name)
+    if metric is None:
+        with _registry_lock:
+            metric = _registry.get(name)
+            if metric is None:
+                metric = _registry[name] = metric_class(name, *args, **kwargs)
+    if not isinstance(metric, metric_class):
+        raise ValueError(f"Metric {name} is already registered as a {metric.type}")
+    return metric
+
+
+def counter(name, documentation, labelnames=()):
+    """Get or create a Counter"""
+    return _register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    """Get or create a Gauge"""
+    return _register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Get or create a Histogram"""
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def collect():
+    """
+    Sum the samples of every process
+
+    Returns:
+        dict: Sample key to value, over all worker files in multiprocess mode
+            (gauges of exited workers excluded), else this process's stores
+    """
+    directory = Config.METRICS_MULTIPROC_DIR
+    if directory:
+        pairs = []
+        for path in glob.glob(os.path.join(directory, '*.db')):
+            pairs.extend(_read_file(path))
+    else:
+        pairs = _store('counter').items() + _store('gauge').items()
+
+    totals = {}
+    for key, value in pairs:
+        totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+def _escape(value):
+    """Escape a label value for the text exposition format"""
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_sample(sample_name, labels, value):
+    """Format one sample line"""
+    if labels:
+        label_text = ','.join(f'{name}="{_escape(label)}"' for name, label in labels)
+        return f"{sample_name}{{{label_text}}} {value!r}"
+    return f"{sample_name} {value!r}"
+
+
+def generate_latest():
+    """
+    Render all registered metrics in the Prometheus text exposition format
+
+    Returns:
+        str: The /metrics response body
+    """
+    samples = {}
+    for key, value in collect().items():
+        metric_name, sample_name, labels = json.loads(key)
+        samples.setdefault(metric_name, []).append((sample_name, labels, value))
+
+    lines = []
+    for name in sorted(_registry):
+        metric = _registry[name]
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.type}")
+        entries = samples.get(name, [])
+        if metric.type != 'histogram':
+            for sample_name, labels, value in sorted(entries, key=lambda entry: entry[1]):
+                lines.append(_format_sample(sample_name, labels, value))
+            continue
+
+        # Buckets are stored per bucket; the exposition format is cumulative
+        series = {}
+        for sample_name, labels, value in entries:
+            if sample_name.endswith('_bucket'):
+                bound = labels[-1][1]
+                series.setdefault(json.dumps(labels[:-1]), {}).setdefault('buckets', {})[bound] = value
+            else:
+                series.setdefault(json.dumps(labels), {})[sample_name] = value
+        for series_key in sorted(series):
+            labels = json.loads(series_key)
+            values = series[series_key]
+            buckets = values.get('buckets', {})
+            cumulative = 0.0
+            for bound in metric.buckets + (float('inf'),):
+                formatted = _format_bound(bound)
+                cumulative += buckets.get(formatted, 0.0)
+                lines.append(_format_sample(f"{name}_bucket", labels + [['le', formatted]], cumulative))
+            lines.append(_format_sample(f"{name}_sum", labels, values.get(f"{name}_sum", 0.0)))
+            lines.append(_format_sample(f"{name}_count", labels, values.get(f"{name}_count", 0.0)))
+    return '\n'.join(lines) + '\n'
+
+
+# Webhook pipeline metrics
+WEBHOOK_REQUESTS = counter('sms_webhook_requests_total', 'Webhook requests by HTTP status', ['status'])
+WEBHOOK_SECONDS = histogram('sms_webhook_request_seconds', 'Webhook request latency in seconds')
+WEBHOOK_BATCH_MESSAGES = counter(
+    'sms_webhook_batch_messages_total', 'Messages received through /webhook/batch by result status', ['status']
+)
+WEBHOOK_IN_PROGRESS = gauge('sms_webhook_in_progress', 'Webhook requests being processed')
+STAGE_SECONDS = histogram(
+    'sms_pipeline_stage_seconds',
+    'Latency of each pipeline stage (parse, eta, format, send) in seconds',
+    ['stage']
+)
+PARSE_SECONDS = STAGE_SECONDS.labels('parse')
+ETA_SECONDS = STAGE_SECONDS.labels('eta')
+FORMAT_SECONDS = STAGE_SECONDS.labels('format')
+SEND_SECONDS = STAGE_SECONDS.labels('send')
+ETA_LOOKUPS = counter('sms_eta_lookups_total', 'ETA lookups by answer source and success', ['source', 'success'])
+ETA_PREFETCHES = counter('sms_eta_prefetches_total', 'Background refreshes of popular ETAs by outcome', ['outcome'])
+SMS_SENDS = counter('sms_sends_total', 'Recipients of Fast2SMS sends by outcome', ['outcome'])
+
+
+def count_eta_lookup(result):
+    """Count an ETA result by where the answer came from"""
+    ETA_LOOKUPS.labels(result.get('source', 'maps'), 'true' if result['success'] else 'false').inc()
+
+
+def count_sms_send(result, recipients):
+    """Count the recipients of a send by outcome"""
+    SMS_SENDS.labels('sent' if result['success'] else 'failed').inc(recipients)
@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import namedtuple
+from config import Config
+from utils.kv_store import create_kv_store
+
+# Reply sent (at most once per window) to senders who exceed the limit
+SLOW_DOWN_MESSAGE = "Too many requests. Please wait a minute and try again."
+
+RateLimitDecision = namedtuple('RateLimitDecision', ['allowed', 'notify', 'retry_after'])
+
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter keyed by sender
+
+    Each sender may send max_messages in a burst, and earns them back evenly
+    over window seconds. Bucket state lives in a KV store entry that expires
+    once the bucket would be full again, so idle senders cost no memory and
+    the store's size bound caps memory under a flood of distinct senders.
+    """
+
+    def __init__(self, store, max_messages=5, window=60):
+        """
+        Initialize the limiter
+
+        Args:
+            store (MemoryKVStore or SQLiteKVStore): Backing store (a SQLite
+                store is shared by all gunicorn workers)
+            max_messages (int): Burst size per sender
+            window (float): Seconds to earn back a full burst; also the
+                minimum gap between "slow down" replies to one sender
+        """
+        self.store = store
+        self.max_messages = max_messages
+        self.window = window
+        self.refill_rate = max_messages / window
+        self.allowed = 0
+        self.throttled = 0
+        # Counters are shared by the threads (or greenlets) of a worker
+        self._lock = threading.Lock()
+
+    def check(self, sender):
+        """
+        Spend one token for a message from sender
+
+        Args:
+            sender (str): The sender's phone number
+
+        Returns:
+            RateLimitDecision: allowed is False when the sender is over the
+                limit; notify is True for the first throttled message of a
+                window (the only one that should get a reply); retry_after
+                is the number of seconds until the next message is allowed
+        """
+        now = time.time()
+        decision = []
+
+        def spend(state):
+            # state: [tokens, updated_at, notified_until]
+            if state is None:
+                tokens, notified_until = float(self.max_messages), 0.0
+            else:
+                tokens, updated_at, notified_until = state
+                tokens = min(self.max_messages, tokens + (now - updated_at) * self.refill_rate)
+
+            if tokens >= 1:
+                decision.append(RateLimitDecision(True, False, 0.0))
+                return [tokens - 1, now, notified_until]
+
+            notify = now >= notified_until
+            if notify:
+                notified_until = now + self.window
+            decision.append(RateLimitDecision(False, notify, (1 - tokens) / self.refill_rate))
+            return [tokens, now, notified_until]
+
+        self.store.update(f"rate:{sender}", spend, ttl=self.window)
+
+        result = decision[-1]
+        with self._lock:
+            if result.allowed:
+                self.allowed += 1
+            else:
+                self.throttled += 1
+        return result
+
+    def stats(self):
+        """
+        Get limiter counters for this process
+
+        Returns:
+            dict: Allowed and throttled message counts and tracked senders
+        """
+        return {
+            'allowed': self.allowed,
+            'throttled': self.throttled,
+            'tracked_senders': len(self.store)
+        }
+
+
+def create_rate_limiter():
+    """
+    Create the rate limiter described by the application configuration
+
+    Returns:
+        RateLimiter: The configured limiter, or None when rate limiting is disabled
+    """
+    backend = Config.RATE_LIMIT_BACKEND
+    if backend == 'none':
+        return None
+
+    store = create_kv_store(
+        backend,
+        path=Config.RATE_LIMIT_PATH,
+        max_entries=Config.RATE_LIMIT_MAX_SENDERS
+    )
+    return RateLimiter(
+        store,
+        max_messages=Config.RATE_LIMIT_MAX_MESSAGES,
+        window=Config.RATE_LIMIT_WINDOW
+    )
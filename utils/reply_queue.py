@@ -0,0 +1,450 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from config import Config
+from utils.retry_scheduler import DeadLetterStore, get_retry_scheduler
+
+
+def _dead_letter(dead_letters, job_id, enqueued_at, attempts, job):
+    """Store a job that failed on every delivery"""
+    logging.error("Giving up on reply job %s after %s attempts", job_id, attempts)
+    dead_letters.add({
+        'label': f"reply job {job_id}",
+        'job': job,
+        'attempts': attempts,
+        'reason': 'max_attempts',
+        'enqueued_at': enqueued_at,
+        'failed_at': time.time()
+    })
+
+
+class MemoryJobQueue:
+    """
+    Bounded in-process job queue (jobs are lost if the worker exits)
+
+    Like SQLiteJobQueue, a job handed out stays claimed until acknowledged
+    and is handed out again after the visibility timeout.
+    """
+
+    def __init__(self, max_size=1000, visibility_timeout=60, max_attempts=3, dead_letters=None):
+        """
+        Initialize the queue
+
+        Args:
+            max_size (int): Maximum number of pending jobs
+            visibility_timeout (float): Seconds before an unacknowledged
+                claimed job becomes available again
+            max_attempts (int): Deliveries of a job before it is dead-lettered
+            dead_letters (DeadLetterStore): Where jobs go after max_attempts
+        """
+        self.max_size = max_size
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.dead_letters = dead_letters if dead_letters is not None else DeadLetterStore()
+        self._queue = queue.Queue(maxsize=max_size)
+        self._claims = {}   # job_id -> [claimed_at, enqueued_at, attempts, job]
+        self._claims_lock = threading.Lock()
+
+    def put(self, job):
+        """
+        Enqueue a job without blocking
+
+        Args:
+            job (dict): JSON-serializable job payload
+
+        Returns:
+            str: The job ID, or None if the queue is full
+        """
+        job_id = uuid.uuid4().hex
+        try:
+            self._queue.put_nowait((job_id, time.time(), job))
+        except queue.Full:
+            return None
+        return job_id
+
+    def get(self, timeout=1.0):
+        """
+        Claim the next job, waiting up to timeout seconds
+
+        Returns:
+            tuple: (job_id, enqueued_at, job), or None if no job arrived
+        """
+        item = self._reclaim()
+        if item is not None:
+            return item
+        # Wake up in time to hand out the next claim that expires
+        with self._claims_lock:
+            if self._claims:
+                expires = min(claim[0] for claim in self._claims.values()) + self.visibility_timeout
+                timeout = max(0.0, min(timeout, expires - time.time()))
+        try:
+            job_id, enqueued_at, job = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return self._reclaim()
+        with self._claims_lock:
+            self._claims[job_id] = [time.time(), enqueued_at, 1, job]
+        return job_id, enqueued_at, job
+
+    def _reclaim(self):
+        """Claim a job whose visibility timeout expired, dead-lettering spent ones"""
+        now = time.time()
+        item = None
+        spent = []
+        with self._claims_lock:
+            for job_id, claim in list(self._claims.items()):
+                if now - claim[0] < self.visibility_timeout:
+                    continue
+                if claim[2] >= self.max_attempts:
+                    del self._claims[job_id]
+                    spent.append((job_id, claim[1], claim[2], claim[3]))
+                    continue
+                claim[0] = now
+                claim[2] += 1
+                item = (job_id, claim[1], claim[3])
+                break
+        for job in spent:
+            _dead_letter(self.dead_letters, *job)
+        return item
+
+    def ack(self, job_id):
+        """Delete a finished job"""
+        with self._claims_lock:
+            self._claims.pop(job_id, None)
+
+    def depth(self):
+        """Return the number of pending and unacknowledged jobs"""
+        with self._claims_lock:
+            claimed = len(self._claims)
+        return self._queue.qsize() + claimed
+
+    def oldest_age(self):
+        """Return the age in seconds of the oldest pending or unacknowledged job"""
+        with self._claims_lock:
+            times = [claim[1] for claim in self._claims.values()]
+        with self._queue.mutex:
+            if self._queue.queue:
+                times.append(self._queue.queue[0][1])
+        if not times:
+            return 0.0
+        return time.time() - min(times)
+
+
+class SQLiteJobQueue:
+    """
+    Bounded job queue persisted in a local SQLite file
+
+    Jobs survive worker restarts: a job is only deleted once acknowledged, and
+    a job claimed by a worker that failed it or died is handed out again after
+    the visibility timeout, up to max_attempts deliveries in all.
+    """
+
+    # Seconds between polls when the queue is empty
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, path, max_size=1000, visibility_timeout=60, max_attempts=3, dead_letters=None):
+        """
+        Initialize the queue
+
+        Args:
+            path (str): Path of the SQLite database file
+            max_size (int): Maximum number of pending jobs
+            visibility_timeout (float): Seconds before an unacknowledged
+                claimed job becomes available again
+            max_attempts (int): Deliveries of a job before it is dead-lettered
+            dead_letters (DeadLetterStore): Where jobs go after max_attempts
+        """
+        self.path = path
+        self.max_size = max_size
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.dead_letters = dead_letters if dead_letters is not None else DeadLetterStore()
+        self._local = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, payload TEXT NOT NULL, '
+            'enqueued_at REAL NOT NULL, claimed_at REAL, '
+            'attempts INTEGER NOT NULL DEFAULT 0)'
+        )
+        self._connection().execute(
+            'CREATE INDEX IF NOT EXISTS jobs_enqueued ON jobs (enqueued_at)'
+        )
+        # Queue files written before attempts were counted
+        columns = [row[1] for row in self._connection().execute('PRAGMA table_info(jobs)')]
+        if 'attempts' not in columns:
+            self._connection().execute('ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+
+    def _connection(self):
+        """Return a connection owned by the current thread and process"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def put(self, job):
+        """
+        Enqueue a job without blocking
+
+        Args:
+            job (dict): JSON-serializable job payload
+
+        Returns:
+            str: The job ID, or None if the queue is full
+        """
+        job_id = uuid.uuid4().hex
+        conn = self._connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                count = conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+                if count >= self.max_size:
+                    conn.execute('ROLLBACK')
+                    return None
+                conn.execute(
+                    'INSERT INTO jobs (id, payload, enqueued_at) VALUES (?, ?, ?)',
+                    (job_id, json.dumps(job), time.time())
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            return job_id
+        except sqlite3.Error as e:
+            logging.error("SQLite job queue write error: %s", e)
+            return None
+
+    def get(self, timeout=1.0):
+        """
+        Claim the next job, waiting up to timeout seconds
+
+        Returns:
+            tuple: (job_id, enqueued_at, job), or None if no job arrived
+        """
+        deadline = time.time() + timeout
+        while True:
+            job = self._claim()
+            if job is not None or time.time() >= deadline:
+                return job
+            time.sleep(self.POLL_INTERVAL)
+
+    def _claim(self):
+        """Claim the oldest available job in a single transaction, dead-lettering spent ones"""
+        now = time.time()
+        spent = []
+        conn = self._connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                while True:
+                    row = conn.execute(
+                        'SELECT id, payload, enqueued_at, attempts FROM jobs '
+                        'WHERE claimed_at IS NULL OR claimed_at < ? '
+                        'ORDER BY enqueued_at LIMIT 1',
+                        (now - self.visibility_timeout,)
+                    ).fetchone()
+                    if row is None or row[3] < self.max_attempts:
+                        break
+                    conn.execute('DELETE FROM jobs WHERE id = ?', (row[0],))
+                    spent.append(row)
+                if row is not None:
+                    conn.execute(
+                        'UPDATE jobs SET claimed_at = ?, attempts = attempts + 1 WHERE id = ?', (now, row[0])
+                    )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            logging.error("SQLite job queue claim error: %s", e)
+            return None
+
+        for job_id, payload, enqueued_at, attempts in spent:
+            _dead_letter(self.dead_letters, job_id, enqueued_at, attempts, json.loads(payload))
+        if row is None:
+            return None
+        return row[0], row[2], json.loads(row[1])
+
+    def ack(self, job_id):
+        """Delete a finished job"""
+        try:
+            self._connection().execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+        except sqlite3.Error as e:
+            logging.error("SQLite job queue ack error: %s", e)
+
+    def depth(self):
+        """Return the number of pending jobs"""
+        return self._connection().execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    def oldest_age(self):
+        """Return the age in seconds of the oldest pending job"""
+        row = self._connection().execute('SELECT MIN(enqueued_at) FROM jobs').fetchone()
+        if row[0] is None:
+            return 0.0
+        return time.time() - row[0]
+
+
+# Pools created in this process; gunicorn creates them in the master
+# (preload_app) and init_worker starts them in every forked worker
+_pools = weakref.WeakSet()
+
+
+def start_reply_workers():
+    """Start the threads of every reply worker pool in this process"""
+    for pool in list(_pools):
+        pool.ensure_started()
+
+
+class ReplyWorkerPool:
+    """
+    Pool of background threads that process queued reply jobs
+
+    Threads are started per process, so a pool created before gunicorn
+    forks is started separately in every worker: from the post_fork hook
+    (see start_reply_workers), or on the first submit otherwise.
+    """
+
+    def __init__(self, job_queue, handler, workers=4):
+        """
+        Initialize the worker pool
+
+        Args:
+            job_queue: MemoryJobQueue or SQLiteJobQueue
+            handler (callable): Called with each job payload
+            workers (int): Number of worker threads
+        """
+        self.queue = job_queue
+        self.handler = handler
+        self.workers = workers
+        self.processed = 0
+        self.failed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._threads = []
+        self._pid = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        _pools.add(self)
+
+    def ensure_started(self):
+        """Start the worker threads if they are not running in this process"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._threads = [
+                threading.Thread(target=self._run, name=f"reply-worker-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def stop(self, timeout=5):
+        """Stop the worker threads after their current job"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._pid = None
+
+    def submit(self, job):
+        """
+        Enqueue a job for background processing
+
+        Args:
+            job (dict): JSON-serializable job payload
+
+        Returns:
+            str: The job ID, or None if the queue is full
+        """
+        self.ensure_started()
+        return self.queue.put(job)
+
+    def _run(self):
+        """Worker loop: take jobs from the queue and run the handler"""
+        while not self._stop.is_set():
+            item = self.queue.get(timeout=0.5)
+            if item is None:
+                continue
+
+            job_id, enqueued_at, job = item
+            lag = time.time() - enqueued_at
+            with self._lock:
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+            try:
+                self.handler(job)
+            except Exception as e:
+                # Not acknowledged: the queue hands the job out again after
+                # its visibility timeout, or dead-letters it
+                logging.error("Reply job %s failed: %s", job_id, e)
+                with self._lock:
+                    self.failed += 1
+                continue
+            self.queue.ack(job_id)
+            with self._lock:
+                self.processed += 1
+
+    def stats(self):
+        """
+        Get queue and worker metrics
+
+        Returns:
+            dict: Queue depth, capacity, lag and job counters
+        """
+        # A SQLite count can wait on other workers' writes; the pool lock
+        # only guards the counters, so workers never wait on /health
+        depth = self.queue.depth()
+        oldest_age = self.queue.oldest_age()
+        with self._lock:
+            return {
+                'depth': depth,
+                'capacity': self.queue.max_size,
+                'oldest_age_seconds': round(oldest_age, 3),
+                'last_lag_seconds': round(self.last_lag, 3),
+                'max_lag_seconds': round(self.max_lag, 3),
+                'processed': self.processed,
+                'failed': self.failed,
+                'workers': self.workers
+            }
+
+
+def create_job_queue():
+    """
+    Create the reply job queue described by the application configuration
+
+    Returns:
+        MemoryJobQueue or SQLiteJobQueue
+    """
+    backend = Config.REPLY_QUEUE_BACKEND
+    # Replies that were never sent join the SMS sends that gave up
+    dead_letters = get_retry_scheduler().dead_letters
+    if backend == 'memory':
+        return MemoryJobQueue(
+            max_size=Config.REPLY_QUEUE_MAX_SIZE,
+            visibility_timeout=Config.REPLY_QUEUE_VISIBILITY_TIMEOUT,
+            max_attempts=Config.REPLY_QUEUE_MAX_ATTEMPTS,
+            dead_letters=dead_letters
+        )
+    if backend == 'sqlite':
+        return SQLiteJobQueue(
+            Config.REPLY_QUEUE_PATH,
+            max_size=Config.REPLY_QUEUE_MAX_SIZE,
+            visibility_timeout=Config.REPLY_QUEUE_VISIBILITY_TIMEOUT,
+            max_attempts=Config.REPLY_QUEUE_MAX_ATTEMPTS,
+            dead_letters=dead_letters
+        )
+    raise ValueError(f"Unknown reply queue backend: {backend}")
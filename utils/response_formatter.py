@@ -1,6 +1,17 @@
 import logging
 from datetime import datetime
+from utils.metrics import FORMAT_SECONDS
+from utils.sms_template import ReplyTemplate, sms_segments
 
+# Compiled once; render() sizes each reply to a single GSM-7 or UCS-2 segment
+ETA_TEMPLATE = ReplyTemplate(
+    "Route {route} from {location}: Next bus in {eta_text} at {departure_time}[. Next: {next_time}]"
+)
+HEADWAY_TEMPLATE = ReplyTemplate(
+    "Route {route} from {location}: Live ETA unavailable. Buses run about every {headway_minutes} mins."
+)
+
+@FORMAT_SECONDS.time()
 def format_eta_response(eta_data, route, location):
     """
     Format ETA data into an SMS-ready response message
@@ -11,7 +22,8 @@ def format_eta_response(eta_data, route, location):
         location (str): The location/origin
         
     Returns:
-        str: Formatted SMS message (max 160 characters)
+        str: Formatted SMS message, at most one segment (160 GSM-7 or 70
+            UCS-2 characters)
     """
     try:
         # Check if we have successful ETA data
@@ -31,19 +43,20 @@ def format_eta_response(eta_data, route, location):
         departure_time = data.get('departure_time', 'Unknown')
         next_time = data.get('next_time', 'Unknown')
         
-        # Format the response message
-        # Format: "Route {route} from {location}: Next bus in {minutes} mins at {time}. Next: {next_time}"
-        message = f"Route {route} from {location}: Next bus in {eta_text} at {departure_time}. Next: {next_time}"
-        
-        # Ensure message is within 160 characters
-        if len(message) > 160:
-            # Truncate if necessary
-            message = message[:157] + "..."
-        
-        return message
+        # Format the response message; a reply that would not fit in one
+        # segment gets a shorter location and drops the following bus
+        if eta_data.get('source') == 'headway_estimate':
+            # Degraded answer while the live ETA source is unavailable
+            return HEADWAY_TEMPLATE.render(
+                route=route, location=location, headway_minutes=data.get('headway_minutes')
+            )
+        return ETA_TEMPLATE.render(
+            route=route, location=location, eta_text=eta_text,
+            departure_time=departure_time, next_time=next_time
+        )
         
     except Exception as e:
-        logging.error(f"Error formatting ETA response: {str(e)}")
+        logging.error("Error formatting ETA response: %s", e)
         return "Error processing your request. Please try again."
 
 # Test the function
@@ -67,4 +80,4 @@ if __name__ == '__main__':
     
     result = format_eta_response(test_eta_data, '23', 'MG Road')
     print(f"Formatted response: {result}")
-    print(f"Length: {len(result)} characters")
\ No newline at end of file
+    print(f"Encoding, length, segments: {sms_segments(result)}")
\ No newline at end of file
@@ -0,0 +1,329 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from utils.logging_setup import get_correlation_id, set_correlation_id
+
+
+class DeadLetterStore:
+    """
+    Record of tasks that failed permanently
+
+    The most recent records are kept in memory for /health and debugging;
+    when a path is configured every record is also appended to it as one
+    JSON line, so dead letters survive restarts and can be replayed.
+    """
+
+    def __init__(self, path='', max_entries=1000):
+        """
+        Initialize the store
+
+        Args:
+            path (str): JSON lines file to append records to (empty keeps
+                them in memory only)
+            max_entries (int): Records kept in memory
+        """
+        self.path = path
+        self.total = 0
+        self._recent = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def add(self, record):
+        """
+        Store a dead letter
+
+        Args:
+            record (dict): JSON-serializable description of the failed task
+        """
+        with self._lock:
+            self.total += 1
+            self._recent.append(record)
+            if not self.path:
+                return
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record) + '\n')
+            except OSError as e:
+                logging.error("Failed to write dead letter to %s: %s", self.path, e)
+
+    def recent(self, limit=20):
+        """Return up to limit of the newest records, oldest first"""
+        with self._lock:
+            return list(self._recent)[-limit:]
+
+    def __len__(self):
+        return self.total
+
+
+class _RetryTask:
+    """One task waiting for its next attempt"""
+
+    __slots__ = ('func', 'args', 'label', 'attempts', 'max_attempts', 'deadline', 'last_error',
+                 'retryable', 'correlation_id')
+
+    def __init__(self, func, args, label, attempts, max_attempts, deadline, last_error, retryable):
+        self.func = func
+        self.args = args
+        self.label = label
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.last_error = last_error
+        self.retryable = retryable
+        # Retries log under the ID of the request that made the first attempt
+        self.correlation_id = get_correlation_id()
+
+
+class RetryScheduler:
+    """
+    Delay queue that re-attempts failed calls in the background
+
+    Tasks wait in a heap ordered by due time; one timer thread sleeps until
+    the earliest is due and hands it to a small pool of send threads, so the
+    caller never waits for a backoff. Delays grow exponentially with equal
+    jitter (half fixed, half random) so retries from many workers do not
+    arrive at the upstream in lockstep. A task that runs out of attempts,
+    would miss its deadline, fails permanently, or does not fit in the queue
+    goes to the dead-letter store.
+    """
+
+    def __init__(self, dead_letters=None, base_delay=1.0, max_delay=30.0, deadline=120.0,
+                 max_pending=10000, workers=2):
+        """
+        Initialize the scheduler
+
+        Args:
+            dead_letters (DeadLetterStore): Where permanently failed tasks go
+            base_delay (float): Delay before the first retry, in seconds
+            max_delay (float): Upper bound of a single backoff delay
+            deadline (float): Default seconds after scheduling by which a task
+                must have succeeded
+            max_pending (int): Maximum tasks waiting for a retry
+            workers (int): Threads performing retry attempts
+        """
+        self.dead_letters = dead_letters if dead_letters is not None else DeadLetterStore()
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.max_pending = max_pending
+        self.workers = workers
+        self.counters = {
+            'scheduled': 0,
+            'attempts': 0,
+            'succeeded': 0,
+            'exhausted': 0,
+            'expired': 0,
+            'rejected': 0,
+            'permanent': 0,
+            'errors': 0
+        }
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = None
+        self._pid = None
+        self._stopped = False
+
+    def _ensure_started(self):
+        """Start the timer thread if it is not running in this process"""
+        if self._pid == os.getpid():
+            return
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            # Tasks inherited from a parent process belong to the parent
+            self._heap = []
+            self._stopped = False
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='retry-send'
+            )
+            thread = threading.Thread(target=self._run, name='retry-timer', daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """Stop the timer thread; pending tasks are dropped"""
+        with self._condition:
+            self._stopped = True
+            self._heap = []
+            self._condition.notify()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._pid = None
+
+    def backoff(self, attempts):
+        """
+        Get the jittered delay before the next attempt
+
+        Args:
+            attempts (int): Attempts made so far
+
+        Returns:
+            float: Seconds to wait
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def schedule(self, func, args, label='', attempts=1, max_attempts=3, deadline=None,
+                 last_error='', retryable=None):
+        """
+        Schedule a retry of a call that already failed
+
+        Args:
+            func (callable): Called with *args; returns a result dict whose
+                'success' key tells whether the attempt worked
+            args (tuple): Positional arguments for func
+            label (str): Description used in logs and dead letters
+            attempts (int): Attempts already made
+            max_attempts (int): Total attempts allowed, including the first
+            deadline (float): Absolute time.time() by which the call must
+                succeed (default: now plus the scheduler's deadline)
+            last_error (str): Error of the failed attempt
+            retryable (callable): Predicate on a failed result; False sends
+                the task straight to the dead-letter store
+
+        Returns:
+            bool: True if a retry was scheduled, False if the task was
+                dead-lettered instead
+        """
+        if deadline is None:
+            deadline = time.time() + self.deadline
+        task = _RetryTask(func, args, label, attempts, max_attempts, deadline, last_error, retryable)
+        return self._push(task, counter='scheduled')
+
+    def _push(self, task, counter=None):
+        """Queue a task for its next attempt, or dead-letter it"""
+        if task.attempts >= task.max_attempts:
+            self._dead_letter(task, 'exhausted')
+            return False
+        due = time.time() + self.backoff(task.attempts)
+        if due > task.deadline:
+            self._dead_letter(task, 'expired')
+            return False
+
+        self._ensure_started()
+        with self._condition:
+            if len(self._heap) >= self.max_pending:
+                rejected = True
+            else:
+                rejected = False
+                if counter:
+                    self.counters[counter] += 1
+                heapq.heappush(self._heap, (due, next(self._sequence), task))
+                self._condition.notify()
+        if rejected:
+            self._dead_letter(task, 'rejected')
+            return False
+        return True
+
+    def _run(self):
+        """Timer loop: hand tasks whose delay elapsed to the send threads"""
+        while True:
+            with self._condition:
+                while not self._stopped and not self._heap:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                wait = self._heap[0][0] - time.time()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                due, sequence, task = heapq.heappop(self._heap)
+            self._executor.submit(self._attempt, task)
+
+    def _attempt(self, task):
+        """Make one retry attempt and reschedule or settle the task"""
+        set_correlation_id(task.correlation_id)
+        task.attempts += 1
+        try:
+            result = task.func(*task.args)
+        except Exception as e:
+            logging.error("Retry of %s raised: %s", task.label, e)
+            result = {'success': False, 'error': f'Unexpected error: {str(e)}'}
+            with self._condition:
+                self.counters['errors'] += 1
+
+        with self._condition:
+            self.counters['attempts'] += 1
+            if result['success']:
+                self.counters['succeeded'] += 1
+        if result['success']:
+            logging.info("Retry of %s succeeded after %s attempts", task.label, task.attempts)
+            return
+
+        task.last_error = result.get('error', '')
+        logging.warning("Retry %s of %s failed: %s", task.attempts, task.label, task.last_error)
+        if task.retryable is not None and not task.retryable(result):
+            self._dead_letter(task, 'permanent')
+            return
+        self._push(task)
+
+    def _dead_letter(self, task, reason):
+        """Count a permanently failed task and store it"""
+        with self._condition:
+            self.counters[reason] += 1
+        logging.error("Giving up on %s (%s) after %s attempts: %s", task.label, reason, task.attempts, task.last_error)
+        self.dead_letters.add({
+            'label': task.label,
+            'args': [str(arg) for arg in task.args],
+            'attempts': task.attempts,
+            'reason': reason,
+            'error': task.last_error,
+            'correlation_id': task.correlation_id,
+            'failed_at': time.time()
+        })
+
+    def pending(self):
+        """Return the number of tasks waiting for a retry"""
+        with self._condition:
+            return len(self._heap)
+
+    def stats(self):
+        """
+        Get retry counters for this process
+
+        Returns:
+            dict: Pending tasks, a counter per outcome and dead letters
+        """
+        with self._condition:
+            stats = dict(self.counters, pending=len(self._heap))
+        stats['dead_letters'] = len(self.dead_letters)
+        return stats
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_retry_scheduler():
+    """
+    Get the shared SMS retry scheduler
+
+    Returns:
+        RetryScheduler: The scheduler configured from Config
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = RetryScheduler(
+                    dead_letters=DeadLetterStore(
+                        Config.SMS_DEAD_LETTER_PATH,
+                        max_entries=Config.SMS_DEAD_LETTER_MAX_ENTRIES
+                    ),
+                    base_delay=Config.SMS_RETRY_BASE_DELAY,
+                    max_delay=Config.SMS_RETRY_MAX_DELAY,
+                    deadline=Config.SMS_RETRY_DEADLINE,
+                    max_pending=Config.SMS_RETRY_MAX_PENDING,
+                    workers=Config.SMS_RETRY_WORKERS
+                )
+    return _scheduler
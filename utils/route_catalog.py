@@ -0,0 +1,255 @@
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+RouteInfo = namedtuple(
+    'RouteInfo', ['route_number', 'destination', 'terminals', 'direction', 'headway_minutes']
+)
+
+# Routes served when no catalog file is configured
+DEFAULT_ROUTES = (
+    RouteInfo('23', 'Downtown', (), '', None),
+    RouteInfo('45', 'Airport', (), '', None),
+    RouteInfo('12', 'Railway Station', (), '', None),
+    RouteInfo('7', 'Shopping Mall', (), '', None),
+    RouteInfo('5', 'University', (), '', None)
+)
+
+
+def normalize_route_number(route_number):
+    """
+    Normalize a route number for lookups ("023" and "23" are the same route)
+
+    Args:
+        route_number (str): Route number as sent or as listed in the catalog
+
+    Returns:
+        str: Lowercased route number without leading zeros
+    """
+    text = str(route_number).strip().lower()
+    return text.lstrip('0') or text
+
+
+def route_not_found(route_number):
+    """
+    Build the ETA result for a route that is not in the catalog
+
+    Args:
+        route_number (str): The requested route number
+
+    Returns:
+        dict: Standardized ETA data with success False
+    """
+    return {
+        'success': False,
+        'error': f'Route {route_number} not found',
+        'source': 'route_catalog',
+        'data': None
+    }
+
+
+def _route_from_record(record):
+    """
+    Build a RouteInfo from a CSV row or JSON object
+
+    Raises:
+        ValueError: If a field is missing or has the wrong type
+    """
+    if not isinstance(record, dict):
+        raise ValueError(f"Route entry must be an object: {record!r}")
+    for key in ('route_number', 'route', 'destination', 'direction', 'headway_minutes'):
+        if not isinstance(record.get(key), (str, int, float, type(None))):
+            raise ValueError(f"Route entry field {key} must be a string or number: {record}")
+    route_number = str(record.get('route_number') or record.get('route') or '').strip()
+    destination = str(record.get('destination') or '').strip()
+    if not route_number or not destination:
+        raise ValueError(f"Route entry needs route_number and destination: {record}")
+
+    terminals = record.get('terminals') or ()
+    if isinstance(terminals, str):
+        terminals = terminals.split('|')
+    elif not isinstance(terminals, (list, tuple)) or not all(isinstance(terminal, str) for terminal in terminals):
+        raise ValueError(f"Route entry terminals must be a list of names: {record}")
+    headway = record.get('headway_minutes')
+    return RouteInfo(
+        route_number,
+        destination,
+        tuple(terminal.strip() for terminal in terminals if terminal.strip()),
+        str(record.get('direction') or '').strip(),
+        float(headway) if headway not in (None, '') else None
+    )
+
+
+class RouteCatalog:
+    """
+    Immutable, indexed route metadata
+
+    Lookups are a single dict access on the normalized route number. A new
+    catalog is built for every reload, so readers never see a partial update.
+    """
+
+    def __init__(self, routes, source='builtin'):
+        """
+        Index routes
+
+        Args:
+            routes (iterable): RouteInfo entries (later duplicates win)
+            source (str): Where the routes came from, for diagnostics
+        """
+        self.source = source
+        self.loaded_at = time.time()
+        self._routes = MappingProxyType({
+            normalize_route_number(route.route_number): route for route in routes
+        })
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Load a catalog from a CSV or JSON file
+
+        CSV files have a header with route_number, destination and optionally
+        terminals ('|'-separated), direction and headway_minutes. JSON files
+        hold a list of objects with the same keys.
+
+        Args:
+            path (str): Catalog file path
+
+        Returns:
+            RouteCatalog: The catalog
+
+        Raises:
+            OSError, ValueError: If the file cannot be read or is malformed
+        """
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            if path.lower().endswith('.json'):
+                records = json.load(f)
+                if not isinstance(records, list):
+                    raise ValueError("Route catalog JSON must be a list of routes")
+            else:
+                records = list(csv.DictReader(f))
+        return cls([_route_from_record(record) for record in records], source=path)
+
+    def get(self, route_number):
+        """
+        Look up a route
+
+        Args:
+            route_number (str): The bus route number
+
+        Returns:
+            RouteInfo: The route, or None if it is not in the catalog
+        """
+        return self._routes.get(normalize_route_number(route_number))
+
+    def __contains__(self, route_number):
+        return self.get(route_number) is not None
+
+    def __len__(self):
+        return len(self._routes)
+
+    def stats(self):
+        """Return the catalog size and origin"""
+        return {'routes': len(self), 'source': self.source, 'loaded_at': self.loaded_at}
+
+
+class ReloadingRouteCatalog:
+    """
+    Route catalog that picks up changes to its file without a restart
+
+    The file's modification time is checked at most every check_interval
+    seconds, on the request path; when it changed, a new RouteCatalog is
+    built and swapped in with one reference assignment. A file that fails to
+    load is logged and the previous catalog stays in service.
+    """
+
+    def __init__(self, path, check_interval=5.0, fallback=None):
+        """
+        Load the catalog file
+
+        Args:
+            path (str): Catalog file path
+            check_interval (float): Minimum seconds between modification checks
+            fallback (RouteCatalog): Catalog served until the file loads
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self.reloads = 0
+        self._catalog = fallback if fallback is not None else RouteCatalog(())
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._reload()
+
+    def _reload(self):
+        """Load the file if it changed since the last load"""
+        self._checked_at = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            catalog = RouteCatalog.from_file(self.path)
+        except (OSError, ValueError, csv.Error) as e:
+            logging.error("Failed to load route catalog from %s: %s", self.path, e)
+            return
+
+        self._catalog = catalog
+        self._mtime = mtime
+        self.reloads += 1
+        logging.info("Loaded %s routes from %s", len(catalog), self.path)
+
+    @property
+    def catalog(self):
+        """Return the current catalog, reloading it first if the file changed"""
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            # One thread checks; the others keep using the current catalog
+            if self._lock.acquire(blocking=False):
+                try:
+                    self._reload()
+                finally:
+                    self._lock.release()
+        return self._catalog
+
+    def get(self, route_number):
+        """Look up a route in the current catalog (see RouteCatalog.get)"""
+        return self.catalog.get(route_number)
+
+    def __contains__(self, route_number):
+        return self.get(route_number) is not None
+
+    def __len__(self):
+        return len(self.catalog)
+
+    def stats(self):
+        """Return the current catalog size and origin, and the reload count"""
+        stats = self.catalog.stats()
+        stats['reloads'] = self.reloads
+        return stats
+
+
+def load_route_catalog(path, check_interval=5.0):
+    """
+    Build the route catalog from configuration
+
+    Args:
+        path (str): Catalog file path (empty serves the built-in routes)
+        check_interval (float): Seconds between file change checks (0 checks
+            on every lookup; negative disables hot reload)
+
+    Returns:
+        RouteCatalog or ReloadingRouteCatalog: The catalog
+    """
+    builtin = RouteCatalog(DEFAULT_ROUTES)
+    if not path:
+        return builtin
+    if check_interval < 0:
+        try:
+            return RouteCatalog.from_file(path)
+        except (OSError, ValueError, csv.Error) as e:
+            logging.error("Failed to load route catalog from %s: %s", path, e)
+            return builtin
+    return ReloadingRouteCatalog(path, check_interval, fallback=builtin)
@@ -0,0 +1,143 @@
+import logging
+import threading
+
+
+class _Call:
+    """An in-flight call whose result is shared by every waiting caller"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key into a single execution
+
+    The first caller for a key runs the function; callers arriving while it is
+    still running block until it finishes and receive the same result.
+    """
+
+    def __init__(self):
+        """Initialize the single-flight group"""
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Run func once for all concurrent callers with the same key
+
+        Args:
+            key (str): Key identifying identical calls
+            func (callable): The function to execute
+            *args, **kwargs: Arguments passed to func
+
+        Returns:
+            The result of func (shared with every concurrent caller)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def do_background(self, key, func, *args, **kwargs):
+        """
+        Run func in a background thread unless a call for the key is in flight
+
+        Args:
+            key (str): Key identifying identical calls
+            func (callable): The function to execute
+            *args, **kwargs: Arguments passed to func
+
+        Returns:
+            bool: True if a background call was started
+        """
+        with self._lock:
+            if key in self._calls:
+                return False
+
+        def run():
+            try:
+                self.do(key, func, *args, **kwargs)
+            except Exception as e:
+                logging.error("Background refresh failed for %s: %s", key, e)
+
+        thread = threading.Thread(target=run, name=f"single-flight-{key}", daemon=True)
+        thread.start()
+        return True
+
+    def in_flight(self):
+        """Return the number of keys currently being executed"""
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """Coalesce concurrent coroutine calls that share a key (asyncio version)"""
+
+    def __init__(self):
+        """Initialize the single-flight group"""
+        self._tasks = {}
+
+    async def do(self, key, func, *args, **kwargs):
+        """
+        Await func once for all concurrent callers with the same key
+
+        Args:
+            key (str): Key identifying identical calls
+            func (callable): Coroutine function to execute
+            *args, **kwargs: Arguments passed to func
+
+        Returns:
+            The result of func (shared with every concurrent caller)
+        """
+        # asyncio is only imported by the asyncio service mode
+        import asyncio
+
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._tasks[key] = task
+            task.add_done_callback(lambda finished: self._tasks.pop(key, None))
+        # Shield so one cancelled caller does not cancel the shared call
+        return await asyncio.shield(task)
+
+    def do_background(self, key, func, *args, **kwargs):
+        """
+        Schedule func on the running loop unless a call for the key is in flight
+
+        Returns:
+            bool: True if a background call was started
+        """
+        import asyncio
+
+        if key in self._tasks:
+            return False
+        task = asyncio.ensure_future(func(*args, **kwargs))
+        self._tasks[key] = task
+        task.add_done_callback(lambda finished: self._tasks.pop(key, None))
+        return True
+
+    def in_flight(self):
+        """Return the number of keys currently being executed"""
+        return len(self._tasks)
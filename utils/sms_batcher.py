@@ -0,0 +1,198 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class _Batch:
+    """Recipients waiting for the same message body"""
+
+    def __init__(self, now):
+        self.recipients = []
+        self.first_at = now
+        self.last_at = now
+
+
+class BatchingSMSSender:
+    """
+    Sender that merges identical outgoing messages into multi-recipient sends
+
+    Messages are held for a short window and grouped by body; each group is
+    flushed as one Fast2SMS bulk call. A group is flushed when no recipient has
+    joined for `window` seconds, when it has been open for `max_latency`
+    seconds, or as soon as it reaches `max_batch_size` recipients.
+    """
+
+    def __init__(self, sender, window=0.2, max_batch_size=50, max_latency=1.0, send_workers=4):
+        """
+        Initialize the batching sender
+
+        Args:
+            sender (Fast2SMSSender): Sender used for the bulk API calls
+            window (float): Seconds to wait for more recipients of a message
+            max_batch_size (int): Maximum recipients per API call
+            max_latency (float): Maximum seconds a message is held
+            send_workers (int): Threads used to perform API calls
+        """
+        self.sender = sender
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.send_workers = send_workers
+        self.batches_sent = 0
+        self.messages_sent = 0
+        self._batches = {}
+        self._condition = threading.Condition()
+        self._executor = None
+        self._pid = None
+
+    def _ensure_started(self):
+        """Start the flusher thread if it is not running in this process"""
+        if self._pid == os.getpid():
+            return
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.send_workers, thread_name_prefix='sms-batch'
+            )
+            thread = threading.Thread(target=self._run, name='sms-batch-flusher', daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, phone_number, message):
+        """
+        Queue a message for batched delivery
+
+        Args:
+            phone_number (str): The recipient's phone number
+            message (str): The message to send
+
+        Returns:
+            Future: Resolves to the per-recipient send result dict
+        """
+        self._ensure_started()
+        future = Future()
+        now = time.monotonic()
+        full_batch = None
+
+        with self._condition:
+            batch = self._batches.get(message)
+            if batch is None:
+                batch = self._batches[message] = _Batch(now)
+            batch.recipients.append((phone_number, future))
+            batch.last_at = now
+            if len(batch.recipients) >= self.max_batch_size:
+                full_batch = self._batches.pop(message)
+            self._condition.notify()
+
+        if full_batch is not None:
+            self._executor.submit(self._flush, message, full_batch)
+        return future
+
+    def send_sms(self, phone_number, message):
+        """
+        Send SMS through the batcher and wait for the result
+
+        Args:
+            phone_number (str): The recipient's phone number
+            message (str): The message to send
+
+        Returns:
+            dict: Success status and details for this recipient
+        """
+        return self.submit(phone_number, message).result()
+
+    def send_bulk_sms(self, phone_numbers, message):
+        """
+        Send a message already grouped by the caller, without waiting for a window
+
+        Args:
+            phone_numbers (list): The recipients' phone numbers
+            message (str): The message to send
+
+        Returns:
+            dict: Success status and details
+        """
+        return self.sender.send_bulk_sms(phone_numbers, message)
+
+    def _deadline(self, batch):
+        """Return the monotonic time at which a batch must be flushed"""
+        return min(batch.last_at + self.window, batch.first_at + self.max_latency)
+
+    def _run(self):
+        """Flusher loop: send batches whose window or latency bound expired"""
+        while True:
+            with self._condition:
+                while not self._batches:
+                    self._condition.wait()
+
+                now = time.monotonic()
+                due = [
+                    message for message, batch in self._batches.items()
+                    if self._deadline(batch) <= now
+                ]
+                if not due:
+                    next_deadline = min(self._deadline(b) for b in self._batches.values())
+                    self._condition.wait(next_deadline - now)
+                    continue
+                ready = [(message, self._batches.pop(message)) for message in due]
+
+            for message, batch in ready:
+                self._executor.submit(self._flush, message, batch)
+
+    def _flush(self, message, batch):
+        """Send one batch and resolve every recipient's future"""
+        try:
+            results = self._send_batch(message, [phone for phone, future in batch.recipients])
+        except Exception as e:
+            logging.error("Unexpected error sending SMS batch: %s", e)
+            failure = {'success': False, 'error': f'Unexpected error: {str(e)}', 'response': None}
+            results = {phone: failure for phone, future in batch.recipients}
+
+        with self._condition:
+            self.batches_sent += 1
+            self.messages_sent += len(batch.recipients)
+
+        for phone, future in batch.recipients:
+            future.set_result(results[phone])
+
+    def _send_batch(self, message, phone_numbers):
+        """
+        Send a message to all recipients with one API call where possible
+
+        If the API rejects a multi-recipient payload (e.g. one invalid number),
+        each recipient is retried individually so failures are reported for
+        the right numbers only.
+
+        Returns:
+            dict: Send result per phone number
+        """
+        unique_numbers = list(dict.fromkeys(phone_numbers))
+        result = self.sender.send_bulk_sms(unique_numbers, message)
+        result = dict(result, batch_size=len(unique_numbers))
+
+        if result['success'] or len(unique_numbers) == 1 or result['response'] is None:
+            return {phone: result for phone in unique_numbers}
+
+        logging.warning("Bulk SMS rejected for %s recipients, sending individually", len(unique_numbers))
+        return {
+            phone: dict(self.sender.send_sms(phone, message), batch_size=1)
+            for phone in unique_numbers
+        }
+
+    def stats(self):
+        """
+        Get batching counters
+
+        Returns:
+            dict: Batches and messages sent and messages currently pending
+        """
+        with self._condition:
+            pending = sum(len(batch.recipients) for batch in self._batches.values())
+            return {
+                'batches_sent': self.batches_sent,
+                'messages_sent': self.messages_sent,
+                'pending': pending
+            }
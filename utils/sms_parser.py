@@ -1,10 +1,43 @@
 import re
 import logging
+from utils.metrics import PARSE_SECONDS
 
+# Words that may precede the route number ("Central Station Route 45",
+# "MG Road bus 23"); compared case-insensitively. Add local-language
+# keywords here.
+ROUTE_KEYWORDS = frozenset(['route', 'bus'])
+
+# Prefixes that may be glued to the route number ("Bus Stop A R12", "MG Road #23")
+ROUTE_PREFIXES = ('r', '#')
+
+# The route number token, with an optional glued prefix
+_ROUTE_TOKEN = re.compile(
+    r'(?:' + '|'.join(re.escape(prefix) for prefix in ROUTE_PREFIXES) + r')?(\d+)',
+    re.IGNORECASE
+)
+
+INVALID_FORMAT_ERROR = 'Invalid format. Send: Location RouteNumber'
+
+
+def _parsed(location, route, error=''):
+    """Build a parse result"""
+    return {
+        'location': location,
+        'route': route,
+        'valid': not error,
+        'error': error
+    }
+
+
+@PARSE_SECONDS.time()
 def parse_sms_input(message_text):
     """
     Parse SMS input message to extract location and route number
     
+    The message is scanned once from the right: the last token must be the
+    route number (optionally prefixed, e.g. "R12" or "#12"), an optional
+    route keyword before it is dropped, and the rest is the location.
+    
     Args:
         message_text (str): The SMS message text
         
@@ -12,74 +45,45 @@ def parse_sms_input(message_text):
         dict: Parsed data with location, route, validity, and error message
     """
     try:
-        # Remove extra whitespace and strip
-        message_text = message_text.strip()
-        
-        if not message_text:
-            return {
-                'location': '',
-                'route': '',
-                'valid': False,
-                'error': 'Invalid format. Send: Location RouteNumber'
-            }
-        
         # Handle formats:
         # "MG Road 23" -> location: "MG Road", route: "23"
         # "Central Station Route 45" -> location: "Central Station", route: "45"
         # "Bus Stop A R12" -> location: "Bus Stop A", route: "12"
+        # "MG Road bus 23" / "MG Road #23" -> location: "MG Road", route: "23"
+        parts = message_text.rsplit(None, 1)
+        if len(parts) < 2:
+            return _parsed('', '', INVALID_FORMAT_ERROR)
         
-        # Pattern 2: "Location Route RouteNumber" (e.g., "Central Station Route 45")
-        pattern2 = re.match(r'^(.+?)\s+route\s+(\d+)$', message_text, re.IGNORECASE)
-        if pattern2:
-            location = pattern2.group(1).strip()
-            route = pattern2.group(2)
-            return {
-                'location': location,
-                'route': route,
-                'valid': True,
-                'error': ''
-            }
+        location, last = parts
+        match = _ROUTE_TOKEN.fullmatch(last)
+        if match is None:
+            return _parsed('', '', INVALID_FORMAT_ERROR)
+        route = match.group(1)
         
-        # Pattern 3: "Location RRouteNumber" (e.g., "Bus Stop A R12")
-        pattern3 = re.match(r'^(.+?)\s+[rR](\d+)$', message_text)
-        if pattern3:
-            location = pattern3.group(1).strip()
-            route = pattern3.group(2)
-            return {
-                'location': location,
-                'route': route,
-                'valid': True,
-                'error': ''
-            }
+        # "Location Route 45": drop the keyword unless it is the whole location
+        if len(last) == len(route):
+            words = location.rsplit(None, 1)
+            if len(words) == 2 and words[1].lower() in ROUTE_KEYWORDS:
+                location = words[0]
         
-        # Pattern 1: "Location RouteNumber" (e.g., "MG Road 23")
-        pattern1 = re.match(r'^(.+?)\s+(\d+)$', message_text)
-        if pattern1:
-            location = pattern1.group(1).strip()
-            route = pattern1.group(2)
-            return {
-                'location': location,
-                'route': route,
-                'valid': True,
-                'error': ''
-            }
-        
-        # If no pattern matches
-        return {
-            'location': '',
-            'route': '',
-            'valid': False,
-            'error': 'Invalid format. Send: Location RouteNumber'
-        }
+        return _parsed(location.strip(), route)
         
     except Exception as e:
-        logging.error(f"Error parsing SMS input: {str(e)}")
-        return {
-            'location': '',
-            'route': '',
-            'valid': False,
-            'error': 'Error processing your request. Please try again.'
-        }
+        logging.error("Error parsing SMS input: %s", e)
+        return _parsed('', '', 'Error processing your request. Please try again.')
+
+
+def parse_sms_batch(messages):
+    """
+    Parse many SMS messages
+    
+    Args:
+        messages (iterable): SMS message texts
+        
+    Returns:
+        list: One parse result per message, in order (see parse_sms_input)
+    """
+    return [parse_sms_input(message_text) for message_text in messages]
 
 # Test cases
 if __name__ == '__main__':
@@ -88,6 +92,8 @@ if __name__ == '__main__':
         "MG Road 23",
         "Central Station Route 45",
         "Bus Stop A R12",
+        "MG Road bus 23",
+        "MG Road #23",
         "Invalid Format",
         "",
         "   ",
@@ -97,4 +103,4 @@ if __name__ == '__main__':
     
     for test_case in test_cases:
         result = parse_sms_input(test_case)
-        print(f"Input: '{test_case}' -> {result}")
\ No newline at end of file
+        print(f"Input: '{test_case}' -> {result}")
@@ -1,7 +1,178 @@
-import requests
 import logging
-import time
 from config import Config
+from utils.http_transport import get_transport
+from utils.circuit_breaker import CircuitOpenError
+from utils.retry_scheduler import get_retry_scheduler
+from utils.metrics import SEND_SECONDS, count_sms_send
+from utils.sms_template import is_gsm7
+
+def build_sms_request(api_key, phone_numbers, message):
+    """
+    Build the headers and JSON payload for a Fast2SMS bulkV2 request
+    
+    Args:
+        api_key (str): Fast2SMS API key
+        phone_numbers (list): The recipients' phone numbers
+        message (str): The message to send
+        
+    Returns:
+        tuple: (headers dict, payload dict)
+    """
+    # Prepare headers
+    headers = {
+        'authorization': api_key,
+        'Content-Type': 'application/json'
+    }
+    
+    # Prepare payload
+    payload = {
+        'route': 'v3',
+        'sender_id': 'TXTIND',  # Default sender ID
+        'message': message,
+        # Messages outside the GSM alphabet must be sent as Unicode (UCS-2)
+        'language': 'english' if is_gsm7(message) else 'unicode',
+        'flash': 0,
+        'numbers': ','.join(phone_numbers)
+    }
+    
+    return headers, payload
+
+def parse_sms_response(response_data):
+    """
+    Convert a decoded Fast2SMS response into the standardized result dict
+    
+    Args:
+        response_data (dict): Decoded Fast2SMS response
+        
+    Returns:
+        dict: Success status and details
+    """
+    # Check if SMS was sent successfully
+    if response_data.get('return') == True:
+        return {
+            'success': True,
+            'error': '',
+            'response': response_data
+        }
+    else:
+        error_message = response_data.get('message', 'Unknown error')
+        logging.error("Fast2SMS API returned error: %s", error_message)
+        return {
+            'success': False,
+            'error': f'Fast2SMS API error: {error_message}',
+            'response': response_data
+        }
+
+def is_retryable_sms_failure(result):
+    """
+    Check whether a failed send may succeed if attempted again
+    
+    Only failures where Fast2SMS cannot have sent the message are retried:
+    the connection could not be opened, the circuit was open, or the
+    gateway answered 429 or 5xx. A read timeout or a dropped connection
+    after the POST went out may mean the SMS was sent, and Fast2SMS takes
+    no idempotency key, so a retry could deliver (and bill) it twice.
+    
+    Args:
+        result (dict): Failed send result
+        
+    Returns:
+        bool: True if the send should be retried
+    """
+    return result.get('transient', False)
+
+def is_retryable_sms_status(status_code):
+    """Check whether a non-200 Fast2SMS status means the message was not accepted"""
+    return status_code == 429 or status_code >= 500
+
+def is_connect_error(error):
+    """
+    Check whether a requests exception was raised before the request was sent
+    
+    Args:
+        error (requests.exceptions.RequestException): The exception
+        
+    Returns:
+        bool: True for connect timeouts and refused or unresolvable connections
+    """
+    import requests
+    from urllib3.exceptions import NewConnectionError
+    
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    # Connection failures surface as ConnectionError wrapping MaxRetryError;
+    # a connection dropped mid-response wraps a ProtocolError instead
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+def send_with_retry(sender, phone_number, message, max_attempts=3, deadline=None):
+    """
+    Send SMS, retrying failed sends in the background
+    
+    The first attempt is made inline. If it fails with a transient error,
+    later attempts are left to the shared retry scheduler, so the caller
+    never waits for a backoff delay.
+    
+    Args:
+        sender: Fast2SMSSender or BatchingSMSSender used for every attempt
+        phone_number (str): The recipient's phone number
+        message (str): The message to send
+        max_attempts (int): Maximum number of attempts, including the first
+        deadline (float): Absolute time.time() by which the SMS must be sent
+        
+    Returns:
+        dict: Result of the first attempt; failed results carry
+            'retry_scheduled' telling whether a retry is pending
+    """
+    result = sender.send_sms(phone_number, message)
+    if result['success']:
+        return result
+    
+    logging.warning("SMS send attempt 1 failed: %s", result['error'])
+    scheduled = max_attempts > 1 and is_retryable_sms_failure(result) and get_retry_scheduler().schedule(
+        sender.send_sms,
+        (phone_number, message),
+        label=f"SMS to {phone_number}",
+        max_attempts=max_attempts,
+        deadline=deadline,
+        last_error=result['error'],
+        retryable=is_retryable_sms_failure
+    )
+    return dict(result, retry_scheduled=scheduled)
+
+def send_bulk_with_retry(sender, phone_numbers, message, max_attempts=3, deadline=None):
+    """
+    Send the same SMS to several recipients, retrying failed sends in the background
+    
+    Like send_with_retry, but the recipients share one Fast2SMS call per
+    attempt.
+    
+    Args:
+        sender: Fast2SMSSender or BatchingSMSSender used for every attempt
+        phone_numbers (list): The recipients' phone numbers
+        message (str): The message to send
+        max_attempts (int): Maximum number of attempts, including the first
+        deadline (float): Absolute time.time() by which the SMS must be sent
+        
+    Returns:
+        dict: Result of the first attempt; failed results carry
+            'retry_scheduled' telling whether a retry is pending
+    """
+    result = sender.send_bulk_sms(phone_numbers, message)
+    if result['success']:
+        return result
+    
+    logging.warning("Bulk SMS send attempt 1 to %s recipients failed: %s", len(phone_numbers), result['error'])
+    scheduled = max_attempts > 1 and is_retryable_sms_failure(result) and get_retry_scheduler().schedule(
+        sender.send_bulk_sms,
+        (phone_numbers, message),
+        label=f"SMS to {len(phone_numbers)} recipients",
+        max_attempts=max_attempts,
+        deadline=deadline,
+        last_error=result['error'],
+        retryable=is_retryable_sms_failure
+    )
+    return dict(result, retry_scheduled=scheduled)
 
 class Fast2SMSSender:
     """Fast2SMS API client for sending SMS messages"""
@@ -25,109 +196,95 @@ class Fast2SMSSender:
         Returns:
             dict: Success status and details
         """
-        try:
-            # Prepare headers
-            headers = {
-                'authorization': self.api_key,
-                'Content-Type': 'application/json'
-            }
+        return self.send_bulk_sms([phone_number], message)
+    
+    def send_bulk_sms(self, phone_numbers, message):
+        """
+        Send the same SMS to several recipients in one Fast2SMS API call
+        
+        Args:
+            phone_numbers (list): The recipients' phone numbers
+            message (str): The message to send (max 160 characters)
             
-            # Prepare payload
-            payload = {
-                'route': 'v3',
-                'sender_id': 'TXTIND',  # Default sender ID
-                'message': message,
-                'language': 'english',
-                'flash': 0,
-                'numbers': phone_number
-            }
+        Returns:
+            dict: Success status and details
+        """
+        with SEND_SECONDS.time():
+            result = self._post_sms(phone_numbers, message)
+        count_sms_send(result, len(phone_numbers))
+        return result
+    
+    def _post_sms(self, phone_numbers, message):
+        """Make the Fast2SMS API call for send_bulk_sms"""
+        # Imported here so the asyncio service mode never loads requests
+        import requests
+        
+        try:
+            headers, payload = build_sms_request(self.api_key, phone_numbers, message)
             
-            # Make API request
-            response = requests.post(
+            # Make API request over the pooled keep-alive transport
+            response = get_transport('sms').post(
                 self.base_url,
                 json=payload,
-                headers=headers,
-                timeout=10
+                headers=headers
             )
             
             # Check if request was successful
             if response.status_code != 200:
-                logging.error(f"Fast2SMS API request failed with status {response.status_code}")
+                logging.error("Fast2SMS API request failed with status %s", response.status_code)
                 return {
                     'success': False,
                     'error': f'Fast2SMS API error: {response.status_code}',
-                    'response': None
+                    'response': None,
+                    'transient': is_retryable_sms_status(response.status_code)
                 }
             
             # Parse response
-            response_data = response.json()
-            
-            # Check if SMS was sent successfully
-            if response_data.get('return') == True:
-                return {
-                    'success': True,
-                    'error': '',
-                    'response': response_data
-                }
-            else:
-                error_message = response_data.get('message', 'Unknown error')
-                logging.error(f"Fast2SMS API returned error: {error_message}")
-                return {
-                    'success': False,
-                    'error': f'Fast2SMS API error: {error_message}',
-                    'response': response_data
-                }
+            return parse_sms_response(response.json())
                 
-        except requests.exceptions.Timeout:
+        except CircuitOpenError:
+            logging.warning("Fast2SMS circuit is open, skipping API call")
+            return {
+                'success': False,
+                'error': 'Fast2SMS API unavailable (circuit open)',
+                'response': None,
+                'transient': True
+            }
+        except requests.exceptions.Timeout as e:
             logging.error("Fast2SMS API request timed out")
             return {
                 'success': False,
                 'error': 'Request to Fast2SMS API timed out',
-                'response': None
+                'response': None,
+                'transient': is_connect_error(e)
             }
         except requests.exceptions.RequestException as e:
-            logging.error(f"Fast2SMS API request error: {str(e)}")
+            logging.error("Fast2SMS API request error: %s", e)
             return {
                 'success': False,
                 'error': f'Fast2SMS API request error: {str(e)}',
-                'response': None
+                'response': None,
+                'transient': is_connect_error(e)
             }
         except Exception as e:
-            logging.error(f"Unexpected error in Fast2SMS client: {str(e)}")
+            logging.error("Unexpected error in Fast2SMS client: %s", e)
             return {
                 'success': False,
                 'error': f'Unexpected error: {str(e)}',
                 'response': None
             }
     
-    def send_sms_with_retry(self, phone_number, message, max_retries=3):
+    def send_sms_with_retry(self, phone_number, message, max_retries=3, deadline=None):
         """
-        Send SMS with retry logic for failed sends
+        Send SMS, retrying failed sends in the background (see send_with_retry)
         
         Args:
             phone_number (str): The recipient's phone number
             message (str): The message to send
-            max_retries (int): Maximum number of retry attempts
+            max_retries (int): Maximum number of attempts, including the first
+            deadline (float): Absolute time.time() by which the SMS must be sent
             
         Returns:
-            dict: Success status and details
+            dict: Result of the first attempt
         """
-        for attempt in range(max_retries):
-            result = self.send_sms(phone_number, message)
-            
-            if result['success']:
-                return result
-            
-            # If not successful, log the attempt and wait before retrying
-            logging.warning(f"SMS send attempt {attempt + 1} failed: {result['error']}")
-            
-            # Wait before retrying (exponential backoff)
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)  # Wait 1, 2, 4 seconds
-        
-        # If all retries failed
-        return {
-            'success': False,
-            'error': f'Failed to send SMS after {max_retries} attempts',
-            'response': None
-        }
\ No newline at end of file
+        return send_with_retry(self, phone_number, message, max_retries, deadline)
@@ -0,0 +1,284 @@
+import re
+import string
+import unicodedata
+from functools import lru_cache
+from operator import itemgetter
+
+# GSM 03.38 default alphabet (one septet each) and its extension table
+# (two septets each: the escape character and the character)
+GSM7_BASIC = (
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENDED = "^{}\\[~]|€\f"
+
+# Units available in one segment, and per part of a concatenated message
+GSM7_SINGLE, GSM7_PART = 160, 153
+UCS2_SINGLE, UCS2_PART = 70, 67
+
+_GSM7 = re.compile('[' + re.escape(GSM7_BASIC + GSM7_EXTENDED) + ']*')
+_GSM7_EXTENDED = re.compile('[' + re.escape(GSM7_EXTENDED) + ']')
+_OPTIONAL = re.compile(r'\[([^\]]*)\]')
+
+# Common characters outside the GSM alphabet with a close GSM spelling
+_GSM_FOLDS = {
+    '‘': "'", '’': "'", '‚': "'", '‛': "'",
+    '“': '"', '”': '"', '„': '"',
+    '–': '-', '—': '-', '−': '-',
+    '…': '...', '\u00a0': ' ', '₹': 'Rs', '`': "'",
+}
+
+# Word abbreviations used when a location does not fit
+LOCATION_ABBREVIATIONS = {
+    'avenue': 'Ave', 'block': 'Blk', 'bridge': 'Brg', 'circle': 'Cir', 'college': 'Clg',
+    'colony': 'Cly', 'complex': 'Cplx', 'cross': 'Crs', 'depot': 'Dpt', 'east': 'E',
+    'extension': 'Extn', 'garden': 'Gdn', 'gardens': 'Gdns', 'government': 'Govt',
+    'hospital': 'Hosp', 'international': 'Intl', 'junction': 'Jn', 'layout': 'Lyt',
+    'market': 'Mkt', 'nagar': 'Ngr', 'near': 'Nr', 'north': 'N', 'opposite': 'Opp',
+    'park': 'Pk', 'phase': 'Ph', 'railway': 'Rly', 'road': 'Rd', 'school': 'Sch',
+    'sector': 'Sec', 'south': 'S', 'stage': 'Stg', 'stand': 'Std', 'station': 'Stn',
+    'street': 'St', 'temple': 'Tmpl', 'terminal': 'Term', 'university': 'Univ', 'west': 'W',
+}
+_ABBREVIABLE = re.compile(r'\b(' + '|'.join(LOCATION_ABBREVIATIONS) + r')\b', re.IGNORECASE)
+
+
+@lru_cache(maxsize=8192)
+def measure(text):
+    """
+    Measure the encoded length of a text
+
+    Args:
+        text (str): Message text or part of one
+
+    Returns:
+        tuple: (GSM-7 septets or None if the text needs UCS-2, UCS-2 code units)
+    """
+    units = len(text) if text.isascii() else len(text.encode('utf-16-le')) // 2
+    if _GSM7.fullmatch(text) is None:
+        return None, units
+    return len(text) + len(_GSM7_EXTENDED.findall(text)), units
+
+
+def is_gsm7(text):
+    """Check whether a text can be sent in the GSM 7-bit alphabet"""
+    return measure(text)[0] is not None
+
+
+def sms_segments(text):
+    """
+    Get how a text would be encoded and billed
+
+    Args:
+        text (str): The message
+
+    Returns:
+        tuple: (encoding 'gsm7' or 'ucs2', encoded length in septets or
+            UCS-2 code units, number of segments)
+    """
+    septets, units = measure(text)
+    if septets is not None:
+        encoding, length, single, part = 'gsm7', septets, GSM7_SINGLE, GSM7_PART
+    else:
+        encoding, length, single, part = 'ucs2', units, UCS2_SINGLE, UCS2_PART
+    segments = 1 if length <= single else -(-length // part)
+    return encoding, length, segments
+
+
+def fold_to_gsm(text):
+    """
+    Replace characters outside the GSM alphabet with a GSM spelling where one exists
+
+    Accented letters lose their accents (unless the GSM alphabet has them)
+    and typographic quotes and dashes become plain ones; characters without
+    a GSM spelling (e.g. Devanagari) are kept.
+
+    Args:
+        text (str): Text to fold
+
+    Returns:
+        str: The folded text
+    """
+    if is_gsm7(text):
+        return text
+    folded = []
+    for char in text:
+        if _GSM7.fullmatch(char) is None:
+            replacement = _GSM_FOLDS.get(char)
+            if replacement is None:
+                stripped = ''.join(c for c in unicodedata.normalize('NFKD', char) if not unicodedata.combining(c))
+                replacement = stripped if stripped and is_gsm7(stripped) else char
+            char = replacement
+        folded.append(char)
+    return ''.join(folded)
+
+
+def _abbreviate_word(match):
+    word = match.group(0)
+    abbreviation = LOCATION_ABBREVIATIONS[word.lower()]
+    if word.isupper() and len(word) > 1:
+        return abbreviation.upper()
+    return abbreviation.lower() if word[0].islower() else abbreviation
+
+
+@lru_cache(maxsize=4096)
+def abbreviate_location(location):
+    """
+    Shorten the common words of a location (Road -> Rd, Station -> Stn, ...)
+
+    Args:
+        location (str): Location text
+
+    Returns:
+        str: The abbreviated location
+    """
+    return _ABBREVIABLE.sub(_abbreviate_word, location)
+
+
+def truncate_to_units(text, budget, gsm):
+    """
+    Cut a text to an encoded length, at a word boundary when possible
+
+    Args:
+        text (str): Text to cut
+        budget (int): Septets (gsm) or UCS-2 code units available
+        gsm (bool): Whether the message is sent in GSM-7
+
+    Returns:
+        str: The text, or its beginning followed by '..'
+    """
+    septets, units = measure(text)
+    if (septets if gsm else units) <= budget:
+        return text
+    # Room is kept for the '..' marking the cut unless almost nothing fits
+    marker = '..' if budget >= 6 else ''
+    room = budget - len(marker)
+    used = end = 0
+    for index, char in enumerate(text):
+        cost = 2 if (char in GSM7_EXTENDED if gsm else ord(char) > 0xFFFF) else 1
+        if used + cost > room:
+            break
+        used += cost
+        end = index + 1
+    cut = text[:end]
+    space = cut.rfind(' ')
+    if space >= end // 2 and end < len(text) and text[end] != ' ':
+        cut = cut[:space]
+    return cut.rstrip(' ,.-:') + marker
+
+
+class ReplyTemplate:
+    """
+    Reply message compiled once and rendered into a single SMS segment
+
+    The pattern uses str.format fields; sections in [brackets] are optional.
+    Rendering measures the exact encoded length (GSM-7 septets, counting
+    extension characters twice, or UCS-2 code units once any part is
+    outside the GSM alphabet) from lengths precomputed for the literal text
+    and cached per field value. A message that does not fit in one segment
+    is shortened step by step: the shortenable field is folded to the GSM
+    alphabet, then its words are abbreviated, then optional sections are
+    dropped (last first), then the field is cut at a word boundary.
+    """
+
+    def __init__(self, pattern, shorten='location'):
+        """
+        Compile the template
+
+        Args:
+            pattern (str): Message pattern, e.g. "Bus {route}[ at {time}]"
+            shorten (str): Field shortened when the message does not fit
+        """
+        self.pattern = pattern
+        self.shorten = shorten
+        sections = []
+        position = 0
+        for match in _OPTIONAL.finditer(pattern):
+            sections.append((pattern[position:match.start()], False))
+            sections.append((match.group(1), True))
+            position = match.end()
+        sections.append((pattern[position:], False))
+        # Layouts tried in order: every section, then without each optional
+        # section in turn, last first
+        self.layouts = [self._compile(sections)]
+        for index in reversed(range(len(sections))):
+            if sections[index][1]:
+                sections = sections[:index] + sections[index + 1:]
+                self.layouts.append(self._compile(sections))
+
+    @staticmethod
+    def _compile(sections):
+        """Precompute the %-format string, literal length and field getter of a layout"""
+        parsed = list(string.Formatter().parse(''.join(section for section, optional in sections)))
+        literals = [literal for literal, field, spec, conversion in parsed]
+        fields = [field for literal, field, spec, conversion in parsed if field is not None]
+        text = ''.join(
+            literal.replace('%', '%%') + ('%s' if field is not None else '')
+            for literal, field, spec, conversion in parsed
+        )
+        septets, units = measure(''.join(literals))
+        if len(fields) == 1:
+            getter = lambda values, field=fields[0]: (values[field],)
+        else:
+            getter = itemgetter(*fields) if fields else (lambda values: ())
+        return text, septets, units, getter
+
+    @staticmethod
+    def _fit(layout, values):
+        """Render a layout if the result fits in one segment, else return None"""
+        text, septets, units, getter = layout
+        items = getter(values)
+        for item in items:
+            item_septets, item_units = measure(item)
+            units += item_units
+            if septets is not None:
+                septets = None if item_septets is None else septets + item_septets
+        if septets is not None and septets > GSM7_SINGLE or septets is None and units > UCS2_SINGLE:
+            return None
+        return text % items
+
+    def render(self, **values):
+        """
+        Render the message
+
+        Args:
+            **values: Field values (converted with str)
+
+        Returns:
+            str: The message, at most one GSM-7 or UCS-2 segment long
+        """
+        values = {name: str(value) for name, value in values.items()}
+        layouts = self.layouts
+        message = self._fit(layouts[0], values)
+        if message is not None:
+            return message
+
+        field = self.shorten
+        if field in values:
+            folded = fold_to_gsm(values[field])
+            for candidate in (folded, abbreviate_location(folded)):
+                if candidate != values[field]:
+                    values[field] = candidate
+                    message = self._fit(layouts[0], values)
+                    if message is not None:
+                        return message
+
+        for layout in layouts[1:]:
+            message = self._fit(layout, values)
+            if message is not None:
+                return message
+
+        text, septets, units, getter = layouts[-1]
+        if field in values:
+            # Whatever is left of the segment goes to the shortened field
+            rest = text % getter(dict(values, **{field: ''}))
+            gsm = is_gsm7(rest) and is_gsm7(values[field])
+            budget = (GSM7_SINGLE if gsm else UCS2_SINGLE) - measure(rest)[0 if gsm else 1]
+            values[field] = truncate_to_units(values[field], max(0, budget), gsm)
+            message = self._fit(layouts[-1], values)
+            if message is not None:
+                return message
+
+        # The required text is too long on its own: cut the message
+        message = text % getter(values)
+        gsm = is_gsm7(message)
+        return truncate_to_units(message, GSM7_SINGLE if gsm else UCS2_SINGLE, gsm)
@@ -0,0 +1,71 @@
+import gc
+import importlib
+import logging
+from utils.circuit_breaker import reset_breakers
+from utils.http_transport import get_transport, reset_transports
+from utils.reply_queue import start_reply_workers
+
+# Modules the sync service imports lazily (on its first upstream call, or
+# first large headway batch); the gunicorn master loads them once so forked
+# workers share them
+SHARED_MODULES = ('requests', 'requests.adapters', 'urllib3.util.retry', 'numpy')
+
+# Upstreams whose connection pools every worker opens
+UPSTREAMS = ('maps', 'sms')
+
+
+def preload_shared_modules(modules=SHARED_MODULES):
+    """
+    Import modules in the master process before workers are forked
+
+    Args:
+        modules (tuple): Module names; ones that fail to import are skipped
+
+    Returns:
+        list: Names of the modules that were imported
+    """
+    loaded = []
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logging.warning("Could not preload %s: %s", name, e)
+            continue
+        loaded.append(name)
+    return loaded
+
+
+def freeze_shared_heap():
+    """
+    Move every object allocated so far out of the garbage collector's reach
+
+    Called in the master right before forking: the collector never touches
+    the reference counts of frozen objects, so the pages holding the route
+    catalog, stop index and timetable stay shared copy-on-write between
+    workers instead of being copied into each of them.
+    """
+    gc.collect()
+    gc.freeze()
+
+
+def init_worker(open_pools=True):
+    """
+    Set up the per-process state of a freshly forked worker
+
+    Drops anything inherited from the master, starts the background reply
+    workers, so queued replies are sent even by a worker that has not
+    served a request yet, then builds this worker's upstream connection
+    pools (no connection is opened until first use), so the first request
+    does not pay for it.
+
+    Args:
+        open_pools (bool): Build the requests pools (the asyncio service
+            mode has its own aiohttp client and does not need them)
+    """
+    reset_transports()
+    reset_breakers()
+    start_reply_workers()
+    if not open_pools:
+        return
+    for name in UPSTREAMS:
+        get_transport(name).session
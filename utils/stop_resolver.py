@@ -0,0 +1,319 @@
+import csv
+import heapq
+import logging
+from collections import Counter, namedtuple
+from operator import itemgetter
+from utils.eta_cache import normalize_location
+
+# Common abbreviations in SMS stop names, expanded before matching
+ABBREVIATIONS = {
+    'rd': 'road',
+    'stn': 'station',
+    'sta': 'station',
+    'st': 'street',
+    'ave': 'avenue',
+    'jn': 'junction',
+    'jct': 'junction',
+    'cir': 'circle',
+    'mkt': 'market',
+    'hosp': 'hospital',
+    'clg': 'college',
+    'centre': 'center',
+    'ctr': 'center',
+    'bs': 'bus stand',
+    'opp': 'opposite'
+}
+
+StopMatch = namedtuple('StopMatch', ['stop_id', 'stop_name', 'distance'])
+
+
+def normalize_stop_name(name):
+    """
+    Normalize a stop name for matching
+
+    Punctuation is dropped, runs of single letters are joined ("M.G." → "mg")
+    and common abbreviations are expanded ("rd" → "road").
+
+    Args:
+        name (str): Stop name as typed or as listed in the stops file
+
+    Returns:
+        str: Canonical matching form
+    """
+    tokens = []
+    letters = ''
+    for token in normalize_location(name).split(' '):
+        if len(token) == 1 and token.isalpha():
+            letters += token
+            continue
+        if letters:
+            tokens.append(letters)
+            letters = ''
+        if token:
+            tokens.append(ABBREVIATIONS.get(token, token))
+    if letters:
+        tokens.append(letters)
+    return ' '.join(tokens)
+
+
+def trigrams(text):
+    """Return the set of character trigrams of a space-padded string"""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def bounded_edit_distance(a, b, limit):
+    """
+    Levenshtein distance between a and b, giving up once it exceeds limit
+
+    Only the diagonal band of width 2 * limit + 1 is computed.
+
+    Returns:
+        int: The distance, or limit + 1 if it is larger than limit
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    if len(a) > len(b):
+        a, b = b, a
+
+    too_far = limit + 1
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        low = max(1, i - limit)
+        high = min(len(b), i + limit)
+        current = [too_far] * (len(b) + 1)
+        if low == 1:
+            current[0] = i
+        row_min = current[0]
+        char_a = a[i - 1]
+        for j in range(low, high + 1):
+            value = previous[j - 1] if char_a == b[j - 1] else previous[j - 1] + 1
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > limit:
+            return too_far
+        previous = current
+    return min(previous[len(b)], too_far)
+
+
+def within_one_edit(a, b):
+    """
+    Check whether a and b are at most one insertion, deletion or substitution apart
+
+    Same answer as bounded_edit_distance(a, b, 1) <= 1, but only string
+    slices are compared: the common prefix is found by binary search, and
+    the rest of both strings must match once one character is skipped.
+
+    Returns:
+        bool: True if the edit distance is 0 or 1
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if len(b) - len(a) > 1:
+        return False
+
+    low, high = 0, len(a)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    if len(a) == len(b):
+        return a[low + 1:] == b[low + 1:]
+    return a[low:] == b[low + 1:]
+
+
+class StopResolver:
+    """
+    Resolve free-text locations to canonical stops
+
+    Built once from a stops list: exact normalized names hit a dict, and other
+    inputs are matched through a trigram inverted index whose best candidates
+    are ranked by bounded edit distance.
+    """
+
+    # Rarest query trigrams looked up in the inverted index
+    MAX_GRAMS = 8
+    # Rarest trigrams counted before looking for a candidate one edit away
+    FAST_GRAMS = 4
+    # Candidates from the trigram index checked for a match one edit away
+    MAX_CANDIDATES = 16
+    # Best candidates re-ranked by banded edit distance, and the fewer of
+    # them compared with the full distance limit
+    MAX_EDIT_CANDIDATES = 8
+    MAX_WIDE_CANDIDATES = 4
+    # Shorter inputs (landmark or stop codes) are only matched exactly: one
+    # edit turns them into too many unrelated names
+    MIN_FUZZY_LENGTH = 4
+
+    def __init__(self, stops, max_distance_ratio=0.34):
+        """
+        Build the index
+
+        Args:
+            stops (iterable): (stop_id, stop_name) pairs
+            max_distance_ratio (float): Maximum edit distance as a fraction of
+                the normalized query length
+        """
+        self.max_distance_ratio = max_distance_ratio
+        self.stop_ids = []
+        self.stop_names = []
+        self.normalized = []
+        self.exact = {}
+        self.postings = {}
+
+        for stop_id, stop_name in stops:
+            index = len(self.stop_ids)
+            key = normalize_stop_name(stop_name)
+            self.stop_ids.append(stop_id)
+            self.stop_names.append(stop_name)
+            self.normalized.append(key)
+            self.exact.setdefault(key, index)
+            for gram in trigrams(key):
+                self.postings.setdefault(gram, []).append(index)
+
+        # Posting lists become tuples to save memory once the index is built
+        self.postings = {gram: tuple(indexes) for gram, indexes in self.postings.items()}
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """
+        Build a resolver from a GTFS stops.txt or any CSV with stop_id and stop_name
+
+        Args:
+            path (str): Path of the stops file
+
+        Returns:
+            StopResolver: The resolver
+        """
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            stops = [(row['stop_id'].strip(), row['stop_name'].strip()) for row in reader]
+        return cls(stops, **kwargs)
+
+    def resolve(self, location):
+        """
+        Resolve a location to the closest known stop
+
+        Args:
+            location (str): Location text as sent by the user
+
+        Returns:
+            StopMatch: The best match, or None if nothing is close enough
+        """
+        key = normalize_stop_name(location)
+        if not key:
+            return None
+
+        index = self.exact.get(key)
+        if index is not None:
+            return StopMatch(self.stop_ids[index], self.stop_names[index], 0)
+        max_limit = int(len(key) * self.max_distance_ratio)
+        if len(key) < self.MIN_FUZZY_LENGTH or max_limit < 1:
+            return None
+
+        # Only the rarest trigrams are counted: they are the most selective,
+        # and one typo destroys at most three of them
+        grams = sorted(
+            (gram for gram in trigrams(key) if gram in self.postings),
+            key=lambda gram: len(self.postings[gram])
+        )
+        # Most inputs are one typo away, and exact names were ruled out, so
+        # a candidate one edit away cannot be beaten: look for one among the
+        # candidates of the few rarest trigrams before counting the others
+        scores = Counter()
+        for gram in grams[:self.FAST_GRAMS]:
+            scores.update(self.postings[gram])
+        match = self._one_edit_match(key, self._top_candidates(scores))
+        if match is not None:
+            return match
+
+        for gram in grams[self.FAST_GRAMS:self.MAX_GRAMS]:
+            scores.update(self.postings[gram])
+        candidates = self._top_candidates(scores)
+        match = self._one_edit_match(key, candidates)
+        if match is not None or max_limit < 2:
+            return match
+
+        # A narrow band is tried first and the full distance limit is only
+        # paid for when it finds nothing
+        best = self._closest(key, candidates[:self.MAX_EDIT_CANDIDATES], 2)
+        if best is None and max_limit > 2:
+            best = self._closest(key, candidates[:self.MAX_WIDE_CANDIDATES], max_limit)
+        if best is None:
+            return None
+
+        distance, index = best
+        return StopMatch(self.stop_ids[index], self.stop_names[index], distance)
+
+    def _top_candidates(self, scores):
+        """Return the indexes sharing the most query trigrams, best first"""
+        return [candidate for candidate, score in
+                heapq.nlargest(self.MAX_CANDIDATES, scores.items(), key=itemgetter(1))]
+
+    def _one_edit_match(self, key, candidates):
+        """Return a StopMatch for the first candidate one edit from key, or None"""
+        for candidate in candidates:
+            if within_one_edit(key, self.normalized[candidate]):
+                return StopMatch(self.stop_ids[candidate], self.stop_names[candidate], 1)
+        return None
+
+    def _closest(self, key, candidates, limit):
+        """
+        Return (distance, index) of the closest candidate within limit, or None
+
+        Candidates one edit away were ruled out, so the first one two edits
+        away cannot be beaten and ends the search.
+        """
+        best = None
+        for candidate in candidates:
+            distance = bounded_edit_distance(key, self.normalized[candidate], limit)
+            if distance <= limit and (best is None or distance < best[0]):
+                best = (distance, candidate)
+                limit = distance
+                if distance <= 2:
+                    break
+        return best
+
+    def canonical_location(self, location):
+        """
+        Map a location to its canonical stop name, or return it unchanged
+
+        Args:
+            location (str): Location text as sent by the user
+
+        Returns:
+            str: The canonical stop name if resolved, else the input
+        """
+        match = self.resolve(location)
+        return match.stop_name if match is not None else location
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+
+def load_stop_resolver(path):
+    """
+    Build the stop resolver from the configured stops file
+
+    Args:
+        path (str): Stops file path (empty disables resolution)
+
+    Returns:
+        StopResolver: The resolver, or None if disabled or unreadable
+    """
+    if not path:
+        return None
+    try:
+        resolver = StopResolver.from_file(path)
+    except (OSError, KeyError, csv.Error) as e:
+        logging.error("Failed to load stops from %s: %s", path, e)
+        return None
+    logging.info("Loaded %s stops for location resolution from %s", len(resolver), path)
+    return resolver
@@ -0,0 +1,413 @@
+import contextvars
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from config import Config
+from utils.logging_setup import get_correlation_id
+
+# Fields holding phone numbers, replaced by stable pseudonyms when capturing
+PHONE_FIELDS = frozenset(['from', 'sender', 'phone_number', 'numbers', 'to'])
+# Fields never written to a capture
+SECRET_FIELDS = frozenset(['key', 'authorization', 'api_key'])
+# Request fields that identify an upstream call when matching recorded
+# responses; everything else (API key, departure_time=now) varies per run
+MATCH_FIELDS = {
+    'maps': ('origin', 'destination', 'mode', 'transit_mode'),
+    'sms': ('message', 'numbers')
+}
+
+# Parse results of the webhook being captured in this thread or task
+_current = contextvars.ContextVar('traffic_capture', default=None)
+
+
+def pseudonymize_phone(number, secret):
+    """
+    Replace a phone number with a stable pseudonym
+
+    The same number maps to the same pseudonym in every worker (and every
+    capture made with the same secret), so per-sender behaviour such as rate
+    limiting and idempotency replays exactly.
+
+    Args:
+        number (str): Phone number, or comma-separated numbers
+        secret (str): Key of the keyed hash
+
+    Returns:
+        str: Ten-digit pseudonym(s) starting with 9, comma-separated like the input
+    """
+    pseudonyms = []
+    for part in str(number).split(','):
+        digest = hmac.new(secret.encode(), part.strip().encode(), hashlib.sha256).hexdigest()
+        pseudonyms.append(f"9{int(digest[:15], 16) % 10 ** 9:09d}")
+    return ','.join(pseudonyms)
+
+
+def redact(value, secret=None):
+    """
+    Drop secrets from a JSON value and pseudonymize its phone numbers
+
+    Args:
+        value: Decoded JSON value
+        secret (str): Pseudonym key; None keeps phone numbers as they are
+
+    Returns:
+        A redacted copy of value
+    """
+    if isinstance(value, dict):
+        redacted = {}
+        for name, item in value.items():
+            if name in SECRET_FIELDS:
+                continue
+            if name in PHONE_FIELDS and secret is not None and isinstance(item, (str, int)) and item != '':
+                redacted[name] = pseudonymize_phone(item, secret)
+            else:
+                redacted[name] = redact(item, secret)
+        return redacted
+    if isinstance(value, list):
+        return [redact(item, secret) for item in value]
+    return value
+
+
+def decode_body(data):
+    """
+    Decode a request or response body for a capture record
+
+    Args:
+        data (bytes): The body
+
+    Returns:
+        tuple: (format 'json', 'ndjson' or 'text', decoded body)
+    """
+    text = data.decode('utf-8', errors='replace')
+    try:
+        return 'json', json.loads(text)
+    except ValueError:
+        pass
+    try:
+        lines = [json.loads(line) for line in text.splitlines() if line.strip()]
+        if lines:
+            return 'ndjson', lines
+    except ValueError:
+        pass
+    return 'text', text
+
+
+def encode_body(body_format, body):
+    """
+    Encode a captured body back into the bytes that were sent
+
+    Args:
+        body_format (str): 'json', 'ndjson' or 'text' (see decode_body)
+        body: The decoded body
+
+    Returns:
+        bytes: Request body
+    """
+    if body_format == 'json':
+        return json.dumps(body).encode()
+    if body_format == 'ndjson':
+        return ''.join(json.dumps(line) + '\n' for line in body).encode()
+    return body.encode()
+
+
+def upstream_request_key(upstream, params=None, json_body=None):
+    """
+    Build the key that matches a replayed upstream request to recorded ones
+
+    Args:
+        upstream (str): Upstream name, 'maps' or 'sms'
+        params (dict): Query parameters
+        json_body (dict): JSON request body
+
+    Returns:
+        str: Match key
+    """
+    fields = dict(params or {})
+    if isinstance(json_body, dict):
+        fields.update(json_body)
+    selected = {name: str(fields[name]) for name in MATCH_FIELDS.get(upstream, ()) if name in fields}
+    return upstream + ':' + json.dumps(selected, sort_keys=True)
+
+
+def note_parsed(parsed):
+    """
+    Add a parse result to the webhook being captured (no-op when not capturing)
+
+    Args:
+        parsed (dict): Result of parse_sms_input
+    """
+    capture = _current.get()
+    if capture is not None:
+        capture.append(parsed)
+
+
+class TrafficRecorder:
+    """
+    Append-only JSON lines capture of webhook traffic
+
+    Every inbound webhook is written as one 'webhook' record (payload, parse
+    results, response status and body, latency) and every upstream call as
+    one 'upstream' record (request parameters, status, response body,
+    latency), tagged with the request's correlation ID. API keys are never
+    written, and phone numbers are replaced by keyed pseudonyms unless
+    disabled. Each record is one O_APPEND write, so all gunicorn workers can
+    share the file. Capture stops once the file reaches max_bytes.
+    """
+
+    # Writes are file I/O, so the asyncio service mode makes them in a thread
+    blocking = True
+
+    def __init__(self, path, max_bytes=0, secret=None):
+        """
+        Initialize the recorder
+
+        Args:
+            path (str): JSON lines file to append to
+            max_bytes (int): File size at which capture stops (0 for no limit)
+            secret (str): Pseudonym key for phone numbers (None records them as is)
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.secret = secret
+        self.records = 0
+        self.full = False
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def begin(self):
+        """
+        Start capturing a webhook in the current thread or task
+
+        Returns:
+            tuple: Token for finish()
+        """
+        parsed = []
+        return _current.set(parsed), parsed, time.time(), time.perf_counter()
+
+    def finish(self, token, path, body, status, response_body):
+        """
+        Write the record of a webhook started with begin()
+
+        Args:
+            token (tuple): Value returned by begin()
+            path (str): Request path
+            body (bytes): Request body
+            status (int): Response status code
+            response_body (bytes): Response body
+        """
+        self.write(self.webhook_record(token, path, body, status, response_body))
+
+    def webhook_record(self, token, path, body, status, response_body):
+        """
+        Build the record of a webhook started with begin() (see finish)
+
+        Must be called in the context that called begin().
+
+        Returns:
+            dict: The record, for write()
+        """
+        context_token, parsed, started_at, start = token
+        _current.reset(context_token)
+        elapsed = time.perf_counter() - start
+        body_format, decoded = decode_body(body)
+        response_format, response = decode_body(response_body)
+        return {
+            'type': 'webhook',
+            't': round(started_at, 6),
+            'id': get_correlation_id(),
+            'path': path,
+            'body_format': body_format,
+            'body': redact(decoded, self.secret),
+            'parsed': parsed,
+            'status': status,
+            'response': redact(response, self.secret),
+            'ms': round(elapsed * 1000, 3)
+        }
+
+    def record_upstream(self, upstream, method, url, params=None, json_body=None, status=None,
+                        response_text=None, elapsed=0.0, error=None):
+        """
+        Write the record of one upstream call
+
+        Args:
+            upstream (str): Upstream name, 'maps' or 'sms'
+            method (str): HTTP method
+            url (str): Request URL
+            params (dict): Query parameters
+            json_body (dict): JSON request body
+            status (int): Response status, or None if the call failed
+            response_text (str): Response body
+            elapsed (float): Seconds the call took
+            error (str): Exception raised by the call, if any
+        """
+        self.write(self.upstream_record(upstream, method, url, params, json_body, status,
+                                        response_text, elapsed, error))
+
+    def upstream_record(self, upstream, method, url, params=None, json_body=None, status=None,
+                        response_text=None, elapsed=0.0, error=None):
+        """
+        Build the record of one upstream call (see record_upstream)
+
+        Returns:
+            dict: The record, for write()
+        """
+        record = {
+            'type': 'upstream',
+            't': round(time.time() - elapsed, 6),
+            'id': get_correlation_id(),
+            'upstream': upstream,
+            'method': method,
+            'url': url.split('?', 1)[0],
+            'params': redact(dict(params or {}), self.secret),
+            'json': redact(json_body, self.secret),
+            'status': status,
+            'response': response_text,
+            'ms': round(elapsed * 1000, 3)
+        }
+        if error is not None:
+            record['error'] = error
+        return record
+
+    def write(self, record):
+        """Append one record as a JSON line"""
+        line = (json.dumps(record, separators=(',', ':'), default=str) + '\n').encode('utf-8')
+        with self._lock:
+            if self.full:
+                return
+            try:
+                if self._pid != os.getpid():
+                    self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                    self._pid = os.getpid()
+                if self.max_bytes and os.fstat(self._fd).st_size + len(line) > self.max_bytes:
+                    self.full = True
+                    logging.warning("Traffic capture %s reached %s bytes, capture stopped", self.path, self.max_bytes)
+                    return
+                os.write(self._fd, line)
+                self.records += 1
+            except OSError as e:
+                logging.error("Failed to write traffic capture to %s: %s", self.path, e)
+
+    def stats(self):
+        """
+        Get capture counters for this process
+
+        Returns:
+            dict: Capture file, records written and whether the size limit was reached
+        """
+        with self._lock:
+            return {'path': self.path, 'records': self.records, 'full': self.full}
+
+
+_recorder = None
+
+
+def configure_traffic_capture():
+    """
+    Install the traffic recorder described by the application configuration
+
+    Returns:
+        TrafficRecorder: The recorder, or None when capture is disabled
+    """
+    global _recorder
+    _recorder = None
+    if Config.TRAFFIC_CAPTURE_PATH:
+        _recorder = TrafficRecorder(
+            Config.TRAFFIC_CAPTURE_PATH,
+            max_bytes=int(Config.TRAFFIC_CAPTURE_MAX_MB * 1024 * 1024),
+            secret=Config.SECRET_KEY if Config.TRAFFIC_CAPTURE_PSEUDONYMIZE else None
+        )
+    return _recorder
+
+
+def get_traffic_recorder():
+    """Return the installed traffic recorder, or None when capture is disabled"""
+    return _recorder
+
+
+def load_capture(path):
+    """
+    Read a capture file
+
+    Args:
+        path (str): JSON lines file written by TrafficRecorder
+
+    Returns:
+        tuple: (webhook records, upstream records), each in time order
+    """
+    webhooks, upstreams = [], []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get('type') == 'webhook':
+                webhooks.append(record)
+            elif record.get('type') == 'upstream':
+                upstreams.append(record)
+    webhooks.sort(key=lambda record: record['t'])
+    upstreams.sort(key=lambda record: record['t'])
+    return webhooks, upstreams
+
+
+class UpstreamPlayback:
+    """
+    Recorded upstream responses served back in a deterministic order
+
+    A request is answered with the recorded responses to the same request
+    (see upstream_request_key) in the order they were recorded, cycling when
+    it is replayed more often than it was captured. A request that was never
+    recorded gets the upstream's recorded responses in order instead.
+    """
+
+    def __init__(self, upstream_records):
+        """
+        Index the recorded calls
+
+        Args:
+            upstream_records (list): 'upstream' records, in time order
+        """
+        self._by_key = {}
+        self._by_upstream = {}
+        for record in upstream_records:
+            if record.get('status') is None:
+                continue
+            response = (record['status'], record.get('response') or '', record.get('ms', 0.0))
+            key = upstream_request_key(record['upstream'], record.get('params'), record.get('json'))
+            self._by_key.setdefault(key, deque()).append(response)
+            self._by_upstream.setdefault(record['upstream'], deque()).append(response)
+        self.counters = {'matched': 0, 'fallback': 0, 'unmatched': 0}
+        self._lock = threading.Lock()
+
+    def lookup(self, upstream, params=None, json_body=None):
+        """
+        Get the recorded response for a replayed request
+
+        Args:
+            upstream (str): Upstream name, 'maps' or 'sms'
+            params (dict): Query parameters
+            json_body (dict): JSON request body
+
+        Returns:
+            tuple: (status, response body text, recorded milliseconds), or
+                None if nothing was recorded for the upstream
+        """
+        with self._lock:
+            responses = self._by_key.get(upstream_request_key(upstream, params, json_body))
+            outcome = 'matched'
+            if responses is None:
+                responses = self._by_upstream.get(upstream)
+                outcome = 'fallback'
+            if responses is None:
+                self.counters['unmatched'] += 1
+                return None
+            self.counters[outcome] += 1
+            response = responses.popleft()
+            responses.append(response)
+            return response
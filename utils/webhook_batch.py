@@ -0,0 +1,380 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from utils.sms_parser import parse_sms_input
+from utils.traffic_capture import note_parsed
+from utils.response_formatter import format_eta_response
+from utils.eta_cache import make_eta_cache_key
+from utils.rate_limiter import SLOW_DOWN_MESSAGE
+from utils.idempotency import make_idempotency_key
+from utils.sms_sender import send_bulk_with_retry
+from utils.metrics import WEBHOOK_BATCH_MESSAGES
+
+INVALID_FORMAT_MESSAGE = "Invalid format. Send: Location RouteNumber"
+ETA_FAILED_MESSAGE = "Unable to fetch ETA. Please try again later."
+
+
+def parse_batch_body(body):
+    """
+    Decode the inbound messages of a batch webhook
+
+    Accepts a JSON array of message objects, an object whose 'messages' key
+    holds that array, or NDJSON (one message object per line).
+
+    Args:
+        body (bytes): Request body
+
+    Returns:
+        list: Message objects (each like a single /webhook body)
+
+    Raises:
+        ValueError: If the body is none of the accepted forms
+    """
+    text = body.decode('utf-8').strip()
+    if not text:
+        raise ValueError("No data received")
+    try:
+        data = json.loads(text)
+    except ValueError:
+        # NDJSON: a JSON document per line
+        data = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(data, dict):
+        data = data.get('messages') if isinstance(data.get('messages'), list) else [data]
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array, an object with 'messages', or NDJSON")
+    return data
+
+
+class _Entry:
+    """One message of a batch as it moves through the pipeline"""
+
+    __slots__ = ('index', 'data', 'phone_number', 'message_text', 'key', 'parsed', 'lookup', 'reply', 'result')
+
+    def __init__(self, index, data):
+        self.index = index
+        self.data = data if isinstance(data, dict) else {}
+        self.phone_number = self.data.get("from", self.data.get("sender", ""))
+        self.message_text = self.data.get("message", self.data.get("text", ""))
+        self.key = None
+        self.parsed = None
+        self.lookup = None
+        self.reply = None
+        self.result = None
+
+
+class BatchPlan:
+    """
+    The work of one batch webhook, independent of how its I/O is performed
+
+    Messages are admitted (format check, rate limit, idempotency), parsed,
+    and reduced to one ETA lookup per distinct (location, route). Once the
+    lookups are answered, replies are grouped by text so every distinct
+    reply costs one bulk send however many senders asked the same thing.
+    Callers perform the lookups and sends (threads or asyncio) between the
+    steps.
+    """
+
+    def __init__(self, items, rate_limiter=None, idempotency=None):
+        """
+        Initialize the plan
+
+        Args:
+            items (list): Message objects from parse_batch_body
+            rate_limiter (RateLimiter): Per-sender limiter, or None
+            idempotency (IdempotencyGuard): Guard against gateway retries, or None
+        """
+        self.entries = [_Entry(index, data) for index, data in enumerate(items)]
+        self.rate_limiter = rate_limiter
+        self.idempotency = idempotency
+        # Replies sent once, without retries: {message text: [phone numbers]}
+        self.notices = {}
+
+    def _notify(self, phone_number, message):
+        if phone_number:
+            self.notices.setdefault(message, []).append(phone_number)
+
+    def admit(self):
+        """
+        Reject malformed, throttled and duplicate messages
+
+        Returns:
+            list: Entries still to be processed
+        """
+        admitted = []
+        for entry in self.entries:
+            if not entry.phone_number or not entry.message_text:
+                self._notify(entry.phone_number, INVALID_FORMAT_MESSAGE)
+                entry.result = ({"error": "Missing phone number or message"}, 400)
+                continue
+
+            if self.rate_limiter is not None:
+                decision = self.rate_limiter.check(entry.phone_number)
+                if not decision.allowed:
+                    logging.warning("Rate limit exceeded by %s", entry.phone_number)
+                    if decision.notify:
+                        self._notify(entry.phone_number, SLOW_DOWN_MESSAGE)
+                    entry.result = (
+                        {"error": "Too many requests", "retry_after": int(decision.retry_after) + 1}, 429
+                    )
+                    continue
+
+            key = None
+            if self.idempotency is not None:
+                key = make_idempotency_key(entry.data, entry.phone_number, entry.message_text,
+                                           Config.IDEMPOTENCY_WINDOW, Config.IDEMPOTENCY_CONTENT_FALLBACK)
+            if key is not None:
+                previous = self.idempotency.begin(key)
+                if previous is not None:
+                    entry.result = previous
+                    continue
+                entry.key = key
+            admitted.append(entry)
+        return admitted
+
+    def lookups(self):
+        """
+        Parse the admitted messages and collect the distinct ETA lookups
+
+        Returns:
+            dict: {lookup key: (location, route)}
+        """
+        lookups = {}
+        for entry in self.pending():
+            entry.parsed = parse_sms_input(entry.message_text)
+            note_parsed(entry.parsed)
+            if not entry.parsed['valid']:
+                logging.error("Invalid SMS format: %s", entry.parsed['error'])
+                self._notify(entry.phone_number, entry.parsed['error'])
+                entry.result = ({"error": entry.parsed['error']}, 400)
+                continue
+            entry.lookup = make_eta_cache_key(entry.parsed['location'], entry.parsed['route'])
+            lookups.setdefault(entry.lookup, (entry.parsed['location'], entry.parsed['route']))
+        return lookups
+
+    def replies(self, etas):
+        """
+        Format the reply to every message and group identical replies
+
+        Args:
+            etas (dict): {lookup key: ETA result}
+
+        Returns:
+            dict: ETA replies to send with retries, {message text: [phone numbers]}
+        """
+        replies = {}
+        for entry in self.pending():
+            eta_data = etas[entry.lookup]
+            route, location = entry.parsed['route'], entry.parsed['location']
+            if not eta_data['success']:
+                logging.error("Failed to get ETA: %s", eta_data['error'])
+                if eta_data.get('source') == 'route_catalog':
+                    self._notify(entry.phone_number, format_eta_response(eta_data, route, location))
+                    entry.result = ({"error": "Route not found"}, 404)
+                else:
+                    self._notify(entry.phone_number, ETA_FAILED_MESSAGE)
+                    entry.result = ({"error": "Failed to get ETA"}, 500)
+                continue
+            entry.reply = format_eta_response(eta_data, route, location)
+            entry.result = ({
+                "message": "SMS processed successfully",
+                "phone_number": entry.phone_number,
+                "location": location,
+                "route": route,
+                "eta_data": eta_data
+            }, 200)
+            replies.setdefault(entry.reply, []).append(entry.phone_number)
+        return replies
+
+    def pending(self):
+        """Return the entries that have no result yet"""
+        return [entry for entry in self.entries if entry.result is None]
+
+    def finish(self, sent):
+        """
+        Settle the replied entries and record every result for idempotency
+
+        Args:
+            sent (dict): {message text: send result} for the grouped ETA replies
+
+        Returns:
+            tuple: (response payload dict, HTTP status code)
+        """
+        for entry in self.entries:
+            if entry.reply is not None:
+                sms_result = sent[entry.reply]
+                if not sms_result['success']:
+                    logging.error("Failed to send SMS: %s", sms_result['error'])
+                    if sms_result.get('retry_scheduled'):
+                        entry.result = ({"message": "Reply send failed, retry scheduled",
+                                         "phone_number": entry.phone_number}, 202)
+                    else:
+                        entry.result = ({"error": "Failed to send response SMS"}, 500)
+                else:
+                    logging.info(
+                        "Replied to %s for route %s at %s", entry.phone_number, entry.parsed['route'],
+                        entry.parsed['location'],
+                        extra={'sample': True, 'eta_source': entry.result[0]['eta_data'].get('source', 'maps')}
+                    )
+            if entry.key is not None:
+                self.idempotency.complete(entry.key, *entry.result)
+                entry.key = None
+        return self.response()
+
+    def abort(self):
+        """Release the idempotency claims of unfinished entries (e.g. after an exception)"""
+        for entry in self.entries:
+            if entry.key is not None:
+                self.idempotency.release(entry.key)
+                entry.key = None
+
+    def response(self):
+        """
+        Build the batch response: one result per message, in order
+
+        Returns:
+            tuple: (response payload dict, HTTP status code)
+        """
+        results = []
+        statuses = {}
+        for entry in self.entries:
+            payload, status = entry.result
+            results.append(dict(payload, index=entry.index, status=status))
+            statuses[status] = statuses.get(status, 0) + 1
+        for status, count in statuses.items():
+            WEBHOOK_BATCH_MESSAGES.labels(status).inc(count)
+        return {"results": results, "statuses": statuses}, 200
+
+
+def _chunks(phone_numbers, size):
+    """Split recipients into groups of at most size"""
+    return [phone_numbers[i:i + size] for i in range(0, len(phone_numbers), size)]
+
+
+def _merge(results):
+    """Combine the send results of one reply's recipient chunks"""
+    failed = [result for result in results if not result['success']]
+    if not failed:
+        return results[0]
+    return dict(failed[0], retry_scheduled=all(result.get('retry_scheduled') for result in failed))
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _with_following(maps_client, etas):
+    """Fill in the following bus of every answer in one pass over the batch"""
+    if maps_client.headways is None:
+        return etas
+    return dict(zip(etas, maps_client.headways.fill(list(etas.values()))))
+
+
+def _get_executor():
+    """Return this process's thread pool for batch fan-out"""
+    global _executor, _executor_pid
+    if _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=Config.WEBHOOK_BATCH_CONCURRENCY,
+                                               thread_name_prefix='webhook-batch')
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def process_batch(items, maps_client, sms_sender, rate_limiter=None, idempotency=None):
+    """
+    Run the parse → ETA → format → send pipeline for a batch of inbound SMS
+
+    Distinct ETA lookups and distinct replies are performed concurrently on
+    a shared thread pool.
+
+    Args:
+        items (list): Message objects from parse_batch_body
+        maps_client (GoogleMapsClient): Client used for the ETA lookups
+        sms_sender (Fast2SMSSender): Client used to send the replies
+        rate_limiter (RateLimiter): Per-sender limiter, or None
+        idempotency (IdempotencyGuard): Guard against gateway retries, or None
+
+    Returns:
+        tuple: (response payload dict, HTTP status code)
+    """
+    plan = BatchPlan(items, rate_limiter, idempotency)
+    executor = _get_executor()
+    size = Config.SMS_BATCH_MAX_SIZE
+    try:
+        plan.admit()
+        lookups = plan.lookups()
+        futures = {key: executor.submit(maps_client.get_bus_eta, *query) for key, query in lookups.items()}
+        etas = {key: future.result() for key, future in futures.items()}
+        replies = plan.replies(_with_following(maps_client, etas))
+
+        sends = {
+            message: [executor.submit(send_bulk_with_retry, sms_sender, chunk, message, Config.SMS_RETRY_ATTEMPTS)
+                      for chunk in _chunks(phone_numbers, size)]
+            for message, phone_numbers in replies.items()
+        }
+        notices = [executor.submit(sms_sender.send_bulk_sms, chunk, message)
+                   for message, phone_numbers in plan.notices.items()
+                   for chunk in _chunks(phone_numbers, size)]
+        sent = {message: _merge([future.result() for future in chunk_futures])
+                for message, chunk_futures in sends.items()}
+        for future in notices:
+            future.result()
+    except BaseException:
+        plan.abort()
+        raise
+    return plan.finish(sent)
+
+
+async def process_batch_async(items, maps_client, sms_sender, rate_limiter=None, idempotency=None):
+    """
+    Run the parse → ETA → format → send pipeline for a batch of inbound SMS (asyncio)
+
+    Args:
+        items (list): Message objects from parse_batch_body
+        maps_client (AsyncGoogleMapsClient): Client used for the ETA lookups
+        sms_sender (AsyncFast2SMSSender): Client used to send the replies
+        rate_limiter (RateLimiter): Per-sender limiter, or None
+        idempotency (IdempotencyGuard): Guard against gateway retries, or None
+
+    Returns:
+        tuple: (response payload dict, HTTP status code)
+    """
+    import asyncio
+    from utils.async_clients import run_blocking
+
+    plan = BatchPlan(items, rate_limiter, idempotency)
+    # Admission and settling call the limiter and the guard, whose SQLite
+    # backends are called from a thread so they never stall the loop
+    stores = [component.store for component in (rate_limiter, idempotency) if component is not None]
+    size = Config.SMS_BATCH_MAX_SIZE
+    limit = asyncio.Semaphore(Config.WEBHOOK_BATCH_CONCURRENCY)
+
+    async def bounded(coroutine):
+        async with limit:
+            return await coroutine
+
+    try:
+        await run_blocking(stores, plan.admit)
+        lookups = plan.lookups()
+        results = await asyncio.gather(*(bounded(maps_client.get_bus_eta(*query)) for query in lookups.values()))
+        replies = plan.replies(_with_following(maps_client, dict(zip(lookups, results))))
+
+        groups = [(message, chunk) for message, phone_numbers in replies.items()
+                  for chunk in _chunks(phone_numbers, size)]
+        notices = [(message, chunk) for message, phone_numbers in plan.notices.items()
+                   for chunk in _chunks(phone_numbers, size)]
+        results = await asyncio.gather(*(bounded(sms_sender.send_bulk_sms(chunk, message))
+                                         for message, chunk in groups + notices))
+        chunk_results = {}
+        for (message, chunk), result in zip(groups, results):
+            chunk_results.setdefault(message, []).append(result)
+        sent = {message: _merge(chunk_results[message]) for message in replies}
+    except BaseException:
+        await run_blocking(stores, plan.abort)
+        raise
+    return await run_blocking(stores, plan.finish, sent)
@@ -0,0 +1,123 @@
+import importlib.util
+import logging
+import math
+import os
+
+# Gunicorn worker class and application of each deployment profile
+PROFILES = {
+    'sync': ('sync', 'app:create_app()'),
+    'gthread': ('gthread', 'app:create_app()'),
+    'gevent': ('gevent', 'app:create_app()'),
+    'asgi': ('uvicorn.workers.UvicornWorker', 'asgi_app:create_asgi_app()')
+}
+
+# Modules a profile needs beyond the base requirements
+PROFILE_MODULES = {
+    'gevent': 'gevent',
+    'asgi': 'uvicorn'
+}
+
+# Threads per gthread worker beyond which GIL contention costs more than
+# the extra concurrency gains
+MAX_THREADS = 64
+# Open connections per gevent worker, keep-alive ones included; greenlets
+# are cheap, so this is a floor on the derived value rather than a cap
+GEVENT_CONNECTIONS = 1000
+
+
+def available_cpus():
+    """Return the number of CPUs this process may run on (container aware)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def concurrency_per_core(upstream_latency_ms, request_cpu_ms):
+    """
+    Get the requests one core must keep in flight to stay busy
+
+    While a request waits upstream_latency_ms for Google Maps and Fast2SMS,
+    the core can run upstream_latency_ms / request_cpu_ms other requests.
+
+    Args:
+        upstream_latency_ms (float): Upstream wait per request
+        request_cpu_ms (float): CPU time per request
+
+    Returns:
+        int: In-flight requests per core
+    """
+    return math.ceil(1 + upstream_latency_ms / max(request_cpu_ms, 0.1))
+
+
+def resolve_profile(name):
+    """
+    Check a profile name, falling back to gthread if its worker is not installed
+
+    Args:
+        name (str): Profile name from the configuration
+
+    Returns:
+        str: The profile to run
+
+    Raises:
+        ValueError: If the profile is unknown
+    """
+    name = name.lower()
+    if name not in PROFILES:
+        raise ValueError(f"Unknown worker profile {name!r}; choose one of {', '.join(PROFILES)}")
+    module = PROFILE_MODULES.get(name)
+    if module and importlib.util.find_spec(module) is None:
+        logging.warning("Worker profile %s needs %s, which is not installed; using gthread", name, module)
+        return 'gthread'
+    return name
+
+
+def tune_profile(name, cpus=None, upstream_latency_ms=300, request_cpu_ms=3, workers=0, threads=0):
+    """
+    Derive gunicorn settings for a deployment profile
+
+    - sync: 2 x cores + 1 single-threaded workers; each holds one request,
+      so throughput is bounded by workers / upstream latency
+    - gthread: one worker per core, with enough threads to keep the core
+      busy while requests wait upstream (at most MAX_THREADS)
+    - gevent: one worker per core, accepting at least GEVENT_CONNECTIONS
+      connections (a greenlet each)
+    - asgi: one uvicorn worker per core, bounded by ASYNC_HTTP_MAX_CONNECTIONS
+
+    Args:
+        name (str): Profile name (see resolve_profile)
+        cpus (int): Cores to size for (default: available_cpus())
+        upstream_latency_ms (float): Measured upstream wait per request
+        request_cpu_ms (float): Measured CPU time per request
+        workers (int): Worker processes (0 derives them)
+        threads (int): Threads or greenlets per worker (0 derives them)
+
+    Returns:
+        dict: worker_class, wsgi_app, workers, threads, worker_connections
+            and concurrency (requests one worker handles at once)
+    """
+    worker_class, wsgi_app = PROFILES[name]
+    cpus = cpus or available_cpus()
+    per_core = concurrency_per_core(upstream_latency_ms, request_cpu_ms)
+    settings = {
+        'profile': name,
+        'worker_class': worker_class,
+        'wsgi_app': wsgi_app,
+        'workers': workers or cpus,
+        'threads': 1,
+        'worker_connections': 1000
+    }
+
+    if name == 'sync':
+        settings['workers'] = workers or 2 * cpus + 1
+        settings['concurrency'] = 1
+    elif name == 'gthread':
+        settings['threads'] = threads or max(4, min(per_core, MAX_THREADS))
+        settings['concurrency'] = settings['threads']
+    elif name == 'gevent':
+        settings['worker_connections'] = threads or max(per_core, GEVENT_CONNECTIONS)
+        settings['concurrency'] = settings['worker_connections']
+    else:
+        settings['concurrency'] = threads or per_core
+    return settings